@@ -0,0 +1,32 @@
+"""add_hedging_to_ai_models
+
+Revision ID: a3d9e1f7b5c2
+Revises: f1c6b2d8e4a0
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d9e1f7b5c2'
+down_revision: Union[str, Sequence[str], None] = 'f1c6b2d8e4a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('ai_models', sa.Column('fallback_order', sa.Integer(), nullable=True))
+    op.add_column('ai_models', sa.Column('hedge_delay_ms', sa.Integer(), nullable=True))
+    # Il modello Pro di default diventa il primo fallback
+    op.execute("UPDATE ai_models SET fallback_order = 1 WHERE name = 'gemini-2.5-pro'")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('ai_models', 'hedge_delay_ms')
+    op.drop_column('ai_models', 'fallback_order')
@@ -0,0 +1,58 @@
+"""add_funnel_analytics
+
+Revision ID: b4e1c7d2a9f0
+Revises: a9347acf1bae
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e1c7d2a9f0'
+down_revision: Union[str, Sequence[str], None] = 'a9347acf1bae'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('lifecycle_events', sa.Column('model_name', sa.String(length=100), nullable=True))
+    op.add_column('lifecycle_events', sa.Column('prompt_name', sa.String(), nullable=True))
+
+    op.create_table('funnel_daily_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('from_stage', sa.String(length=50), nullable=False),
+    sa.Column('to_stage', sa.String(length=50), nullable=False),
+    sa.Column('model_name', sa.String(length=100), nullable=False),
+    sa.Column('prompt_name', sa.String(), nullable=False),
+    sa.Column('transitions', sa.Integer(), nullable=False),
+    sa.Column('duration_sum_seconds', sa.Float(), nullable=False),
+    sa.Column('duration_histogram', sa.Text(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('day', 'from_stage', 'to_stage', 'model_name', 'prompt_name', name='uq_funnel_daily_rollup_key')
+    )
+    op.create_index(op.f('ix_funnel_daily_rollups_id'), 'funnel_daily_rollups', ['id'], unique=False)
+    op.create_index(op.f('ix_funnel_daily_rollups_day'), 'funnel_daily_rollups', ['day'], unique=False)
+
+    op.create_table('analytics_cursors',
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('last_event_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('analytics_cursors')
+    op.drop_index(op.f('ix_funnel_daily_rollups_day'), table_name='funnel_daily_rollups')
+    op.drop_index(op.f('ix_funnel_daily_rollups_id'), table_name='funnel_daily_rollups')
+    op.drop_table('funnel_daily_rollups')
+    op.drop_column('lifecycle_events', 'prompt_name')
+    op.drop_column('lifecycle_events', 'model_name')
@@ -0,0 +1,32 @@
+"""add_client_message_id_to_messages
+
+Revision ID: c5f2d8e3b1a7
+Revises: b4e1c7d2a9f0
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5f2d8e3b1a7'
+down_revision: Union[str, Sequence[str], None] = 'b4e1c7d2a9f0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('client_message_id', sa.String(length=255), nullable=True))
+    op.create_unique_constraint(
+        'uq_messages_session_client_message_id', 'messages', ['session_id', 'client_message_id']
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_messages_session_client_message_id', 'messages', type_='unique')
+    op.drop_column('messages', 'client_message_id')
@@ -0,0 +1,40 @@
+"""add_model_routes_table
+
+Revision ID: c7e2a9d4f1b6
+Revises: a3d9e1f7b5c2
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2a9d4f1b6'
+down_revision: Union[str, Sequence[str], None] = 'a3d9e1f7b5c2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('model_routes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('lifecycle', pg.ENUM('NUOVA_LEAD', 'CONTRASSEGNATO', 'IN_TARGET', 'LINK_DA_INVIARE', 'LINK_INVIATO', name='lifecyclestage', create_type=False), nullable=True),
+    sa.Column('min_history_messages', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('model_name', sa.String(length=100), nullable=False),
+    sa.Column('is_enabled', sa.Boolean(), nullable=False, server_default=sa.true()),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_model_routes_id'), 'model_routes', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_model_routes_id'), table_name='model_routes')
+    op.drop_table('model_routes')
@@ -0,0 +1,28 @@
+"""add_pending_gaps_to_analytics_cursors
+
+Revision ID: d2f8b6a1c3e5
+Revises: c7e2a9d4f1b6
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2f8b6a1c3e5'
+down_revision: Union[str, Sequence[str], None] = 'c7e2a9d4f1b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('analytics_cursors', sa.Column('pending_gaps', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('analytics_cursors', 'pending_gaps')
@@ -0,0 +1,52 @@
+"""add_chat_jobs_table
+
+Revision ID: d7a3e9f4c2b8
+Revises: c5f2d8e3b1a7
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a3e9f4c2b8'
+down_revision: Union[str, Sequence[str], None] = 'c5f2d8e3b1a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('session_id', sa.String(), nullable=False),
+    sa.Column('client_message_id', sa.String(length=255), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('available_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('locked_until', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('locked_by', sa.String(), nullable=True),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('completed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('session_id', 'client_message_id', name='uq_chat_jobs_session_client_message_id')
+    )
+    op.create_index(op.f('ix_chat_jobs_id'), 'chat_jobs', ['id'], unique=False)
+    op.create_index(op.f('ix_chat_jobs_session_id'), 'chat_jobs', ['session_id'], unique=False)
+    op.create_index('ix_chat_jobs_status_available_at', 'chat_jobs', ['status', 'available_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_jobs_status_available_at', table_name='chat_jobs')
+    op.drop_index(op.f('ix_chat_jobs_session_id'), table_name='chat_jobs')
+    op.drop_index(op.f('ix_chat_jobs_id'), table_name='chat_jobs')
+    op.drop_table('chat_jobs')
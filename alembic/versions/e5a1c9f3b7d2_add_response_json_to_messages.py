@@ -0,0 +1,28 @@
+"""add_response_json_to_messages
+
+Revision ID: e5a1c9f3b7d2
+Revises: d2f8b6a1c3e5
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a1c9f3b7d2'
+down_revision: Union[str, Sequence[str], None] = 'd2f8b6a1c3e5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('response_json', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'response_json')
@@ -0,0 +1,50 @@
+"""add_outbound_messages_table
+
+Revision ID: e8b4f0a5d3c9
+Revises: d7a3e9f4c2b8
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b4f0a5d3c9'
+down_revision: Union[str, Sequence[str], None] = 'd7a3e9f4c2b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('outbound_messages',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('session_id', sa.String(), nullable=False),
+    sa.Column('source_message_id', sa.Integer(), nullable=True),
+    sa.Column('part_index', sa.Integer(), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('sink', sa.String(length=20), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('due_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('locked_until', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('delivered_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_message_id', 'part_index', name='uq_outbound_messages_source_part')
+    )
+    op.create_index(op.f('ix_outbound_messages_id'), 'outbound_messages', ['id'], unique=False)
+    op.create_index(op.f('ix_outbound_messages_session_id'), 'outbound_messages', ['session_id'], unique=False)
+    op.create_index('ix_outbound_messages_status_due_at', 'outbound_messages', ['status', 'due_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_outbound_messages_status_due_at', table_name='outbound_messages')
+    op.drop_index(op.f('ix_outbound_messages_session_id'), table_name='outbound_messages')
+    op.drop_index(op.f('ix_outbound_messages_id'), table_name='outbound_messages')
+    op.drop_table('outbound_messages')
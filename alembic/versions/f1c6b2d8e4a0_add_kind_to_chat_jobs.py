@@ -0,0 +1,28 @@
+"""add_kind_to_chat_jobs
+
+Revision ID: f1c6b2d8e4a0
+Revises: e8b4f0a5d3c9
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c6b2d8e4a0'
+down_revision: Union[str, Sequence[str], None] = 'e8b4f0a5d3c9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_jobs', sa.Column('kind', sa.String(length=20), server_default='turn', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_jobs', 'kind')
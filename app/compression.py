@@ -0,0 +1,182 @@
+"""
+Compressione delle risposte HTTP (middleware ASGI)
+
+Comprime con brotli (se il pacchetto è installato e il client lo accetta) o gzip:
+- solo i content type dell'allow-list (JSON, HTML, testo, CSV, JS, CSS, SVG);
+- le risposte complete solo sopra COMPRESSION_MINIMUM_SIZE byte: le risposte piccole,
+  come quelle di /chat, escono invariate e non pagano la CPU della compressione;
+- le risposte in streaming chunk per chunk, con flush a ogni chunk così il client riceve
+  i dati man mano (text/event-stream resta fuori dall'allow-list).
+
+Le risposte che hanno già un Content-Encoding non vengono toccate. Un ETag forte di una
+risposta compressa diventa debole (W/...): le route lo confrontano con If-None-Match
+in modo debole, come previsto per le richieste condizionali GET.
+"""
+import zlib
+from typing import Iterable, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.services.metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dipende dall'ambiente
+    brotli = None
+
+DEFAULT_CONTENT_TYPES: Tuple[str, ...] = (
+    "application/json",
+    "text/html",
+    "text/plain",
+    "text/csv",
+    "text/css",
+    "text/javascript",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def negotiate_encoding(accept_encoding: str, brotli_available: bool = brotli is not None) -> Optional[str]:
+    """Sceglie "br" o "gzip" dall'header Accept-Encoding (q=0 esclude la codifica)"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    if brotli_available and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    """Interfaccia comune a gzip e brotli per compressione completa e a chunk"""
+
+    def __init__(self, encoding: str, level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 16 + MAX_WBITS: formato gzip (header e trailer)
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """Middleware ASGI: la decisione si prende sulla prima parte del body di ogni risposta"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        level: int = 6,
+        brotli_quality: int = 4,
+        content_types: Iterable[str] = DEFAULT_CONTENT_TYPES,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.content_types = tuple(content_types)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressionResponder(self, encoding, send).run(scope, receive)
+
+    def is_compressible(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        return content_type in self.content_types
+
+
+class _CompressionResponder:
+    """Stato di una singola risposta: decide alla prima parte del body se comprimere"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def run(self, scope: Scope, receive: Receive) -> None:
+        await self.middleware.app(scope, receive, self.handle)
+
+    def _compressed_start(self, content_length: Optional[int]) -> Message:
+        headers = MutableHeaders(raw=list(self.start["headers"]))
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            # I byte compressi non sono quelli a cui l'ETag forte si riferisce: diventa debole
+            headers["ETag"] = f"W/{etag}"
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+        return {**self.start, "headers": headers.raw}
+
+    async def handle(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+
+        if self.compressor is None:
+            compressible = self.middleware.is_compressible(Headers(raw=self.start["headers"]))
+            if not compressible or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                if compressible:
+                    # La rappresentazione dipende comunque da Accept-Encoding (cache intermedie)
+                    start_headers = MutableHeaders(raw=list(self.start["headers"]))
+                    start_headers.add_vary_header("Accept-Encoding")
+                    self.start = {**self.start, "headers": start_headers.raw}
+                await self.send(self.start)
+                await self.send(message)
+                return
+
+            self.compressor = _Compressor(self.encoding, self.middleware.level, self.middleware.brotli_quality)
+            metrics.increment("http_compressed_responses_total", encoding=self.encoding, streaming=more_body)
+            if not more_body:
+                compressed = self.compressor.compress(body, final=True)
+                await self.send(self._compressed_start(len(compressed)))
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            await self.send(self._compressed_start(None))
+
+        await self.send({
+            "type": "http.response.body",
+            "body": self.compressor.compress(body, final=not more_body),
+            "more_body": more_body,
+        })
@@ -3,27 +3,25 @@ Configurazione dei lifecycle e script per il chatter di nutrizione e psicologia
 """
 from typing import Dict, List, Any
 from app.models.lifecycle import LifecycleStage
-from app.data.snippets import (
-    LEVEL_2_SNIPPETS, LEVEL_3_SNIPPETS, LEVEL_4_SNIPPETS, LEVEL_5_SNIPPETS,
-    GENERIC_SNIPPETS, GENERIC_MESSAGES, get_snippet
-)
+from app.data.snippets import DEGRADED_MESSAGES
 
 
 # Configurazione degli script per ogni lifecycle (senza triggers_to_next)
-# nuova lead serve solo per inizializzare la conversazione
+# nuova lead serve solo per inizializzare la conversazione.
+# "script" e "available_snippets" sono gruppi di SNIPPET_GROUPS: i testi (e i blocchi
+# formattati per il prompt) vengono dallo snippet store
 LIFECYCLE_SCRIPTS: Dict[LifecycleStage, Dict] = {
     LifecycleStage.NUOVA_LEAD: {
-        "script": """
-        """,
+        "script": None,
         "next_stage": LifecycleStage.CONTRASSEGNATO,
         "objective": "",
         "transition_indicators": [
         ],
-        "available_snippets": ""
+        "available_snippets": []
     },
 
     LifecycleStage.CONTRASSEGNATO: {
-        "script": list(LEVEL_2_SNIPPETS.values()),
+        "script": "level_2",
         "next_stage": LifecycleStage.IN_TARGET,
         "objective": "Rispondi dopo il messaggio automatico con esattamente lo script guida senza scusarti per l'attesa. Raccogli le informazioni di base in un unico messaggio (NON SPEZZETTARE), e solo una volta ottenute, chiedere esplicitamente qual è la motivazione principale per cui vuole migliorare (SPEZZETTARE qui esattamente come da script), passare al prossimo lifecycle appena chiesta la motivazione.",
         "transition_indicators": [
@@ -31,39 +29,57 @@ LIFECYCLE_SCRIPTS: Dict[LifecycleStage, Dict] = {
             "Il cliente ha confermato interesse a proseguire",
             "Il cliente ha fornito dettagli aggiuntivi sul suo obiettivo"
         ],
-        "available_snippets": {**GENERIC_SNIPPETS}
+        "available_snippets": ["generic"]
     },
 
     LifecycleStage.IN_TARGET: {
-        "script": list(LEVEL_3_SNIPPETS.values()),
+        "script": "level_3",
         "next_stage": LifecycleStage.LINK_DA_INVIARE,
         "objective": "Presentare i benefici del percorso integrato e introdurre la consulenza gratuita.",
         "transition_indicators": [
             "Solo se dopo aver presentato la consulenza gratuita, il cliente ha accettato di prenotare",
         ],
-        "available_snippets": {**GENERIC_MESSAGES, **GENERIC_SNIPPETS}
+        "available_snippets": ["generic_messages", "generic"]
     },
 
     LifecycleStage.LINK_DA_INVIARE: {
-        "script": list(LEVEL_4_SNIPPETS.values()),
+        "script": "level_4",
         "next_stage": LifecycleStage.LINK_INVIATO,
         "objective": "Inviare il link di prenotazione e ottenere conferma",
         "transition_indicators": [
             "PASSA SUBITO A LINK_INVIATO al primo segno positivo - NON CHIEDERE ULTERIORI CONFERME"
         ],
-        "available_snippets": {**GENERIC_MESSAGES, **GENERIC_SNIPPETS}
+        "available_snippets": ["generic_messages", "generic"]
     },
 
     LifecycleStage.LINK_INVIATO: {
-        "script": list(LEVEL_5_SNIPPETS.values()),
+        "script": "level_5",
         "next_stage": None,  # Final stage
         "objective": "",
         "transition_indicators": [
         ],
-        "available_snippets": ""
+        "available_snippets": []
     }
 }
 
+# Risposta immediata per lifecycle quando l'AI non è disponibile (circuito aperto):
+# il turno vero viene differito a quando il circuito si richiude
+DEGRADED_REPLY_SNIPPETS: Dict[LifecycleStage, str] = {
+    LifecycleStage.NUOVA_LEAD: "attesa_nuova_lead",
+    LifecycleStage.CONTRASSEGNATO: "attesa_contrassegnato",
+    LifecycleStage.IN_TARGET: "attesa_in_target",
+    LifecycleStage.LINK_DA_INVIARE: "attesa_link_da_inviare",
+    LifecycleStage.LINK_INVIATO: "attesa_link_inviato",
+}
+
+
+def get_degraded_reply(lifecycle: LifecycleStage) -> str:
+    """Testo della risposta in modalità degradata per il lifecycle"""
+    from app.services.snippet_store import snippet_store
+    snippet_id = DEGRADED_REPLY_SNIPPETS.get(lifecycle, "attesa_nuova_lead")
+    return snippet_store.text(snippet_id) or DEGRADED_MESSAGES[snippet_id]
+
+
 # Prompt per il sistema dinamico di decisione lifecycle
 LIFECYCLE_DECISION_PROMPT = """
 ANALISI LIFECYCLE: Basandoti sulla conversazione corrente, devi decidere se è il momento di cambiare lifecycle.
@@ -92,5 +108,8 @@ Devi rispondere SEMPRE in questo formato JSON:
     "reasoning": "Spiegazione dettagliata della decisione"
 }}
 
+CRONOLOGIA CONVERSAZIONE:
+{conversation_context}
+
 MESSAGGIO UTENTE: {user_message}
 """
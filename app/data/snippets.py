@@ -82,6 +82,16 @@ GENERIC_MESSAGES = {
     "risposta_tardiva3": "Hey NOME Buon/a Giorno/Pomeriggio/Sera , scusami la risposta tardiva 🙏🏼\ncome stai? :)"
 }
 
+# Risposte immediate della modalità degradata (AI non disponibile), una per lifecycle:
+# tengono la conversazione nel punto dello script in cui si trova, senza farla avanzare
+DEGRADED_MESSAGES = {
+    "attesa_nuova_lead": GENERIC_MESSAGES["risposta_tardiva2"],
+    "attesa_contrassegnato": "Grazie per avermi scritto 🙏 Sto leggendo con attenzione quello che mi hai raccontato, ti rispondo personalmente tra pochissimo!",
+    "attesa_in_target": "Mi hai dato un quadro molto chiaro, grazie 🙏 Dammi solo un attimo e ti scrivo con calma come posso aiutarti!",
+    "attesa_link_da_inviare": "Perfetto! Dammi solo un momento che ti preparo tutto per la prenotazione :)",
+    "attesa_link_inviato": "Ricevuto! Se hai problemi con il link o con gli orari ti rispondo tra un attimo :)",
+}
+
 # Raccolta completa di tutti gli snippet organizzati
 ALL_SNIPPETS = {
     **LEVEL_2_SNIPPETS,
@@ -91,7 +101,31 @@ ALL_SNIPPETS = {
     **GENERIC_SNIPPETS,
     **RESOURCE_SNIPPETS,
     **INFO_SNIPPETS,
-    **GENERIC_MESSAGES
+    **GENERIC_MESSAGES,
+    **DEGRADED_MESSAGES
+}
+
+# Gruppi di snippet referenziati dai lifecycle (l'ordine è quello dello script guida).
+# Il testo viene da app/snippets/Snippets.csv tramite lo snippet store; i dizionari sopra
+# restano il fallback per gli ID assenti dal CSV. Nel CSV livello_2 è diviso in 2A/2B/2C,
+# dove 2A e 2C sono alternativi (vedi NAME_DEPENDENT_STEPS).
+SNIPPET_GROUPS = {
+    "level_2": ["livello_2", "a_livello_2_b", "a_livello_2_c", "livello_3_a", "livello_3_b", "a_livello_3_c"],
+    "level_3": list(LEVEL_3_SNIPPETS),
+    "level_4": list(LEVEL_4_SNIPPETS),
+    "level_5": list(LEVEL_5_SNIPPETS),
+    "generic": list(GENERIC_SNIPPETS),
+    "resources": list(RESOURCE_SNIPPETS),
+    "info": list(INFO_SNIPPETS),
+    "generic_messages": list(GENERIC_MESSAGES),
+}
+
+# Passi dello script che dipendono dal nome del contatto: True = solo se il nome è noto,
+# False = solo se manca. Il saluto 2A ("Bene NOME !!") e la richiesta del nome 2C sono
+# alternativi, mai entrambi nello stesso script.
+NAME_DEPENDENT_STEPS = {
+    "livello_2": True,
+    "a_livello_2_c": False,
 }
 
 def get_snippet(snippet_id: str) -> str:
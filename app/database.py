@@ -1,6 +1,11 @@
 """
 Configurazione del database
 """
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 from app.config import settings
@@ -27,6 +32,41 @@ engine = create_async_engine(get_database_url(), echo=settings.debug)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+class QueryCounter:
+    """Query SQL eseguite dentro un blocco count_queries()"""
+
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+_query_counter: ContextVar[Optional[QueryCounter]] = ContextVar("query_counter", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """Conta le query eseguite nel task corrente (e nei suoi sotto-task) durante il blocco
+
+    Usato dai test per fissare un budget di query per endpoint e scoprire le regressioni N+1.
+    """
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+
 async def get_db() -> AsyncSession:
     async with async_session() as session:
         try:
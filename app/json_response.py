@@ -0,0 +1,102 @@
+"""
+Serializzazione JSON delle risposte API
+
+FastJSONResponse è la response class di default dell'app. Con orjson installato
+(JSON_ENCODER=auto|orjson) la codifica avviene in C e datetime, date, Enum, UUID e
+dataclass sono serializzati nativamente; altrimenti si usa json della libreria standard
+con lo stesso output compatto (datetime in ISO 8601, come isoformat()).
+
+Gli endpoint con liste grandi (cronologia, lista sessioni, timeline) costruiscono le
+righe con i serializzatori qui sotto e restituiscono direttamente FastJSONResponse:
+così saltano anche jsonable_encoder, che FastAPI applica a ogni valore restituito.
+"""
+import dataclasses
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Dict, Iterable, List
+from uuid import UUID
+
+from fastapi.responses import JSONResponse
+from loguru import logger
+from pydantic import BaseModel
+
+from app.config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipende dall'ambiente
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """Tipi non gestiti dall'encoder (pydantic, Decimal, set; per stdlib anche datetime ed Enum)"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    raise TypeError(f"Oggetto di tipo {type(obj).__name__} non serializzabile in JSON")
+
+
+def _orjson_dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _stdlib_dumps(content: Any) -> bytes:
+    # Stesse opzioni della JSONResponse di Starlette
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def _select_encoder(name: str):
+    if name in ("auto", "orjson") and orjson is not None:
+        return "orjson", _orjson_dumps
+    if name == "orjson":
+        logger.warning("JSON_ENCODER=orjson ma orjson non è installato: uso json della libreria standard")
+    return "stdlib", _stdlib_dumps
+
+
+encoder_name, dumps = _select_encoder(settings.json_encoder)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse codificata con l'encoder configurato"""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.model_dump_json().encode("utf-8")
+        return dumps(content)
+
+
+def message_rows(messages: Iterable[Any]) -> List[Dict[str, Any]]:
+    """Messaggi della cronologia (MessageModel) come righe JSON"""
+    return [
+        {'id': msg.id, 'role': msg.role, 'message': msg.message, 'timestamp': msg.timestamp}
+        for msg in messages
+    ]
+
+
+def session_rows(rows: Iterable[Any]) -> List[Dict[str, Any]]:
+    """Righe della lista sessioni (session_id, date, lifecycle, message_count)"""
+    return [
+        {
+            'session_id': row.session_id,
+            'created_at': row.created_at,
+            'updated_at': row.updated_at,
+            'current_lifecycle': row.current_lifecycle.value if row.current_lifecycle else None,
+            'message_count': row.message_count
+        }
+        for row in rows
+    ]
@@ -3,36 +3,81 @@ Applicazione FastAPI principale per il Chatbot
 """
 
 import os
+import time
 import asyncio
 from contextlib import asynccontextmanager
+from pathlib import Path
 from datetime import datetime
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from loguru import logger
 from dotenv import load_dotenv
 
+# Inizio dell'avvio, per misurare il tempo di import dei moduli dell'app
+_import_started = time.perf_counter()
+
 # Carica le variabili d'ambiente da .env.local
 load_dotenv('.env.local')
 
 from .config import Settings, settings
 from app.models.lifecycle import LifecycleResponse
 from .services.system_prompt_service import SystemPromptService
+from .services.ai_model_service import AIModelService
 from .services.unified_agent import unified_agent
+from .services.status_service import status_monitor
+from .services.funnel_analytics_service import funnel_analytics
+from .services.chat_jobs import chat_worker_pool
+from .services.outbound_scheduler import outbound_scheduler
+from .services.chat_events import chat_events
+from .services.command_runner import command_runner
+from .services.snippet_store import snippet_store
+from .services.session_lock import session_lock
 from .database import engine, Base
+from .json_response import FastJSONResponse
+from .compression import CompressionMiddleware
+from sqlalchemy import text
 from .routes import router
 
 
+class SchemaRevisionError(RuntimeError):
+    """Il database non è alla revisione Alembic attesa dal codice"""
+    pass
+
+
+def _check_alembic_revision(sync_conn) -> None:
+    """Confronta la revisione del database con la head delle migrazioni (nessun DDL)"""
+    from alembic.config import Config
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+
+    alembic_cfg = Config(str(Path(__file__).resolve().parent.parent / "alembic.ini"))
+    expected = set(ScriptDirectory.from_config(alembic_cfg).get_heads())
+    current = set(MigrationContext.configure(sync_conn).get_current_heads())
+    if current != expected:
+        raise SchemaRevisionError(
+            f"Revisione del database {sorted(current) or 'assente'} diversa dalla head {sorted(expected)}: "
+            "eseguire `alembic upgrade head`"
+        )
+
+
 async def wait_for_db(max_retries: int = 10, delay: int = 2):
-    """Attende che il database sia disponibile con retry"""
+    """Attende che il database sia disponibile con retry e prepara lo schema
+
+    Con startup_schema_mode="create_all" crea le tabelle mancanti; con "check_revision"
+    verifica soltanto che le migrazioni Alembic siano state applicate.
+    """
+    mode = settings.startup_schema_mode
     for attempt in range(max_retries):
         try:
             logger.info(f"Tentativo di connessione al database ({attempt + 1}/{max_retries})...")
             async with engine.begin() as conn:
-                await conn.run_sync(Base.metadata.create_all)
+                if mode == "create_all":
+                    await conn.run_sync(Base.metadata.create_all)
+                else:
+                    await conn.execute(text("SELECT 1"))
             logger.info("✅ Connessione al database riuscita")
-            return True
+            break
         except Exception as e:
             if attempt < max_retries - 1:
                 logger.warning(f"⏳ Database non pronto, attesa {delay}s... ({attempt + 1}/{max_retries})")
@@ -40,35 +85,99 @@ async def wait_for_db(max_retries: int = 10, delay: int = 2):
             else:
                 logger.error(f"❌ Impossibile connettersi al database dopo {max_retries} tentativi: {e}")
                 raise
-    return False
+
+    if mode == "check_revision":
+        async with engine.connect() as conn:
+            await conn.run_sync(_check_alembic_revision)
+        logger.info("✅ Schema del database alla revisione Alembic attesa")
+    return True
+
+
+async def _timed(step: str, coro):
+    """Esegue un passo di avvio registrandone la durata in status_monitor.startup_timings"""
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        status_monitor.startup_timings[step] = round(time.perf_counter() - started, 3)
+
+
+async def _prepare_database() -> None:
+    """Schema, poi in parallelo prompt di sistema e modello attivo (riempiono le cache)"""
+    await _timed("database", wait_for_db())
+
+    async def warm_prompt():
+        await SystemPromptService.initialize_default_prompt()
+        await SystemPromptService.get_active_prompt()
+
+    await asyncio.gather(
+        _timed("system_prompt", warm_prompt()),
+        _timed("active_model", AIModelService.get_active_model_name()),
+    )
+    logger.info("✅ Database e prompt di sistema pronti")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gestisce il ciclo di vita dell'applicazione"""
     # Startup
+    startup_started = time.perf_counter()
+    status_monitor.startup_timings["imports"] = round(startup_started - _import_started, 3)
     logger.info("🚀 Avvio dell'applicazione chatbot")
     logger.info(f"Versione: {settings.app_version}")
     logger.info(f"Debug mode: {settings.debug}")
-    
-    # Crea le tabelle del database con retry
-    await wait_for_db()
-    logger.info("✅ Tabelle del database create")
-    
-    # Inizializza il prompt di sistema di default
-    await SystemPromptService.initialize_default_prompt()
-    logger.info("✅ Prompt di sistema inizializzato")
-    
+    logger.info(f"Modalità schema all'avvio: {settings.startup_schema_mode}")
+
+    # Database e snippet sono indipendenti: vengono preparati in parallelo. Il client AI
+    # dipende dal modello attivo letto dal database, quindi parte dopo lo schema
+    async def prepare_database_and_llm():
+        await _prepare_database()
+        await _timed("llm_client", unified_agent.warm_up())
+
+    await asyncio.gather(
+        prepare_database_and_llm(),
+        _timed("snippets", snippet_store.start()),
+    )
+
     # Verifica la disponibilità dei servizi
     if await unified_agent.is_available():
         logger.info("✅ Agente unificato disponibile")
     else:
         logger.warning("⚠️ Agente unificato non disponibile")
+
+    # Avvia il refresher dello snapshot di stato (/status, /health/ready)
+    await _timed("status_snapshot", status_monitor.start())
+    status_monitor.startup_complete = True
+    logger.info("✅ Snapshot di stato attivo")
+
+    # Avvia l'aggregazione incrementale del funnel di lifecycle
+    await funnel_analytics.start()
+
+    # Reaper dei batch bloccati e i worker dei chat job (modalità "queue" o risposte
+    # differite della modalità degradata)
+    await chat_worker_pool.start(
+        run_workers=settings.chat_workers_in_process
+        and (settings.chat_execution_mode == "queue" or settings.ai_circuit_enabled)
+    )
+
+    # Consegna lato server delle parti pianificate (riprende quelle pendenti dopo un riavvio)
+    await outbound_scheduler.start()
+
+    status_monitor.startup_timings["total"] = round(time.perf_counter() - _import_started, 3)
+    logger.info(f"⏱️ Tempi di avvio (s): {status_monitor.startup_timings}")
     
     yield
     
     # Shutdown
     logger.info("🛑 Spegnimento dell'applicazione")
+    await status_monitor.stop()
+    await funnel_analytics.stop()
+    await chat_worker_pool.stop()
+    await outbound_scheduler.stop()
+    await chat_events.stop()
+    await command_runner.stop()
+    await snippet_store.stop()
+    await session_lock.close()
 
 
 # Creazione dell'app FastAPI
@@ -77,6 +186,7 @@ app = FastAPI(
     version=settings.app_version,
     description="Un chatbot moderno costruito con FastAPI",
     lifespan=lifespan,
+    default_response_class=FastJSONResponse,
     docs_url="/docs" if settings.debug else None,
     redoc_url="/redoc" if settings.debug else None,
 )
@@ -93,6 +203,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compressione delle risposte grandi (cronologia, liste, dashboard HTML)
+if settings.compression_enabled:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.compression_minimum_size,
+        level=settings.compression_level,
+        brotli_quality=settings.compression_brotli_quality,
+    )
+
 
 # Dependency per ottenere le impostazioni
 def get_settings() -> Settings:
@@ -104,7 +223,7 @@ def get_settings() -> Settings:
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """Gestisce le eccezioni HTTP"""
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail, "timestamp": datetime.now().isoformat()}
     )
@@ -114,7 +233,7 @@ async def http_exception_handler(request, exc):
 async def general_exception_handler(request, exc):
     """Gestisce le eccezioni generali"""
     logger.error(f"Errore non gestito: {exc}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=500,
         content={
             "detail": "Errore interno del server",
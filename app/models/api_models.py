@@ -2,7 +2,9 @@
 Modelli Pydantic per l'API
 """
 from typing import Dict, Any, Optional, List, Union
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from app.models.lifecycle import LifecycleStage
 
 
 class ChatMessage(BaseModel):
@@ -13,6 +15,12 @@ class ChatMessage(BaseModel):
     model_name: Optional[str] = None  # Nome del modello AI selezionato
     context: Optional[Dict[str, Any]] = None
     batch_wait_seconds: Optional[int] = None  # Numero di secondi da aspettare per aggregare messaggi (opzionale)
+    # Chiave di idempotenza (o id del messaggio lato client): i retry con la stessa chiave
+    # ricevono la risposta originale senza nuove chiamate AI né scritture
+    idempotency_key: Optional[str] = Field(default=None, max_length=255)
+    client_message_id: Optional[str] = Field(default=None, max_length=255)
+    # "server" per far consegnare le parti dal server rispettando delay_ms (default da OUTBOUND_DELIVERY_MODE)
+    delivery: Optional[str] = Field(default=None, pattern="^(client|server)$")
 
 
 class ChatResponse(BaseModel):
@@ -29,6 +37,7 @@ class ChatResponse(BaseModel):
     is_conversation_finished: bool = False
     requires_human: bool = False
     human_task: Optional[Dict[str, Any]] = None
+    delivery: str = "client"  # "server": le parti vengono consegnate dallo scheduler, non dal client
 
 
 class HealthCheck(BaseModel):
@@ -54,6 +63,20 @@ class SystemPromptUpdate(BaseModel):
     description: Optional[str] = None
 
 
+class AIModelHedgingUpdate(BaseModel):
+    """Posizione nella catena di fallback e hedge delay di un modello AI (None = non impostato)"""
+    fallback_order: Optional[int] = Field(default=None, ge=0)
+    hedge_delay_ms: Optional[int] = Field(default=None, ge=0)
+
+
+class ModelRouteUpsert(BaseModel):
+    """Regola di routing del modello AI per lifecycle (lifecycle None = tutti i lifecycle)"""
+    lifecycle: Optional[LifecycleStage] = None
+    min_history_messages: int = Field(default=0, ge=0)
+    model_name: str
+    is_enabled: bool = True
+
+
 class HumanTaskCreate(BaseModel):
     """Modello per creare una human task via API"""
     title: str
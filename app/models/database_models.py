@@ -1,9 +1,9 @@
 """
 Modelli del database per sessioni e conversazioni
 """
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from typing import List, Optional
-from sqlalchemy import String, Integer, DateTime, Text, ForeignKey, Enum as SQLEnum
+from sqlalchemy import String, Integer, Float, Date, DateTime, Text, ForeignKey, Index, UniqueConstraint, Enum as SQLEnum
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from app.database import Base
 from app.models.lifecycle import LifecycleStage
@@ -46,6 +46,9 @@ class SessionModel(Base):
 
 class MessageModel(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        UniqueConstraint("session_id", "client_message_id", name="uq_messages_session_client_message_id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     session_id: Mapped[int] = mapped_column(Integer, ForeignKey("sessions.id"), index=True)
@@ -54,6 +57,11 @@ class MessageModel(Base):
     timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     # Save lifecycle at the time the message was created (useful to track the agent's behavior)
     lifecycle: Mapped[Optional[LifecycleStage]] = mapped_column(SQLEnum(LifecycleStage), nullable=True)
+    # Chiave di idempotenza inviata dal client con il messaggio utente (unica per sessione)
+    client_message_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # ChatResponse del turno di questo messaggio (JSON), restituita ai retry con la stessa chiave;
+    # caricata solo su richiesta per non appesantire le letture della cronologia
+    response_json: Mapped[Optional[str]] = mapped_column(Text, nullable=True, deferred=True)
 
     # Relationship
     session: Mapped["SessionModel"] = relationship("SessionModel", back_populates="messages")
@@ -98,6 +106,25 @@ class AIModelModel(Base):
     display_name: Mapped[str] = mapped_column(String)  # Nome visualizzato nell'UI
     is_active: Mapped[bool] = mapped_column(default=False)  # Se è il modello attivo
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # Descrizione del modello
+    # Posizione nella catena di fallback/hedging (None = il modello non fa da fallback)
+    fallback_order: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # Attesa prima della richiesta hedged quando è il primario (None = p95 delle latenze recenti)
+    hedge_delay_ms: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+
+class ModelRouteModel(Base):
+    """Regola di routing: il modello AI per i turni di un lifecycle (e, opzionalmente, da una certa lunghezza della cronologia)"""
+    __tablename__ = "model_routes"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    # None = qualsiasi lifecycle (regola di ripiego)
+    lifecycle: Mapped[Optional[LifecycleStage]] = mapped_column(SQLEnum(LifecycleStage), nullable=True)
+    # La regola vale quando la cronologia ha almeno questi messaggi (0 = sempre)
+    min_history_messages: Mapped[int] = mapped_column(Integer, default=0)
+    model_name: Mapped[str] = mapped_column(String(100))  # Nome in ai_models
+    is_enabled: Mapped[bool] = mapped_column(default=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
@@ -130,6 +157,9 @@ class LifecycleEventModel(Base):
     new_lifecycle: Mapped[LifecycleStage] = mapped_column(SQLEnum(LifecycleStage), nullable=False)
     trigger_message_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("messages.id"), nullable=True)
     confidence: Mapped[Optional[float]] = mapped_column(Integer, nullable=True)
+    # Modello e prompt di sistema attivi quando è avvenuta la transizione (per le analytics del funnel)
+    model_name: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    prompt_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
     # Relationship back to session and optionally message
@@ -146,3 +176,87 @@ class SessionNoteModel(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
     session: Mapped["SessionModel"] = relationship("SessionModel", back_populates="notes")
+
+
+class FunnelDailyRollupModel(Base):
+    """Rollup giornaliero delle transizioni di lifecycle per modello e prompt"""
+    __tablename__ = "funnel_daily_rollups"
+    __table_args__ = (
+        UniqueConstraint("day", "from_stage", "to_stage", "model_name", "prompt_name", name="uq_funnel_daily_rollup_key"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    day: Mapped[date] = mapped_column(Date, index=True)
+    # Valori di LifecycleStage; "" per la prima transizione senza stage precedente
+    from_stage: Mapped[str] = mapped_column(String(50), default="")
+    to_stage: Mapped[str] = mapped_column(String(50))
+    model_name: Mapped[str] = mapped_column(String(100), default="")
+    prompt_name: Mapped[str] = mapped_column(String, default="")
+    transitions: Mapped[int] = mapped_column(Integer, default=0)
+    # Tempo trascorso nello stage di partenza prima della transizione
+    duration_sum_seconds: Mapped[float] = mapped_column(Float, default=0.0)
+    duration_histogram: Mapped[str] = mapped_column(Text, default="{}")  # JSON: bucket log2 -> conteggio
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+
+class AnalyticsCursorModel(Base):
+    """Ultimo evento già aggregato da ciascun job incrementale di analytics"""
+    __tablename__ = "analytics_cursors"
+
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    last_event_id: Mapped[int] = mapped_column(Integer, default=0)
+    # Id saltati sotto il cursore (transazioni non ancora committate): JSON {id: epoch del primo avvistamento}
+    pending_gaps: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+
+class ChatJobModel(Base):
+    """Turno di chat da eseguire in modo durevole dai worker (coda su database)"""
+    __tablename__ = "chat_jobs"
+    __table_args__ = (
+        Index("ix_chat_jobs_status_available_at", "status", "available_at"),
+        UniqueConstraint("session_id", "client_message_id", name="uq_chat_jobs_session_client_message_id"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    session_id: Mapped[str] = mapped_column(String, index=True)  # session_id esterno
+    client_message_id: Mapped[str] = mapped_column(String(255))  # chiave di idempotenza del messaggio
+    # "turn": turno di chat; "deferred_reply": risposta differita dalla modalità degradata
+    kind: Mapped[str] = mapped_column(String(20), default="turn", server_default="turn")
+    payload: Mapped[str] = mapped_column(Text)  # JSON del ChatMessage (o del turno differito)
+    status: Mapped[str] = mapped_column(String(20), default="pending")  # pending|running|done|dead
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, default=3)
+    available_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Visibility timeout: se il worker muore, dopo locked_until il job torna disponibile
+    locked_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    locked_by: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    result: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON della ChatResponse
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    completed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class OutboundMessageModel(Base):
+    """Parte di una risposta da consegnare lato server al suo orario (delay_ms)"""
+    __tablename__ = "outbound_messages"
+    __table_args__ = (
+        Index("ix_outbound_messages_status_due_at", "status", "due_at"),
+        UniqueConstraint("source_message_id", "part_index", name="uq_outbound_messages_source_part"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    session_id: Mapped[str] = mapped_column(String, index=True)  # session_id esterno
+    source_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # messaggio assistant di origine
+    part_index: Mapped[int] = mapped_column(Integer, default=0)
+    text: Mapped[str] = mapped_column(Text)
+    sink: Mapped[str] = mapped_column(String(20), default="log")  # log|webhook|sse
+    status: Mapped[str] = mapped_column(String(20), default="pending")  # pending|sending|sent|failed
+    due_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # Lease della consegna in corso: scaduto, la parte torna consegnabile (crash durante l'invio)
+    locked_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    delivered_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
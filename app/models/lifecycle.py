@@ -59,3 +59,7 @@ class LifecycleResponse(BaseModel):
     requires_human: bool = False
     human_task: Optional[Dict[str, Any]] = None
     is_conversation_finished: bool = False
+    # Richiesta duplicata (chiave già registrata) ed eventuale ChatResponse salvata dal turno
+    # originale, da restituire così com'è
+    is_duplicate: bool = False
+    replayed_response: Optional[Dict[str, Any]] = None
@@ -4,29 +4,46 @@ Contiene tutti gli endpoint FastAPI
 """
 import os
 import time
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from typing import Dict, Optional
 
-from fastapi import APIRouter, HTTPException, Request, Body
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, HTTPException, Request, Response, Body, Header, WebSocket
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy import func, select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import contains_eager, selectinload
 
 from app.config import get_settings
 from app.models.database_models import SessionModel, MessageModel, SystemPromptModel
 from app.services.system_prompt_service import SystemPromptService
 from app.services.ai_model_service import AIModelService
+from app.services.model_routing_service import ModelRoutingService
 from app.models.api_models import ChatMessage, ChatResponse, HealthCheck, SystemPromptCreate, SystemPromptUpdate
+from app.models.api_models import AIModelHedgingUpdate, ModelRouteUpsert
 from app.models.api_models import MessageNoteCreate, MessageNoteResponse, MessageNoteUpdate
 from app.models.api_models import SessionNoteCreate, SessionNoteResponse, SessionNoteUpdate
 from app.models.api_models import HumanTaskCreate, HumanTaskUpdate
+from app.json_response import FastJSONResponse, message_rows, session_rows
 from app.database import get_db
 import json as json_lib
-import subprocess
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 from app.services.unified_agent import unified_agent, AIError, ParsingError, ChatbotError
+from app.services.session_cache import session_cache
+from app.services.status_service import status_monitor
+from app.services.session_lock import SessionLockTimeout
+from app.services.metrics import metrics
+from app.services.chat_service import ChatTurnPending, client_message_key, execute_chat_turn
+from app.services.chat_events import chat_events
+from app.services.circuit_breaker import ai_circuit_breaker, classifier_circuit_breaker
+from app.services.model_hedging import model_latency
+from app.services.snippet_store import snippet_store
+from app.services.retry_policy import request_deadline
+from app.services.command_runner import UnknownCommandError, command_runner
+from app.services.chat_websocket import ChatSocket
+from app.services.chat_jobs import chat_job_queue
+from app.services.outbound_scheduler import outbound_scheduler, outbound_payload, sse_sink
+from app.services.funnel_analytics_service import funnel_analytics, GROUP_BY_COLUMNS
+from app.services.timeline_service import timeline_service
 from app.models.database_models import HumanTaskModel
 from app.models.database_models import MessageNoteModel
 from app.models.database_models import SessionNoteModel
@@ -169,95 +186,16 @@ async def session_conversation(session_id: str, request: Request):
     """Visualizza la conversazione completa di una sessione specifica"""
     try:
         async for db in get_db():
-            # Query ORM per ottenere la sessione
-            session_stmt = select(SessionModel).where(SessionModel.session_id == session_id)
+            # Query ORM per ottenere la sessione (con le note di sessione)
+            session_stmt = select(SessionModel).options(selectinload(SessionModel.notes)).where(SessionModel.session_id == session_id)
             session_result = await db.execute(session_stmt)
             session_data = session_result.scalar_one_or_none()
 
             if not session_data:
                 raise HTTPException(status_code=404, detail="Sessione non trovata")
 
-            # Query ORM per ottenere tutti i messaggi della sessione
-            messages_stmt = select(MessageModel).where(
-                MessageModel.session_id == session_data.id
-            ).order_by(MessageModel.timestamp.asc(), MessageModel.id.asc())
-
-            messages_result = await db.execute(messages_stmt)
-            messages_data = messages_result.scalars().all()
-
-            # Also load lifecycle events to show transition markers anchored to messages
-            from app.models.database_models import LifecycleEventModel
-            events_stmt = select(LifecycleEventModel).where(LifecycleEventModel.session_id == session_data.id).order_by(LifecycleEventModel.created_at.asc())
-            events_result = await db.execute(events_stmt)
-            events_data = events_result.scalars().all()
-
-        # Helper per garantire timezone awareness
-        def ensure_aware(dt):
-            if dt and dt.tzinfo is None:
-                return dt.replace(tzinfo=timezone.utc)
-            return dt
-
-        # Converti i messaggi in dizionari
-        messages = []
-        for msg in messages_data:
-            messages.append({
-                'id': msg.id,
-                'role': msg.role,
-                'message': msg.message,
-                'timestamp': ensure_aware(msg.timestamp)
-                , 'lifecycle': msg.lifecycle.value if msg.lifecycle else None
-            })
-
-        # Merge messages and lifecycle events into a single timeline (entries)
-        entries = []
-        for msg in messages:
-            entries.append({
-                'type': 'message',
-                'id': msg['id'],
-                'role': msg['role'],
-                'message': msg['message'],
-                'timestamp': msg['timestamp'],
-                'lifecycle': msg['lifecycle']
-            })
-
-        for ev in events_data:
-            entries.append({
-                'type': 'lifecycle_event',
-                'previous_lifecycle': ev.previous_lifecycle.value if ev.previous_lifecycle else None,
-                'new_lifecycle': ev.new_lifecycle.value,
-                'timestamp': ensure_aware(ev.created_at),
-                'message_id': ev.trigger_message_id
-            })
-
-        # If there are events anchored to message ids, place them right before the message with that id
-        # else just sort by timestamp
-        # Create a dict for quick access
-        msg_index = {e['id']: i for i, e in enumerate(entries) if e['type'] == 'message'}
-        anchored = []
-        unanchored = []
-        for e in entries:
-            if e['type'] == 'lifecycle_event' and e.get('message_id'):
-                idx = msg_index.get(e['message_id'])
-                if idx is not None:
-                    anchored.append((idx, e))
-                else:
-                    unanchored.append(e)
-            else:
-                unanchored.append(e)
-
-        # Insert anchored events before the associated message by sorting
-        anchored.sort(key=lambda x: x[0])
-        # flatten anchored into unanchored list as specified
-        for idx, ev in anchored:
-            # place this event before the message with id
-            # find message in unanchored by id
-            for i, ee in enumerate(unanchored):
-                if ee.get('type') == 'message' and ee.get('id') == entries[idx]['id']:
-                    unanchored.insert(i, ev)
-                    break
-
-        # Finally, sort all by timestamp for chronological ordering
-        entries = sorted(unanchored, key=lambda x: (x['timestamp'], 0 if x['type'] == 'lifecycle_event' else 1))
+            # Messaggi e transizioni di lifecycle uniti in un'unica timeline (in cache)
+            entries = await timeline_service.get_timeline(db, session_data.id)
 
         # Converti i dati della sessione
         session_info = {
@@ -268,22 +206,16 @@ async def session_conversation(session_id: str, request: Request):
             'is_conversation_finished': session_data.is_conversation_finished,
             'created_at': session_data.created_at,
             'updated_at': session_data.updated_at,
-            'message_count': len(messages)
+            'message_count': sum(1 for e in entries if e['type'] == 'message')
         }
 
-        # Get session notes
-        async for db in get_db():
-            stmt_session_notes = select(SessionNoteModel).where(SessionNoteModel.session_id == session_data.id).order_by(SessionNoteModel.created_at.desc())
-            result_session_notes = await db.execute(stmt_session_notes)
-            session_notes = result_session_notes.scalars().all()
-
-            session_notes_data = [{
-                'id': n.id,
-                'note': n.note,
-                'created_by': n.created_by,
-                'created_at': n.created_at.strftime('%d/%m/%Y %H:%M'),
-                'updated_at': n.updated_at.strftime('%d/%m/%Y %H:%M')
-            } for n in session_notes]
+        # Session notes (già caricate con la sessione)
+        session_notes_data = [{
+            'id': n.id,
+            'note': n.note,
+            'created_at': n.created_at.strftime('%d/%m/%Y %H:%M'),
+            'updated_at': n.updated_at.strftime('%d/%m/%Y %H:%M')
+        } for n in session_data.notes]
 
         # Prepara i dati del template
         settings = get_settings()
@@ -293,7 +225,7 @@ async def session_conversation(session_id: str, request: Request):
             {
                 "request": request,
                 "session": session_info,
-                "entries": entries if 'entries' in locals() else messages,
+                "entries": entries,
                 "app_version": settings.app_version,
                 "session_notes": session_notes_data
             }
@@ -321,6 +253,47 @@ async def health_check():
     )
 
 
+@router.get("/health/live")
+async def liveness_probe():
+    """Liveness probe: il processo risponde, nessuna dipendenza esterna verificata"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+
+@router.get("/health/ready")
+async def readiness_probe():
+    """Readiness probe: avvio completato e database raggiungibile all'ultimo refresh"""
+    snapshot = status_monitor.get_snapshot()
+    ready = status_monitor.is_ready()
+    return FastJSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "database": snapshot.get("database"),
+            "snapshot_age_seconds": snapshot.get("age_seconds"),
+        },
+    )
+
+
+@router.get("/api/snippets")
+async def get_snippets():
+    """Snippet correnti dello snippet store (sorgente, ID, gruppi e argomenti)"""
+    index = snippet_store.index
+    return {
+        **snippet_store.stats(),
+        "snippets": [
+            {"id": s.id, "name": s.name, "text": s.text, "topics": list(s.topics), "groups": list(s.groups)}
+            for s in index.by_id.values()
+        ],
+    }
+
+
+@router.post("/api/snippets/reload")
+async def reload_snippets():
+    """Ricarica subito gli snippet dal CSV (senza attendere il controllo periodico)"""
+    await snippet_store.load()
+    return snippet_store.stats()
+
+
 @router.get("/api/models")
 async def get_available_models():
     """Ottiene la lista dei modelli AI disponibili"""
@@ -332,10 +305,14 @@ async def get_available_models():
                     "name": m.name,
                     "display_name": m.display_name or m.name,
                     "is_active": m.is_active,
-                    "description": m.description
+                    "description": m.description,
+                    "fallback_order": m.fallback_order,
+                    "hedge_delay_ms": m.hedge_delay_ms
                 }
                 for m in models
-            ]
+            ],
+            "hedging_enabled": get_settings().ai_hedging_enabled,
+            "latency": model_latency.snapshot()
         }
     except Exception as e:
         from app.main import logger
@@ -343,6 +320,79 @@ async def get_available_models():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.put("/api/models/{name}/hedging")
+async def update_model_hedging(name: str, payload: AIModelHedgingUpdate):
+    """Imposta fallback_order e hedge_delay_ms di un modello (catena di fallback e hedging)"""
+    try:
+        model = await AIModelService.update_hedging(name, payload.fallback_order, payload.hedge_delay_ms)
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nell'aggiornamento dell'hedging: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if model is None:
+        raise HTTPException(status_code=404, detail=f"Modello {name} non trovato")
+    return {
+        "name": model.name,
+        "fallback_order": model.fallback_order,
+        "hedge_delay_ms": model.hedge_delay_ms
+    }
+
+
+def _model_route_row(route) -> Dict:
+    return {
+        "id": route.id,
+        "lifecycle": route.lifecycle.value if route.lifecycle else None,
+        "min_history_messages": route.min_history_messages,
+        "model_name": route.model_name,
+        "is_enabled": route.is_enabled
+    }
+
+
+@router.get("/api/model_routes")
+async def get_model_routes():
+    """Tabella di routing dei modelli per lifecycle e modello attivo usato senza regole applicabili"""
+    routes = await ModelRoutingService.get_all_routes()
+    return {
+        "routes": [_model_route_row(r) for r in routes],
+        "default_model": await AIModelService.get_active_model_name()
+    }
+
+
+async def _validate_route_model(model_name: str) -> None:
+    if await AIModelService.get_model_by_name(model_name) is None:
+        raise HTTPException(status_code=400, detail=f"Modello {model_name} non presente in ai_models")
+
+
+@router.post("/api/model_routes")
+async def create_model_route(payload: ModelRouteUpsert):
+    """Aggiunge una regola di routing (attiva subito, senza riavvio)"""
+    await _validate_route_model(payload.model_name)
+    route = await ModelRoutingService.create_route(payload.lifecycle, payload.min_history_messages, payload.model_name, payload.is_enabled)
+    if route is None:
+        raise HTTPException(status_code=409, detail="Esiste già una regola per questo lifecycle e questa soglia")
+    return _model_route_row(route)
+
+
+@router.put("/api/model_routes/{route_id}")
+async def update_model_route(route_id: int, payload: ModelRouteUpsert):
+    """Modifica una regola di routing"""
+    await _validate_route_model(payload.model_name)
+    if route_id not in {r.id for r in await ModelRoutingService.get_all_routes()}:
+        raise HTTPException(status_code=404, detail=f"Regola {route_id} non trovata")
+    route = await ModelRoutingService.update_route(route_id, payload.lifecycle, payload.min_history_messages, payload.model_name, payload.is_enabled)
+    if route is None:
+        raise HTTPException(status_code=409, detail="Esiste già una regola per questo lifecycle e questa soglia")
+    return _model_route_row(route)
+
+
+@router.delete("/api/model_routes/{route_id}")
+async def delete_model_route(route_id: int):
+    """Elimina una regola di routing"""
+    if not await ModelRoutingService.delete_route(route_id):
+        raise HTTPException(status_code=404, detail=f"Regola {route_id} non trovata")
+    return {"message": "Regola eliminata"}
+
+
 @router.get("/api/sessions_list")
 async def get_sessions_list():
     """Ottiene la lista delle sessioni disponibili per il selettore nella chat UI"""
@@ -368,18 +418,7 @@ async def get_sessions_list():
             result = await db.execute(stmt)
             sessions_data = result.fetchall()
 
-        # Converti i risultati in dizionari
-        sessions = []
-        for row in sessions_data:
-            sessions.append({
-                'session_id': row.session_id,
-                'created_at': row.created_at.isoformat(),
-                'updated_at': row.updated_at.isoformat(),
-                'current_lifecycle': row.current_lifecycle.value if row.current_lifecycle else None,
-                'message_count': row.message_count
-            })
-
-        return {"sessions": sessions}
+        return FastJSONResponse(content={"sessions": session_rows(sessions_data)})
 
     except Exception as e:
         from app.main import logger
@@ -387,115 +426,253 @@ async def get_sessions_list():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _history_etag(session_pk: int, last_message_id: Optional[int], lifecycle: Optional[LifecycleStage]) -> str:
+    """ETag forte della cronologia: cambia con un nuovo messaggio o un cambio di lifecycle"""
+    return f'"h{session_pk}-{last_message_id or 0}-{lifecycle.name if lifecycle else ""}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Confronto debole (If-None-Match): l'ETag torna con W/ se la risposta era compressa"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+
 @router.get("/api/session/{session_id}/history")
-async def get_session_history(session_id: str):
-    """Ottiene la cronologia dei messaggi per una sessione specifica"""
+async def get_session_history(
+    session_id: str,
+    after_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    if_none_match: Optional[str] = Header(default=None)
+):
+    """Ottiene la cronologia dei messaggi per una sessione specifica
+
+    Con `after_id` (o `since`) restituisce solo i messaggi successivi al cursore. Se
+    l'ETag inviato in If-None-Match è ancora valido risponde 304 dopo una sola query.
+    """
     try:
         async for db in get_db():
-            # Query per ottenere la sessione
-            session_stmt = select(SessionModel).where(SessionModel.session_id == session_id)
-            session_result = await db.execute(session_stmt)
-            session_data = session_result.scalar_one_or_none()
+            # Sessione, lifecycle e ultimo messaggio in una sola query: bastano per l'ETag
+            last_message_id = select(func.max(MessageModel.id)).where(
+                MessageModel.session_id == SessionModel.id
+            ).scalar_subquery()
+            head_stmt = select(
+                SessionModel.id,
+                SessionModel.current_lifecycle,
+                last_message_id.label('last_message_id')
+            ).where(SessionModel.session_id == session_id)
+            head_result = await db.execute(head_stmt)
+            head = head_result.one_or_none()
 
-            if not session_data:
+            if not head:
                 raise HTTPException(status_code=404, detail="Sessione non trovata")
 
-            # Query per ottenere tutti i messaggi della sessione
+            etag = _history_etag(head.id, head.last_message_id, head.current_lifecycle)
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+
+            # Query per ottenere i messaggi della sessione (solo quelli dopo il cursore, se presente)
             messages_stmt = select(MessageModel).where(
-                MessageModel.session_id == session_data.id
+                MessageModel.session_id == head.id
             ).order_by(MessageModel.timestamp.asc(), MessageModel.id.asc())
+            if after_id is not None:
+                messages_stmt = messages_stmt.where(MessageModel.id > after_id)
+            if since is not None:
+                messages_stmt = messages_stmt.where(MessageModel.timestamp > since)
 
             messages_result = await db.execute(messages_stmt)
             messages_data = messages_result.scalars().all()
 
-        # Converti i messaggi in dizionari
-        messages = []
-        for msg in messages_data:
-            messages.append({
-                'id': msg.id,
-                'role': msg.role,
-                'message': msg.message,
-                'timestamp': msg.timestamp.isoformat()
-            })
+        return FastJSONResponse(
+            content={
+                "session_id": session_id,
+                "messages": message_rows(messages_data),
+                "current_lifecycle": head.current_lifecycle.value if head.current_lifecycle else None,
+                "last_message_id": head.last_message_id,
+                "is_delta": after_id is not None or since is not None
+            },
+            headers=headers
+        )
 
-        return {
+    except HTTPException:
+        raise
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nel recupero della cronologia sessione {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/api/session/{session_id}/timeline")
+async def get_session_timeline(session_id: str):
+    """Timeline della sessione: messaggi e transizioni di lifecycle in ordine di visualizzazione"""
+    try:
+        async for db in get_db():
+            session = session_cache.get(session_id)
+            if session is None:
+                session_result = await db.execute(select(SessionModel).where(SessionModel.session_id == session_id))
+                session_data = session_result.scalar_one_or_none()
+                if not session_data:
+                    raise HTTPException(status_code=404, detail="Sessione non trovata")
+                session = session_cache.store(session_data)
+
+            entries = await timeline_service.get_timeline(db, session.id)
+
+        # Le voci (con datetime) vengono codificate direttamente, senza copie intermedie
+        return FastJSONResponse(content={
             "session_id": session_id,
-            "messages": messages,
-            "current_lifecycle": session_data.current_lifecycle.value if session_data.current_lifecycle else None
-        }
+            "current_lifecycle": session.current_lifecycle.value if session.current_lifecycle else None,
+            "entries": entries
+        })
 
     except HTTPException:
         raise
     except Exception as e:
         from app.main import logger
-        logger.error(f"Errore nel recupero della cronologia sessione {session_id}: {e}")
+        logger.error(f"Errore nel recupero della timeline sessione {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/analytics/funnel", response_class=HTMLResponse)
+async def funnel_dashboard(request: Request):
+    """Dashboard del funnel di lifecycle"""
+    try:
+        settings = get_settings()
+        return templates.TemplateResponse(
+            "funnel_analytics.html",
+            {
+                "request": request,
+                "app_version": settings.app_version
+            }
+        )
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nel rendering della dashboard del funnel: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Errore nel caricamento della dashboard: {str(e)}"
+        )
+
+
+@router.get("/api/analytics/funnel")
+async def get_funnel_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    group_by: Optional[str] = None
+):
+    """Funnel di lifecycle dai rollup giornalieri (default: ultimi 7 giorni)
+
+    group_by: "model" o "prompt" per il breakdown delle transizioni.
+    """
+    if group_by is not None and group_by not in GROUP_BY_COLUMNS:
+        raise HTTPException(status_code=400, detail="group_by deve essere 'model' o 'prompt'")
+    default_start, default_end = funnel_analytics.default_range()
+    start = start or default_start
+    end = end or default_end
+    if start > end:
+        raise HTTPException(status_code=400, detail="start deve precedere end")
+
+    try:
+        return await funnel_analytics.get_funnel(start, end, group_by)
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nel calcolo del funnel: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/api/analytics/funnel/refresh")
+async def refresh_funnel_analytics():
+    """Aggrega subito i lifecycle_events non ancora inclusi nei rollup"""
+    try:
+        processed = await funnel_analytics.update()
+        return {"processed_events": processed}
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nell'aggiornamento dei rollup del funnel: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/api/import/conversations")
+async def import_conversations(
+    request: Request,
+    batch_size: Optional[int] = None,
+    on_conflict: str = "skip",
+    rebase_to_now: bool = False,
+    dry_run: bool = False
+):
+    """Importa conversazioni in blocco da un body NDJSON (una conversazione per riga), senza chiamare l'AI"""
+    try:
+        from app.services.bulk_import_service import BulkImportService
+
+        if on_conflict not in ("skip", "fail"):
+            raise HTTPException(status_code=400, detail="on_conflict deve essere 'skip' o 'fail'")
+
+        async def body_lines():
+            # Il body viene letto in streaming e spezzato per righe senza caricarlo tutto in memoria
+            buffer = b""
+            async for chunk in request.stream():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    yield line
+            if buffer:
+                yield buffer
+
+        return await BulkImportService.import_ndjson(
+            body_lines(),
+            batch_size=batch_size,
+            on_conflict=on_conflict,
+            rebase_to=datetime.now(timezone.utc) if rebase_to_now else None,
+            dry_run=dry_run
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nell'import delle conversazioni: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(chat_message: ChatMessage):
+async def chat_endpoint(
+    chat_message: ChatMessage,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    request_timeout: Optional[float] = Header(None, alias="X-Request-Timeout"),
+):
     """
     Endpoint per la chat con agente unificato che gestisce conversazione e lifecycle
+
+    Una chiave di idempotenza (campo idempotency_key/client_message_id o header
+    Idempotency-Key) fa sì che i retry ricevano la risposta originale.
+    L'header X-Request-Timeout (secondi) è la deadline del client: le chiamate AI del
+    turno e i loro retry non la superano (in modalità inline).
     """
     try:
         from app.main import logger
 
         logger.info(f"Messaggio ricevuto da sessione {chat_message.session_id}: {chat_message.message}")
+        client_message_id = client_message_key(chat_message, idempotency_key)
 
-        # Verifica se la conversazione è finita
-        async for db in get_db():
-            from sqlalchemy import select
-            result = await db.execute(
-                select(SessionModel).where(SessionModel.session_id == chat_message.session_id)
+        try:
+            with request_deadline(request_timeout):
+                response = await execute_chat_turn(chat_message, client_message_id)
+        except ChatTurnPending as pending:
+            # Ancora in corso: il client può seguire il job
+            job = pending.job
+            return FastJSONResponse(
+                status_code=202,
+                content={"job_id": job.id, "status": job.status, "session_id": job.session_id}
             )
-            session = result.scalar_one_or_none()
-
-            if session and session.is_conversation_finished:
-                logger.warning(f"Tentativo di invio messaggio a conversazione finita per sessione {chat_message.session_id}")
-                # Restituisci una risposta che indica che la conversazione è finita senza messaggi
-                return ChatResponse(
-                    messages=[],  # Lista vuota per indicare che non ci sono messaggi da mostrare
-                    session_id=chat_message.session_id,
-                    current_lifecycle=session.current_lifecycle.value,
-                    lifecycle_changed=False,
-                    previous_lifecycle=None,
-                    ai_reasoning="Conversazione terminata",
-                    confidence=1.0,
-                    timestamp=str(int(time.time())),
-                    is_conversation_finished=True
-                )
 
-        # Usa l'agente unificato
-        lifecycle_response = await unified_agent.chat(
-            session_id=chat_message.session_id,
-            user_message=chat_message.message,
-            model_name=chat_message.model_name,
-            batch_wait_seconds=chat_message.batch_wait_seconds
-        )
-
-        # Estrai il testo per il logging
-        if isinstance(lifecycle_response.messages, str):
-            log_text = lifecycle_response.messages
-        else:
-            log_text = " ".join([msg.get("text", "") for msg in lifecycle_response.messages])
-
-        logger.info(f"Risposta agente unificato per sessione {chat_message.session_id}: {log_text[:100]}...")
-
-        return ChatResponse(
-            messages=lifecycle_response.messages,
-            session_id=chat_message.session_id,
-            current_lifecycle=lifecycle_response.current_lifecycle.value,
-            lifecycle_changed=lifecycle_response.lifecycle_changed,
-            previous_lifecycle=lifecycle_response.previous_lifecycle.value if lifecycle_response.previous_lifecycle else None,
-            # next_actions removed - no longer part of API
-            ai_reasoning=lifecycle_response.ai_reasoning,
-            confidence=lifecycle_response.confidence,
-            timestamp=str(int(time.time())),
-            is_conversation_finished=lifecycle_response.is_conversation_finished
-            ,requires_human=lifecycle_response.requires_human
-            ,human_task=lifecycle_response.human_task
-        )
+        # Client WebSocket della stessa sessione (altre schede, operatori)
+        chat_events.publish_turn(chat_message.session_id, response)
+        return response
 
+    except SessionLockTimeout as e:
+        from app.main import logger
+        logger.warning(f"Sessione {chat_message.session_id} occupata da un altro turno: {e}")
+        raise HTTPException(status_code=409, detail=str(e))
     except AIError as e:
         from app.main import logger
         logger.error(f"Errore AI nell'endpoint chat per sessione {chat_message.session_id}: {e}")
@@ -514,16 +691,113 @@ async def chat_endpoint(chat_message: ChatMessage):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.websocket("/ws/chat/{session_id}")
+async def chat_websocket(websocket: WebSocket, session_id: str, after_id: Optional[int] = None):
+    """Chat via WebSocket: ack immediato, push di parti ed eventi, resume da `after_id`"""
+    await ChatSocket(websocket, session_id).serve(after_id)
+
+
+def _serialize_chat_job(job) -> Dict:
+    """Serializza un chat job per le API"""
+    return {
+        "id": job.id,
+        "session_id": job.session_id,
+        "client_message_id": job.client_message_id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "last_error": job.last_error,
+        "result": json_lib.loads(job.result) if job.result else None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "completed_at": job.completed_at.isoformat() if job.completed_at else None
+    }
+
+
+@router.get("/api/chat/jobs")
+async def list_chat_jobs(status: Optional[str] = None, limit: int = 50):
+    """Elenco dei chat job (es. status=dead per la dead-letter)"""
+    try:
+        jobs = await chat_job_queue.list_jobs(status=status, limit=min(limit, 500))
+        return [_serialize_chat_job(job) for job in jobs]
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nel recupero dei chat job: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/api/chat/jobs/{job_id}")
+async def get_chat_job(job_id: int):
+    """Stato e risultato di un chat job"""
+    job = await chat_job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return _serialize_chat_job(job)
+
+
+@router.post("/api/chat/jobs/{job_id}/retry")
+async def retry_chat_job(job_id: int):
+    """Rimette in coda un job in dead-letter"""
+    if not await chat_job_queue.retry(job_id):
+        raise HTTPException(status_code=409, detail="Solo i job in dead-letter possono essere rimessi in coda")
+    return {"id": job_id, "status": "pending"}
+
+
+@router.get("/api/outbound")
+async def outbound_stats():
+    """Conteggi delle parti in uscita per stato e dimensione della coda in memoria"""
+    try:
+        return await outbound_scheduler.stats()
+    except Exception as e:
+        from app.main import logger
+        logger.error(f"Errore nel recupero delle statistiche di consegna: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/api/outbound/{session_id}")
+async def list_outbound_messages(session_id: str, limit: int = 100):
+    """Parti pianificate per una sessione, in ordine di consegna"""
+    items = await outbound_scheduler.list_messages(session_id, limit=min(limit, 500))
+    return [outbound_payload(item) for item in items]
+
+
+@router.delete("/api/outbound/{session_id}")
+async def cancel_outbound_messages(session_id: str):
+    """Annulla le parti non ancora consegnate di una sessione"""
+    cancelled = await outbound_scheduler.cancel(session_id)
+    return {"session_id": session_id, "cancelled": cancelled}
+
+
+@router.get("/api/outbound/{session_id}/stream")
+async def stream_outbound_messages(session_id: str, request: Request):
+    """Stream SSE delle parti consegnate con il sink "sse" per una sessione"""
+    queue = sse_sink.connect(session_id)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Keep-alive per proxy e load balancer
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {payload['id']}\nevent: message\ndata: {json_lib.dumps(payload)}\n\n"
+        finally:
+            sse_sink.disconnect(session_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/status")
 async def status():
-    """Endpoint per lo status dettagliato dell'applicazione"""
+    """Endpoint per lo status dettagliato dell'applicazione (servito dallo snapshot in memoria)"""
     settings = get_settings()
-
-    async for db in get_db():
-        result = await db.execute(
-            func.count(SessionModel.id)
-        )
-        active_sessions = result.scalar()
+    snapshot = status_monitor.get_snapshot()
 
     unified_agent_available = await unified_agent.is_available()
 
@@ -537,12 +811,25 @@ async def status():
             "unified_agent": {
                 "status": "healthy" if unified_agent_available else "unhealthy",
                 "ai_client_available": unified_agent_available,
-                "active_sessions": active_sessions
-            }
-        }
+                "active_sessions": snapshot.get("sessions", {}).get("total"),
+                "last_llm_success_at": snapshot["llm"]["last_success_at"]
+            },
+            "session_cache": session_cache.stats(),
+            "websocket": {"connections": chat_events.connection_count},
+            "ai_circuit": ai_circuit_breaker.snapshot(),
+            "classifier_circuit": classifier_circuit_breaker.snapshot(),
+            "snippets": snippet_store.stats()
+        },
+        "snapshot": snapshot
     }
 
 
+@router.get("/api/metrics")
+async def get_metrics():
+    """Metriche in-process (contatori e istogrammi) di questo worker"""
+    return metrics.snapshot()
+
+
 @router.get("/session/{session_id}")
 async def get_session_info(session_id: str):
     """Endpoint per ottenere informazioni sulla sessione e lifecycle corrente"""
@@ -586,6 +873,7 @@ async def finish_session(session_id: str, set_lifecycle: bool = True):
                 session.current_lifecycle = LifecycleStage.LINK_INVIATO
 
             await db.commit()
+            session_cache.store(session)
 
             return {
                 "session_id": session.session_id,
@@ -625,6 +913,8 @@ async def create_human_task(task: HumanTaskCreate):
             db.add(new_task)
             await db.commit()
             await db.refresh(new_task)
+            if task.session_id:
+                session_cache.update(task.session_id, has_open_task=True)
 
             return {
                 "id": new_task.id,
@@ -799,25 +1089,29 @@ async def get_human_task(task_id: int):
 
 
 @router.get("/unified/health")
-async def unified_agent_health_check():
-    """Endpoint per verificare lo stato dell'agente unificato"""
+async def unified_agent_health_check(probe: bool = False):
+    """Endpoint per verificare lo stato dell'agente unificato
+
+    Con probe=true esegue anche la chiamata di prova all'AI, limitata a una per intervallo.
+    """
     try:
         is_available = await unified_agent.is_available()
+        snapshot = status_monitor.get_snapshot()
 
-        async for db in get_db():
-            result = await db.execute(
-                func.count(SessionModel.id)
-            )
-            active_sessions = result.scalar()
+        details = {
+            "ai_client_available": is_available,
+            "active_sessions": snapshot.get("sessions", {}).get("total"),
+            "last_llm_success_at": snapshot["llm"]["last_success_at"],
+            "snapshot_age_seconds": snapshot.get("age_seconds")
+        }
+        if probe:
+            details["llm_probe"] = await unified_agent.health_check()
 
         return {
             "status": "healthy" if is_available else "unhealthy",
             "service": "unified_agent",
             "timestamp": datetime.now().isoformat(),
-            "details": {
-                "ai_client_available": is_available,
-                "active_sessions": active_sessions
-            }
+            "details": details
         }
     except Exception as e:
         from app.main import logger
@@ -828,7 +1122,6 @@ async def unified_agent_health_check():
         }
 
 
-
 @router.put("/api/tasks/{task_id}")
 async def update_human_task(task_id: int, task_update: HumanTaskUpdate):
     """Aggiorna una human task - permette di marcare completata"""
@@ -848,6 +1141,17 @@ async def update_human_task(task_id: int, task_update: HumanTaskUpdate):
 
             await db.commit()
             await db.refresh(t)
+            if t.session_id and task_update.completed is not None:
+                # Potrebbero esserci altre task aperte: si lascia decidere al prossimo turno
+                session_cache.update_by_id(t.session_id, has_open_task=None if t.completed else True)
+            if t.session_id and chat_events.active:
+                # Stato della task ai client WebSocket della sessione
+                external_id = await db.scalar(select(SessionModel.session_id).where(SessionModel.id == t.session_id))
+                if external_id:
+                    chat_events.publish(external_id, {
+                        "type": "human_task",
+                        "task": {"id": t.id, "status": t.status, "completed": bool(t.completed)}
+                    })
 
             return {
                 "id": t.id,
@@ -1036,12 +1340,16 @@ async def session_tasks_dashboard(session_id: str, request: Request):
     """Pagina dashboard per le task di una sessione specifica"""
     try:
         async for db in get_db():
-            # Find session
-            stmt = select(SessionModel).where(SessionModel.session_id == session_id)
+            # Find session, with its message count computed in the same query
+            message_count = select(func.count(MessageModel.id)).where(
+                MessageModel.session_id == SessionModel.id
+            ).scalar_subquery()
+            stmt = select(SessionModel, message_count.label('message_count')).where(SessionModel.session_id == session_id)
             result = await db.execute(stmt)
-            session = result.scalar_one_or_none()
-            if not session:
+            row = result.one_or_none()
+            if not row:
                 raise HTTPException(status_code=404, detail="Sessione non trovata")
+            session, message_count = row
 
             # Get all tasks for this session
             stmt_tasks = select(HumanTaskModel).where(
@@ -1064,16 +1372,10 @@ async def session_tasks_dashboard(session_id: str, request: Request):
                     'created_at': t.created_at.isoformat(),
                 })
 
-            # Avoid triggering lazy load on session.messages (which would cause greenlet_spawn error)
-            # Do an explicit count query instead
-            from app.models.database_models import MessageModel
-            result_count = await db.execute(select(func.count(MessageModel.id)).where(MessageModel.session_id == session.id))
-            message_count = result_count.scalar() or 0
-
             session_info = {
                 'session_id': session.session_id,
                 'current_lifecycle': session.current_lifecycle.value,
-                'message_count': int(message_count),
+                'message_count': int(message_count or 0),
                 'task_count': len(tasks)
             }
 
@@ -1096,16 +1398,17 @@ async def session_notes_dashboard(session_id: str, request: Request):
     """Pagina dashboard per le note di una sessione specifica"""
     try:
         async for db in get_db():
-            # Find session
-            stmt = select(SessionModel).where(SessionModel.session_id == session_id)
+            # Find session, with its session notes eager-loaded
+            stmt = select(SessionModel).options(selectinload(SessionModel.notes)).where(SessionModel.session_id == session_id)
             result = await db.execute(stmt)
             session = result.scalar_one_or_none()
             if not session:
                 raise HTTPException(status_code=404, detail="Sessione non trovata")
 
-            # Get all message notes for this session (via messages)
-            from app.models.database_models import MessageNoteModel, MessageModel
-            stmt_notes = select(MessageNoteModel).join(MessageModel).where(
+            # Get all message notes for this session together with their message (single JOIN)
+            stmt_notes = select(MessageNoteModel).join(MessageNoteModel.message).options(
+                contains_eager(MessageNoteModel.message)
+            ).where(
                 MessageModel.session_id == session.id
             ).order_by(MessageNoteModel.created_at.desc())
 
@@ -1113,33 +1416,21 @@ async def session_notes_dashboard(session_id: str, request: Request):
             notes = result_notes.scalars().all()
 
             # Prepare message notes data
-            notes_data = []
-            for n in notes:
-                # Re-query with eager load
-                stmt_n = select(MessageNoteModel).options(selectinload(MessageNoteModel.message)).where(MessageNoteModel.id == n.id)
-                res_n = await db.execute(stmt_n)
-                full_note = res_n.scalar_one()
-
-                notes_data.append({
-                    'id': full_note.id,
-                    'rating': full_note.rating,
-                    'note': full_note.note,
-                    'created_by': full_note.created_by,
-                    'created_at': full_note.created_at.strftime('%d/%m/%Y %H:%M'),
-                    'message_preview': full_note.message.message if full_note.message else "Messaggio non trovato"
-                })
-
-            # Get session notes
-            stmt_session_notes = select(SessionNoteModel).where(SessionNoteModel.session_id == session.id).order_by(SessionNoteModel.created_at.desc())
-            result_session_notes = await db.execute(stmt_session_notes)
-            session_notes = result_session_notes.scalars().all()
+            notes_data = [{
+                'id': n.id,
+                'rating': n.rating,
+                'note': n.note,
+                'created_by': n.created_by,
+                'created_at': n.created_at.strftime('%d/%m/%Y %H:%M'),
+                'message_preview': n.message.message if n.message else "Messaggio non trovato"
+            } for n in notes]
 
             session_notes_data = [{
                 'id': n.id,
                 'note': n.note,
                 'created_at': n.created_at.strftime('%d/%m/%Y %H:%M'),
                 'updated_at': n.updated_at.strftime('%d/%m/%Y %H:%M')
-            } for n in session_notes]
+            } for n in session.notes]
 
             session_info = {
                 'session_id': session.session_id,
@@ -1449,66 +1740,49 @@ async def delete_system_prompt(prompt_id: int):
 
 """Endpoint API per eseguire comandi del server script"""
 @router.get("/api/execute/{command}")
-async def execute_command(command: str):
-    """Endpoint API per eseguire comandi del server script"""
+async def execute_command(command: str, stream: bool = False):
+    """Endpoint API per eseguire comandi del server script
+
+    Con `stream=true` l'output arriva man mano come text/plain; altrimenti si attende la
+    fine del comando e si risponde in JSON.
+    """
     try:
         from app.main import logger
 
-        # Mappa dei comandi disponibili
-        available_commands = {
-        "server-status": ["./server", "server-status"],
-        "monitor-health": ["./server", "monitor-health"],
-        "ssl-check": ["./server", "ssl-check"],
-        "dependencies-check": ["./server", "dependencies-check"],
-        "dependencies-lock": ["./server", "dependencies-lock"]
-        }
-
-        if command not in available_commands:
+        try:
+            run = command_runner.start(command)
+        except UnknownCommandError:
             raise HTTPException(status_code=400, detail=f"Comando non disponibile: {command}")
 
-        logger.info(f"Eseguendo comando API: {command}")
-
-        # Esegui il comando in un thread separato per non bloccare l'event loop
-        def run_command():
-            try:
-                # Usa la directory del container dove è copiato il file server
-                container_dir = "/app"
-                result = subprocess.run(
-                    available_commands[command],
-                    capture_output=True,
-                    text=True,
-                    cwd=container_dir,
-                    timeout=30  # Timeout più lungo per comandi complessi
-                )
-                return {
-                    "success": result.returncode == 0,
-                    "returncode": result.returncode,
-                    "stdout": result.stdout,
-                    "stderr": result.stderr
-                }
-            except Exception as e:
-                return {
-                    "success": False,
-                    "error": str(e)
-                }
+        logger.info(f"Eseguendo comando API: {command}{' (cache)' if run.cached else ''}")
 
-        # Esegui in thread pool
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            result = await loop.run_in_executor(executor, run_command)
+        if stream:
+            async def output():
+                async for chunk in run.stream():
+                    yield chunk
+                if not run.result.success:
+                    yield f"\n✗ Comando fallito: {run.result.failure_detail}\n"
 
-            if not result["success"]:
-                logger.error(f"Comando {command} fallito: {result.get('stderr', result.get('error', 'Errore sconosciuto'))}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Comando fallito: {result.get('stderr', result.get('error', 'Errore sconosciuto'))}"
-                )
+            return StreamingResponse(
+                output(),
+                media_type="text/plain; charset=utf-8",
+                headers={"Cache-Control": "no-cache", "X-Command-Cached": "true" if run.cached else "false"}
+            )
+
+        result = await run.wait()
+        if not result.success:
+            logger.error(f"Comando {command} fallito: {result.failure_detail}")
+            raise HTTPException(status_code=500, detail=f"Comando fallito: {result.failure_detail}")
 
-            logger.info(f"Comando {command} eseguito con successo")
+        logger.info(f"Comando {command} eseguito con successo")
         return {
             "command": command,
             "success": True,
-            "output": result["stdout"],
+            "output": result.output,
+            "stderr": result.stderr,
+            "cached": run.cached,
+            "duration_seconds": result.duration_seconds,
+            "finished_at": result.finished_at.isoformat(),
             "timestamp": datetime.now().isoformat()
         }
 
@@ -1,10 +1,12 @@
 """
 Servizio per la gestione dei modelli AI nel database
 """
-from typing import List, Optional
+import time
+from typing import Dict, List, Optional, Tuple
 from sqlalchemy import select
 from loguru import logger
 
+from app.config import settings
 from app.database import get_db_session
 from app.models.database_models import AIModelModel
 
@@ -12,6 +14,89 @@ from app.models.database_models import AIModelModel
 class AIModelService:
     """Servizio per gestire i modelli AI"""
 
+    # Cache in-process del nome del modello attivo, invalidata dalle scritture
+    _active_name_cache: Optional[str] = None
+    _active_name_cached_at: float = 0.0
+
+    # Cache della configurazione di hedging: (catena di fallback, hedge_delay_ms per modello)
+    _routing_cache: Optional[Tuple[List[str], Dict[str, Optional[int]]]] = None
+    _routing_cached_at: float = 0.0
+
+    @staticmethod
+    def invalidate_active_cache() -> None:
+        """Forza la rilettura del modello attivo alla prossima richiesta"""
+        AIModelService._active_name_cache = None
+        AIModelService._routing_cache = None
+
+    @staticmethod
+    async def get_active_model_name(default: str = "gemini-flash-latest") -> str:
+        """Nome del modello attivo (o `default` se nessuno), dalla cache se ancora valida
+
+        Se la lettura fallisce (es. database non ancora pronto all'avvio) si usa `default`
+        senza metterlo in cache: la richiesta successiva riprova.
+        """
+        cached = AIModelService._active_name_cache
+        if cached is not None and time.monotonic() - AIModelService._active_name_cached_at < settings.active_config_cache_ttl_seconds:
+            return cached
+
+        db = await get_db_session()
+        try:
+            result = await db.execute(
+                select(AIModelModel.name).where(AIModelModel.is_active == True)
+            )
+            active_name = result.scalar_one_or_none()
+        except Exception as e:
+            logger.error(f"Errore nel recupero del modello attivo, uso {default}: {e}")
+            return default
+        finally:
+            await db.close()
+        AIModelService._active_name_cache = active_name or default
+        AIModelService._active_name_cached_at = time.monotonic()
+        return AIModelService._active_name_cache
+
+    @staticmethod
+    async def get_hedging_config() -> Tuple[List[str], Dict[str, Optional[int]]]:
+        """Catena di fallback (per fallback_order) e hedge_delay_ms dei modelli, dalla cache se valida"""
+        cached = AIModelService._routing_cache
+        if cached is not None and time.monotonic() - AIModelService._routing_cached_at < settings.active_config_cache_ttl_seconds:
+            return cached
+
+        models = await AIModelService.get_all_models()
+        chain = [m.name for m in sorted(
+            (m for m in models if m.fallback_order is not None), key=lambda m: (m.fallback_order, m.id)
+        )]
+        AIModelService._routing_cache = (chain, {m.name: m.hedge_delay_ms for m in models})
+        AIModelService._routing_cached_at = time.monotonic()
+        return AIModelService._routing_cache
+
+    @staticmethod
+    async def update_hedging(name: str, fallback_order: Optional[int], hedge_delay_ms: Optional[int]) -> Optional[AIModelModel]:
+        """Imposta posizione nella catena di fallback e hedge delay di un modello
+
+        None se il modello non esiste; gli errori del database vengono rilanciati.
+        """
+        db = await get_db_session()
+        try:
+            result = await db.execute(
+                select(AIModelModel).where(AIModelModel.name == name)
+            )
+            model = result.scalar_one_or_none()
+            if model is None:
+                return None
+            model.fallback_order = fallback_order
+            model.hedge_delay_ms = hedge_delay_ms
+            await db.commit()
+            await db.refresh(model)
+            AIModelService.invalidate_active_cache()
+            logger.info(f"Hedging del modello {name}: fallback_order={fallback_order}, hedge_delay_ms={hedge_delay_ms}")
+            return model
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Errore nell'aggiornamento dell'hedging del modello {name}: {e}")
+            raise
+        finally:
+            await db.close()
+
     @staticmethod
     async def get_all_models() -> List[AIModelModel]:
         """Ottiene tutti i modelli AI disponibili"""
@@ -58,7 +143,7 @@ class AIModelService:
             await db.close()
 
     @staticmethod
-    async def create_model(name: str, display_name: str, description: Optional[str] = None, is_active: bool = False) -> Optional[AIModelModel]:
+    async def create_model(name: str, display_name: str, description: Optional[str] = None, is_active: bool = False, fallback_order: Optional[int] = None) -> Optional[AIModelModel]:
         """Crea un nuovo modello AI"""
         db = await get_db_session()
         try:
@@ -66,11 +151,13 @@ class AIModelService:
                 name=name,
                 display_name=display_name,
                 description=description,
-                is_active=is_active
+                is_active=is_active,
+                fallback_order=fallback_order
             )
             db.add(new_model)
             await db.commit()
             await db.refresh(new_model)
+            AIModelService.invalidate_active_cache()
             logger.info(f"Creato modello AI: {name}")
             return new_model
         except Exception as e:
@@ -101,6 +188,7 @@ class AIModelService:
             if model:
                 model.is_active = True
                 await db.commit()
+                AIModelService.invalidate_active_cache()
                 logger.info(f"Modello attivo impostato: {model.name}")
                 return True
             
@@ -134,7 +222,8 @@ class AIModelService:
                 "name": "gemini-2.5-pro",
                 "display_name": "Gemini 2.5 Pro",
                 "description": "Modello Gemini 2.5 Pro, più avanzato e preciso",
-                "is_active": False
+                "is_active": False,
+                "fallback_order": 1
             }
         ]
         
@@ -0,0 +1,440 @@
+"""
+Servizio per l'importazione massiva di conversazioni da file NDJSON
+
+Ogni riga del file è una conversazione completa:
+
+    {
+        "session_id": "lead-123",
+        "current_lifecycle": "in_target",            # opzionale
+        "is_conversation_finished": false,           # opzionale
+        "user_info": {"firstname": "Anna"},          # opzionale (dict o stringa JSON)
+        "created_at": "2025-11-20T10:00:00+00:00",   # opzionale
+        "messages": [
+            {"role": "user", "message": "Ciao", "timestamp": "2025-11-20T10:00:00+00:00"},
+            {"role": "assistant", "message": "Ciao!", "timestamp": "...", "lifecycle": "contrassegnato"}
+        ],
+        "lifecycle_events": [
+            {"previous_lifecycle": "nuova_lead", "new_lifecycle": "contrassegnato",
+             "created_at": "...", "trigger_message_index": 1, "confidence": 0.9}
+        ]
+    }
+
+L'import non chiama mai l'AI: sessioni, messaggi ed eventi vengono scritti direttamente
+con insert batch (executemany) e, su PostgreSQL con asyncpg, con COPY per messaggi ed eventi.
+
+Uso da riga di comando:
+    python -m app.services.bulk_import_service conversazioni.ndjson --batch-size 2000
+"""
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterable, Dict, Iterable, List, Optional, Tuple, Union
+
+from loguru import logger
+from sqlalchemy import insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import get_db
+from app.models.database_models import LifecycleEventModel, MessageModel, SessionModel
+from app.models.lifecycle import LifecycleStage
+
+
+class ConversationImportError(Exception):
+    """Errore di validazione di una riga NDJSON"""
+    pass
+
+
+class BulkImportService:
+    """Importa conversazioni in blocco senza passare dall'agente"""
+
+    MESSAGE_COLUMNS = ["id", "session_id", "role", "message", "timestamp", "lifecycle"]
+    EVENT_COLUMNS = ["session_id", "previous_lifecycle", "new_lifecycle", "trigger_message_id", "confidence", "created_at"]
+
+    @staticmethod
+    def _parse_lifecycle(value: Optional[str]) -> Optional[LifecycleStage]:
+        """Accetta sia il valore ("in_target") sia il nome ("IN_TARGET") dello stage"""
+        if value is None or value == "":
+            return None
+        if isinstance(value, LifecycleStage):
+            return value
+        try:
+            return LifecycleStage(str(value).lower())
+        except ValueError:
+            try:
+                return LifecycleStage[str(value).upper().replace(" ", "_")]
+            except KeyError:
+                raise ConversationImportError(f"Lifecycle non valido: {value}")
+
+    @staticmethod
+    def _parse_timestamp(value: Optional[str], default: datetime) -> datetime:
+        """Converte un timestamp ISO 8601 (o epoch in secondi) in datetime timezone-aware"""
+        if value is None or value == "":
+            return default
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        try:
+            dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            raise ConversationImportError(f"Timestamp non valido: {value}")
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt
+
+    @staticmethod
+    def _parse_confidence(value: Any, label: str) -> Optional[float]:
+        """Confidenza dell'evento come float tra 0 e 1 (assente o null = None)"""
+        if value is None or value == "":
+            return None
+        if isinstance(value, bool):
+            raise ConversationImportError(f"{label}: confidence non valida ({value})")
+        try:
+            confidence = float(value)
+        except (TypeError, ValueError):
+            raise ConversationImportError(f"{label}: confidence non valida ({value})")
+        if not 0.0 <= confidence <= 1.0:
+            raise ConversationImportError(f"{label}: confidence fuori range ({value})")
+        return confidence
+
+    @staticmethod
+    def _object_list(raw: Dict[str, Any], field: str, label: str) -> List[Dict[str, Any]]:
+        """Lista di oggetti JSON del campo `field` (assente o null = lista vuota)"""
+        items = raw.get(field)
+        if items is None:
+            return []
+        if not isinstance(items, list):
+            raise ConversationImportError(f"Campo '{field}' non valido: attesa una lista")
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ConversationImportError(f"{label} {i}: atteso un oggetto JSON")
+        return items
+
+    @classmethod
+    def _parse_conversation(cls, raw: Any, now: datetime) -> Dict[str, Any]:
+        """Valida e normalizza una conversazione letta dal file"""
+        if not isinstance(raw, dict):
+            raise ConversationImportError("La riga deve contenere un oggetto JSON")
+        session_id = raw.get("session_id")
+        if not session_id or not isinstance(session_id, str):
+            raise ConversationImportError("Campo 'session_id' mancante o non valido")
+
+        messages = []
+        for i, m in enumerate(cls._object_list(raw, "messages", "Messaggio")):
+            role = m.get("role")
+            if role not in ("user", "assistant"):
+                raise ConversationImportError(f"Messaggio {i}: ruolo non valido '{role}'")
+            text_value = m.get("message", m.get("text"))
+            if text_value is None:
+                raise ConversationImportError(f"Messaggio {i}: testo mancante")
+            messages.append({
+                "role": role,
+                "message": str(text_value),
+                "timestamp": cls._parse_timestamp(m.get("timestamp"), now),
+                "lifecycle": cls._parse_lifecycle(m.get("lifecycle")),
+            })
+
+        events = []
+        for i, e in enumerate(cls._object_list(raw, "lifecycle_events", "Evento")):
+            new_lifecycle = cls._parse_lifecycle(e.get("new_lifecycle"))
+            if new_lifecycle is None:
+                raise ConversationImportError(f"Evento {i}: 'new_lifecycle' mancante")
+            trigger_index = e.get("trigger_message_index")
+            if trigger_index is not None and not (0 <= int(trigger_index) < len(messages)):
+                raise ConversationImportError(f"Evento {i}: trigger_message_index fuori range ({trigger_index})")
+            events.append({
+                "previous_lifecycle": cls._parse_lifecycle(e.get("previous_lifecycle")),
+                "new_lifecycle": new_lifecycle,
+                "trigger_message_index": int(trigger_index) if trigger_index is not None else None,
+                "confidence": cls._parse_confidence(e.get("confidence"), f"Evento {i}"),
+                "created_at": cls._parse_timestamp(e.get("created_at"), now),
+            })
+
+        # Lifecycle corrente: esplicito, altrimenti dall'ultimo evento o dall'ultimo messaggio
+        current = cls._parse_lifecycle(raw.get("current_lifecycle"))
+        if current is None and events:
+            current = max(events, key=lambda ev: ev["created_at"])["new_lifecycle"]
+        if current is None:
+            current = next((m["lifecycle"] for m in reversed(messages) if m["lifecycle"]), LifecycleStage.NUOVA_LEAD)
+
+        finished = raw.get("is_conversation_finished")
+        if finished is None:
+            # Stessa regola di UnifiedAgent._update_session_lifecycle
+            finished = current == LifecycleStage.LINK_INVIATO
+
+        user_info = raw.get("user_info")
+        if user_info is not None and not isinstance(user_info, str):
+            user_info = json.dumps(user_info, ensure_ascii=False)
+
+        timestamps = [m["timestamp"] for m in messages] + [e["created_at"] for e in events]
+        created_at = cls._parse_timestamp(raw.get("created_at"), min(timestamps) if timestamps else now)
+        updated_at = max(timestamps) if timestamps else created_at
+
+        return {
+            "session_id": session_id,
+            "current_lifecycle": current,
+            "is_conversation_finished": bool(finished),
+            "user_info": user_info,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "messages": messages,
+            "lifecycle_events": events,
+        }
+
+    @staticmethod
+    def _shift_conversation(conv: Dict[str, Any], offset: timedelta) -> None:
+        """Sposta tutti i timestamp di una conversazione (modalità replay)"""
+        conv["created_at"] += offset
+        conv["updated_at"] += offset
+        for m in conv["messages"]:
+            m["timestamp"] += offset
+        for e in conv["lifecycle_events"]:
+            e["created_at"] += offset
+
+    @staticmethod
+    def _uses_copy(db: AsyncSession) -> bool:
+        """COPY è disponibile solo su PostgreSQL con driver asyncpg"""
+        bind = db.get_bind()
+        return bind.dialect.name == "postgresql" and bind.dialect.driver == "asyncpg"
+
+    @staticmethod
+    async def _allocate_ids(db: AsyncSession, table: str, count: int) -> List[int]:
+        """Riserva `count` id dalla sequence della tabella (necessario per COPY)"""
+        result = await db.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            {"table": table, "count": count},
+        )
+        return [row[0] for row in result.fetchall()]
+
+    @staticmethod
+    async def _copy_records(db: AsyncSession, table: str, columns: List[str], records: List[Tuple]) -> None:
+        """Scrive i record con COPY usando la connessione asyncpg della sessione corrente"""
+        conn = await db.connection()
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(table, records=records, columns=columns)
+
+    @classmethod
+    async def _write_batch(cls, db: AsyncSession, conversations: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """Scrive un batch di conversazioni in un'unica transazione. Ritorna (messaggi, eventi)"""
+        use_copy = cls._uses_copy(db)
+
+        # Sessioni: insert multiplo con RETURNING per ottenere gli id interni
+        session_rows = [
+            {
+                "session_id": c["session_id"],
+                "current_lifecycle": c["current_lifecycle"],
+                "user_info": c["user_info"],
+                "is_conversation_finished": c["is_conversation_finished"],
+                "is_batch_waiting": False,
+                "created_at": c["created_at"],
+                "updated_at": c["updated_at"],
+            }
+            for c in conversations
+        ]
+        result = await db.execute(
+            insert(SessionModel.__table__).returning(
+                SessionModel.__table__.c.id, sort_by_parameter_order=True
+            ),
+            session_rows,
+        )
+        session_ids = [row[0] for row in result.fetchall()]
+
+        # Messaggi: gli id servono per ancorare gli eventi di lifecycle
+        flat_messages = [(sid, m) for sid, c in zip(session_ids, conversations) for m in c["messages"]]
+        message_ids: List[int] = []
+        if flat_messages:
+            if use_copy:
+                message_ids = await cls._allocate_ids(db, "messages", len(flat_messages))
+                await cls._copy_records(db, "messages", cls.MESSAGE_COLUMNS, [
+                    (mid, sid, m["role"], m["message"], m["timestamp"], m["lifecycle"].name if m["lifecycle"] else None)
+                    for mid, (sid, m) in zip(message_ids, flat_messages)
+                ])
+            else:
+                result = await db.execute(
+                    insert(MessageModel.__table__).returning(
+                        MessageModel.__table__.c.id, sort_by_parameter_order=True
+                    ),
+                    [
+                        {"session_id": sid, "role": m["role"], "message": m["message"],
+                         "timestamp": m["timestamp"], "lifecycle": m["lifecycle"]}
+                        for sid, m in flat_messages
+                    ],
+                )
+                message_ids = [row[0] for row in result.fetchall()]
+
+        # Eventi di lifecycle, con trigger_message_index risolto sull'id reale
+        event_rows = []
+        offset = 0
+        for sid, c in zip(session_ids, conversations):
+            conv_message_ids = message_ids[offset:offset + len(c["messages"])]
+            offset += len(c["messages"])
+            for e in c["lifecycle_events"]:
+                idx = e["trigger_message_index"]
+                event_rows.append({
+                    "session_id": sid,
+                    "previous_lifecycle": e["previous_lifecycle"],
+                    "new_lifecycle": e["new_lifecycle"],
+                    "trigger_message_id": conv_message_ids[idx] if idx is not None else None,
+                    "confidence": e["confidence"],
+                    "created_at": e["created_at"],
+                })
+
+        if event_rows:
+            if use_copy:
+                await cls._copy_records(db, "lifecycle_events", cls.EVENT_COLUMNS, [
+                    (r["session_id"],
+                     r["previous_lifecycle"].name if r["previous_lifecycle"] else None,
+                     r["new_lifecycle"].name,
+                     r["trigger_message_id"],
+                     r["confidence"],
+                     r["created_at"])
+                    for r in event_rows
+                ])
+            else:
+                await db.execute(insert(LifecycleEventModel.__table__), event_rows)
+
+        return len(flat_messages), len(event_rows)
+
+    @staticmethod
+    async def _iter_lines(source: Union[Iterable[str], AsyncIterable[str]]):
+        """Itera sulle righe sia da sorgenti sincrone (file) sia asincrone (body HTTP)"""
+        if hasattr(source, "__aiter__"):
+            async for line in source:
+                yield line
+        else:
+            for line in source:
+                yield line
+
+    @classmethod
+    async def import_ndjson(
+        cls,
+        lines: Union[Iterable[str], AsyncIterable[str]],
+        batch_size: Optional[int] = None,
+        on_conflict: str = "skip",
+        rebase_to: Optional[datetime] = None,
+        dry_run: bool = False,
+    ) -> Dict[str, Any]:
+        """Importa conversazioni da righe NDJSON
+
+        Args:
+            lines: righe NDJSON (file aperto, lista o iteratore asincrono)
+            batch_size: conversazioni per transazione (default da settings)
+            on_conflict: "skip" ignora le sessioni già presenti, "fail" le conta come errore
+            rebase_to: se valorizzato, sposta i timestamp di ogni conversazione in modo che
+                l'ultimo messaggio cada in quell'istante (replay di storie sintetiche)
+            dry_run: valida il file senza scrivere nulla
+
+        Returns:
+            Report con conteggi, errori per riga e throughput
+        """
+        batch_size = batch_size or settings.bulk_import_batch_size
+        now = datetime.now(timezone.utc)
+        started = time.perf_counter()
+
+        report: Dict[str, Any] = {
+            "sessions_imported": 0,
+            "sessions_skipped": 0,
+            "messages_imported": 0,
+            "lifecycle_events_imported": 0,
+            "errors": [],
+            "dry_run": dry_run,
+        }
+
+        async def flush(batch: List[Tuple[int, Dict[str, Any]]]) -> None:
+            # Deduplica dentro il batch e contro il database con una sola query
+            unique: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+            for line_no, conv in batch:
+                if conv["session_id"] in unique:
+                    report["errors"].append({"line": line_no, "error": f"session_id duplicato nel file: {conv['session_id']}"})
+                    continue
+                unique[conv["session_id"]] = (line_no, conv)
+
+            async for db in get_db():
+                try:
+                    result = await db.execute(
+                        select(SessionModel.session_id).where(SessionModel.session_id.in_(list(unique.keys())))
+                    )
+                    existing = set(result.scalars().all())
+                    to_write = []
+                    for sid, (line_no, conv) in unique.items():
+                        if sid in existing:
+                            if on_conflict == "fail":
+                                report["errors"].append({"line": line_no, "error": f"Sessione già esistente: {sid}"})
+                            else:
+                                report["sessions_skipped"] += 1
+                            continue
+                        to_write.append(conv)
+
+                    if not to_write or dry_run:
+                        report["sessions_imported"] += len(to_write) if dry_run else 0
+                        return
+
+                    n_messages, n_events = await cls._write_batch(db, to_write)
+                    await db.commit()
+                    report["sessions_imported"] += len(to_write)
+                    report["messages_imported"] += n_messages
+                    report["lifecycle_events_imported"] += n_events
+                except Exception as e:
+                    await db.rollback()
+                    first_line = batch[0][0] if batch else None
+                    logger.error(f"Errore nell'import del batch a partire dalla riga {first_line}: {e}")
+                    report["errors"].append({"line": first_line, "error": f"Batch fallito: {str(e)}"})
+
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+        line_no = 0
+        async for line in cls._iter_lines(lines):
+            line_no += 1
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                conv = cls._parse_conversation(json.loads(line), now)
+                if rebase_to is not None:
+                    cls._shift_conversation(conv, rebase_to - conv["updated_at"])
+                batch.append((line_no, conv))
+            except (json.JSONDecodeError, ConversationImportError, TypeError, ValueError) as e:
+                report["errors"].append({"line": line_no, "error": str(e)})
+                continue
+
+            if len(batch) >= batch_size:
+                await flush(batch)
+                batch = []
+
+        if batch:
+            await flush(batch)
+
+        elapsed = time.perf_counter() - started
+        report["elapsed_seconds"] = round(elapsed, 3)
+        report["messages_per_second"] = round(report["messages_imported"] / elapsed, 1) if elapsed > 0 else None
+        logger.info(
+            f"Import NDJSON completato: {report['sessions_imported']} sessioni, "
+            f"{report['messages_imported']} messaggi, {len(report['errors'])} errori in {elapsed:.2f}s"
+        )
+        return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Importa conversazioni da un file NDJSON")
+    parser.add_argument("path", help="File NDJSON da importare")
+    parser.add_argument("--batch-size", type=int, default=None, help="Conversazioni per transazione")
+    parser.add_argument("--on-conflict", choices=["skip", "fail"], default="skip")
+    parser.add_argument("--rebase-to-now", action="store_true", help="Sposta i timestamp in modo che ogni conversazione termini ora")
+    parser.add_argument("--dry-run", action="store_true", help="Valida il file senza scrivere")
+    args = parser.parse_args()
+
+    async def _main() -> None:
+        with open(args.path, encoding="utf-8") as fh:
+            report = await BulkImportService.import_ndjson(
+                fh,
+                batch_size=args.batch_size,
+                on_conflict=args.on_conflict,
+                rebase_to=datetime.now(timezone.utc) if args.rebase_to_now else None,
+                dry_run=args.dry_run,
+            )
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    asyncio.run(_main())
@@ -0,0 +1,160 @@
+"""
+Bus in-process degli eventi di chat, consegnati ai client WebSocket di /ws/chat/{session_id}
+
+Ogni connessione ha una coda limitata: un client troppo lento non blocca chi pubblica,
+la sua coda viene svuotata e riceve un evento "resync" per recuperare dal cursore.
+
+Gli eventi vengono pubblicati dal processo che ha ricevuto la richiesta (HTTP o
+WebSocket): con più istanze, i client della stessa sessione devono raggiungere la stessa
+istanza (sticky session) oppure recuperare con il resume dal cursore.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Union
+
+from loguru import logger
+
+from app.config import settings
+from app.services.metrics import metrics
+
+Event = Dict[str, Any]
+
+
+class ChatEventHub:
+    """Sottoscrittori per session_id esterno e pubblicazione degli eventi di un turno"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # Ultima consegna accodata per sessione: la successiva parte quando questa è finita
+        self._deliveries: Dict[str, asyncio.Task] = {}
+
+    @property
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def has_subscribers(self, session_id: str) -> bool:
+        return session_id in self._subscribers
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(session_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[session_id]
+
+    def publish(self, session_id: str, event: Event) -> int:
+        """Accoda l'evento per tutte le connessioni della sessione; ritorna quante lo ricevono"""
+        queues = self._subscribers.get(session_id)
+        if not queues:
+            return 0
+        event = {"session_id": session_id, "ts": time.time(), **event}
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Client troppo lento: scarta gli eventi in coda e chiedi di risincronizzarsi
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync", "session_id": session_id, "ts": time.time()})
+                metrics.increment("chat_events_overflow_total")
+        metrics.increment("chat_events_published_total", value=len(queues), type=event.get("type"))
+        return len(queues)
+
+    def _chain(self, session_id: str, deliver: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        """Esegue la consegna dopo quelle già in corso per la sessione
+
+        Le parti di un turno escono scandite dai delay_ms: senza la catena, un turno
+        successivo inizierebbe a pubblicare mentre il precedente è ancora in pausa.
+        """
+        previous = self._deliveries.get(session_id)
+
+        async def run() -> None:
+            if previous is not None:
+                await asyncio.wait([previous])
+            try:
+                await deliver()
+            except Exception as e:
+                logger.warning(f"Errore nella consegna degli eventi per sessione {session_id}: {e}")
+
+        task = asyncio.create_task(run())
+        self._deliveries[session_id] = task
+        self._tasks.add(task)
+
+        def done(finished: asyncio.Task) -> None:
+            self._tasks.discard(finished)
+            if self._deliveries.get(session_id) is finished:
+                del self._deliveries[session_id]
+
+        task.add_done_callback(done)
+        return task
+
+    async def _release_parts(self, session_id: str, messages: Union[str, List[Dict[str, Any]]]) -> None:
+        """Pubblica le parti di una risposta rispettando i delay_ms (la parte i dopo la somma dei precedenti)"""
+        if isinstance(messages, str):
+            messages = [{"text": messages, "delay_ms": 0}]
+        for index, part in enumerate(messages):
+            if index > 0:
+                await asyncio.sleep(int(messages[index - 1].get("delay_ms") or 0) / 1000)
+            self.publish(session_id, {
+                "type": "message",
+                "role": "assistant",
+                "id": part.get("id"),
+                "part_index": index,
+                "parts": len(messages),
+                "text": part.get("text", ""),
+            })
+
+    def publish_parts(self, session_id: str, messages: Union[str, List[Dict[str, Any]]]) -> Optional[asyncio.Task]:
+        """Accoda le parti di una risposta dopo quelle dei turni precedenti della sessione"""
+        if not self.has_subscribers(session_id) or not messages:
+            return None
+        return self._chain(session_id, lambda: self._release_parts(session_id, messages))
+
+    def publish_turn(self, session_id: str, response) -> Optional[asyncio.Task]:
+        """Eventi di un turno completato: parti della risposta, cambio di lifecycle, human task
+
+        Gli eventi seguono l'ultima parte e i turni precedenti della sessione; il task
+        restituito termina quando sono stati tutti pubblicati (None senza sottoscrittori).
+        """
+        if not self.has_subscribers(session_id):
+            return None
+
+        async def deliver() -> None:
+            # Con la consegna lato server le parti passano dall'outbound scheduler (sink "ws")
+            if response.delivery != "server" and response.messages:
+                await self._release_parts(session_id, response.messages)
+            if response.lifecycle_changed:
+                self.publish(session_id, {
+                    "type": "lifecycle",
+                    "previous_lifecycle": response.previous_lifecycle,
+                    "current_lifecycle": response.current_lifecycle,
+                    "reasoning": response.ai_reasoning,
+                    "confidence": response.confidence,
+                })
+            if response.requires_human:
+                self.publish(session_id, {"type": "human_task", "task": response.human_task})
+            if response.is_conversation_finished:
+                self.publish(session_id, {"type": "conversation_finished"})
+
+        return self._chain(session_id, deliver)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Bus globale degli eventi di chat
+chat_events = ChatEventHub(queue_size=settings.ws_send_queue_size)
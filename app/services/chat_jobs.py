@@ -0,0 +1,425 @@
+"""
+Coda durevole dei turni di chat (tabella chat_jobs) e pool di worker asincroni
+
+In modalità "queue" /chat registra un job e ne attende il risultato; i worker (nello
+stesso processo o in un deployment separato) lo reclamano con SELECT ... FOR UPDATE
+SKIP LOCKED, eseguono la pipeline dell'UnifiedAgent e salvano la ChatResponse.
+
+- Visibility timeout: un job in esecuzione ha un lease (locked_until) rinnovato da un
+  heartbeat; se il worker muore il lease scade e un altro worker riprende il job.
+- Retry con backoff esponenziale fino a chat_job_max_attempts, poi dead-letter
+  (status "dead"), rimettibile in coda a mano.
+- Un job ripreso dopo un'interruzione non duplica il messaggio utente (resume).
+- Il reaper sblocca le sessioni rimaste con is_batch_waiting dopo un riavvio.
+- Job "deferred_reply": risposte AI differite dei turni serviti in modalità degradata
+  (circuito dell'AI aperto), eseguite anche in modalità inline.
+
+Su SQLite SKIP LOCKED non esiste: il claim usa comunque un UPDATE condizionale, quindi
+più worker nello stesso processo non eseguono mai lo stesso job.
+
+Avvio di un pool standalone: python -m app.services.chat_jobs
+"""
+import asyncio
+import json as json_lib
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from loguru import logger
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import get_db
+from app.models.api_models import ChatMessage, ChatResponse
+from app.models.database_models import ChatJobModel, SessionModel
+from app.services.metrics import metrics
+from app.services.session_cache import session_cache
+
+FINAL_STATUSES = ("done", "dead")
+
+
+def _claimable(now: datetime):
+    """Job in attesa già disponibili, o in esecuzione con lease scaduto"""
+    return or_(
+        and_(ChatJobModel.status == "pending", ChatJobModel.available_at <= now),
+        and_(ChatJobModel.status == "running", ChatJobModel.locked_until < now),
+    )
+
+
+class ChatJobQueue:
+    """Operazioni sulla tabella chat_jobs"""
+
+    def __init__(self):
+        # Job completati in questo processo: svegliano subito chi li attende
+        self._events: Dict[int, asyncio.Event] = {}
+        self.wakeup = asyncio.Event()
+
+    async def enqueue(self, chat_message: ChatMessage, client_message_id: Optional[str] = None) -> ChatJobModel:
+        """Registra un turno; con la stessa chiave di idempotenza restituisce il job esistente"""
+        key = client_message_id or f"job-{uuid.uuid4().hex}"
+        payload = json_lib.dumps(chat_message.model_dump(exclude={"idempotency_key", "client_message_id"}))
+
+        async for db in get_db():
+            existing = await self._find(db, chat_message.session_id, key)
+            if existing is not None:
+                return existing
+
+            job = ChatJobModel(
+                session_id=chat_message.session_id,
+                client_message_id=key,
+                payload=payload,
+                status="pending",
+                attempts=0,
+                max_attempts=settings.chat_job_max_attempts,
+                available_at=datetime.now(timezone.utc),
+            )
+            db.add(job)
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Stessa chiave registrata in parallelo da un'altra richiesta
+                await db.rollback()
+                return await self._find(db, chat_message.session_id, key)
+
+            await db.refresh(job)
+            metrics.increment("chat_jobs_total", event="enqueued")
+            self.wakeup.set()
+            return job
+
+    async def enqueue_deferred_reply(self, session_id: str, after_message_id: int, model_name: Optional[str], delay_seconds: float) -> ChatJobModel:
+        """Registra la risposta AI differita di un turno servito in modalità degradata
+
+        Un job per messaggio di riferimento: altri messaggi arrivati mentre il circuito è
+        aperto confluiscono nello stesso turno differito.
+        """
+        key = f"deferred-reply-{after_message_id}"
+        payload = json_lib.dumps({"session_id": session_id, "after_message_id": after_message_id, "model_name": model_name})
+
+        async for db in get_db():
+            existing = await self._find(db, session_id, key)
+            if existing is not None:
+                return existing
+
+            job = ChatJobModel(
+                session_id=session_id,
+                client_message_id=key,
+                kind="deferred_reply",
+                payload=payload,
+                status="pending",
+                attempts=0,
+                max_attempts=settings.chat_job_max_attempts,
+                available_at=datetime.now(timezone.utc) + timedelta(seconds=delay_seconds),
+            )
+            db.add(job)
+            try:
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()
+                return await self._find(db, session_id, key)
+
+            await db.refresh(job)
+            metrics.increment("chat_jobs_total", event="deferred")
+            return job
+
+    @staticmethod
+    async def _find(db, session_id: str, key: str) -> Optional[ChatJobModel]:
+        result = await db.execute(
+            select(ChatJobModel).where(
+                ChatJobModel.session_id == session_id,
+                ChatJobModel.client_message_id == key,
+            )
+        )
+        return result.scalar_one_or_none()
+
+    async def claim(self, worker_id: str) -> Optional[ChatJobModel]:
+        """Reclama il prossimo job disponibile (None se la coda è vuota)"""
+        async for db in get_db():
+            now = datetime.now(timezone.utc)
+            result = await db.execute(
+                select(ChatJobModel.id)
+                .where(_claimable(now))
+                .order_by(ChatJobModel.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            job_id = result.scalar_one_or_none()
+            if job_id is None:
+                await db.commit()
+                return None
+
+            claimed = await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job_id, _claimable(now))
+                .values(
+                    status="running",
+                    attempts=ChatJobModel.attempts + 1,
+                    locked_until=now + timedelta(seconds=settings.chat_job_visibility_timeout_seconds),
+                    locked_by=worker_id,
+                )
+            )
+            await db.commit()
+            if claimed.rowcount != 1:
+                # Reclamato da un altro worker tra la SELECT e l'UPDATE
+                return None
+            return await db.get(ChatJobModel, job_id, populate_existing=True)
+
+    async def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """Rinnova il lease; False se il job non appartiene più a questo worker"""
+        async for db in get_db():
+            result = await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job_id, ChatJobModel.locked_by == worker_id, ChatJobModel.status == "running")
+                .values(locked_until=datetime.now(timezone.utc) + timedelta(seconds=settings.chat_job_visibility_timeout_seconds))
+            )
+            await db.commit()
+            return result.rowcount == 1
+
+    async def complete(self, job_id: int, worker_id: str, response: ChatResponse) -> None:
+        async for db in get_db():
+            result = await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job_id, ChatJobModel.locked_by == worker_id)
+                .values(
+                    status="done",
+                    result=response.model_dump_json(),
+                    locked_until=None,
+                    completed_at=datetime.now(timezone.utc),
+                )
+            )
+            await db.commit()
+            if result.rowcount != 1:
+                logger.warning(f"Chat job {job_id}: lease perso prima del completamento")
+        metrics.increment("chat_jobs_total", event="done")
+        self._notify(job_id)
+
+    async def fail(self, job: ChatJobModel, worker_id: str, error: Exception) -> None:
+        """Rimette in coda con backoff, o sposta in dead-letter se i tentativi sono esauriti"""
+        dead = job.attempts >= job.max_attempts
+        backoff = min(2 ** job.attempts, 60)
+        async for db in get_db():
+            await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job.id, ChatJobModel.locked_by == worker_id)
+                .values(
+                    status="dead" if dead else "pending",
+                    last_error=str(error)[:2000],
+                    locked_until=None,
+                    locked_by=None,
+                    available_at=datetime.now(timezone.utc) + timedelta(seconds=backoff),
+                    completed_at=datetime.now(timezone.utc) if dead else None,
+                )
+            )
+            await db.commit()
+        metrics.increment("chat_jobs_total", event="dead" if dead else "retried")
+        if dead:
+            logger.error(f"Chat job {job.id} in dead-letter dopo {job.attempts} tentativi: {error}")
+            self._notify(job.id)
+        else:
+            logger.warning(f"Chat job {job.id} fallito (tentativo {job.attempts}), nuovo tentativo tra {backoff}s: {error}")
+
+    async def postpone(self, job: ChatJobModel, worker_id: str, delay_seconds: float, reason: str) -> None:
+        """Rimette in coda senza consumare un tentativo (es. AI non disponibile)"""
+        async for db in get_db():
+            await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job.id, ChatJobModel.locked_by == worker_id)
+                .values(
+                    status="pending",
+                    attempts=ChatJobModel.attempts - 1,
+                    last_error=reason[:2000],
+                    locked_until=None,
+                    locked_by=None,
+                    available_at=datetime.now(timezone.utc) + timedelta(seconds=delay_seconds),
+                )
+            )
+            await db.commit()
+        metrics.increment("chat_jobs_total", event="postponed")
+
+    async def get(self, job_id: int) -> Optional[ChatJobModel]:
+        async for db in get_db():
+            return await db.get(ChatJobModel, job_id, populate_existing=True)
+
+    async def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[ChatJobModel]:
+        async for db in get_db():
+            query = select(ChatJobModel).order_by(ChatJobModel.id.desc()).limit(limit)
+            if status:
+                query = query.where(ChatJobModel.status == status)
+            result = await db.execute(query)
+            return result.scalars().all()
+
+    async def retry(self, job_id: int) -> bool:
+        """Rimette in coda un job in dead-letter azzerando i tentativi"""
+        async for db in get_db():
+            result = await db.execute(
+                update(ChatJobModel)
+                .where(ChatJobModel.id == job_id, ChatJobModel.status == "dead")
+                .values(status="pending", attempts=0, available_at=datetime.now(timezone.utc), completed_at=None)
+            )
+            await db.commit()
+            if result.rowcount == 1:
+                self.wakeup.set()
+                return True
+            return False
+
+    def _notify(self, job_id: int) -> None:
+        event = self._events.get(job_id)
+        if event is not None:
+            event.set()
+
+    async def wait_for(self, job_id: int, timeout: float) -> Optional[ChatJobModel]:
+        """Attende che il job sia concluso (o il timeout) e ne restituisce lo stato"""
+        event = self._events.setdefault(job_id, asyncio.Event())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                job = await self.get(job_id)
+                remaining = deadline - loop.time()
+                if job is None or job.status in FINAL_STATUSES or remaining <= 0:
+                    return job
+                # Sveglia immediata se il job gira in questo processo, altrimenti polling
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, settings.chat_job_poll_interval_seconds))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._events.pop(job_id, None)
+
+    async def reap_stale_batches(self) -> int:
+        """Sblocca le sessioni rimaste in attesa di batch (es. dopo un riavvio del pod)"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.batch_flag_stale_seconds)
+        async for db in get_db():
+            result = await db.execute(
+                select(SessionModel.id, SessionModel.session_id).where(
+                    SessionModel.is_batch_waiting == True,
+                    SessionModel.batch_started_at < cutoff,
+                )
+            )
+            stale = result.all()
+            if not stale:
+                return 0
+            await db.execute(
+                update(SessionModel)
+                .where(SessionModel.id.in_([row.id for row in stale]), SessionModel.is_batch_waiting == True)
+                .values(is_batch_waiting=False, batch_started_at=None)
+            )
+            await db.commit()
+            for row in stale:
+                session_cache.invalidate(row.session_id)
+            logger.warning(f"Sbloccate {len(stale)} sessioni con batch in attesa da oltre {settings.batch_flag_stale_seconds}s")
+            return len(stale)
+
+
+class ChatWorkerPool:
+    """Worker asincroni che eseguono i chat job, più il reaper dei batch bloccati"""
+
+    def __init__(self, queue: ChatJobQueue, concurrency: int):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._tasks: List[asyncio.Task] = []
+
+    async def _run_job(self, job: ChatJobModel, worker_id: str) -> None:
+        # Import ritardato: evita il ciclo chat_service -> unified_agent all'import del modulo
+        from app.services.chat_service import run_chat_turn, run_deferred_reply
+        from app.services.unified_agent import AIUnavailableError
+
+        async def keep_lease():
+            while True:
+                await asyncio.sleep(settings.chat_job_visibility_timeout_seconds / 3)
+                if not await self.queue.heartbeat(job.id, worker_id):
+                    return
+
+        heartbeat = asyncio.create_task(keep_lease())
+        try:
+            if job.kind == "deferred_reply":
+                response = await run_deferred_reply(**json_lib.loads(job.payload))
+            else:
+                chat_message = ChatMessage(**json_lib.loads(job.payload))
+                response = await run_chat_turn(chat_message, job.client_message_id, resume=job.attempts > 1)
+            await self.queue.complete(job.id, worker_id, response)
+        except AIUnavailableError as e:
+            # Circuito ancora aperto: si riprova quando accetterà chiamate di prova
+            await self.queue.postpone(job, worker_id, e.retry_after + settings.ai_deferred_reply_margin_seconds, str(e))
+        except Exception as e:
+            await self.queue.fail(job, worker_id, e)
+        finally:
+            heartbeat.cancel()
+
+    async def _worker(self, index: int) -> None:
+        worker_id = f"{self.worker_prefix}:{index}"
+        while True:
+            try:
+                job = await self.queue.claim(worker_id)
+            except Exception as e:
+                logger.warning(f"Errore nel claim dei chat job: {e}")
+                job = None
+
+            if job is None:
+                # Coda vuota: attende un enqueue locale o il prossimo polling
+                self.queue.wakeup.clear()
+                # asyncio.wait non assorbe una cancellazione concomitante al risveglio (stop())
+                waiter = asyncio.ensure_future(self.queue.wakeup.wait())
+                try:
+                    await asyncio.wait([waiter], timeout=settings.chat_job_poll_interval_seconds)
+                finally:
+                    waiter.cancel()
+                continue
+
+            if job.attempts > job.max_attempts:
+                # Lease scaduto troppe volte (worker morti durante il turno)
+                await self.queue.fail(job, worker_id, RuntimeError("Tentativi esauriti dopo lease scaduti"))
+                continue
+
+            await self._run_job(job, worker_id)
+
+    async def _reaper(self) -> None:
+        while True:
+            try:
+                await self.queue.reap_stale_batches()
+            except Exception as e:
+                logger.warning(f"Errore nel reaper dei batch: {e}")
+            await asyncio.sleep(60)
+
+    async def start(self, run_workers: bool = True) -> None:
+        """Avvia il reaper e, se richiesto, i worker"""
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._reaper()))
+        if run_workers:
+            for index in range(self.concurrency):
+                self._tasks.append(asyncio.create_task(self._worker(index)))
+            logger.info(f"Pool di chat worker avviato ({self.concurrency} worker)")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+# Istanze globali di coda e pool
+chat_job_queue = ChatJobQueue()
+chat_worker_pool = ChatWorkerPool(chat_job_queue, concurrency=settings.chat_worker_concurrency)
+
+
+async def _run_standalone() -> None:
+    """Pool di worker senza API (deployment dedicato alla capacità AI)"""
+    from app.services.unified_agent import unified_agent
+
+    await unified_agent.warm_up()
+    await chat_worker_pool.start(run_workers=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await chat_worker_pool.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_run_standalone())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,176 @@
+"""
+Esecuzione di un turno di chat, condivisa da /chat, /ws/chat e dai worker dei chat job
+"""
+import json as json_lib
+import time
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.database import get_db
+from app.models.api_models import ChatMessage, ChatResponse
+from app.models.database_models import MessageModel, SessionModel
+from app.services.chat_events import chat_events
+from app.services.chat_jobs import chat_job_queue
+from app.services.idempotency import chat_idempotency
+from app.services.metrics import metrics
+from app.services.outbound_scheduler import outbound_scheduler
+from app.services.session_cache import session_cache
+from app.services.unified_agent import ChatbotError, unified_agent
+
+
+class ChatTurnPending(Exception):
+    """In modalità queue il job non si è concluso entro l'attesa: il client lo segue per id"""
+
+    def __init__(self, job):
+        super().__init__(f"Chat job {job.id} ancora in corso ({job.status})")
+        self.job = job
+
+
+def client_message_key(chat_message: ChatMessage, header_key: Optional[str] = None) -> Optional[str]:
+    """Chiave di idempotenza del messaggio: campo del body o header Idempotency-Key"""
+    return chat_message.idempotency_key or chat_message.client_message_id or header_key
+
+
+async def run_chat_turn(chat_message: ChatMessage, client_message_id: Optional[str] = None, resume: bool = False) -> ChatResponse:
+    """Esegue un turno completo con l'agente unificato e costruisce la ChatResponse"""
+    # Verifica se la conversazione è finita (dalla cache delle sessioni quando possibile)
+    session = session_cache.get(chat_message.session_id)
+    if session is None:
+        async for db in get_db():
+            result = await db.execute(
+                select(SessionModel).where(SessionModel.session_id == chat_message.session_id)
+            )
+            session_row = result.scalar_one_or_none()
+            if session_row:
+                session = session_cache.store(session_row)
+
+    if session and session.is_conversation_finished:
+        logger.warning(f"Tentativo di invio messaggio a conversazione finita per sessione {chat_message.session_id}")
+        # Restituisci una risposta che indica che la conversazione è finita senza messaggi
+        return ChatResponse(
+            messages=[],  # Lista vuota per indicare che non ci sono messaggi da mostrare
+            session_id=chat_message.session_id,
+            current_lifecycle=session.current_lifecycle.value,
+            lifecycle_changed=False,
+            previous_lifecycle=None,
+            ai_reasoning="Conversazione terminata",
+            confidence=1.0,
+            timestamp=str(int(time.time())),
+            is_conversation_finished=True
+        )
+
+    # Usa l'agente unificato
+    lifecycle_response = await unified_agent.chat(
+        session_id=chat_message.session_id,
+        user_message=chat_message.message,
+        model_name=chat_message.model_name,
+        batch_wait_seconds=chat_message.batch_wait_seconds,
+        client_message_id=client_message_id,
+        resume=resume
+    )
+
+    if lifecycle_response.replayed_response is not None:
+        # Retry arrivato dopo il TTL della cache di idempotenza o su un altro worker
+        metrics.increment("chat_idempotency_total", result="replayed")
+        return ChatResponse(**lifecycle_response.replayed_response)
+
+    # Estrai il testo per il logging
+    if isinstance(lifecycle_response.messages, str):
+        log_text = lifecycle_response.messages
+    else:
+        log_text = " ".join([msg.get("text", "") for msg in lifecycle_response.messages])
+
+    logger.info(f"Risposta agente unificato per sessione {chat_message.session_id}: {log_text[:100]}...")
+
+    delivery = chat_message.delivery or settings.outbound_delivery_mode
+    if delivery == "server" and lifecycle_response.messages:
+        # Le parti escono dallo scheduler ai rispettivi orari; il client non deve scandirle
+        await outbound_scheduler.schedule(chat_message.session_id, lifecycle_response.messages)
+
+    response = _build_chat_response(chat_message.session_id, lifecycle_response, delivery)
+    if client_message_id and not lifecycle_response.is_duplicate:
+        await _store_turn_response(chat_message.session_id, client_message_id, response)
+    return response
+
+
+async def _store_turn_response(session_id: str, client_message_id: str, response: ChatResponse) -> None:
+    """Salva la risposta sul messaggio utente del turno, per i retry con la stessa chiave
+
+    Un turno ripreso dopo un crash non sovrascrive una risposta già salvata. Un errore qui non fa fallire il turno: il retry riceverebbe solo una risposta vuota.
+    """
+    try:
+        async for db in get_db():
+            internal_id = select(SessionModel.id).where(SessionModel.session_id == session_id).scalar_subquery()
+            await db.execute(
+                update(MessageModel)
+                .where(
+                    MessageModel.session_id == internal_id,
+                    MessageModel.client_message_id == client_message_id,
+                    MessageModel.response_json.is_(None),
+                )
+                .values(response_json=response.model_dump_json())
+            )
+            await db.commit()
+    except Exception as e:
+        logger.warning(f"Risposta del messaggio {client_message_id} non salvata per sessione {session_id}: {e}")
+
+
+def _build_chat_response(session_id: str, lifecycle_response, delivery: str) -> ChatResponse:
+    return ChatResponse(
+        messages=lifecycle_response.messages,
+        session_id=session_id,
+        current_lifecycle=lifecycle_response.current_lifecycle.value,
+        lifecycle_changed=lifecycle_response.lifecycle_changed,
+        previous_lifecycle=lifecycle_response.previous_lifecycle.value if lifecycle_response.previous_lifecycle else None,
+        # next_actions removed - no longer part of API
+        ai_reasoning=lifecycle_response.ai_reasoning,
+        confidence=lifecycle_response.confidence,
+        timestamp=str(int(time.time())),
+        is_conversation_finished=lifecycle_response.is_conversation_finished,
+        requires_human=lifecycle_response.requires_human,
+        human_task=lifecycle_response.human_task,
+        delivery=delivery
+    )
+
+
+async def run_deferred_reply(session_id: str, after_message_id: int, model_name: Optional[str] = None) -> ChatResponse:
+    """Risposta AI differita di un turno servito in modalità degradata (job "deferred_reply")
+
+    Non c'è una richiesta in attesa: la risposta arriva ai client via WebSocket, consegna
+    lato server (se configurata) o sync della cronologia.
+    """
+    lifecycle_response = await unified_agent.reply_deferred(session_id, after_message_id, model_name)
+    delivery = settings.outbound_delivery_mode
+    if delivery == "server" and lifecycle_response.messages:
+        await outbound_scheduler.schedule(session_id, lifecycle_response.messages)
+
+    response = _build_chat_response(session_id, lifecycle_response, delivery)
+    chat_events.publish_turn(session_id, response)
+    return response
+
+
+async def execute_chat_turn(chat_message: ChatMessage, client_message_id: Optional[str] = None, wait_seconds: Optional[float] = None) -> ChatResponse:
+    """Esegue il turno secondo chat_execution_mode
+
+    inline: nella richiesta, con idempotenza per chiave; queue: tramite chat_jobs,
+    attendendo al massimo `wait_seconds` (ChatTurnPending se il job è ancora in corso).
+    """
+    if settings.chat_execution_mode == "queue":
+        # Turno durevole: registrato in chat_jobs ed eseguito dai worker
+        job = await chat_job_queue.enqueue(chat_message, client_message_id)
+        job = await chat_job_queue.wait_for(job.id, wait_seconds if wait_seconds is not None else settings.chat_job_wait_seconds)
+        if job.status == "done":
+            return ChatResponse(**json_lib.loads(job.result))
+        if job.status == "dead":
+            raise ChatbotError(f"Turno non completato dopo {job.attempts} tentativi: {job.last_error}")
+        raise ChatTurnPending(job)
+
+    async def run_turn() -> ChatResponse:
+        return await run_chat_turn(chat_message, client_message_id)
+
+    if client_message_id:
+        return await chat_idempotency.run(chat_message.session_id, client_message_id, run_turn)
+    return await run_turn()
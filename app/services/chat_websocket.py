@@ -0,0 +1,187 @@
+"""
+Connessione WebSocket di chat (/ws/chat/{session_id})
+
+Protocollo (JSON):
+- client -> server: {"type": "message", "text": ..., "client_message_id": ..., "model_name": ...,
+  "batch_wait_seconds": ...}, {"type": "ping"}, {"type": "pong"}
+- server -> client: "ack" (subito, alla ricezione), "typing", "queued" (messaggio aggregato
+  nel turno di un'altra richiesta), "message" (parti della risposta, ai rispettivi delay_ms),
+  "lifecycle", "human_task", "turn_complete", "error", "ping"/"pong", "resync"
+
+Resume: alla riconnessione il client passa `?after_id=<ultimo id messaggio visto>` e riceve
+prima i messaggi successivi dal database (replay), poi gli eventi live.
+
+Ogni connessione usa due task (lettura e scrittura) e una coda limitata: migliaia di
+connessioni inattive costano solo un heartbeat ogni ws_heartbeat_interval_seconds.
+"""
+import asyncio
+import time
+import uuid
+from typing import Any, Dict, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from loguru import logger
+from pydantic import ValidationError
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import get_db
+from app.models.api_models import ChatMessage
+from app.models.database_models import MessageModel, SessionModel
+from app.services.chat_events import chat_events
+from app.services.chat_service import ChatTurnPending, execute_chat_turn
+from app.services.metrics import metrics
+from app.services.session_lock import SessionLockTimeout
+
+SPLIT_SEPARATOR = "\n---SPLIT---\n"
+
+
+class ChatSocket:
+    """Una connessione WebSocket legata a una sessione"""
+
+    def __init__(self, websocket: WebSocket, session_id: str):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.queue: Optional[asyncio.Queue] = None
+        self.last_seen = time.monotonic()
+        self._turns: Set[asyncio.Task] = set()
+
+    def _send(self, event: Dict[str, Any]) -> None:
+        """Accoda un evento solo per questa connessione (ack, errori, pong)"""
+        event = {"session_id": self.session_id, "ts": time.time(), **event}
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            metrics.increment("chat_events_overflow_total")
+
+    async def _replay(self, after_id: int) -> None:
+        """Invia i messaggi salvati dopo il cursore del client"""
+        async for db in get_db():
+            result = await db.execute(
+                select(MessageModel)
+                .join(SessionModel, SessionModel.id == MessageModel.session_id)
+                .where(SessionModel.session_id == self.session_id, MessageModel.id > after_id)
+                .order_by(MessageModel.timestamp.asc(), MessageModel.id.asc())
+            )
+            messages = result.scalars().all()
+
+        for msg in messages:
+            parts = msg.message.split(SPLIT_SEPARATOR) if msg.role == "assistant" else [msg.message]
+            for index, text in enumerate(parts):
+                await self.websocket.send_json({
+                    "type": "message",
+                    "session_id": self.session_id,
+                    "role": msg.role,
+                    "id": msg.id,
+                    "part_index": index,
+                    "parts": len(parts),
+                    "text": text,
+                    "timestamp": msg.timestamp.isoformat(),
+                    "replay": True,
+                })
+
+    async def _writer(self) -> None:
+        """Unico task che scrive sul socket: eventi in coda e heartbeat"""
+        while True:
+            try:
+                event = await asyncio.wait_for(self.queue.get(), timeout=settings.ws_heartbeat_interval_seconds)
+            except asyncio.TimeoutError:
+                if time.monotonic() - self.last_seen > settings.ws_idle_timeout_seconds:
+                    await self.websocket.close(code=1001)
+                    return
+                event = {"type": "ping", "ts": time.time()}
+            await self.websocket.send_json(event)
+
+    async def _run_turn(self, chat_message: ChatMessage, client_message_id: str) -> None:
+        chat_events.publish(self.session_id, {"type": "typing", "client_message_id": client_message_id})
+        try:
+            while True:
+                try:
+                    response = await execute_chat_turn(chat_message, client_message_id)
+                    break
+                except ChatTurnPending as pending:
+                    # Modalità queue: il job è ancora in coda o in esecuzione, si continua ad attendere
+                    self._send({"type": "queued", "client_message_id": client_message_id, "job_id": pending.job.id})
+        except SessionLockTimeout as e:
+            self._send({"type": "error", "client_message_id": client_message_id, "status": 409, "detail": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"Errore nel turno WebSocket per sessione {self.session_id}: {e}")
+            self._send({"type": "error", "client_message_id": client_message_id, "status": 500, "detail": str(e)})
+            return
+
+        if not response.messages and not response.is_conversation_finished and not response.requires_human:
+            # Messaggio aggregato nel turno di un'altra richiesta (batch): la risposta arriverà da lì
+            self._send({"type": "queued", "client_message_id": client_message_id})
+        delivery = chat_events.publish_turn(self.session_id, response)
+        if delivery is not None:
+            # turn_complete dopo l'ultima parte del turno (e dei turni precedenti)
+            await asyncio.wait([delivery])
+        self._send({
+            "type": "turn_complete",
+            "client_message_id": client_message_id,
+            "current_lifecycle": response.current_lifecycle,
+            "lifecycle_changed": response.lifecycle_changed,
+            "is_conversation_finished": response.is_conversation_finished,
+            "requires_human": response.requires_human,
+        })
+
+    def _handle(self, data: Any) -> None:
+        if not isinstance(data, dict):
+            self._send({"type": "error", "status": 400, "detail": "Messaggio non valido"})
+            return
+
+        kind = data.get("type")
+        if kind == "ping":
+            self._send({"type": "pong"})
+            return
+        if kind == "pong":
+            return
+        if kind != "message":
+            self._send({"type": "error", "status": 400, "detail": f"Tipo di messaggio sconosciuto: {kind}"})
+            return
+
+        client_message_id = data.get("client_message_id") or f"ws-{uuid.uuid4().hex}"
+        try:
+            chat_message = ChatMessage(
+                message=data.get("text") or "",
+                session_id=self.session_id,
+                model_name=data.get("model_name"),
+                batch_wait_seconds=data.get("batch_wait_seconds"),
+                client_message_id=client_message_id,
+            )
+        except ValidationError as e:
+            self._send({"type": "error", "client_message_id": client_message_id, "status": 422, "detail": str(e)})
+            return
+        if not chat_message.message.strip():
+            self._send({"type": "error", "client_message_id": client_message_id, "status": 422, "detail": "Messaggio vuoto"})
+            return
+
+        self._send({"type": "ack", "client_message_id": client_message_id})
+        task = asyncio.create_task(self._run_turn(chat_message, client_message_id))
+        self._turns.add(task)
+        task.add_done_callback(self._turns.discard)
+
+    async def serve(self, after_id: Optional[int] = None) -> None:
+        await self.websocket.accept()
+        self.queue = chat_events.subscribe(self.session_id)
+        metrics.increment("ws_connections_total")
+        writer: Optional[asyncio.Task] = None
+        try:
+            if after_id is not None:
+                await self._replay(after_id)
+            writer = asyncio.create_task(self._writer())
+            while True:
+                data = await self.websocket.receive_json()
+                self.last_seen = time.monotonic()
+                self._handle(data)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.warning(f"Connessione WebSocket chiusa per sessione {self.session_id}: {e}")
+        finally:
+            chat_events.unsubscribe(self.session_id, self.queue)
+            if writer is not None:
+                writer.cancel()
+            # I turni in corso proseguono: le risposte restano nel database e arrivano
+            # agli altri client della sessione o al resume dal cursore
@@ -0,0 +1,177 @@
+"""
+Circuit breaker per le chiamate al modello AI
+
+Stati:
+- closed: le chiamate passano; gli esiti delle ultime `window_size` chiamate decidono
+  l'apertura quando il tasso di errori o di chiamate lente supera la soglia (con almeno
+  `minimum_calls` esiti nella finestra);
+- open: le chiamate falliscono subito (CircuitOpenError) per `open_seconds`;
+- half_open: passano al massimo `half_open_max_calls` chiamate di prova; se riescono
+  (e non sono lente) il circuito si richiude, altrimenti si riapre.
+
+Lo stato è per processo.
+"""
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.config import settings
+from app.services.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Il circuito è aperto: la chiamata non viene tentata"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuito {name} aperto, nuovo tentativo tra {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Finestra scorrevole degli esiti e transizioni closed -> open -> half_open"""
+
+    def __init__(
+        self,
+        name: str,
+        window_size: int = 20,
+        minimum_calls: int = 5,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 20.0,
+        slow_call_rate_threshold: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_max_calls: int = 1,
+    ):
+        self.name = name
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        # Esiti recenti: (fallita, lenta)
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window_size)
+        self._state = CLOSED
+        self._opened_at: Optional[float] = None
+        self._probes_in_flight = 0
+        self._last_reason: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN, "timeout di apertura scaduto")
+        return self._state
+
+    def retry_after(self) -> float:
+        """Secondi prima che il circuito accetti chiamate di prova (0 se non è aperto)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def _transition(self, state: str, reason: str) -> None:
+        previous, self._state = self._state, state
+        self._last_reason = reason
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state in (CLOSED, OPEN):
+            self._probes_in_flight = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+        metrics.increment("circuit_breaker_transitions_total", circuit=self.name, to=state)
+        log = logger.info if state == CLOSED else logger.warning
+        log(f"Circuito {self.name}: {previous} -> {state} ({reason})")
+
+    def acquire(self) -> None:
+        """Da chiamare prima della chiamata protetta: CircuitOpenError se non è consentita"""
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and self._probes_in_flight < self.half_open_max_calls:
+            self._probes_in_flight += 1
+            return
+        metrics.increment("circuit_breaker_rejected_total", circuit=self.name)
+        raise CircuitOpenError(self.name, self.retry_after())
+
+    def record_success(self, duration: float) -> None:
+        slow = duration >= self.slow_call_seconds
+        if self._state == HALF_OPEN:
+            if slow:
+                self._transition(OPEN, f"chiamata di prova lenta ({duration:.1f}s)")
+            else:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self._probes_in_flight == 0:
+                    self._transition(CLOSED, "chiamata di prova riuscita")
+            return
+        self._record(False, slow)
+
+    def record_failure(self, duration: float = 0.0) -> None:
+        if self._state == HALF_OPEN:
+            self._transition(OPEN, "chiamata di prova fallita")
+            return
+        self._record(True, duration >= self.slow_call_seconds)
+
+    def release(self) -> None:
+        """Chiamata interrotta senza esito (es. cancellata): libera lo slot di prova"""
+        if self._state == HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        self._outcomes.append((failed, slow))
+        if self._state != CLOSED or len(self._outcomes) < self.minimum_calls:
+            return
+        total = len(self._outcomes)
+        failure_rate = sum(1 for f, _ in self._outcomes if f) / total
+        slow_rate = sum(1 for _, s in self._outcomes if s) / total
+        if failure_rate >= self.failure_rate_threshold:
+            self._transition(OPEN, f"tasso di errori {failure_rate:.0%} su {total} chiamate")
+        elif slow_rate >= self.slow_call_rate_threshold:
+            self._transition(OPEN, f"tasso di chiamate lente {slow_rate:.0%} su {total} chiamate")
+
+    def reset(self) -> None:
+        self._outcomes.clear()
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self._last_reason = None
+
+    def snapshot(self) -> Dict[str, object]:
+        total = len(self._outcomes)
+        return {
+            "state": self.state,
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "window_calls": total,
+            "failure_rate": round(sum(1 for f, _ in self._outcomes if f) / total, 3) if total else None,
+            "slow_call_rate": round(sum(1 for _, s in self._outcomes if s) / total, 3) if total else None,
+            "last_reason": self._last_reason,
+        }
+
+
+# Circuit breaker globale delle chiamate al modello AI
+ai_circuit_breaker = CircuitBreaker(
+    "ai",
+    window_size=settings.ai_circuit_window_size,
+    minimum_calls=settings.ai_circuit_minimum_calls,
+    failure_rate_threshold=settings.ai_circuit_failure_rate_threshold,
+    slow_call_seconds=settings.ai_circuit_slow_call_seconds,
+    slow_call_rate_threshold=settings.ai_circuit_slow_call_rate_threshold,
+    open_seconds=settings.ai_circuit_open_seconds,
+)
+
+# Circuit breaker separato per il classificatore lifecycle (modalità split): gli errori del
+# modello piccolo non aprono il circuito delle risposte e viceversa
+classifier_circuit_breaker = CircuitBreaker(
+    "lifecycle_classifier",
+    window_size=settings.ai_circuit_window_size,
+    minimum_calls=settings.ai_circuit_minimum_calls,
+    failure_rate_threshold=settings.ai_circuit_failure_rate_threshold,
+    slow_call_seconds=settings.ai_circuit_slow_call_seconds,
+    slow_call_rate_threshold=settings.ai_circuit_slow_call_rate_threshold,
+    open_seconds=settings.ai_circuit_open_seconds,
+)
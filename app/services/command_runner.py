@@ -0,0 +1,223 @@
+"""
+Esecuzione dei comandi dello script ./server per la dashboard di monitoraggio (/api/execute)
+
+- Sottoprocessi asyncio nativi (niente thread), con un limite globale di concorrenza.
+- Single-flight: richieste concorrenti dello stesso comando si agganciano all'esecuzione
+  già in corso e ne ricevono tutto l'output, dall'inizio.
+- I comandi di sola lettura (server-status, ssl-check, ...) restano in cache per
+  command_cache_ttl_seconds dopo un'esecuzione riuscita.
+- stdout è disponibile man mano, per lo streaming al client; stderr resta separato e
+  compare nel risultato (e nel dettaglio dell'errore se il comando fallisce).
+"""
+import asyncio
+import codecs
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from app.config import settings
+from app.services.metrics import metrics
+
+# Comando -> (argv, sola lettura)
+COMMANDS: Dict[str, Tuple[List[str], bool]] = {
+    "server-status": (["./server", "server-status"], True),
+    "monitor-health": (["./server", "monitor-health"], True),
+    "ssl-check": (["./server", "ssl-check"], True),
+    "dependencies-check": (["./server", "dependencies-check"], True),
+    "dependencies-lock": (["./server", "dependencies-lock"], False),
+}
+
+
+class UnknownCommandError(ValueError):
+    """Comando non presente in COMMANDS"""
+
+
+@dataclass
+class CommandResult:
+    command: str
+    returncode: Optional[int]
+    output: str
+    duration_seconds: float
+    stderr: str = ""
+    finished_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    error: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        return self.error is None and self.returncode == 0
+
+    @property
+    def failure_detail(self) -> str:
+        return self.error or self.stderr.strip()[-2000:] or self.output.strip()[-2000:] or f"exit code {self.returncode}"
+
+
+class CommandRun:
+    """Un'esecuzione (in corso o conclusa) condivisa tra tutti i client che la attendono"""
+
+    def __init__(self, command: str, cached: bool = False):
+        self.command = command
+        self.cached = cached
+        self.chunks: List[str] = []
+        self.stderr_chunks: List[str] = []
+        self.result: Optional[CommandResult] = None
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # Ogni attesa usa l'evento corrente: lo si sostituisce dopo averlo segnalato
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def append(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, result: CommandResult) -> None:
+        self.result = result
+        self._notify()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Output dall'inizio, poi i nuovi chunk fino alla fine dell'esecuzione"""
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.result is not None:
+                return
+            await changed.wait()
+
+    async def wait(self) -> CommandResult:
+        while self.result is None:
+            await self._changed.wait()
+        return self.result
+
+
+class CommandRunner:
+    """Esegue i comandi di COMMANDS con cache, coalescing e limite di concorrenza"""
+
+    def __init__(self, cwd: str, max_concurrency: int, timeout_seconds: float, cache_ttl_seconds: float):
+        self.cwd = cwd
+        self.timeout_seconds = timeout_seconds
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[str, CommandRun] = {}
+        self._cache: Dict[str, Tuple[float, CommandResult]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, command: str) -> CommandRun:
+        """Esecuzione del comando: dalla cache, quella già in corso o una nuova"""
+        if command not in COMMANDS:
+            raise UnknownCommandError(command)
+
+        cached = self._cache.get(command)
+        if cached is not None and cached[0] > time.monotonic():
+            metrics.increment("command_runs_total", command=command, source="cache")
+            run = CommandRun(command, cached=True)
+            run.append(cached[1].output)
+            run.finish(cached[1])
+            return run
+
+        run = self._inflight.get(command)
+        if run is not None:
+            metrics.increment("command_runs_total", command=command, source="coalesced")
+            return run
+
+        metrics.increment("command_runs_total", command=command, source="executed")
+        run = CommandRun(command)
+        self._inflight[command] = run
+        task = asyncio.create_task(self._execute(run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return run
+
+    async def _execute(self, run: CommandRun) -> None:
+        argv, read_only = COMMANDS[run.command]
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        stderr_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        returncode: Optional[int] = None
+        error: Optional[str] = None
+        started = time.monotonic()
+        try:
+            async with self._semaphore:
+                started = time.monotonic()
+                run.process = await asyncio.create_subprocess_exec(
+                    *argv,
+                    cwd=self.cwd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+
+                async def read_stderr() -> None:
+                    while data := await run.process.stderr.read(4096):
+                        run.stderr_chunks.append(stderr_decoder.decode(data))
+
+                try:
+                    async with asyncio.timeout(self.timeout_seconds):
+                        # Le due pipe si leggono insieme: una pipe piena bloccherebbe il processo
+                        stderr_reader = asyncio.create_task(read_stderr())
+                        try:
+                            while data := await run.process.stdout.read(4096):
+                                run.append(decoder.decode(data))
+                            await stderr_reader
+                        finally:
+                            stderr_reader.cancel()
+                        returncode = await run.process.wait()
+                except TimeoutError:
+                    run.process.kill()
+                    await run.process.wait()
+                    error = f"Timeout dopo {self.timeout_seconds:g}s"
+        except asyncio.CancelledError:
+            if run.process is not None and run.process.returncode is None:
+                run.process.kill()
+            error = "Esecuzione interrotta"
+            raise
+        except OSError as e:
+            error = str(e)
+        finally:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                run.chunks.append(tail)
+            run.stderr_chunks.append(stderr_decoder.decode(b"", final=True))
+            result = CommandResult(
+                command=run.command,
+                returncode=returncode,
+                output="".join(run.chunks),
+                stderr="".join(run.stderr_chunks),
+                duration_seconds=round(time.monotonic() - started, 3),
+                error=error,
+            )
+            self._inflight.pop(run.command, None)
+            if not read_only:
+                # Un comando che modifica lo stato rende vecchie le letture in cache
+                self._cache.clear()
+            elif result.success and self.cache_ttl_seconds > 0:
+                self._cache[run.command] = (time.monotonic() + self.cache_ttl_seconds, result)
+            metrics.observe("command_duration_seconds", result.duration_seconds, command=run.command)
+            if not result.success:
+                logger.warning(f"Comando {run.command} fallito: {result.failure_detail[:200]}")
+            run.finish(result)
+
+    def invalidate(self, command: Optional[str] = None) -> None:
+        if command is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(command, None)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Istanza globale del runner dei comandi
+command_runner = CommandRunner(
+    cwd=settings.command_working_dir,
+    max_concurrency=settings.command_max_concurrency,
+    timeout_seconds=settings.command_timeout_seconds,
+    cache_ttl_seconds=settings.command_cache_ttl_seconds,
+)
@@ -0,0 +1,385 @@
+"""
+Analytics del funnel di lifecycle con rollup giornalieri incrementali
+
+Le transizioni registrate in `lifecycle_events` vengono aggregate in `funnel_daily_rollups`
+(una riga per giorno, transizione, modello e prompt) a partire dall'ultimo evento già
+elaborato, salvato in `analytics_cursors`. Le API leggono solo i rollup, mai gli eventi.
+
+Il tempo nello stage è la distanza tra la transizione e quella precedente della stessa
+sessione (o la creazione della sessione per la prima). Le durate sono salvate come
+istogramma a bucket logaritmici (base 2): mediana e percentili sono stime con errore
+limitato alla larghezza del bucket, ma si possono sommare tra giorni e gruppi.
+
+Gli id sono assegnati all'insert ma gli eventi diventano visibili al commit: un evento con
+id più basso può comparire dopo che il cursore lo ha superato. Gli id saltati da un batch
+vengono quindi ricordati nel cursore (pending_gaps) e ricontrollati a ogni aggiornamento,
+finché compaiono o scade funnel_gap_timeout_seconds (transazione annullata). Il tempo nello
+stage di un evento recuperato in ritardo è calcolato rispetto agli eventi con id precedente.
+"""
+import asyncio
+import json as json_lib
+import math
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import get_db
+from app.models.database_models import (
+    AnalyticsCursorModel,
+    FunnelDailyRollupModel,
+    LifecycleEventModel,
+    SessionModel,
+)
+from app.models.lifecycle import LifecycleStage
+
+CURSOR_NAME = "funnel_daily"
+
+# Ordine degli stage nel funnel
+FUNNEL_STAGES: List[LifecycleStage] = [
+    LifecycleStage.NUOVA_LEAD,
+    LifecycleStage.CONTRASSEGNATO,
+    LifecycleStage.IN_TARGET,
+    LifecycleStage.LINK_DA_INVIARE,
+    LifecycleStage.LINK_INVIATO,
+]
+
+GROUP_BY_COLUMNS = {"model": "model_name", "prompt": "prompt_name"}
+
+RollupKey = Tuple[date, str, str, str, str]
+
+# Limite degli id saltati ricordati per batch (salti enormi della sequenza non sono attese reali)
+MAX_TRACKED_GAPS = 5000
+
+
+def _as_utc(value: datetime) -> datetime:
+    """SQLite restituisce datetime naive: li consideriamo UTC"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _bucket(seconds: float) -> int:
+    """Bucket i = durate in [2^i - 1, 2^(i+1) - 1) secondi"""
+    return int(math.log2(max(seconds, 0.0) + 1))
+
+
+def _percentile(histogram: Dict[int, int], q: float) -> Optional[float]:
+    """Stima del percentile q (0-1) come punto medio del bucket che lo contiene"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            lower, upper = 2 ** bucket - 1, 2 ** (bucket + 1) - 1
+            return round((lower + upper) / 2, 1)
+    return None
+
+
+def _merge_histogram(target: Dict[int, int], source: Dict[int, int]) -> None:
+    for bucket, count in source.items():
+        target[bucket] = target.get(bucket, 0) + count
+
+
+class FunnelAnalyticsService:
+    """Aggiornamento incrementale dei rollup e lettura del funnel"""
+
+    def __init__(self, refresh_interval: float, batch_size: int = 5000, response_ttl: float = 30.0):
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.response_ttl = response_ttl
+        self.last_update_at: Optional[datetime] = None
+        self._responses: Dict[Tuple, Tuple[float, Dict[str, Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _lock_cursor(self, db: AsyncSession) -> AnalyticsCursorModel:
+        """Legge il cursore bloccandone la riga (un solo aggiornamento alla volta tra i worker)"""
+        result = await db.execute(
+            select(AnalyticsCursorModel)
+            .where(AnalyticsCursorModel.name == CURSOR_NAME)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        cursor = result.scalar_one_or_none()
+        if cursor is None:
+            cursor = AnalyticsCursorModel(name=CURSOR_NAME, last_event_id=0)
+            db.add(cursor)
+            await db.flush()
+        return cursor
+
+    async def _previous_transition_times(
+        self, db: AsyncSession, session_ids: List[int], before_id: int
+    ) -> Dict[int, datetime]:
+        """Inizio dello stage corrente per ogni sessione, prima degli eventi del batch"""
+        starts: Dict[int, datetime] = {}
+        result = await db.execute(
+            select(SessionModel.id, SessionModel.created_at).where(SessionModel.id.in_(session_ids))
+        )
+        for session_pk, created_at in result.all():
+            if created_at is not None:
+                starts[session_pk] = _as_utc(created_at)
+
+        if before_id:
+            last_ids = (
+                select(func.max(LifecycleEventModel.id).label("id"))
+                .where(
+                    LifecycleEventModel.session_id.in_(session_ids),
+                    LifecycleEventModel.id <= before_id,
+                )
+                .group_by(LifecycleEventModel.session_id)
+                .subquery()
+            )
+            result = await db.execute(
+                select(LifecycleEventModel.session_id, LifecycleEventModel.created_at)
+                .join(last_ids, LifecycleEventModel.id == last_ids.c.id)
+            )
+            for session_pk, created_at in result.all():
+                starts[session_pk] = _as_utc(created_at)
+        return starts
+
+    async def _apply_batch(self, db: AsyncSession, events: List[LifecycleEventModel], cursor_id: int) -> None:
+        """Aggrega un batch di eventi e lo somma ai rollup esistenti"""
+        starts = await self._previous_transition_times(db, list({e.session_id for e in events}), cursor_id)
+
+        deltas: Dict[RollupKey, Dict[str, Any]] = {}
+        for event in events:
+            happened_at = _as_utc(event.created_at)
+            key = (
+                happened_at.date(),
+                event.previous_lifecycle.value if event.previous_lifecycle else "",
+                event.new_lifecycle.value,
+                event.model_name or "",
+                event.prompt_name or "",
+            )
+            delta = deltas.setdefault(key, {"transitions": 0, "sum": 0.0, "histogram": {}})
+            delta["transitions"] += 1
+
+            started_at = starts.get(event.session_id)
+            if started_at is not None:
+                seconds = max((happened_at - started_at).total_seconds(), 0.0)
+                delta["sum"] += seconds
+                bucket = _bucket(seconds)
+                delta["histogram"][bucket] = delta["histogram"].get(bucket, 0) + 1
+            starts[event.session_id] = happened_at
+
+        result = await db.execute(
+            select(FunnelDailyRollupModel).where(
+                FunnelDailyRollupModel.day.in_({key[0] for key in deltas})
+            )
+        )
+        existing = {
+            (row.day, row.from_stage, row.to_stage, row.model_name, row.prompt_name): row
+            for row in result.scalars().all()
+        }
+
+        for key, delta in deltas.items():
+            row = existing.get(key)
+            if row is None:
+                day, from_stage, to_stage, model_name, prompt_name = key
+                row = FunnelDailyRollupModel(
+                    day=day,
+                    from_stage=from_stage,
+                    to_stage=to_stage,
+                    model_name=model_name,
+                    prompt_name=prompt_name,
+                    transitions=0,
+                    duration_sum_seconds=0.0,
+                    duration_histogram="{}",
+                )
+                db.add(row)
+            histogram = {int(k): v for k, v in json_lib.loads(row.duration_histogram or "{}").items()}
+            _merge_histogram(histogram, delta["histogram"])
+            row.transitions += delta["transitions"]
+            row.duration_sum_seconds += delta["sum"]
+            row.duration_histogram = json_lib.dumps(histogram)
+
+    @staticmethod
+    def _load_gaps(cursor: AnalyticsCursorModel) -> Dict[int, float]:
+        return {int(k): v for k, v in json_lib.loads(cursor.pending_gaps or "{}").items()}
+
+    @staticmethod
+    def _save_gaps(cursor: AnalyticsCursorModel, gaps: Dict[int, float]) -> None:
+        cursor.pending_gaps = json_lib.dumps(gaps) if gaps else None
+
+    @staticmethod
+    def _track_gaps(gaps: Dict[int, float], after_id: int, events: List[LifecycleEventModel]) -> None:
+        """Ricorda gli id tra il cursore e l'ultimo evento del batch che non sono ancora visibili"""
+        seen = {event.id for event in events}
+        missing = [i for i in range(after_id + 1, events[-1].id) if i not in seen]
+        if len(missing) > MAX_TRACKED_GAPS:
+            logger.warning(f"Rollup funnel: {len(missing)} id saltati dopo {after_id}, ricordati solo gli ultimi {MAX_TRACKED_GAPS}")
+            missing = missing[-MAX_TRACKED_GAPS:]
+        now = time.time()
+        for event_id in missing:
+            gaps.setdefault(event_id, now)
+
+    async def _recover_gaps(self, db: AsyncSession) -> int:
+        """Aggrega gli eventi comparsi negli id saltati e scarta quelli in attesa da troppo"""
+        cursor = await self._lock_cursor(db)
+        gaps = self._load_gaps(cursor)
+        if not gaps:
+            return 0
+
+        result = await db.execute(
+            select(LifecycleEventModel)
+            .where(LifecycleEventModel.id.in_(list(gaps)))
+            .order_by(LifecycleEventModel.id)
+        )
+        events = result.scalars().all()
+        for event in events:
+            # Stage precedente calcolato rispetto agli eventi con id più basso
+            await self._apply_batch(db, [event], event.id - 1)
+            del gaps[event.id]
+
+        expired_before = time.time() - settings.funnel_gap_timeout_seconds
+        expired = [event_id for event_id, seen_at in gaps.items() if seen_at < expired_before]
+        for event_id in expired:
+            del gaps[event_id]
+        if events or expired:
+            logger.info(f"Rollup funnel: {len(events)} eventi recuperati in ritardo, {len(expired)} id saltati scaduti")
+
+        self._save_gaps(cursor, gaps)
+        await db.commit()
+        return len(events)
+
+    async def update(self) -> int:
+        """Aggrega gli eventi successivi al cursore e quelli comparsi in ritardo; ritorna il numero di eventi elaborati"""
+        processed = 0
+        async for db in get_db():
+            processed += await self._recover_gaps(db)
+            while True:
+                cursor = await self._lock_cursor(db)
+                result = await db.execute(
+                    select(LifecycleEventModel)
+                    .where(LifecycleEventModel.id > cursor.last_event_id)
+                    .order_by(LifecycleEventModel.id)
+                    .limit(self.batch_size)
+                )
+                events = result.scalars().all()
+                if not events:
+                    await db.commit()
+                    break
+
+                gaps = self._load_gaps(cursor)
+                self._track_gaps(gaps, cursor.last_event_id, events)
+                await self._apply_batch(db, events, cursor.last_event_id)
+                cursor.last_event_id = events[-1].id
+                self._save_gaps(cursor, gaps)
+                await db.commit()
+                processed += len(events)
+
+        self.last_update_at = datetime.now(timezone.utc)
+        if processed:
+            self._responses.clear()
+            logger.info(f"Rollup funnel aggiornati con {processed} eventi di lifecycle")
+        return processed
+
+    async def get_funnel(self, start: date, end: date, group_by: Optional[str] = None) -> Dict[str, Any]:
+        """Funnel, tempi per transizione ed eventuale breakdown per modello o prompt"""
+        cache_key = (start, end, group_by)
+        cached = self._responses.get(cache_key)
+        if cached and time.monotonic() - cached[0] < self.response_ttl:
+            return cached[1]
+
+        rows: List[FunnelDailyRollupModel] = []
+        async for db in get_db():
+            result = await db.execute(
+                select(FunnelDailyRollupModel).where(
+                    FunnelDailyRollupModel.day >= start,
+                    FunnelDailyRollupModel.day <= end,
+                )
+            )
+            rows = result.scalars().all()
+
+        transitions: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        groups: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            item = transitions.setdefault(
+                (row.from_stage, row.to_stage), {"count": 0, "sum": 0.0, "histogram": {}}
+            )
+            item["count"] += row.transitions
+            item["sum"] += row.duration_sum_seconds
+            _merge_histogram(item["histogram"], {int(k): v for k, v in json_lib.loads(row.duration_histogram).items()})
+
+            if group_by:
+                group = getattr(row, GROUP_BY_COLUMNS[group_by]) or "unknown"
+                counts = groups.setdefault(group, {})
+                counts[row.to_stage] = counts.get(row.to_stage, 0) + row.transitions
+
+        # Lead che hanno raggiunto ogni stage (NUOVA_LEAD: lead che ne sono uscite)
+        reached: Dict[str, int] = {stage.value: 0 for stage in FUNNEL_STAGES}
+        for (from_stage, to_stage), item in transitions.items():
+            if to_stage in reached:
+                reached[to_stage] += item["count"]
+            if from_stage == LifecycleStage.NUOVA_LEAD.value:
+                reached[from_stage] += item["count"]
+
+        funnel = []
+        previous_count = None
+        for stage in FUNNEL_STAGES:
+            count = reached[stage.value]
+            funnel.append({
+                "stage": stage.value,
+                "count": count,
+                "conversion_from_previous": round(count / previous_count, 3) if previous_count else None,
+            })
+            previous_count = count
+
+        response: Dict[str, Any] = {
+            "range": {"start": start.isoformat(), "end": end.isoformat()},
+            "funnel": funnel,
+            "transitions": [
+                {
+                    "from": from_stage or None,
+                    "to": to_stage,
+                    "count": item["count"],
+                    "avg_seconds": round(item["sum"] / sum(item["histogram"].values()), 1) if item["histogram"] else None,
+                    "median_seconds": _percentile(item["histogram"], 0.5),
+                    "p90_seconds": _percentile(item["histogram"], 0.9),
+                    "p99_seconds": _percentile(item["histogram"], 0.99),
+                }
+                for (from_stage, to_stage), item in sorted(transitions.items())
+            ],
+            "updated_at": self.last_update_at.isoformat() if self.last_update_at else None,
+        }
+        if group_by:
+            response["breakdown"] = {"group_by": group_by, "groups": groups}
+
+        self._responses[cache_key] = (time.monotonic(), response)
+        return response
+
+    @staticmethod
+    def default_range(days: int = 7) -> Tuple[date, date]:
+        """Ultimi `days` giorni, oggi compreso (UTC)"""
+        end = datetime.now(timezone.utc).date()
+        return end - timedelta(days=days - 1), end
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.update()
+            except Exception as e:
+                logger.warning(f"Aggiornamento rollup funnel fallito: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Istanza globale del servizio di analytics del funnel
+funnel_analytics = FunnelAnalyticsService(refresh_interval=settings.funnel_rollup_interval_seconds)
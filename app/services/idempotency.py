@@ -0,0 +1,86 @@
+"""
+Cache delle risposte di /chat indicizzata per (session_id, chiave di idempotenza)
+
+Un retry del client con la stessa chiave riceve la risposta originale senza nuove
+chiamate AI né scritture. Se il retry arriva mentre la richiesta originale è ancora in
+corso, attende il suo risultato (single-flight) invece di rieseguire il turno.
+
+La cache è per processo: i retry che arrivano su un altro worker (o dopo il TTL) sono
+comunque protetti dal vincolo unico su messages(session_id, client_message_id) e
+ricevono la risposta salvata sul messaggio (messages.response_json); solo se il turno
+originale è ancora in corso altrove la risposta è vuota.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.config import settings
+from app.services.metrics import metrics
+
+CacheKey = Tuple[str, str]
+
+
+class IdempotencyCache:
+    """Risposte recenti per chiave di idempotenza, con TTL e limite di dimensione"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._responses: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict()
+        self._in_flight: Dict[CacheKey, asyncio.Future] = {}
+
+    def get(self, session_id: str, key: str) -> Optional[Any]:
+        entry = self._responses.get((session_id, key))
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._responses[(session_id, key)]
+            return None
+        return response
+
+    def put(self, session_id: str, key: str, response: Any) -> None:
+        self._responses[(session_id, key)] = (time.monotonic(), response)
+        self._responses.move_to_end((session_id, key))
+        while len(self._responses) > self.max_size:
+            self._responses.popitem(last=False)
+
+    async def run(self, session_id: str, key: str, producer: Callable[[], Awaitable[Any]]) -> Any:
+        """Restituisce la risposta in cache, attende quella in corso o esegue `producer`
+
+        Gli errori non vengono memorizzati: un retry dopo un fallimento riesegue il turno.
+        """
+        cached = self.get(session_id, key)
+        if cached is not None:
+            metrics.increment("chat_idempotency_total", result="cached")
+            return cached
+
+        in_flight = self._in_flight.get((session_id, key))
+        if in_flight is not None:
+            metrics.increment("chat_idempotency_total", result="joined")
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[(session_id, key)] = future
+        try:
+            response = await producer()
+        except BaseException as e:
+            future.set_exception(e)
+            # Evita il warning "exception was never retrieved" se nessuno era in attesa
+            future.exception()
+            raise
+        else:
+            self.put(session_id, key, response)
+            future.set_result(response)
+            metrics.increment("chat_idempotency_total", result="executed")
+            return response
+        finally:
+            self._in_flight.pop((session_id, key), None)
+
+
+# Istanza globale della cache di idempotenza di /chat
+chat_idempotency = IdempotencyCache(
+    ttl_seconds=settings.idempotency_ttl_seconds,
+    max_size=settings.idempotency_cache_max_size,
+)
@@ -0,0 +1,68 @@
+"""
+Decisione del lifecycle: unificata o separata (split)
+
+- unified: una sola chiamata genera la risposta e decide il cambio di lifecycle.
+- split: la risposta viene generata da un prompt che non chiede la decisione, mentre in
+  parallelo un modello piccolo (LIFECYCLE_CLASSIFIER_MODEL) valuta la transizione con
+  LIFECYCLE_DECISION_PROMPT. Le due risposte vengono unite in _process_ai_response.
+
+Per il confronto A/B la modalità split può essere assegnata a una quota stabile di
+sessioni (LIFECYCLE_SPLIT_TRAFFIC_PERCENT). Latenza e decisioni sono registrate per
+modalità; l'accuratezza delle transizioni si misura offline con
+scripts/eval_lifecycle_classifier.py su conversazioni etichettate.
+"""
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.data.lifecycle_config import LIFECYCLE_DECISION_PROMPT, LIFECYCLE_SCRIPTS
+from app.models.lifecycle import LifecycleStage
+from app.services.response_mode import traffic_bucket
+
+UNIFIED = "unified"
+SPLIT = "split"
+
+
+def choose_decision_mode(session_id: str) -> str:
+    """Modalità di decisione del lifecycle per la sessione secondo la configurazione corrente"""
+    if settings.lifecycle_decision_mode == SPLIT:
+        return SPLIT
+    # Bucket indipendente da quello del formato lean, così i due esperimenti non si sovrappongono
+    if traffic_bucket(session_id, salt=SPLIT) < settings.lifecycle_split_traffic_percent:
+        return SPLIT
+    return UNIFIED
+
+
+def build_decision_prompt(lifecycle: LifecycleStage, user_message: str, conversation_context: str) -> Optional[str]:
+    """Prompt del classificatore, None nel lifecycle finale (nessuna transizione possibile)"""
+    config = LIFECYCLE_SCRIPTS.get(lifecycle, {})
+    next_stage = config.get("next_stage")
+    if next_stage is None:
+        return None
+    indicators = config.get("transition_indicators", [])
+    return LIFECYCLE_DECISION_PROMPT.format(
+        current_lifecycle=lifecycle.value,
+        current_objective=config.get("objective", ""),
+        transition_indicators="\n".join(f"- {indicator}" for indicator in indicators),
+        next_stage=next_stage.value,
+        conversation_context=conversation_context,
+        user_message=user_message,
+    )
+
+
+def stay_decision(reasoning: str) -> Dict[str, Any]:
+    """Nessun cambio di lifecycle (anche quando il classificatore non risponde)"""
+    return {"should_change": False, "new_lifecycle_str": None, "confidence": 0.0, "reasoning": reasoning}
+
+
+def parse_decision(data: Dict[str, Any], lifecycle: LifecycleStage) -> Dict[str, Any]:
+    """Risposta del classificatore nelle chiavi usate da _process_ai_response"""
+    reasoning = str(data.get("reasoning") or "Decisione del classificatore lifecycle")
+    if not data.get("should_change_lifecycle"):
+        return stay_decision(reasoning)
+    try:
+        confidence = float(data.get("confidence_score", 0.0))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    next_stage = LIFECYCLE_SCRIPTS.get(lifecycle, {}).get("next_stage")
+    target = data.get("target_lifecycle") or (next_stage.value if next_stage else None)
+    return {"should_change": True, "new_lifecycle_str": target, "confidence": confidence, "reasoning": reasoning}
@@ -0,0 +1,96 @@
+"""
+Registro in-process di metriche (contatori e istogrammi) esposto da /api/metrics
+
+Le metriche sono per processo: con più worker ogni processo riporta le proprie.
+"""
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+# Limiti superiori dei bucket in secondi, adatti ad attese di lock e chiamate AI
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Histogram:
+    """Distribuzione di valori con bucket cumulativi fissi"""
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.bucket_counts[index] += 1
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else None,
+            "max": round(self.max, 6),
+            "buckets": {str(upper): count for upper, count in zip(self.buckets, self.bucket_counts)},
+        }
+
+
+class MetricsRegistry:
+    """Contatori e istogrammi indicizzati per nome ed etichette"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+
+    def increment(self, name: str, value: float = 1.0, **labels) -> None:
+        """Incrementa un contatore"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = DEFAULT_BUCKETS, **labels) -> None:
+        """Registra un valore in un istogramma"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, **labels) -> float:
+        return self._counters.get(name, {}).get(_label_key(labels), 0.0)
+
+    def snapshot(self) -> Dict[str, Dict[str, List[Dict[str, object]]]]:
+        """Tutte le serie, nel formato restituito da /api/metrics"""
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.to_dict()} for key, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+# Registro globale delle metriche
+metrics = MetricsRegistry()
@@ -0,0 +1,131 @@
+"""
+Hedged requests e catena di fallback tra i modelli AI (tabella ai_models)
+
+Con AI_HEDGING_ENABLED ogni chiamata parte sul modello primario; se non ha risposto
+entro l'hedge delay parte una seconda richiesta al primo modello della catena di
+fallback (fallback_order crescente). Vince la prima risposta riuscita, l'altra richiesta
+viene cancellata. Se una richiesta fallisce si passa al modello successivo della catena;
+in volo ci sono al massimo due richieste.
+
+Hedge delay: hedge_delay_ms del modello primario se impostato, altrimenti il p95 delle
+sue latenze recenti, AI_HEDGE_DEFAULT_DELAY_SECONDS finché i campioni sono pochi. Le
+chiamate cancellate perché superate dall'hedge contano con il tempo trascorso fino alla
+cancellazione (limite inferiore della latenza vera).
+"""
+import asyncio
+import math
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from loguru import logger
+
+from app.config import settings
+from app.services.metrics import metrics
+
+T = TypeVar("T")
+
+MAX_IN_FLIGHT = 2
+
+
+class ModelLatencyTracker:
+    """Latenze recenti delle chiamate per modello (riuscite o cancellate dall'hedge)"""
+
+    def __init__(self, window_size: int = 200, minimum_samples: int = 20):
+        self.window_size = window_size
+        self.minimum_samples = minimum_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model_name: str, seconds: float) -> None:
+        samples = self._samples.get(model_name)
+        if samples is None:
+            samples = self._samples[model_name] = deque(maxlen=self.window_size)
+        samples.append(seconds)
+
+    def percentile(self, model_name: str, quantile: float) -> Optional[float]:
+        """Percentile (nearest-rank) delle latenze, None se i campioni sono meno di minimum_samples"""
+        samples = self._samples.get(model_name)
+        if not samples or len(samples) < self.minimum_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(quantile * len(ordered)) - 1)]
+
+    def hedge_delay(self, model_name: str, configured_ms: Optional[int]) -> float:
+        if configured_ms is not None:
+            return configured_ms / 1000
+        p95 = self.percentile(model_name, 0.95)
+        if p95 is None:
+            return settings.ai_hedge_default_delay_seconds
+        return max(settings.ai_hedge_min_delay_seconds, p95)
+
+    def snapshot(self) -> Dict[str, Dict[str, Optional[float]]]:
+        return {
+            name: {
+                "samples": len(samples),
+                "p50_seconds": self.percentile(name, 0.5),
+                "p95_seconds": self.percentile(name, 0.95),
+            }
+            for name, samples in self._samples.items()
+        }
+
+    def reset(self) -> None:
+        self._samples.clear()
+
+
+async def race_models(
+    call: Callable[[str], Awaitable[T]],
+    models: List[str],
+    hedge_delay: float,
+) -> Tuple[str, T]:
+    """Esegue `call` sul primo modello di `models` con hedging e failover sui successivi
+
+    Restituisce (modello vincente, risultato); se falliscono tutti rilancia l'ultimo errore.
+    """
+    waiting = list(models)
+    running: Dict[asyncio.Task, str] = {}
+    hedged = False
+    last_error: Optional[BaseException] = None
+
+    def launch() -> None:
+        name = waiting.pop(0)
+        running[asyncio.create_task(call(name))] = name
+
+    launch()
+    try:
+        while running:
+            # L'hedge scatta una sola volta, mentre il primario è l'unica richiesta in volo
+            timeout = hedge_delay if not hedged and waiting and len(running) == 1 else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                primary = next(iter(running.values()))
+                metrics.increment("ai_hedged_requests_total", primary=primary, fallback=waiting[0])
+                logger.info(f"Nessuna risposta da {primary} dopo {hedge_delay:.2f}s: richiesta hedged a {waiting[0]}")
+                launch()
+                continue
+
+            for task in done:
+                name = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    metrics.increment("ai_hedge_winner_total", model=name, hedged=hedged)
+                    return name, task.result()
+                last_error = error
+                metrics.increment("ai_model_failover_total", model=name)
+                logger.warning(f"Chiamata al modello {name} fallita: {error}")
+
+            # Failover: il posto della richiesta fallita va al modello successivo della catena
+            while waiting and len(running) < (MAX_IN_FLIGHT if hedged else 1):
+                launch()
+        raise last_error
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+# Latenze per modello usate per l'hedge delay
+model_latency = ModelLatencyTracker(
+    window_size=settings.ai_hedge_latency_window,
+    minimum_samples=settings.ai_hedge_minimum_samples,
+)
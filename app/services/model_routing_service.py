@@ -0,0 +1,175 @@
+"""
+Routing dei modelli AI per lifecycle
+
+Ogni regola di model_routes assegna un modello di ai_models ai turni di un lifecycle
+(o di tutti, con lifecycle NULL), opzionalmente solo da una certa lunghezza della
+cronologia in poi. Per un turno vince la regola più specifica: prima quelle del
+lifecycle, poi quelle generiche; a parità, la soglia min_history_messages più alta
+raggiunta. Senza regole applicabili si usa il modello attivo.
+
+Le regole si modificano via API senza riavvio: la scrittura invalida la cache del
+processo, gli altri worker la rileggono entro active_config_cache_ttl_seconds.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import get_db_session
+from app.models.database_models import ModelRouteModel
+from app.models.lifecycle import LifecycleStage
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    id: int
+    lifecycle: Optional[LifecycleStage]
+    min_history_messages: int
+    model_name: str
+
+    def matches(self, lifecycle: LifecycleStage, history_length: int) -> bool:
+        if self.lifecycle is not None and self.lifecycle != lifecycle:
+            return False
+        return history_length >= self.min_history_messages
+
+    @property
+    def specificity(self):
+        return (self.lifecycle is not None, self.min_history_messages)
+
+
+class ModelRoutingService:
+    """Servizio per la tabella di routing dei modelli"""
+
+    # Cache in-process delle regole abilitate, invalidata dalle scritture
+    _routes_cache: Optional[List[ModelRoute]] = None
+    _routes_cached_at: float = 0.0
+
+    @staticmethod
+    def invalidate_cache() -> None:
+        """Forza la rilettura delle regole alla prossima richiesta"""
+        ModelRoutingService._routes_cache = None
+
+    @staticmethod
+    async def get_enabled_routes() -> List[ModelRoute]:
+        """Regole abilitate dalla più specifica, dalla cache se ancora valida"""
+        cached = ModelRoutingService._routes_cache
+        if cached is not None and time.monotonic() - ModelRoutingService._routes_cached_at < settings.active_config_cache_ttl_seconds:
+            return cached
+
+        routes = [
+            ModelRoute(r.id, r.lifecycle, r.min_history_messages, r.model_name)
+            for r in await ModelRoutingService.get_all_routes()
+            if r.is_enabled
+        ]
+        routes.sort(key=lambda r: r.specificity, reverse=True)
+        ModelRoutingService._routes_cache = routes
+        ModelRoutingService._routes_cached_at = time.monotonic()
+        return routes
+
+    @staticmethod
+    async def resolve(lifecycle: LifecycleStage, history_length: int) -> Optional[ModelRoute]:
+        """La regola da applicare al turno, None se vale il modello attivo"""
+        for route in await ModelRoutingService.get_enabled_routes():
+            if route.matches(lifecycle, history_length):
+                return route
+        return None
+
+    @staticmethod
+    async def get_all_routes() -> List[ModelRouteModel]:
+        """Tutte le regole di routing"""
+        db = await get_db_session()
+        try:
+            result = await db.execute(
+                select(ModelRouteModel).order_by(ModelRouteModel.id)
+            )
+            return result.scalars().all()
+        except Exception as e:
+            logger.error(f"Errore nel recupero delle regole di routing: {e}")
+            return []
+        finally:
+            await db.close()
+
+    @staticmethod
+    async def _has_conflict(db: AsyncSession, lifecycle: Optional[LifecycleStage], min_history_messages: int, exclude_id: Optional[int] = None) -> bool:
+        """Esiste già una regola con lo stesso lifecycle e la stessa soglia"""
+        stmt = select(ModelRouteModel.id).where(
+            ModelRouteModel.lifecycle.is_(None) if lifecycle is None else ModelRouteModel.lifecycle == lifecycle,
+            ModelRouteModel.min_history_messages == min_history_messages,
+        )
+        if exclude_id is not None:
+            stmt = stmt.where(ModelRouteModel.id != exclude_id)
+        return (await db.execute(stmt)).first() is not None
+
+    @staticmethod
+    async def create_route(lifecycle: Optional[LifecycleStage], min_history_messages: int, model_name: str, is_enabled: bool = True) -> Optional[ModelRouteModel]:
+        """Crea una regola di routing (None se ne esiste già una per lifecycle e soglia)"""
+        db = await get_db_session()
+        try:
+            if await ModelRoutingService._has_conflict(db, lifecycle, min_history_messages):
+                return None
+            route = ModelRouteModel(
+                lifecycle=lifecycle,
+                min_history_messages=min_history_messages,
+                model_name=model_name,
+                is_enabled=is_enabled
+            )
+            db.add(route)
+            await db.commit()
+            await db.refresh(route)
+            ModelRoutingService.invalidate_cache()
+            logger.info(f"Creata regola di routing {route.id}: {lifecycle.value if lifecycle else '*'} -> {model_name}")
+            return route
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Errore nella creazione della regola di routing: {e}")
+            return None
+        finally:
+            await db.close()
+
+    @staticmethod
+    async def update_route(route_id: int, lifecycle: Optional[LifecycleStage], min_history_messages: int, model_name: str, is_enabled: bool = True) -> Optional[ModelRouteModel]:
+        """Aggiorna una regola di routing (None se non esiste o andrebbe in conflitto)"""
+        db = await get_db_session()
+        try:
+            route = await db.get(ModelRouteModel, route_id)
+            if route is None or await ModelRoutingService._has_conflict(db, lifecycle, min_history_messages, exclude_id=route_id):
+                return None
+            route.lifecycle = lifecycle
+            route.min_history_messages = min_history_messages
+            route.model_name = model_name
+            route.is_enabled = is_enabled
+            await db.commit()
+            await db.refresh(route)
+            ModelRoutingService.invalidate_cache()
+            logger.info(f"Aggiornata regola di routing {route_id}: {lifecycle.value if lifecycle else '*'} -> {model_name}")
+            return route
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Errore nell'aggiornamento della regola di routing {route_id}: {e}")
+            return None
+        finally:
+            await db.close()
+
+    @staticmethod
+    async def delete_route(route_id: int) -> bool:
+        """Elimina una regola di routing"""
+        db = await get_db_session()
+        try:
+            route = await db.get(ModelRouteModel, route_id)
+            if route is None:
+                return False
+            await db.delete(route)
+            await db.commit()
+            ModelRoutingService.invalidate_cache()
+            logger.info(f"Eliminata regola di routing {route_id}")
+            return True
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Errore nell'eliminazione della regola di routing {route_id}: {e}")
+            return False
+        finally:
+            await db.close()
@@ -0,0 +1,432 @@
+"""
+Consegna lato server delle risposte multi-parte, rispettando i delay_ms dell'AI
+
+Ogni parte è una riga di outbound_messages con il proprio due_at. In memoria resta solo
+una coda di priorità (heap) con le parti in scadenza entro outbound_lookahead_seconds:
+un loop dorme fino alla prossima scadenza e un refresh periodico carica dal database la
+finestra successiva. Decine di migliaia di parti in attesa costano quindi solo righe sul
+database; dopo un riavvio le parti pendenti (anche quelle già scadute) vengono
+ricaricate e consegnate.
+
+La consegna reclama la riga con un UPDATE condizionale (pending -> sending con lease),
+così più istanze possono condividere la tabella senza doppi invii. Se una parte fallisce,
+le parti successive della stessa risposta vengono posticipate dello stesso backoff per
+non arrivare prima di lei.
+
+Sink disponibili: "log" (stub locale), "webhook" (POST JSON), "sse" (stream per sessione
+su /api/outbound/{session_id}/stream) e "ws" (client di /ws/chat/{session_id}).
+"""
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import httpx
+from loguru import logger
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import get_db
+from app.models.database_models import OutboundMessageModel
+from app.services.chat_events import chat_events
+from app.services.metrics import metrics
+
+# Consegne contemporanee massime (sessioni diverse vengono servite in parallelo)
+DELIVERY_CONCURRENCY = 32
+# Parti caricate al massimo per ogni refresh della finestra
+WINDOW_LOAD_LIMIT = 10000
+
+
+def _as_utc(value: datetime) -> datetime:
+    """SQLite restituisce datetime naive: vanno interpretati come UTC"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def outbound_payload(item: OutboundMessageModel) -> Dict[str, Any]:
+    """Rappresentazione JSON di una parte, usata da webhook, SSE e API"""
+    return {
+        "id": item.id,
+        "session_id": item.session_id,
+        "source_message_id": item.source_message_id,
+        "part_index": item.part_index,
+        "text": item.text,
+        "sink": item.sink,
+        "status": item.status,
+        "attempts": item.attempts,
+        "due_at": _as_utc(item.due_at).isoformat(),
+        "delivered_at": _as_utc(item.delivered_at).isoformat() if item.delivered_at else None,
+        "last_error": item.last_error,
+    }
+
+
+class OutboundSink:
+    """Destinazione delle parti in uscita: deliver() solleva un'eccezione se la consegna fallisce"""
+    name = "base"
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class LogSink(OutboundSink):
+    """Stub locale: scrive la parte nel log"""
+    name = "log"
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        logger.info(f"📤 Sessione {item.session_id}, parte {item.part_index}: {item.text[:100]}")
+
+
+class WebhookSink(OutboundSink):
+    """POST JSON della parte verso outbound_webhook_url"""
+    name = "webhook"
+
+    def __init__(self, url: Optional[str], timeout_seconds: float):
+        self.url = url
+        self.timeout_seconds = timeout_seconds
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        if not self.url:
+            raise RuntimeError("OUTBOUND_WEBHOOK_URL non configurato")
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout_seconds)
+        response = await self._client.post(self.url, json=outbound_payload(item))
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class SSESink(OutboundSink):
+    """Inoltra la parte ai client connessi allo stream SSE della sessione
+
+    Senza client connessi la consegna fallisce e viene ritentata con backoff.
+    """
+    name = "sse"
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def connect(self, session_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def disconnect(self, session_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(session_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[session_id]
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        queues = self._subscribers.get(item.session_id)
+        if not queues:
+            raise RuntimeError(f"Nessun client SSE connesso per la sessione {item.session_id}")
+        payload = outbound_payload(item)
+        for queue in queues:
+            queue.put_nowait(payload)
+
+
+class ChatEventsSink(OutboundSink):
+    """Inoltra la parte ai client WebSocket della sessione (/ws/chat/{session_id})"""
+    name = "ws"
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        if not chat_events.has_subscribers(item.session_id):
+            raise RuntimeError(f"Nessun client WebSocket connesso per la sessione {item.session_id}")
+        chat_events.publish(item.session_id, {
+            "type": "message",
+            "role": "assistant",
+            "id": item.source_message_id,
+            "part_index": item.part_index,
+            "text": item.text,
+        })
+
+
+class OutboundScheduler:
+    """Coda di priorità delle parti in uscita, persistita in outbound_messages"""
+
+    def __init__(self, sinks: List[OutboundSink]):
+        self.sinks: Dict[str, OutboundSink] = {sink.name: sink for sink in sinks}
+        # (due_at come timestamp, id) delle parti in scadenza entro la finestra
+        self._heap: List[Tuple[float, int]] = []
+        self._queued: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def _push(self, item_id: int, due_at: datetime) -> None:
+        if item_id in self._queued:
+            return
+        heapq.heappush(self._heap, (_as_utc(due_at).timestamp(), item_id))
+        self._queued.add(item_id)
+
+    async def schedule(
+        self,
+        session_id: str,
+        messages: Union[str, List[Dict[str, Any]]],
+        sink: Optional[str] = None,
+        start_at: Optional[datetime] = None,
+    ) -> List[OutboundMessageModel]:
+        """Pianifica le parti di una risposta: la parte i esce dopo la somma dei delay_ms precedenti
+
+        Le parti sono identificate da (id del messaggio assistant, indice): pianificare due
+        volte la stessa risposta non duplica gli invii.
+        """
+        sink = sink or settings.outbound_sink
+        if sink not in self.sinks:
+            raise ValueError(f"Sink di consegna sconosciuto: {sink}")
+        if isinstance(messages, str):
+            messages = [{"text": messages, "delay_ms": 0}]
+        if not messages:
+            return []
+
+        source_message_id = messages[0].get("id")
+        due_at = start_at or datetime.now(timezone.utc)
+        items = []
+        for index, message in enumerate(messages):
+            items.append(OutboundMessageModel(
+                session_id=session_id,
+                source_message_id=source_message_id,
+                part_index=index,
+                text=str(message.get("text", "")),
+                sink=sink,
+                status="pending",
+                due_at=due_at,
+                attempts=0,
+            ))
+            due_at = due_at + timedelta(milliseconds=int(message.get("delay_ms") or 0))
+
+        async for db in get_db():
+            db.add_all(items)
+            try:
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()
+                logger.info(f"Risposta {source_message_id} già pianificata per la sessione {session_id}")
+                return []
+
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=settings.outbound_lookahead_seconds)
+        for item in items:
+            if _as_utc(item.due_at) <= horizon:
+                self._push(item.id, item.due_at)
+        self._wakeup.set()
+        metrics.increment("outbound_messages_total", value=len(items), event="scheduled", sink=sink)
+        return items
+
+    async def cancel(self, session_id: str) -> int:
+        """Annulla le parti non ancora consegnate di una sessione (es. presa in carico umana)"""
+        async for db in get_db():
+            result = await db.execute(
+                update(OutboundMessageModel)
+                .where(OutboundMessageModel.session_id == session_id, OutboundMessageModel.status == "pending")
+                .values(status="cancelled")
+            )
+            await db.commit()
+            return result.rowcount
+
+    async def list_messages(self, session_id: str, limit: int = 100) -> List[OutboundMessageModel]:
+        async for db in get_db():
+            result = await db.execute(
+                select(OutboundMessageModel)
+                .where(OutboundMessageModel.session_id == session_id)
+                .order_by(OutboundMessageModel.due_at, OutboundMessageModel.id)
+                .limit(limit)
+            )
+            return result.scalars().all()
+
+    async def stats(self) -> Dict[str, Any]:
+        async for db in get_db():
+            result = await db.execute(
+                select(OutboundMessageModel.status, func.count()).group_by(OutboundMessageModel.status)
+            )
+            return {
+                "by_status": {status: count for status, count in result.all()},
+                "in_memory": len(self._heap),
+                "next_due_in_seconds": round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+            }
+
+    @staticmethod
+    def _deliverable(now: datetime):
+        """Parti pendenti già scadute, o in consegna con lease scaduto"""
+        return or_(
+            and_(OutboundMessageModel.status == "pending", OutboundMessageModel.due_at <= now),
+            and_(OutboundMessageModel.status == "sending", OutboundMessageModel.locked_until < now),
+        )
+
+    async def _load_window(self) -> None:
+        """Porta nell'heap le parti in scadenza entro la finestra di lookahead"""
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=settings.outbound_lookahead_seconds)
+        async for db in get_db():
+            result = await db.execute(
+                select(OutboundMessageModel.id, OutboundMessageModel.due_at)
+                .where(self._deliverable(horizon))
+                .order_by(OutboundMessageModel.due_at)
+                .limit(WINDOW_LOAD_LIMIT)
+            )
+            for item_id, due_at in result.all():
+                self._push(item_id, due_at)
+
+    async def _claim(self, item_id: int) -> Optional[OutboundMessageModel]:
+        async for db in get_db():
+            now = datetime.now(timezone.utc)
+            result = await db.execute(
+                update(OutboundMessageModel)
+                .where(OutboundMessageModel.id == item_id, self._deliverable(now))
+                .values(
+                    status="sending",
+                    attempts=OutboundMessageModel.attempts + 1,
+                    locked_until=now + timedelta(seconds=settings.outbound_lease_seconds),
+                )
+            )
+            await db.commit()
+            if result.rowcount != 1:
+                # Già consegnata, annullata, posticipata o reclamata da un'altra istanza
+                return None
+            return await db.get(OutboundMessageModel, item_id, populate_existing=True)
+
+    async def _mark_sent(self, item: OutboundMessageModel) -> None:
+        async for db in get_db():
+            await db.execute(
+                update(OutboundMessageModel)
+                .where(OutboundMessageModel.id == item.id)
+                .values(status="sent", locked_until=None, delivered_at=datetime.now(timezone.utc))
+            )
+            await db.commit()
+
+    async def _mark_failed(self, item: OutboundMessageModel, error: Exception) -> None:
+        """Ritenta con backoff (posticipando le parti successive) o marca la parte come fallita"""
+        failed = item.attempts >= settings.outbound_max_attempts
+        backoff = timedelta(seconds=min(2 ** item.attempts, 300))
+        async for db in get_db():
+            await db.execute(
+                update(OutboundMessageModel)
+                .where(OutboundMessageModel.id == item.id)
+                .values(
+                    status="failed" if failed else "pending",
+                    locked_until=None,
+                    last_error=str(error)[:2000],
+                    due_at=datetime.now(timezone.utc) + backoff,
+                )
+            )
+            if not failed and item.source_message_id is not None:
+                # Poche parti per risposta: lo spostamento si calcola qui (l'aritmetica
+                # sulle date in SQL non è portabile su SQLite)
+                result = await db.execute(
+                    select(OutboundMessageModel.id, OutboundMessageModel.due_at).where(
+                        OutboundMessageModel.source_message_id == item.source_message_id,
+                        OutboundMessageModel.part_index > item.part_index,
+                        OutboundMessageModel.status == "pending",
+                    )
+                )
+                for later_id, due_at in result.all():
+                    await db.execute(
+                        update(OutboundMessageModel)
+                        .where(OutboundMessageModel.id == later_id, OutboundMessageModel.status == "pending")
+                        .values(due_at=_as_utc(due_at) + backoff)
+                    )
+            await db.commit()
+        metrics.increment("outbound_messages_total", event="failed" if failed else "retried", sink=item.sink)
+        if failed:
+            logger.error(f"Parte in uscita {item.id} non consegnata dopo {item.attempts} tentativi: {error}")
+        else:
+            logger.warning(f"Consegna della parte {item.id} fallita (tentativo {item.attempts}): {error}")
+
+    async def _deliver(self, item: OutboundMessageModel) -> None:
+        try:
+            sink = self.sinks.get(item.sink)
+            if sink is None:
+                raise RuntimeError(f"Sink di consegna sconosciuto: {item.sink}")
+            await sink.deliver(item)
+        except Exception as e:
+            await self._mark_failed(item, e)
+            return
+
+        await self._mark_sent(item)
+        lag = time.time() - _as_utc(item.due_at).timestamp()
+        metrics.increment("outbound_messages_total", event="sent", sink=item.sink)
+        metrics.observe("outbound_delivery_lag_seconds", max(lag, 0.0), sink=item.sink)
+
+    async def _deliver_session(self, items: List[OutboundMessageModel]) -> None:
+        # Le parti della stessa sessione escono in ordine, una alla volta
+        async with self._semaphore:
+            for item in items:
+                await self._deliver(item)
+
+    async def _deliver_due(self, item_ids: List[int]) -> None:
+        by_session: Dict[str, List[OutboundMessageModel]] = {}
+        for item_id in item_ids:
+            item = await self._claim(item_id)
+            if item is not None:
+                by_session.setdefault(item.session_id, []).append(item)
+        await asyncio.gather(*(self._deliver_session(items) for items in by_session.values()))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_refresh = 0.0
+        while True:
+            if loop.time() >= next_refresh:
+                try:
+                    await self._load_window()
+                except Exception as e:
+                    logger.warning(f"Errore nel caricamento delle parti in uscita: {e}")
+                next_refresh = loop.time() + settings.outbound_poll_interval_seconds
+
+            now_ts = time.time()
+            due_ids = []
+            while self._heap and self._heap[0][0] <= now_ts:
+                _, item_id = heapq.heappop(self._heap)
+                self._queued.discard(item_id)
+                due_ids.append(item_id)
+            if due_ids:
+                self._spawn(self._deliver_due(due_ids))
+
+            timeout = next_refresh - loop.time()
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - time.time())
+            self._wakeup.clear()
+            if timeout > 0:
+                # asyncio.wait (non wait_for) non assorbe una cancellazione che arriva
+                # insieme al risveglio: stop() termina sempre il loop
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait([waiter], timeout=timeout)
+                finally:
+                    waiter.cancel()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = [task for task in [self._task, *self._deliveries] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        for sink in self.sinks.values():
+            await sink.close()
+
+
+# Sink e scheduler globali
+sse_sink = SSESink()
+outbound_scheduler = OutboundScheduler([
+    LogSink(),
+    WebhookSink(settings.outbound_webhook_url, settings.outbound_webhook_timeout_seconds),
+    sse_sink,
+    ChatEventsSink(),
+])
@@ -0,0 +1,152 @@
+"""
+Formato della risposta dell'AI: verbose o lean
+
+- verbose: chiavi estese e tutti i campi (reasoning completo, scheletro di human_task).
+- lean: chiavi brevi, i campi con il valore predefinito vengono omessi, il reasoning è
+  facoltativo e limitato a poche parole, la task umana compare solo quando serve.
+  Meno token in uscita, quindi turni più rapidi.
+
+La modalità si sceglie per ambiente (AI_RESPONSE_MODE) oppure su una quota del traffico
+(AI_LEAN_TRAFFIC_PERCENT). La quota è calcolata per sessione, così una conversazione
+resta sempre nello stesso formato. Le risposte lean vengono riportate al formato verbose
+prima dell'elaborazione, quindi il resto del flusso non cambia.
+"""
+import hashlib
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.models.lifecycle import LifecycleStage
+
+VERBOSE = "verbose"
+LEAN = "lean"
+
+# Chiavi della risposta lean -> chiavi verbose
+LEAN_MESSAGE_KEYS = {"t": "text", "d": "delay_ms", "s": "snippet_id"}
+
+# Confidenza di un "lc" senza "c": il prompt chiede "lc" solo da 0.7 in su, quindi
+# la sua presenza vale almeno la soglia di transizione (0.5 la scarterebbe in silenzio)
+LEAN_IMPLIED_CONFIDENCE = 0.7
+
+# Nomi usati nelle istruzioni del prompt per la task umana e i riferimenti agli snippet
+PROMPT_KEYS = {
+    VERBOSE: {"human_task": "human_task", "snippet_ref": '{"snippet_id": "..."}'},
+    LEAN: {"human_task": "h", "snippet_ref": '{"s": "..."}'},
+}
+
+
+def traffic_bucket(session_id: str, salt: str = "") -> int:
+    """Bucket stabile 0-99 della sessione (`salt` distingue esperimenti diversi)"""
+    key = f"{salt}:{session_id}" if salt else session_id
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % 100
+
+
+def choose_response_mode(session_id: str) -> str:
+    """Formato della risposta per la sessione secondo la configurazione corrente"""
+    if settings.ai_response_mode == LEAN:
+        return LEAN
+    if traffic_bucket(session_id) < settings.ai_lean_traffic_percent:
+        return LEAN
+    return VERBOSE
+
+
+def is_lean_response(data: Any) -> bool:
+    return isinstance(data, dict) and "m" in data and "messages" not in data
+
+
+def _expand_message(message: Any) -> Any:
+    if not isinstance(message, dict):
+        return message
+    return {LEAN_MESSAGE_KEYS.get(key, key): value for key, value in message.items()}
+
+
+def expand_lean_response(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Risposta lean riportata alle chiavi verbose; le chiavi omesse restano assenti (valori predefiniti)"""
+    messages = data.get("m")
+    if isinstance(messages, list):
+        messages = [_expand_message(message) for message in messages]
+    else:
+        messages = _expand_message(messages)
+
+    expanded: Dict[str, Any] = {"messages": messages}
+    if data.get("lc"):
+        expanded["should_change_lifecycle"] = True
+        expanded["new_lifecycle"] = data["lc"]
+        expanded["confidence"] = LEAN_IMPLIED_CONFIDENCE
+    if data.get("c") is not None:
+        expanded["confidence"] = data["c"]
+    if data.get("r"):
+        expanded["reasoning"] = data["r"]
+
+    human_task = data.get("h")
+    if human_task:
+        if isinstance(human_task, str):
+            human_task = {"title": human_task[:120], "description": human_task}
+        expanded["requires_human"] = True
+        expanded["human_task"] = human_task
+    return expanded
+
+
+def response_format_block(mode: str, next_stage: Optional[LifecycleStage], include_decision: bool = True) -> str:
+    """Sezione del prompt con il formato JSON richiesto
+
+    Con include_decision=False (decisione del lifecycle affidata al classificatore) le
+    chiavi sul cambio di lifecycle non vengono chieste.
+    """
+    next_value = next_stage.value if next_stage else None
+    if mode == LEAN:
+        decision_keys = f"""
+    "lc": "{next_value or 'null'}",
+    "c": 0.0-1.0,
+    "r": "Motivo in massimo 12 parole",""" if include_decision else ""
+        decision_rules = """
+- "lc" e "c" solo se passi al prossimo lifecycle e ne sei sicuro al 70% o più (c >= 0.7)
+- "r" è facoltativo, al massimo 12 parole""" if include_decision else ""
+        return f"""FORMATO RISPOSTA RICHIESTO:
+Rispondi SEMPRE con un solo oggetto JSON a chiavi brevi:
+{{
+    "m": "La tua risposta completa"
+    OPPURE
+    "m": [
+        {{"t": "Prima parte del messaggio", "d": 10000}},
+        {{"s": "id_dello_snippet", "d": 10000}}
+    ],{decision_keys}
+    "h": {{"title": "Breve titolo della task", "description": "Dettaglio per l'operatore umano"}}
+}}
+
+IMPORTANTE:
+- Solo "m" è obbligatorio: ometti le altre chiavi quando non servono
+- "m" può essere una stringa o un array di oggetti con "t" (testo) oppure "s" (ID di uno snippet da inviare così com'è) e "d" (millisecondi di attesa prima del prossimo, minimo 10000 se multipli){decision_rules}
+- "h" solo se serve un operatore umano; in quel caso "m" è ""
+- La risposta deve essere SEMPRE un JSON valido"""
+
+    decision_keys = f"""
+    "should_change_lifecycle": true/false,
+    "new_lifecycle": "{next_value + ' o null' if next_value else 'null'}",
+    "reasoning": "Spiegazione del perché hai deciso di cambiare o non cambiare lifecycle",
+    "confidence": 0.0-1.0,""" if include_decision else ""
+    decision_rules = """
+- Cambia lifecycle solo se sei sicuro al 70% o più (confidence >= 0.7)""" if include_decision else ""
+    return f"""FORMATO RISPOSTA RICHIESTO:
+Devi rispondere SEMPRE in questo formato JSON:
+{{
+    "messages": "La tua risposta completa"
+    OPPURE
+    "messages": [
+        {{"text": "Prima parte del messaggio", "delay_ms": 10000}},
+        {{"text": "Seconda parte", "delay_ms": 10000}},
+        {{"snippet_id": "id_dello_snippet", "delay_ms": 10000}}
+    ],{decision_keys}
+    "requires_human": true/false,
+    "human_task": {{
+        "title": "Breve titolo della task",
+        "description": "Dettaglio della task per l'operatore umano",
+        "assigned_to": "opzionale@team.it",
+        "metadata": {{"key": "value"}}
+    }}
+}}
+
+IMPORTANTE:
+- Il campo "messages" può essere una stringa (risposta singola senza delay), un oggetto singolo con "text" e "delay_ms", o un array di oggetti
+- Ogni oggetto nell'array ha "text" (il messaggio) oppure "snippet_id" (lo snippet da inviare così com'è) e "delay_ms" (millisecondi di attesa prima del prossimo, minimo 10000ms se multipli){decision_rules}
+- La risposta deve essere SEMPRE un JSON valido"""
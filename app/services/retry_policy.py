@@ -0,0 +1,149 @@
+"""
+Retry delle chiamate al modello AI
+
+- Ogni errore è classificato (rate_limited, server_error, timeout, parse, fatal) e ogni
+  classe ha il suo budget di nuovi tentativi per turno; gli errori fatal (4xx, chiave
+  non valida, ...) non si riprovano mai.
+- Attesa tra i tentativi: backoff esponenziale con full jitter,
+  uniform(0, min(max_delay, base_delay * 2^tentativo)).
+- Deadline end-to-end: il livello HTTP (header X-Request-Timeout) e l'agente (SLA della
+  fase AI del turno) la impostano in un ContextVar; ogni tentativo è limitato dal tempo
+  rimasto e non si riprova se dopo l'attesa non resterebbe il tempo per un tentativo.
+"""
+import asyncio
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from app.config import settings
+from app.services.metrics import metrics
+
+RATE_LIMITED = "rate_limited"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+PARSE = "parse"
+FATAL = "fatal"
+
+# Istante (time.monotonic) entro cui il turno corrente deve concludersi
+_deadline: ContextVar[Optional[float]] = ContextVar("ai_request_deadline", default=None)
+
+_STATUS_IN_MESSAGE = re.compile(r"\b(429|500|502|503|504)\b")
+
+
+@contextmanager
+def request_deadline(seconds: Optional[float]) -> Iterator[Optional[float]]:
+    """Imposta la deadline a `seconds` da adesso (mai oltre quella già impostata)"""
+    if seconds is None:
+        yield _deadline.get()
+        return
+    deadline = time.monotonic() + max(0.0, seconds)
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(current, deadline)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining() -> Optional[float]:
+    """Secondi rimasti prima della deadline corrente (None se non c'è una deadline)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def classify_error(error: BaseException) -> str:
+    """Classe di errore di una chiamata fallita (decide il budget di retry)"""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or "Timeout" in type(error).__name__:
+        return TIMEOUT
+    if isinstance(error, ConnectionError):
+        return SERVER_ERROR
+
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if not isinstance(code, int):
+        match = _STATUS_IN_MESSAGE.search(str(error))
+        code = int(match.group(1)) if match else None
+    if code == 429 or "RESOURCE_EXHAUSTED" in str(error):
+        return RATE_LIMITED
+    if code is not None and 500 <= code < 600:
+        return SERVER_ERROR
+    return FATAL
+
+
+class RetryPolicy:
+    """Budget per classe di errore e parametri del backoff"""
+
+    def __init__(
+        self,
+        budgets: Dict[str, int],
+        base_delay_seconds: float = 0.5,
+        max_delay_seconds: float = 8.0,
+        min_attempt_seconds: float = 3.0,
+    ):
+        self.budgets = budgets
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.min_attempt_seconds = min_attempt_seconds
+
+    def start(self) -> "RetryState":
+        return RetryState(self)
+
+
+class RetryState:
+    """Tentativi di un turno: budget consumati e latenza aggiunta dai retry"""
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.retries: Dict[str, int] = {}
+        self.added_latency = 0.0
+
+    @property
+    def total_retries(self) -> int:
+        return sum(self.retries.values())
+
+    def next_delay(self, error_class: str, backoff: bool = True) -> Optional[float]:
+        """Attesa prima del prossimo tentativo, None se non si riprova (budget o deadline)
+
+        Con backoff=False (re-prompt dopo una risposta non parsabile) si riprova subito.
+        """
+        if self.retries.get(error_class, 0) >= self.policy.budgets.get(error_class, 0):
+            metrics.increment("ai_retry_exhausted_total", error=error_class, reason="budget")
+            return None
+        delay = 0.0
+        if backoff:
+            ceiling = min(self.policy.max_delay_seconds, self.policy.base_delay_seconds * 2 ** self.total_retries)
+            delay = random.uniform(0, ceiling)
+        remaining = time_remaining()
+        if remaining is not None and delay + self.policy.min_attempt_seconds > remaining:
+            metrics.increment("ai_retry_exhausted_total", error=error_class, reason="deadline")
+            return None
+        self.retries[error_class] = self.retries.get(error_class, 0) + 1
+        metrics.increment("ai_retries_total", error=error_class)
+        return delay
+
+    def record_outcome(self, success: bool) -> None:
+        """Esporta tentativi e latenza aggiunta dai retry (tentativi falliti e attese)"""
+        outcome = "success" if success else "failure"
+        metrics.observe("ai_call_attempts", self.total_retries + 1, buckets=(1, 2, 3, 4, 6, 8), outcome=outcome)
+        if self.retries:
+            metrics.observe("ai_retry_added_latency_seconds", self.added_latency, outcome=outcome)
+
+
+# Policy globale dei retry delle chiamate al modello AI
+ai_retry_policy = RetryPolicy(
+    budgets={
+        RATE_LIMITED: settings.ai_retry_rate_limited_budget,
+        SERVER_ERROR: settings.ai_retry_server_error_budget,
+        TIMEOUT: settings.ai_retry_timeout_budget,
+        PARSE: settings.ai_retry_parse_budget,
+    },
+    base_delay_seconds=settings.ai_retry_base_delay_seconds,
+    max_delay_seconds=settings.ai_retry_max_delay_seconds,
+    min_attempt_seconds=settings.ai_retry_min_attempt_seconds,
+)
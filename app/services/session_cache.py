@@ -0,0 +1,209 @@
+"""
+Cache LRU in-process dello stato delle sessioni, indicizzata per session_id esterno
+
+Evita di risolvere più volte per richiesta la stringa `session_id` in una riga di
+SessionModel. La cache è write-through: i percorsi di scrittura (UnifiedAgent, route
+delle task e di chiusura sessione) la aggiornano subito dopo il commit.
+
+Nota: con più worker/istanze ogni processo ha la sua cache; il TTL limita quanto a lungo
+uno stato scritto da un altro processo può restare non visto. I flag has_open_task e
+has_messages scadono in base a quando sono stati letti dal database (o scritti da questo
+processo), non all'ultima riscrittura della voce: una sessione attiva viene riscritta a
+ogni turno, ma una task umana aperta da un'altra istanza viene comunque vista entro il TTL.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from app.config import settings
+from app.models.database_models import SessionModel
+from app.models.lifecycle import LifecycleStage
+
+# Flag derivati da altre tabelle (human_tasks, messages), con una scadenza propria
+FLAG_FIELDS = ("has_open_task", "has_messages")
+
+
+@dataclass
+class CachedSession:
+    """Stato minimo di una sessione necessario per gestire un turno di chat"""
+    id: int
+    session_id: str
+    current_lifecycle: LifecycleStage
+    is_conversation_finished: bool = False
+    is_batch_waiting: bool = False
+    batch_started_at: Optional[datetime] = None
+    # None = non noto, serve una query per saperlo
+    has_open_task: Optional[bool] = None
+    has_messages: Optional[bool] = None
+    cached_at: float = field(default_factory=time.monotonic)
+    # Quando ciascun flag noto è stato letto dal database o scritto da questo processo
+    flags_at: Dict[str, float] = field(default_factory=dict)
+
+
+class SessionCache:
+    """LRU con limite di dimensione e TTL per lo stato delle sessioni"""
+
+    def __init__(self, max_size: int, ttl_seconds: float, enabled: bool = True):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, CachedSession]" = OrderedDict()
+        # Indice secondario id interno -> session_id (le task conoscono solo l'id interno)
+        self._by_id: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[CachedSession]:
+        """Ritorna lo stato in cache se presente e non scaduto"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if now - entry.cached_at > self.ttl_seconds:
+            self.invalidate(session_id)
+            self.misses += 1
+            return None
+        values, flags_at = self._fresh_flags(entry, now)
+        if flags_at != entry.flags_at:
+            # Flag scaduti: tornano non noti e vanno riletti dal database
+            entry = replace(entry, flags_at=flags_at, **values)
+            self._entries[session_id] = entry
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return entry
+
+    def put(self, entry: CachedSession) -> None:
+        """Inserisce o sostituisce uno stato, espellendo il meno usato oltre il limite"""
+        if not self.enabled:
+            return
+        self._entries[entry.session_id] = entry
+        self._entries.move_to_end(entry.session_id)
+        self._by_id[entry.id] = entry.session_id
+        while len(self._entries) > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._by_id.pop(evicted.id, None)
+
+    def _fresh_flags(self, entry: CachedSession, now: float) -> Tuple[Dict[str, Optional[bool]], Dict[str, float]]:
+        """Valori e istanti di lettura dei flag di `entry` non ancora scaduti (gli altri a None)"""
+        values: Dict[str, Optional[bool]] = {}
+        flags_at: Dict[str, float] = {}
+        for name in FLAG_FIELDS:
+            read_at = entry.flags_at.get(name)
+            if read_at is not None and now - read_at <= self.ttl_seconds:
+                values[name] = getattr(entry, name)
+                flags_at[name] = read_at
+            else:
+                values[name] = None
+        return values, flags_at
+
+    def store(self, session: SessionModel, **flags) -> CachedSession:
+        """Aggiorna la cache a partire da una riga di SessionModel appena letta o scritta
+
+        I flag non passati esplicitamente (has_open_task, has_messages) vengono
+        mantenuti dalla voce precedente, se presente, con il loro istante di lettura:
+        riscrivere la voce non ne allunga la validità.
+        """
+        now = time.monotonic()
+        previous = self._entries.get(session.session_id)
+        values, flags_at = self._fresh_flags(previous, now) if previous else ({}, {})
+        for name, value in flags.items():
+            values[name] = value
+            if value is None:
+                flags_at.pop(name, None)
+            else:
+                flags_at[name] = now
+        entry = CachedSession(
+            id=session.id,
+            session_id=session.session_id,
+            current_lifecycle=session.current_lifecycle,
+            is_conversation_finished=bool(session.is_conversation_finished),
+            is_batch_waiting=bool(session.is_batch_waiting),
+            batch_started_at=session.batch_started_at,
+            has_open_task=values.get("has_open_task"),
+            has_messages=values.get("has_messages"),
+            cached_at=now,
+            flags_at=flags_at,
+        )
+        self.put(entry)
+        return entry
+
+    def update(self, session_id: str, **fields) -> None:
+        """Aggiorna alcuni campi di una voce esistente (no-op se assente o scaduta)"""
+        entry = self.get(session_id)
+        if entry is not None:
+            now = time.monotonic()
+            flags_at = dict(entry.flags_at)
+            for name in FLAG_FIELDS:
+                if name in fields:
+                    if fields[name] is None:
+                        flags_at.pop(name, None)
+                    else:
+                        flags_at[name] = now
+            self.put(replace(entry, cached_at=now, flags_at=flags_at, **fields))
+
+    def update_by_id(self, internal_id: int, **fields) -> None:
+        """Come update(), ma a partire dall'id interno della sessione"""
+        session_id = self._by_id.get(internal_id)
+        if session_id is not None:
+            self.update(session_id, **fields)
+
+    def invalidate(self, session_id: str) -> None:
+        """Rimuove una sessione dalla cache"""
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._by_id.pop(entry.id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_id.clear()
+
+    def attach(self, entry: CachedSession, db: AsyncSession) -> SessionModel:
+        """Crea un'istanza persistente di SessionModel dalla cache senza SELECT
+
+        Gli attributi non presenti in cache (user_info, created_at, ...) restano non caricati:
+        il flusso di chat non li usa.
+        """
+        existing = db.identity_map.get(identity_key(SessionModel, entry.id))
+        if existing is not None:
+            return existing
+
+        session = SessionModel(
+            id=entry.id,
+            session_id=entry.session_id,
+            current_lifecycle=entry.current_lifecycle,
+            is_conversation_finished=entry.is_conversation_finished,
+            is_batch_waiting=entry.is_batch_waiting,
+            batch_started_at=entry.batch_started_at,
+        )
+        make_transient_to_detached(session)
+        db.add(session)
+        return session
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# Istanza globale della cache delle sessioni
+session_cache = SessionCache(
+    max_size=settings.session_cache_max_size,
+    ttl_seconds=settings.session_cache_ttl_seconds,
+    enabled=settings.session_cache_enabled,
+)
@@ -0,0 +1,161 @@
+"""
+Serializzazione per sessione dei turni di chat, valida anche tra worker e istanze
+
+Su PostgreSQL il lock è un `pg_advisory_xact_lock` sull'hash a 64 bit del session_id,
+rilasciato a fine transazione (anche se il processo muore). La connessione che lo tiene
+resta occupata per tutto il turno, chiamata AI compresa, quindi viene da un pool piccolo
+e separato (SESSION_LOCK_POOL_SIZE): i turni in attesa del lock non possono esaurire il
+pool delle query dei turni che lo hanno già ottenuto. Oltre la dimensione del pool si
+attende una connessione entro il timeout del lock, poi SessionLockTimeout.
+
+Prima del lock sul database si prende sempre un asyncio.Lock locale: le richieste
+concorrenti dello stesso processo attendono in memoria senza occupare connessioni.
+Su SQLite (un solo processo) basta il lock locale.
+"""
+import asyncio
+import hashlib
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.config import settings
+from app.database import engine, get_database_url
+from app.services.metrics import metrics
+
+
+class SessionLockTimeout(Exception):
+    """Il lock della sessione non è stato ottenuto entro il timeout"""
+    pass
+
+
+def advisory_key(session_id: str) -> int:
+    """Chiave bigint (con segno) per pg_advisory_xact_lock"""
+    digest = hashlib.blake2b(session_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class SessionLockManager:
+    """Lock per sessione: asyncio.Lock locale + advisory lock PostgreSQL"""
+
+    def __init__(self, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        # session_id -> (lock, numero di richieste che lo usano o attendono)
+        self._local: Dict[str, Tuple[asyncio.Lock, int]] = {}
+        self._engine: Optional[AsyncEngine] = None
+
+    @property
+    def uses_advisory_locks(self) -> bool:
+        return engine.dialect.name == "postgresql"
+
+    def lock_engine(self) -> AsyncEngine:
+        """Engine con il pool riservato ai lock, creato al primo uso"""
+        if self._engine is None:
+            self._engine = create_async_engine(
+                get_database_url(),
+                pool_size=settings.session_lock_pool_size,
+                max_overflow=0,
+                pool_timeout=self.timeout_seconds,
+                pool_pre_ping=True,
+            )
+        return self._engine
+
+    async def close(self) -> None:
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = None
+
+    def _local_lock(self, session_id: str) -> asyncio.Lock:
+        lock, users = self._local.get(session_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._local[session_id] = (lock, users + 1)
+        return lock
+
+    def _release_local(self, session_id: str) -> None:
+        lock, users = self._local[session_id]
+        if users <= 1:
+            del self._local[session_id]
+        else:
+            self._local[session_id] = (lock, users - 1)
+
+    @asynccontextmanager
+    async def hold(self, session_id: str, phase: str = "turn") -> AsyncIterator[None]:
+        """Esegue il blocco in esclusiva rispetto agli altri turni della stessa sessione
+
+        Args:
+            session_id: ID esterno della sessione
+            phase: etichetta per le metriche (es. "decision", "reply")
+        """
+        backend = "advisory" if self.uses_advisory_locks else "local"
+        started = time.perf_counter()
+        deadline = started + self.timeout_seconds
+        lock = self._local_lock(session_id)
+        try:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout=self.timeout_seconds)
+            except asyncio.TimeoutError:
+                metrics.increment("session_lock_timeouts_total", phase=phase, backend=backend)
+                raise SessionLockTimeout(f"Sessione {session_id} occupata da un altro turno")
+
+            try:
+                if not self.uses_advisory_locks:
+                    self._record_wait(started, phase, backend)
+                    held_since = time.perf_counter()
+                    try:
+                        yield
+                    finally:
+                        metrics.observe("session_lock_held_seconds", time.perf_counter() - held_since, phase=phase)
+                    return
+
+                try:
+                    conn = await asyncio.wait_for(
+                        self.lock_engine().connect().start(),
+                        timeout=max(deadline - time.perf_counter(), 0.001),
+                    )
+                except (asyncio.TimeoutError, PoolTimeoutError):
+                    metrics.increment("session_lock_timeouts_total", phase=phase, backend=backend)
+                    logger.warning(f"Pool dei lock di sessione esaurito, sessione {session_id} non servita")
+                    raise SessionLockTimeout(f"Sessione {session_id} occupata da un altro turno")
+
+                try:
+                    async with conn.begin():
+                        remaining_ms = max(int((deadline - time.perf_counter()) * 1000), 1)
+                        await conn.execute(text(f"SET LOCAL lock_timeout = {remaining_ms}"))
+                        try:
+                            await conn.execute(
+                                text("SELECT pg_advisory_xact_lock(:key)"),
+                                {"key": advisory_key(session_id)},
+                            )
+                        except Exception as e:
+                            metrics.increment("session_lock_timeouts_total", phase=phase, backend=backend)
+                            logger.warning(f"Advisory lock non ottenuto per sessione {session_id}: {e}")
+                            raise SessionLockTimeout(f"Sessione {session_id} occupata da un altro turno") from e
+
+                        self._record_wait(started, phase, backend)
+                        held_since = time.perf_counter()
+                        try:
+                            yield
+                        finally:
+                            metrics.observe("session_lock_held_seconds", time.perf_counter() - held_since, phase=phase)
+                finally:
+                    await conn.close()
+            finally:
+                lock.release()
+        finally:
+            self._release_local(session_id)
+
+    @staticmethod
+    def _record_wait(started: float, phase: str, backend: str) -> None:
+        waited = time.perf_counter() - started
+        metrics.observe("session_lock_wait_seconds", waited, phase=phase, backend=backend)
+        if waited > 1:
+            logger.info(f"Attesa lock di sessione ({phase}): {waited:.2f}s")
+
+
+# Istanza globale del gestore dei lock di sessione
+session_lock = SessionLockManager(timeout_seconds=settings.session_lock_timeout_seconds)
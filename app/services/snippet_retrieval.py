@@ -0,0 +1,84 @@
+"""
+Selezione degli snippet pertinenti ai messaggi recenti (BM25, Python puro)
+
+Ogni snippet è un documento con testo, nome, ID e argomenti (gli argomenti contano
+doppio). La tokenizzazione toglie accenti, stopword italiane e la vocale finale, così
+"costa", "costo" e "costi" coincidono. Gli indici sono costruiti dallo snippet store a
+ogni caricamento del CSV, uno per lifecycle sugli snippet disponibili in quella fase.
+"""
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+_WORD = re.compile(r"[a-z0-9€]+")
+
+_STOPWORDS_TEXT = """
+a ad al allo ai agli all alla alle anche avere c che chi ci come con cosa cui d da dal dallo dai dagli
+dalla dalle del dello dei degli della delle di e ed è era essere fa fare gli ha hai ho i il in io la le
+lei li lo loro lui ma me mi mia mie mio miei ne nei nel nello negli nella nelle no noi non o per perché
+più po poi qua quale quando quella quelle quello questa queste questo qui se sei si sia sono su sua sue
+suo suoi sul sullo sui sugli sulla sulle te ti tra tu tua tue tuo tuoi un una uno vi voi vostra vostro
+"""
+
+
+def _fold(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+STOPWORDS = frozenset(_fold(word) for word in _STOPWORDS_TEXT.split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Token normalizzati: minuscole senza accenti, senza stopword, senza vocale finale"""
+    tokens = []
+    for word in _WORD.findall(_fold(text.replace("_", " "))):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 3 and word[-1] in "aeio":
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 su un piccolo corpus (decine di documenti): punteggi calcolati al volo"""
+
+    def __init__(self, documents: Sequence[Tuple[str, str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = [doc_id for doc_id, _ in documents]
+        self._term_freqs = [Counter(tokenize(text)) for _, text in documents]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+
+        doc_freq: Counter = Counter()
+        for tf in self._term_freqs:
+            doc_freq.update(tf.keys())
+        total = len(documents)
+        self._idf: Dict[str, float] = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        """I `top_k` documenti con punteggio positivo, dal più pertinente"""
+        terms = [t for t in set(tokenize(query)) if t in self._idf]
+        if not terms or top_k <= 0:
+            return []
+        scored = []
+        for doc_id, tf, length in zip(self.ids, self._term_freqs, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length)
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self._idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scored.append((doc_id, score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:top_k]
@@ -0,0 +1,333 @@
+"""
+Snippet store: testi degli snippet da app/snippets/Snippets.csv, indicizzati in memoria
+
+- Indici per ID, gruppo (SNIPPET_GROUPS), lifecycle e argomento (colonna "Argomenti").
+- Per ogni lifecycle i blocchi del prompt (script guida numerato e snippet disponibili)
+  e l'indice BM25 della selezione per turno sono costruiti al caricamento. Lo script
+  guida ha due versioni, con e senza il nome del contatto (NAME_DEPENDENT_STEPS).
+- Hot reload: un task controlla mtime e dimensione del CSV ogni
+  SNIPPETS_RELOAD_INTERVAL_SECONDS; il nuovo indice viene costruito in un thread e
+  sostituito con un solo assegnamento, quindi le richieste vedono sempre un indice
+  completo (il vecchio o il nuovo). Ogni worker ricarica il proprio, senza riavvii.
+- L'AI può rispondere con {"snippet_id": ...} invece di riscrivere il testo: render()
+  restituisce lo snippet con i placeholder compilati dai dati del contatto. Gli snippet
+  con segnaposto da completare a mano ([LINK], NOME, Buon/a) non sono referenziabili:
+  nel prompt compaiono senza ID e l'AI deve riscriverli.
+- Gli ID assenti dal CSV usano i testi di app/data/snippets.py; se il CSV non è
+  leggibile resta in uso l'ultimo indice valido.
+"""
+import asyncio
+import csv
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import settings
+from app.data.lifecycle_config import LIFECYCLE_SCRIPTS
+from app.data.snippets import ALL_SNIPPETS, NAME_DEPENDENT_STEPS, SNIPPET_GROUPS
+from app.models.lifecycle import LifecycleStage
+from app.services.metrics import metrics
+from app.services.snippet_retrieval import BM25Index
+
+# Placeholder del CRM nel testo degli snippet, es. {{$contact.firstname}}
+PLACEHOLDER_PATTERN = re.compile(r"\{\{\s*\$?([\w.]+)\s*\}\}")
+# Lo stesso placeholder con gli spazi che lo precedono (tolti insieme se manca il valore)
+_PLACEHOLDER_WITH_SPACE = re.compile(r"([ \t]*)" + PLACEHOLDER_PATTERN.pattern)
+
+# Come i placeholder appaiono nel prompt: l'AI li sostituisce (es. NOME, come in risposta_tardiva3)
+PROMPT_PLACEHOLDERS = {
+    "contact.firstname": "NOME",
+}
+
+# Segnaposto che il CRM non compila (da completare a mano): [LINK], NOME, Buon/a
+MANUAL_PLACEHOLDER_PATTERN = re.compile(r"\[[A-Z]+\]|\bNOME\b|\w/a\b")
+
+NO_SNIPPETS_TEXT = "Nessuno snippet disponibile per questa fase."
+
+
+@dataclass(frozen=True)
+class Snippet:
+    id: str
+    name: str
+    text: str
+    topics: Tuple[str, ...] = ()
+    groups: Tuple[str, ...] = ()
+
+    @property
+    def referenceable(self) -> bool:
+        """False se il testo ha segnaposto da completare: non può essere inviato tale e quale"""
+        return MANUAL_PLACEHOLDER_PATTERN.search(self.text) is None
+
+
+def render_for_prompt(text: str) -> str:
+    """Testo dello snippet con i placeholder noti resi come nel prompt"""
+    return PLACEHOLDER_PATTERN.sub(lambda m: PROMPT_PLACEHOLDERS.get(m.group(1), m.group(0)), text)
+
+
+def fill_placeholders(text: str, values: Dict[str, str]) -> str:
+    """Testo con i placeholder compilati da `values`
+
+    Un placeholder senza valore viene tolto insieme allo spazio che lo precede, così
+    "Bene {{$contact.firstname}} !! :)" senza nome diventa "Bene !! :)".
+    """
+    def replace(match: "re.Match[str]") -> str:
+        value = values.get(match.group(2))
+        return f"{match.group(1)}{value}" if value else ""
+
+    return _PLACEHOLDER_WITH_SPACE.sub(replace, text).strip()
+
+
+def _split_topics(raw: str) -> Tuple[str, ...]:
+    return tuple(t.strip().lower() for t in re.split(r"[,;|]", raw or "") if t.strip())
+
+
+@dataclass
+class SnippetIndex:
+    """Fotografia immutabile degli snippet: non viene mai modificata dopo la costruzione"""
+    by_id: Dict[str, Snippet]
+    by_group: Dict[str, Tuple[Snippet, ...]]
+    by_topic: Dict[str, Tuple[Snippet, ...]]
+    by_lifecycle: Dict[LifecycleStage, Tuple[Snippet, ...]]
+    # Script guida per (lifecycle, nome del contatto noto)
+    script_blocks: Dict[Tuple[LifecycleStage, bool], str]
+    # Lifecycle il cui script ha passi diversi in base al nome del contatto
+    name_dependent_scripts: FrozenSet[LifecycleStage]
+    snippet_blocks: Dict[LifecycleStage, str]
+    # Righe "- id: testo" già renderizzate e indici BM25 per lifecycle (selezione per turno)
+    snippet_lines: Dict[str, str]
+    retrievers: Dict[LifecycleStage, BM25Index]
+    source: str
+    signature: Optional[Tuple[int, int]] = None
+    loaded_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def build(cls, rows: List[Dict[str, str]], source: str, signature: Optional[Tuple[int, int]] = None) -> "SnippetIndex":
+        membership: Dict[str, List[str]] = {}
+        for group, ids in SNIPPET_GROUPS.items():
+            for snippet_id in ids:
+                membership.setdefault(snippet_id, []).append(group)
+
+        by_id: Dict[str, Snippet] = {
+            snippet_id: Snippet(snippet_id, snippet_id, text, groups=tuple(membership.get(snippet_id, ())))
+            for snippet_id, text in ALL_SNIPPETS.items()
+        }
+        for row in rows:
+            snippet_id = (row.get("ID") or "").strip()
+            text = (row.get("Messaggio") or "").strip()
+            if not snippet_id or not text:
+                continue
+            by_id[snippet_id] = Snippet(
+                id=snippet_id,
+                name=(row.get("Nome") or snippet_id).strip(),
+                text=text,
+                topics=_split_topics(row.get("Argomenti", "")),
+                groups=tuple(membership.get(snippet_id, ())),
+            )
+
+        by_group = {
+            group: tuple(by_id[i] for i in ids if i in by_id)
+            for group, ids in SNIPPET_GROUPS.items()
+        }
+        topics: Dict[str, List[Snippet]] = {}
+        for snippet in by_id.values():
+            for topic in snippet.topics:
+                topics.setdefault(topic, []).append(snippet)
+
+        # Gli snippet non referenziabili compaiono senza ID: l'AI li riscrive completandoli
+        snippet_lines = {
+            s.id: f"- {s.id}: {render_for_prompt(s.text)}" if s.referenceable
+            else f"- (da adattare) {render_for_prompt(s.text)}"
+            for s in by_id.values()
+        }
+        by_lifecycle: Dict[LifecycleStage, Tuple[Snippet, ...]] = {}
+        script_blocks: Dict[Tuple[LifecycleStage, bool], str] = {}
+        name_dependent_scripts = set()
+        snippet_blocks: Dict[LifecycleStage, str] = {}
+        retrievers: Dict[LifecycleStage, BM25Index] = {}
+        for lifecycle, config in LIFECYCLE_SCRIPTS.items():
+            script = by_group.get(config.get("script") or "", ())
+            available: List[Snippet] = []
+            for group in config.get("available_snippets") or []:
+                available.extend(s for s in by_group.get(group, ()) if s not in available)
+            by_lifecycle[lifecycle] = tuple(available)
+            for name_known in (True, False):
+                steps = [s for s in script if NAME_DEPENDENT_STEPS.get(s.id, name_known) == name_known]
+                script_blocks[(lifecycle, name_known)] = "\n".join(
+                    f"{i + 1}. [{s.id}] {render_for_prompt(s.text)}" if s.referenceable
+                    else f"{i + 1}. {render_for_prompt(s.text)}"
+                    for i, s in enumerate(steps)
+                )
+            if any(s.id in NAME_DEPENDENT_STEPS for s in script):
+                name_dependent_scripts.add(lifecycle)
+            snippet_blocks[lifecycle] = "\n".join(snippet_lines[s.id] for s in available) or NO_SNIPPETS_TEXT
+            retrievers[lifecycle] = BM25Index([
+                (s.id, " ".join((s.name, s.id, s.text) + s.topics * 2)) for s in available
+            ])
+
+        return cls(
+            by_id=by_id,
+            by_group=by_group,
+            by_topic={topic: tuple(items) for topic, items in topics.items()},
+            by_lifecycle=by_lifecycle,
+            script_blocks=script_blocks,
+            name_dependent_scripts=frozenset(name_dependent_scripts),
+            snippet_blocks=snippet_blocks,
+            snippet_lines=snippet_lines,
+            retrievers=retrievers,
+            source=source,
+            signature=signature,
+        )
+
+
+class SnippetStore:
+    """Indice corrente degli snippet e ricarica quando il CSV cambia"""
+
+    def __init__(self, csv_path: str, reload_interval_seconds: float = 5.0):
+        self.csv_path = csv_path
+        self.reload_interval_seconds = reload_interval_seconds
+        self._index: Optional[SnippetIndex] = None
+        # Firma dell'ultimo CSV non leggibile: non lo si riprova finché non cambia
+        self._failed_signature: Optional[Tuple[int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.csv_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _build(self) -> SnippetIndex:
+        signature = self._signature()
+        if signature is None:
+            logger.warning(f"CSV degli snippet {self.csv_path} non trovato: uso i testi predefiniti")
+            return SnippetIndex.build([], source="builtin")
+        with open(self.csv_path, encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.DictReader(f))
+        return SnippetIndex.build(rows, source=self.csv_path, signature=signature)
+
+    @property
+    def index(self) -> SnippetIndex:
+        if self._index is None:
+            # Primo accesso prima dello startup (script, test): caricamento sincrono
+            self._index = self._build()
+        return self._index
+
+    def _swap(self, index: SnippetIndex) -> None:
+        self._index = index
+        metrics.increment("snippet_store_reloads_total", result="ok")
+        logger.info(f"Snippet caricati: {len(index.by_id)} da {index.source}")
+
+    async def load(self) -> SnippetIndex:
+        """Costruisce l'indice in un thread e lo rende corrente"""
+        async with self._lock:
+            try:
+                index = await asyncio.to_thread(self._build)
+            except (OSError, csv.Error, UnicodeDecodeError) as e:
+                metrics.increment("snippet_store_reloads_total", result="error")
+                logger.error(f"Ricarica degli snippet da {self.csv_path} fallita, resta l'indice precedente: {e}")
+                self._failed_signature = self._signature()
+                if self._index is None:
+                    self._index = SnippetIndex.build([], source="builtin")
+                return self._index
+            self._swap(index)
+            return index
+
+    async def reload_if_changed(self) -> bool:
+        current = self._index
+        signature = self._signature()
+        if current is not None and signature in (current.signature, self._failed_signature):
+            return False
+        await self.load()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval_seconds)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                logger.warning(f"Controllo del CSV degli snippet fallito: {e}")
+
+    async def start(self) -> None:
+        await self.load()
+        if self._task is None and self.reload_interval_seconds > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get(self, snippet_id: str) -> Optional[Snippet]:
+        return self.index.by_id.get(snippet_id)
+
+    def text(self, snippet_id: str) -> str:
+        snippet = self.index.by_id.get(snippet_id)
+        return snippet.text if snippet else ""
+
+    def render(self, snippet_id: str, values: Dict[str, str]) -> Optional[str]:
+        """Testo dello snippet pronto per l'invio (placeholder compilati), None se l'ID non esiste"""
+        snippet = self.index.by_id.get(snippet_id)
+        return fill_placeholders(snippet.text, values) if snippet else None
+
+    def script_block(self, lifecycle: LifecycleStage, name_known: bool = True) -> str:
+        return self.index.script_blocks.get((lifecycle, name_known), "")
+
+    def script_uses_name(self, lifecycle: LifecycleStage) -> bool:
+        """True se lo script del lifecycle cambia in base al nome del contatto"""
+        return lifecycle in self.index.name_dependent_scripts
+
+    def snippets_block(self, lifecycle: LifecycleStage) -> str:
+        return self.index.snippet_blocks.get(lifecycle, NO_SNIPPETS_TEXT)
+
+    def select_snippets_block(self, lifecycle: LifecycleStage, query: str, top_k: int) -> str:
+        """Blocco con i soli `top_k` snippet più pertinenti a `query` (BM25)
+
+        Senza nessun risultato (messaggi brevi o formulati con parole diverse da quelle
+        degli snippet) si usa il blocco completo del lifecycle: meglio un prompt più lungo
+        che lasciare l'AI senza snippet.
+        """
+        index = self.index
+        retriever = index.retrievers.get(lifecycle)
+        if retriever is None or not len(retriever):
+            return NO_SNIPPETS_TEXT
+        if top_k >= len(retriever):
+            return index.snippet_blocks[lifecycle]
+        hits = retriever.search(query, top_k)
+        metrics.observe("snippet_retrieval_selected", len(hits), buckets=(0, 1, 2, 3, 5, 8, 13))
+        if not hits:
+            metrics.increment("snippet_retrieval_fallback_total", lifecycle=lifecycle.value)
+            return index.snippet_blocks[lifecycle]
+        return "\n".join(index.snippet_lines[snippet_id] for snippet_id, _ in hits)
+
+    def snippets_for_lifecycle(self, lifecycle: LifecycleStage) -> Tuple[Snippet, ...]:
+        return self.index.by_lifecycle.get(lifecycle, ())
+
+    def snippets_for_topic(self, topic: str) -> Tuple[Snippet, ...]:
+        return self.index.by_topic.get(topic.strip().lower(), ())
+
+    def stats(self) -> Dict[str, object]:
+        index = self.index
+        return {
+            "source": index.source,
+            "count": len(index.by_id),
+            "topics": len(index.by_topic),
+            "loaded_at": index.loaded_at,
+        }
+
+
+# Istanza globale dello snippet store
+snippet_store = SnippetStore(
+    csv_path=settings.snippets_csv_path,
+    reload_interval_seconds=settings.snippets_reload_interval_seconds,
+)
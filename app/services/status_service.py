@@ -0,0 +1,137 @@
+"""
+Snapshot dello stato dell'applicazione aggiornato in background
+
+Le sonde dei load balancer e degli uptime monitor (/status, /health/ready, /unified/health)
+leggono lo snapshot in memoria invece di interrogare il database o chiamare l'AI a ogni hit.
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from sqlalchemy import func, select
+
+from app.config import settings
+from app.database import engine, get_db
+from app.models.database_models import HumanTaskModel, SessionModel
+
+
+class StatusMonitor:
+    """Mantiene uno snapshot dello stato (DB, sessioni, task, AI) aggiornato periodicamente"""
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.snapshot: Dict[str, Any] = {}
+        self.refreshed_at: Optional[float] = None
+        self.db_ok = False
+        self.startup_complete = False
+        # Durata (secondi) dei passi di avvio, registrata dal lifespan
+        self.startup_timings: Dict[str, float] = {}
+        self.last_llm_success_at: Optional[datetime] = None
+        self.last_llm_error_at: Optional[datetime] = None
+        self.last_llm_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record_llm_success(self) -> None:
+        """Registrata dall'agente a ogni chiamata AI riuscita"""
+        self.last_llm_success_at = datetime.now(timezone.utc)
+
+    def record_llm_failure(self, error: Exception) -> None:
+        """Registrata dall'agente a ogni chiamata AI fallita"""
+        self.last_llm_error_at = datetime.now(timezone.utc)
+        self.last_llm_error = str(error)
+
+    @staticmethod
+    def _pool_status() -> Dict[str, Any]:
+        """Stato del connection pool (i pool senza contatori riportano solo la classe)"""
+        pool = engine.pool
+        status: Dict[str, Any] = {"class": type(pool).__name__}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            method = getattr(pool, name, None)
+            if callable(method):
+                try:
+                    status[name] = method()
+                except Exception:
+                    pass
+        return status
+
+    async def refresh(self) -> Dict[str, Any]:
+        """Ricalcola lo snapshot con poche query aggregate"""
+        sessions_by_lifecycle: Dict[str, int] = {}
+        open_tasks = None
+        try:
+            async for db in get_db():
+                result = await db.execute(
+                    select(SessionModel.current_lifecycle, func.count(SessionModel.id))
+                    .group_by(SessionModel.current_lifecycle)
+                )
+                for lifecycle, count in result.all():
+                    sessions_by_lifecycle[lifecycle.value if lifecycle else "unknown"] = count
+
+                result = await db.execute(
+                    select(func.count(HumanTaskModel.id)).where(HumanTaskModel.completed == False)
+                )
+                open_tasks = result.scalar() or 0
+            self.db_ok = True
+        except Exception as e:
+            self.db_ok = False
+            logger.warning(f"Aggiornamento snapshot di stato fallito: {e}")
+
+        self.refreshed_at = time.monotonic()
+        self.snapshot = {
+            "refreshed_at": datetime.now(timezone.utc).isoformat(),
+            "database": {"ok": self.db_ok, "pool": self._pool_status()},
+            "sessions": {
+                "total": sum(sessions_by_lifecycle.values()),
+                "by_lifecycle": sessions_by_lifecycle,
+            },
+            "open_human_tasks": open_tasks,
+        }
+        return self.get_snapshot()
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """Snapshot corrente con i campi AI sempre aggiornati (non richiedono query)"""
+        snapshot = dict(self.snapshot)
+        snapshot["llm"] = {
+            "last_success_at": self.last_llm_success_at.isoformat() if self.last_llm_success_at else None,
+            "last_error_at": self.last_llm_error_at.isoformat() if self.last_llm_error_at else None,
+            "last_error": self.last_llm_error,
+        }
+        snapshot["age_seconds"] = round(time.monotonic() - self.refreshed_at, 1) if self.refreshed_at else None
+        snapshot["startup"] = self.startup_timings
+        return snapshot
+
+    def is_ready(self) -> bool:
+        """Pronto se l'avvio è terminato e l'ultimo refresh recente ha raggiunto il database"""
+        if not self.startup_complete or self.refreshed_at is None:
+            return False
+        fresh = time.monotonic() - self.refreshed_at < self.refresh_interval * 3
+        return self.db_ok and fresh
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Errore nel refresher dello stato: {e}")
+
+    async def start(self) -> None:
+        """Primo refresh sincrono e avvio del task periodico"""
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Istanza globale del monitor di stato
+status_monitor = StatusMonitor(refresh_interval=settings.status_refresh_interval_seconds)
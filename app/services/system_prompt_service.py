@@ -1,10 +1,12 @@
 """
 Servizio per la gestione dei system prompts nel database
 """
-from typing import List, Optional
+import time
+from typing import List, Optional, Tuple
 from sqlalchemy import select
 from loguru import logger
 
+from app.config import settings
 from app.database import get_db
 from app.models.database_models import SystemPromptModel
 
@@ -12,19 +14,46 @@ from app.models.database_models import SystemPromptModel
 class SystemPromptService:
     """Servizio per gestire i system prompts"""
 
+    # Cache in-process del prompt attivo (nome, contenuto), invalidata dalle scritture
+    _active_cache: Optional[Tuple[Optional[str], Optional[str]]] = None
+    _active_cached_at: float = 0.0
+
     @staticmethod
-    async def get_active_prompt() -> Optional[str]:
-        """Ottiene il prompt di sistema attivo"""
+    def invalidate_active_cache() -> None:
+        """Forza la rilettura del prompt attivo alla prossima richiesta"""
+        SystemPromptService._active_cache = None
+
+    @staticmethod
+    async def _get_active_record() -> Tuple[Optional[str], Optional[str]]:
+        """Nome e contenuto del prompt attivo, dalla cache se ancora valida"""
+        cached = SystemPromptService._active_cache
+        if cached is not None and time.monotonic() - SystemPromptService._active_cached_at < settings.active_config_cache_ttl_seconds:
+            return cached
+
         async for db in get_db():
             try:
                 result = await db.execute(
-                    select(SystemPromptModel).where(SystemPromptModel.is_active == True)
+                    select(SystemPromptModel.name, SystemPromptModel.content).where(SystemPromptModel.is_active == True)
                 )
-                prompt = result.scalar_one_or_none()
-                return prompt.content if prompt else None
+                row = result.first()
+                SystemPromptService._active_cache = (row.name, row.content) if row else (None, None)
+                SystemPromptService._active_cached_at = time.monotonic()
+                return SystemPromptService._active_cache
             except Exception as e:
                 logger.error(f"Errore nel recupero del prompt attivo: {e}")
-                return None
+                return None, None
+
+    @staticmethod
+    async def get_active_prompt() -> Optional[str]:
+        """Ottiene il prompt di sistema attivo"""
+        _, content = await SystemPromptService._get_active_record()
+        return content
+
+    @staticmethod
+    async def get_active_prompt_name() -> Optional[str]:
+        """Ottiene il nome del prompt di sistema attivo"""
+        name, _ = await SystemPromptService._get_active_record()
+        return name
 
     @staticmethod
     async def get_all_prompts() -> List[SystemPromptModel]:
@@ -84,6 +113,7 @@ class SystemPromptService:
                     prompt.description = description
 
                 await db.commit()
+                SystemPromptService.invalidate_active_cache()
                 logger.info(f"Prompt aggiornato: {prompt_id}")
                 return True
             except Exception as e:
@@ -110,6 +140,7 @@ class SystemPromptService:
 
                 prompt.is_active = True
                 await db.commit()
+                SystemPromptService.invalidate_active_cache()
                 logger.info(f"Prompt attivo impostato: {prompt_id}")
                 return True
             except Exception as e:
@@ -130,6 +161,7 @@ class SystemPromptService:
 
                 await db.delete(prompt)
                 await db.commit()
+                SystemPromptService.invalidate_active_cache()
                 logger.info(f"Prompt eliminato: {prompt_id}")
                 return True
             except Exception as e:
@@ -161,6 +193,7 @@ class SystemPromptService:
                     # Attiva quello esistente
                     existing_default.is_active = True
                     await db.commit()
+                    SystemPromptService.invalidate_active_cache()
                     logger.info("Prompt default esistente attivato")
                     return
                 else:
@@ -0,0 +1,136 @@
+"""
+Timeline di una sessione (messaggi + transizioni di lifecycle) per la vista conversazione
+
+Messaggi ed eventi arrivano dal database già ordinati, quindi la timeline si costruisce
+con un solo passaggio di merge: un evento ancorato a un messaggio (trigger_message_id)
+viene emesso subito prima di quel messaggio, gli altri in ordine di tempo, prima dei
+messaggi con lo stesso timestamp.
+
+Le timeline restano in cache per sessione. Prima di usarle si confronta un'impronta
+(numero e id massimo di messaggi ed eventi) letta con una sola query aggregata: un nuovo
+messaggio o evento, scritto da qualsiasi processo, invalida la voce.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models.database_models import LifecycleEventModel, MessageModel
+from app.services.metrics import metrics
+
+Fingerprint = Tuple[int, Optional[int], int, Optional[int]]
+
+
+def _ensure_aware(dt: Optional[datetime]) -> Optional[datetime]:
+    if dt and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _message_entry(msg: MessageModel) -> Dict[str, Any]:
+    return {
+        'type': 'message',
+        'id': msg.id,
+        'role': msg.role,
+        'message': msg.message,
+        'timestamp': _ensure_aware(msg.timestamp),
+        'lifecycle': msg.lifecycle.value if msg.lifecycle else None
+    }
+
+
+def _event_entry(ev: LifecycleEventModel) -> Dict[str, Any]:
+    return {
+        'type': 'lifecycle_event',
+        'id': ev.id,
+        'previous_lifecycle': ev.previous_lifecycle.value if ev.previous_lifecycle else None,
+        'new_lifecycle': ev.new_lifecycle.value,
+        'timestamp': _ensure_aware(ev.created_at),
+        'message_id': ev.trigger_message_id
+    }
+
+
+def merge_timeline(messages: Sequence[MessageModel], events: Sequence[LifecycleEventModel]) -> List[Dict[str, Any]]:
+    """Unisce messaggi (ordinati per timestamp, id) ed eventi (ordinati per created_at) in O(n + m)"""
+    message_ids = {msg.id for msg in messages}
+    anchored: Dict[int, List[LifecycleEventModel]] = {}
+    floating: List[LifecycleEventModel] = []
+    for ev in events:
+        if ev.trigger_message_id in message_ids:
+            anchored.setdefault(ev.trigger_message_id, []).append(ev)
+        else:
+            floating.append(ev)
+
+    entries: List[Dict[str, Any]] = []
+    next_event = 0
+    for msg in messages:
+        timestamp = _ensure_aware(msg.timestamp)
+        while next_event < len(floating) and _ensure_aware(floating[next_event].created_at) <= timestamp:
+            entries.append(_event_entry(floating[next_event]))
+            next_event += 1
+        for ev in anchored.get(msg.id, ()):
+            entries.append(_event_entry(ev))
+        entries.append(_message_entry(msg))
+    entries.extend(_event_entry(ev) for ev in floating[next_event:])
+    return entries
+
+
+class TimelineService:
+    """Costruzione e cache LRU delle timeline per id interno di sessione"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, Tuple[Fingerprint, List[Dict[str, Any]]]]" = OrderedDict()
+
+    @staticmethod
+    async def _fingerprint(db: AsyncSession, session_pk: int) -> Fingerprint:
+        def aggregate(column, session_column):
+            return select(column).where(session_column == session_pk).scalar_subquery()
+
+        result = await db.execute(select(
+            aggregate(func.count(MessageModel.id), MessageModel.session_id),
+            aggregate(func.max(MessageModel.id), MessageModel.session_id),
+            aggregate(func.count(LifecycleEventModel.id), LifecycleEventModel.session_id),
+            aggregate(func.max(LifecycleEventModel.id), LifecycleEventModel.session_id),
+        ))
+        return tuple(result.one())
+
+    async def get_timeline(self, db: AsyncSession, session_pk: int) -> List[Dict[str, Any]]:
+        """Timeline della sessione; la lista restituita è condivisa e non va modificata"""
+        fingerprint = await self._fingerprint(db, session_pk)
+        cached = self._entries.get(session_pk)
+        if cached is not None and cached[0] == fingerprint:
+            self._entries.move_to_end(session_pk)
+            metrics.increment("timeline_cache_total", result="hit")
+            return cached[1]
+
+        metrics.increment("timeline_cache_total", result="miss")
+        messages_result = await db.execute(
+            select(MessageModel)
+            .where(MessageModel.session_id == session_pk)
+            .order_by(MessageModel.timestamp.asc(), MessageModel.id.asc())
+        )
+        events_result = await db.execute(
+            select(LifecycleEventModel)
+            .where(LifecycleEventModel.session_id == session_pk)
+            .order_by(LifecycleEventModel.created_at.asc(), LifecycleEventModel.id.asc())
+        )
+        entries = merge_timeline(messages_result.scalars().all(), events_result.scalars().all())
+
+        self._entries[session_pk] = (fingerprint, entries)
+        self._entries.move_to_end(session_pk)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entries
+
+    def invalidate(self, session_pk: int) -> None:
+        self._entries.pop(session_pk, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+# Istanza globale del servizio timeline
+timeline_service = TimelineService(max_size=settings.timeline_cache_max_size)
@@ -3,21 +3,22 @@ Agente unificato che gestisce conversazione e lifecycle management in un'unica c
 """
 import json
 import time
-from typing import Dict, Optional, List, Union
+from typing import TYPE_CHECKING, Any, Dict, Optional, List, Tuple, Union
 from datetime import datetime, timezone
-from sqlalchemy import select, func
+from sqlalchemy import select, func, inspect as sa_inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 import asyncio
 
-from datapizza.clients.google import GoogleClient
-from datapizza.agents import Agent
+if TYPE_CHECKING:
+    # datapizza (e l'SDK Google) è pesante da importare: viene caricato al primo uso
+    from datapizza.agents import Agent
 
 from app.models.lifecycle import (
     LifecycleStage,
     LifecycleResponse
 )
-from app.data.lifecycle_config import LIFECYCLE_SCRIPTS
+from app.data.lifecycle_config import LIFECYCLE_SCRIPTS, get_degraded_reply
 from app.config import settings
 from app.database import get_db
 from app.models.database_models import SessionModel, MessageModel
@@ -26,6 +27,25 @@ from app.logger_config import log_capture
 import json as json_lib
 
 from app.services.system_prompt_service import SystemPromptService
+from app.services.session_cache import session_cache
+from app.services.status_service import status_monitor
+from app.services.session_lock import session_lock, SessionLockTimeout
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError, ai_circuit_breaker, classifier_circuit_breaker
+from app.services.metrics import metrics
+from app.services.snippet_store import snippet_store
+from app.services.lifecycle_classifier import (
+    SPLIT, UNIFIED, build_decision_prompt, choose_decision_mode, parse_decision, stay_decision,
+)
+from app.services.response_mode import (
+    LEAN, PROMPT_KEYS, VERBOSE, choose_response_mode, expand_lean_response, is_lean_response, response_format_block,
+)
+from app.services.model_hedging import model_latency, race_models
+from app.services.model_routing_service import ModelRoutingService
+from app.services.retry_policy import (
+    FATAL, PARSE, RetryState, ai_retry_policy, classify_error, request_deadline, time_remaining
+)
+
+DEFAULT_MODEL_NAME = "gemini-flash-latest"
 
 
 class ChatbotError(Exception):
@@ -38,11 +58,33 @@ class AIError(ChatbotError):
     pass
 
 
+class AIUnavailableError(AIError):
+    """Circuito dell'AI aperto: la chiamata non viene tentata"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class ParsingError(ChatbotError):
     """Errore nel parsing della risposta AI"""
     pass
 
 
+# Risposta automatica al primo messaggio di un nuovo lead (inviata prima del turno AI)
+FIRST_MESSAGE_AUTO_RESPONSE = """Ciao! Grazie di avermi scritto!
+
+Questo è un messaggio automatico che ho scritto personalmente per riuscire a ringraziarti subito della fiducia!🙏
+
+Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti personalmente l'attenzione che meriti."""
+
+# Aggiunto al prompt quando la risposta precedente non era JSON valido
+REPROMPT_AFTER_PARSE_ERROR = """
+
+ATTENZIONE: la tua risposta precedente non era un JSON valido nel formato richiesto ({error}).
+Rispondi di nuovo con il solo oggetto JSON nel formato richiesto, senza testo prima o dopo."""
+
+
 class UnifiedAgent:
     """Agente unificato che gestisce conversazione e lifecycle management"""
 
@@ -53,23 +95,49 @@ class UnifiedAgent:
             if not settings.google_ai_api_key:
                 raise ValueError("GOOGLE_AI_API_KEY non configurata nel file .env")
 
-            # Inizializza il client Google
-            self.client = GoogleClient(
-                api_key=settings.google_ai_api_key,
-                model="gemini-flash-latest",
-            )
+            # Client Google per modello, creati al primo uso (o da warm_up all'avvio)
+            self._clients: Dict[str, Any] = {}
 
             # Carica il prompt di sistema attivo dal database
             # Nota: il prompt verrà caricato dinamicamente per ogni richiesta
             self.agent = None  # Verrà inizializzato al primo uso
 
+            # Ultimo risultato della sonda AI, riusato fino a llm_probe_interval_seconds
+            self._health_result: Optional[Dict[str, str]] = None
+            self._health_checked_at: Optional[float] = None
+            self._health_lock = asyncio.Lock()
+
             logger.info("UnifiedAgent inizializzato con successo")
 
         except Exception as e:
             logger.error(f"Errore nell'inizializzazione di UnifiedAgent: {e}")
             raise
 
-    async def _get_agent(self, model_name: str = None) -> Agent:
+    def _get_client(self, model_name: str) -> Any:
+        """Restituisce il client Google per il modello, creandolo al primo uso"""
+        client = self._clients.get(model_name)
+        if client is None:
+            from datapizza.clients.google import GoogleClient
+
+            client = GoogleClient(
+                api_key=settings.google_ai_api_key,
+                model=model_name,
+            )
+            self._clients[model_name] = client
+        return client
+
+    @property
+    def client(self) -> Any:
+        """Client del modello di default"""
+        return self._get_client(DEFAULT_MODEL_NAME)
+
+    async def warm_up(self) -> None:
+        """Importa datapizza e crea il client del modello attivo fuori dal percorso di una richiesta"""
+        from app.services.ai_model_service import AIModelService
+        model_name = await AIModelService.get_active_model_name(DEFAULT_MODEL_NAME)
+        await asyncio.to_thread(self._get_client, model_name)
+
+    async def _get_agent(self, model_name: str = None) -> "Agent":
         """Ottiene l'agente con il prompt di sistema attivo e il modello specificato
 
         Args:
@@ -79,8 +147,7 @@ class UnifiedAgent:
         if not model_name:
             # Se non specificato, usa il modello attivo dal database
             from app.services.ai_model_service import AIModelService
-            active_model = await AIModelService.get_active_model()
-            model_name = active_model.name if active_model else "gemini-flash-latest"
+            model_name = await AIModelService.get_active_model_name(DEFAULT_MODEL_NAME)
 
         logger.info(f"Utilizzo del modello: {model_name}")
 
@@ -91,15 +158,11 @@ class UnifiedAgent:
         logger.info(f"{system_prompt}")
         logger.info("===============================================")
 
-        # Crea un nuovo client con il modello specificato
-        client = GoogleClient(
-            api_key=settings.google_ai_api_key,
-            model=model_name,
-        )
+        from datapizza.agents import Agent
 
-        # Inizializza l'agente con il prompt caricato
+        # Inizializza l'agente con il prompt caricato e il client del modello
         agent = Agent(
-            client=client,
+            client=self._get_client(model_name),
             name="Corposostenibile Unified Agent",
             system_prompt=system_prompt,
         )
@@ -108,6 +171,11 @@ class UnifiedAgent:
         return agent
 
     async def get_or_create_session(self, session_id: str, db: AsyncSession) -> SessionModel:
+        # Sessione già vista da questo processo: nessuna SELECT
+        cached = session_cache.get(session_id)
+        if cached:
+            return session_cache.attach(cached, db)
+
         # Cerca la sessione esistente
         result = await db.execute(
             select(SessionModel).where(SessionModel.session_id == session_id)
@@ -115,6 +183,7 @@ class UnifiedAgent:
         session = result.scalar_one_or_none()
 
         if session:
+            session_cache.store(session)
             return session
 
         # Crea una nuova sessione
@@ -122,19 +191,19 @@ class UnifiedAgent:
         db.add(new_session)
         await db.commit()
         await db.refresh(new_session)
+        session_cache.store(new_session, has_open_task=False, has_messages=False)
         logger.info(f"Nuova sessione creata: {session_id}")
         return new_session
 
-    def _format_snippets_context(self, snippets: Dict[str, str]) -> str:
-        """Formatta gli snippet disponibili per il contesto del prompt"""
-        if not snippets:
-            return "Nessuno snippet disponibile per questa fase."
-
-        snippets_list = []
-        for snippet_id, snippet_content in snippets.items():
-            snippets_list.append(f"- {snippet_id}: {snippet_content}")
-
-        return "\n".join(snippets_list)
+    @staticmethod
+    def _batch_window_elapsed(session: SessionModel, wait_seconds: int) -> bool:
+        """La finestra di batch aperta sulla sessione è già scaduta (nessun turno la sta attendendo)"""
+        started_at = session.batch_started_at
+        if started_at is None:
+            return True
+        if started_at.tzinfo is None:
+            started_at = started_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - started_at).total_seconds() >= wait_seconds
 
     def _clean_ai_response(self, ai_response: str) -> str:
         """Pulisce la risposta AI rimuovendo markdown e spazi extra"""
@@ -145,36 +214,39 @@ class UnifiedAgent:
             cleaned_response = cleaned_response[:-3]
         return cleaned_response.strip()
 
-    async def _add_user_message_to_history(self, session: SessionModel, user_message: str, db: AsyncSession) -> None:
+    async def _add_user_message_to_history(self, session: SessionModel, user_message: str, db: AsyncSession, client_message_id: Optional[str] = None) -> None:
         """Aggiunge solo il messaggio utente alla cronologia senza risposta dell'assistente"""
-        # Deduplicate identical user messages sent within a short time window
-        try:
-            from sqlalchemy import select
-
-            result = await db.execute(
-                select(MessageModel)
-                .where(MessageModel.session_id == session.id)
-                .order_by(MessageModel.timestamp.desc())
-                .limit(1)
-            )
-            last_msg = result.scalar_one_or_none()
-            if last_msg and last_msg.role == "user":
-                # If exactly the same text and sent within 3 seconds, skip duplicate
-                delta = datetime.now(timezone.utc) - last_msg.timestamp
-                if last_msg.message.strip() == user_message.strip() and delta.total_seconds() < 3:
-                    return
-        except Exception:
-            # If anything fails, fallback to saving message
-            pass
-
         user_msg = MessageModel(
             session_id=session.id,
             role="user",
             message=user_message,
-            timestamp=datetime.now(timezone.utc)
+            timestamp=datetime.now(timezone.utc),
+            client_message_id=client_message_id
         )
         db.add(user_msg)
         await db.commit()
+        session_cache.update(session.session_id, has_messages=True)
+
+    async def _find_client_message(self, session: SessionModel, client_message_id: str, db: AsyncSession) -> Optional[Tuple[int, Optional[str]]]:
+        """Id del messaggio utente già registrato con questa chiave e risposta salvata del suo turno"""
+        result = await db.execute(
+            select(MessageModel.id, MessageModel.response_json).where(
+                MessageModel.session_id == session.id,
+                MessageModel.client_message_id == client_message_id
+            ).limit(1)
+        )
+        return result.one_or_none()
+
+    async def _has_reply_after(self, session: SessionModel, message_id: int, db: AsyncSession) -> bool:
+        """Verifica se esiste una risposta dell'assistente successiva al messaggio"""
+        result = await db.execute(
+            select(MessageModel.id).where(
+                MessageModel.session_id == session.id,
+                MessageModel.role == "assistant",
+                MessageModel.id > message_id
+            ).limit(1)
+        )
+        return result.scalar_one_or_none() is not None
 
     def _parse_ai_response(self, ai_response: str) -> Dict:
         """Parssa la risposta JSON dell'AI"""
@@ -190,35 +262,89 @@ class UnifiedAgent:
             try:
                 # Initialize variables used in all control flows
                 created_task = None
-                fixed = self._repair_unescaped_inner_quotes(cleaned_response, keys=["text", "reasoning", "message"])
+                fixed = self._repair_unescaped_inner_quotes(cleaned_response, keys=["text", "reasoning", "message", "t", "r"])
                 return json.loads(fixed)
             except Exception:
                 logger.error(f"Riparazione JSON fallita. Raw response: {ai_response}")
                 raise ParsingError(f"Errore nel parsing della risposta AI: {str(e)}")
 
     def _normalize_messages(self, messages: Union[str, Dict, List]) -> List[Dict[str, Union[str, int]]]:
-        """Normalizza i messaggi da stringa, dict singolo o lista eterogenea a lista uniforme"""
+        """Normalizza i messaggi da stringa, dict singolo o lista eterogenea a lista uniforme
+
+        Gli oggetti con "snippet_id" mantengono il riferimento, espanso poi da _expand_snippet_refs.
+        """
         if isinstance(messages, str):
             return [{"text": messages, "delay_ms": 0}]
         elif isinstance(messages, dict):
-            return [{
-                "text": messages.get("text", ""),
-                "delay_ms": messages.get("delay_ms", 0)
-            }]
+            return [self._normalize_message_item(messages, default_delay_ms=0)]
         elif isinstance(messages, list):
             normalized_messages = []
             for msg in messages:
                 if isinstance(msg, dict):
-                    normalized_messages.append({
-                        "text": msg.get("text", ""),
-                        "delay_ms": msg.get("delay_ms", 1000)
-                    })
+                    normalized_messages.append(self._normalize_message_item(msg, default_delay_ms=1000))
                 else:
                     normalized_messages.append({"text": str(msg), "delay_ms": 1000})
             return normalized_messages
         else:
             return [{"text": str(messages), "delay_ms": 0}]
 
+    def _normalize_message_item(self, msg: Dict, default_delay_ms: int) -> Dict[str, Union[str, int]]:
+        item = {
+            "text": msg.get("text", ""),
+            "delay_ms": msg.get("delay_ms", default_delay_ms)
+        }
+        if msg.get("snippet_id"):
+            item["snippet_id"] = str(msg["snippet_id"]).strip()
+        return item
+
+    async def _contact_fields(self, session: SessionModel, db: AsyncSession) -> Dict[str, str]:
+        """Valori dei placeholder {{$contact.*}} dai dati del contatto salvati in user_info"""
+        if "user_info" in sa_inspect(session).unloaded:
+            # Sessione ricostruita dalla cache: user_info non è stato caricato
+            await db.refresh(session, ["user_info"])
+        try:
+            info = json.loads(session.user_info or "{}")
+        except (TypeError, ValueError):
+            return {}
+        if not isinstance(info, dict):
+            return {}
+
+        fields = {
+            f"contact.{key.lower()}": str(value).strip()
+            for key, value in info.items()
+            if isinstance(value, (str, int, float)) and str(value).strip()
+        }
+        for alias in ("first_name", "nome"):
+            if fields.get(f"contact.{alias}"):
+                fields.setdefault("contact.firstname", fields[f"contact.{alias}"])
+        return fields
+
+    def _expand_snippet_refs(self, messages: List[Dict[str, Union[str, int]]], contact: Dict[str, str]) -> List[Dict[str, Union[str, int]]]:
+        """Sostituisce i riferimenti {"snippet_id": ...} con il testo esatto dello snippet
+
+        Un ID sconosciuto senza testo alternativo o uno snippet non referenziabile (segnaposto
+        da completare) è un errore di parsing: il prompt viene ripetuto.
+        """
+        expanded = []
+        for msg in messages:
+            snippet_id = msg.pop("snippet_id", None)
+            if snippet_id is not None:
+                snippet = snippet_store.get(snippet_id)
+                if snippet is not None and not snippet.referenceable:
+                    metrics.increment("ai_snippet_refs_total", result="not_referenceable")
+                    raise ParsingError(f"snippet_id '{snippet_id}' non referenziabile: va riscritto completando i segnaposto")
+                text = snippet_store.render(snippet_id, contact)
+                if text is None:
+                    metrics.increment("ai_snippet_refs_total", result="unknown")
+                    logger.warning(f"Snippet '{snippet_id}' richiesto dall'AI non trovato")
+                    if not msg["text"]:
+                        raise ParsingError(f"snippet_id '{snippet_id}' inesistente")
+                else:
+                    metrics.increment("ai_snippet_refs_total", result="expanded")
+                    msg["text"] = text
+            expanded.append(msg)
+        return expanded
+
     def _repair_unescaped_inner_quotes(self, text: str, keys: list[str]) -> str:
         """Ripara stringhe JSON dove l'AI ha inserito doppi apici non scappati all'interno del contenuto.
 
@@ -269,21 +395,185 @@ class UnifiedAgent:
 
         return ''.join(chars)
 
-    async def _call_ai_agent(self, prompt: str, model_name: str = None, context: str = "") -> str:
-        """Chiama l'agente AI e gestisce gli errori
+    async def _call_ai_agent(self, prompt: str, model_name: str = None, context: str = "", retry: Optional[RetryState] = None, breaker: CircuitBreaker = ai_circuit_breaker) -> str:
+        """Chiama l'agente AI riprovando gli errori transitori (429, 5xx, timeout)
+
+        I tentativi seguono ai_retry_policy (budget per classe di errore, backoff con full
+        jitter) e restano entro la deadline corrente; un circuito aperto non si riprova.
 
         Args:
             prompt: Il prompt da inviare all'AI
             model_name: Nome del modello da utilizzare (opzionale)
             context: Contesto aggiuntivo per il logging
+            retry: Stato dei retry del turno (budget condivisi con il re-prompt); se assente
+                ne viene creato uno per questa chiamata
+            breaker: Circuit breaker che registra gli esiti (quello del classificatore per
+                le chiamate del classificatore lifecycle)
         """
+        owns_retry = retry is None
+        if retry is None:
+            retry = ai_retry_policy.start()
+
+        while True:
+            attempt_started = time.monotonic()
+            try:
+                text = await self._attempt_ai_call(prompt, model_name, context, breaker)
+            except AIUnavailableError:
+                if owns_retry:
+                    retry.record_outcome(False)
+                raise
+            except AIError as e:
+                error_class = classify_error(e.__cause__ or e)
+                delay = retry.next_delay(error_class) if error_class != FATAL else None
+                if delay is None:
+                    if owns_retry:
+                        retry.record_outcome(False)
+                    raise
+                logger.warning(f"Errore AI ({error_class}){context}, nuovo tentativo tra {delay:.2f}s")
+                await asyncio.sleep(delay)
+                retry.added_latency += time.monotonic() - attempt_started
+                continue
+            if owns_retry:
+                retry.record_outcome(True)
+            return text
+
+    async def _attempt_ai_call(self, prompt: str, model_name: Optional[str], context: str, breaker: CircuitBreaker = ai_circuit_breaker) -> str:
+        """Singolo tentativo, attraverso il circuit breaker e limitato dal tempo rimasto"""
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            metrics.increment("ai_deadline_exceeded_total")
+            raise AIError(f"Deadline del turno superata prima della chiamata AI{context}") from TimeoutError()
+
+        if settings.ai_circuit_enabled:
+            try:
+                breaker.acquire()
+            except CircuitOpenError as e:
+                raise AIUnavailableError(f"AI non disponibile{context}: {e}", retry_after=e.retry_after)
+
+        started = time.monotonic()
         try:
-            agent = await self._get_agent(model_name=model_name)
-            ai_result = await agent.a_run(prompt)
-            return ai_result.text
+            async with asyncio.timeout(remaining):
+                text = await self._run_models(prompt, model_name)
+        except asyncio.CancelledError:
+            if settings.ai_circuit_enabled:
+                breaker.release()
+            raise
         except Exception as ai_error:
+            if settings.ai_circuit_enabled:
+                breaker.record_failure(time.monotonic() - started)
+            status_monitor.record_llm_failure(ai_error)
+            if isinstance(ai_error, TimeoutError) and remaining is not None:
+                metrics.increment("ai_deadline_exceeded_total")
             logger.error(f"Errore con l'AI{context}: {ai_error}")
-            raise AIError(f"Errore nell'elaborazione della richiesta AI{context}: {str(ai_error)}")
+            raise AIError(f"Errore nell'elaborazione della richiesta AI{context}: {str(ai_error)}") from ai_error
+        if settings.ai_circuit_enabled:
+            breaker.record_success(time.monotonic() - started)
+        status_monitor.record_llm_success()
+        return text
+
+    async def _run_model(self, prompt: str, model_name: str) -> str:
+        """Chiamata a un singolo modello; le latenze alimentano l'hedge delay
+
+        Una chiamata cancellata (primario lento superato dall'hedge) registra il tempo
+        trascorso come limite inferiore della sua latenza: senza questi campioni il p95
+        vedrebbe solo le risposte veloci e l'hedge delay si accorcerebbe sempre di più.
+        """
+        started = time.monotonic()
+        try:
+            agent = await self._get_agent(model_name=model_name)
+            ai_result = await agent.a_run(prompt)
+        except asyncio.CancelledError:
+            model_latency.record(model_name, time.monotonic() - started)
+            raise
+        model_latency.record(model_name, time.monotonic() - started)
+        return ai_result.text
+
+    async def _run_models(self, prompt: str, model_name: Optional[str]) -> str:
+        """Il modello richiesto o, con l'hedging attivo, la corsa con la sua catena di fallback"""
+        from app.services.ai_model_service import AIModelService
+        if not model_name:
+            model_name = await AIModelService.get_active_model_name(DEFAULT_MODEL_NAME)
+        if not settings.ai_hedging_enabled:
+            return await self._run_model(prompt, model_name)
+
+        chain, hedge_delays = await AIModelService.get_hedging_config()
+        models = [model_name] + [name for name in chain if name != model_name]
+        if len(models) == 1:
+            return await self._run_model(prompt, model_name)
+
+        hedge_delay = model_latency.hedge_delay(model_name, hedge_delays.get(model_name))
+        winner, text = await race_models(lambda name: self._run_model(prompt, name), models, hedge_delay)
+        if winner != model_name:
+            log_capture.add_log("INFO", f"AI response from fallback model {winner}")
+        return text
+
+    async def _ask_ai(self, prompt: str, session: SessionModel, db: AsyncSession, model_name: Optional[str] = None, decision_prompt: Optional[str] = None) -> Dict:
+        """Chiamata AI ed elaborazione della risposta entro la deadline della fase AI del turno
+
+        La deadline è la più stretta tra quella della richiesta HTTP e ai_turn_deadline_seconds.
+        Se la risposta non è JSON valido il prompt viene ripetuto indicando l'errore, finché
+        il budget "parse" e la deadline lo consentono. Con `decision_prompt` (modalità split)
+        il classificatore lifecycle gira in parallelo e la sua decisione viene unita alla risposta.
+        """
+        decision_mode = SPLIT if decision_prompt else UNIFIED
+        started = time.monotonic()
+        retry = ai_retry_policy.start()
+        with request_deadline(settings.ai_turn_deadline_seconds):
+            decision_task = None
+            if decision_prompt:
+                decision_task = asyncio.create_task(self._classify_lifecycle(decision_prompt, session))
+            current_prompt = prompt
+            try:
+                while True:
+                    ai_response = await self._call_ai_agent(current_prompt, model_name=model_name, retry=retry)
+                    decision = await decision_task if decision_task else None
+                    try:
+                        result = await self._process_ai_response(ai_response, session, db, decision=decision)
+                    except ParsingError as e:
+                        if retry.next_delay(PARSE, backoff=False) is None:
+                            raise
+                        logger.warning(f"Risposta AI non valida per sessione {session.session_id}, nuova richiesta: {e}")
+                        log_capture.add_log("INFO", "AI response not valid JSON, re-prompting")
+                        current_prompt = prompt + REPROMPT_AFTER_PARSE_ERROR.format(error=e)
+                        continue
+                    retry.record_outcome(True)
+                    metrics.observe("ai_turn_seconds", time.monotonic() - started, buckets=(1, 2, 4, 8, 15, 30, 60), decision_mode=decision_mode)
+                    metrics.increment(
+                        "lifecycle_decisions_total",
+                        decision_mode=decision_mode,
+                        lifecycle=session.current_lifecycle.value,
+                        outcome="change" if result["should_change"] else "stay",
+                    )
+                    return result
+            except ChatbotError:
+                retry.record_outcome(False)
+                raise
+            finally:
+                if decision_task is not None and not decision_task.done():
+                    decision_task.cancel()
+
+    async def _classify_lifecycle(self, decision_prompt: str, session: SessionModel) -> Dict:
+        """Decisione del lifecycle con LIFECYCLE_DECISION_PROMPT (modalità split)
+
+        Un errore del classificatore non fa fallire il turno: il lifecycle resta invariato.
+        Gli esiti vanno sul circuit breaker del classificatore, non su quello delle risposte.
+        """
+        started = time.monotonic()
+        try:
+            response = await self._call_ai_agent(
+                decision_prompt,
+                model_name=settings.lifecycle_classifier_model,
+                context=" (lifecycle_classifier)",
+                breaker=classifier_circuit_breaker,
+            )
+            decision = parse_decision(self._parse_ai_response(response), session.current_lifecycle)
+            outcome = "ok"
+        except Exception as e:
+            logger.warning(f"Classificatore lifecycle non disponibile per sessione {session.session_id}: {e}")
+            decision = stay_decision(f"Classificatore lifecycle non disponibile: {e}")
+            outcome = "error"
+        metrics.observe("lifecycle_classifier_seconds", time.monotonic() - started, buckets=(0.5, 1, 2, 4, 8, 15), outcome=outcome)
+        return decision
 
     async def _handle_lifecycle_transition(self, session: SessionModel, new_lifecycle_str: str, confidence: float, db: AsyncSession) -> bool:
         """Gestisce la transizione del lifecycle se necessario"""
@@ -322,10 +612,19 @@ class UnifiedAgent:
 
         return False
 
-    async def _process_ai_response(self, ai_response: str, session: SessionModel, db: AsyncSession) -> Dict:
-        """Elabora la risposta AI completa: parsing, normalizzazione, transizione"""
-        # Parse risposta AI
+    async def _process_ai_response(self, ai_response: str, session: SessionModel, db: AsyncSession, decision: Optional[Dict] = None) -> Dict:
+        """Elabora la risposta AI completa: parsing, normalizzazione, transizione
+
+        In modalità split `decision` è la decisione del classificatore lifecycle e sostituisce
+        quella (assente) della risposta.
+        """
+        # Parse risposta AI (le risposte lean sono riportate alle chiavi verbose)
         response_data = self._parse_ai_response(ai_response)
+        response_mode = VERBOSE
+        if is_lean_response(response_data):
+            response_mode = LEAN
+            response_data = expand_lean_response(response_data)
+        metrics.observe("ai_response_chars", len(ai_response), buckets=(100, 200, 400, 800, 1600, 3200), mode=response_mode)
 
         # Estrai dati
         messages = response_data.get("messages") or response_data.get("message", "Ciao! Come posso aiutarti oggi?")
@@ -335,6 +634,11 @@ class UnifiedAgent:
         confidence = response_data.get("confidence", 0.5)
         requires_human = response_data.get("requires_human", False)
         human_task = response_data.get("human_task")
+        if decision is not None:
+            should_change = decision["should_change"]
+            new_lifecycle_str = decision["new_lifecycle_str"] or session.current_lifecycle.value
+            confidence = decision["confidence"]
+            reasoning = decision["reasoning"]
 
         # Normalizza messaggi
         # If a human task is required, the AI should not return messages for the user
@@ -342,6 +646,9 @@ class UnifiedAgent:
             normalized_messages = []
         else:
             normalized_messages = self._normalize_messages(messages)
+            if any("snippet_id" in msg for msg in normalized_messages):
+                contact = await self._contact_fields(session, db)
+                normalized_messages = self._expand_snippet_refs(normalized_messages, contact)
 
         # Gestisci transizione lifecycle: ora viene applicata solo dopo che l'eventuale
         # assistant message è stato salvato nella cronologia (per evitare transizioni duplicate
@@ -361,16 +668,17 @@ class UnifiedAgent:
             "full_message_text": "\n---SPLIT---\n".join([msg["text"] for msg in normalized_messages])
         }
 
-    async def _build_conversation_context(self, session: SessionModel, db: AsyncSession) -> str:
-        """Costruisce il contesto della conversazione dalla cronologia"""
-        # Ottieni l'intera cronologia della conversazione in ordine cronologico
+    async def _load_history(self, session: SessionModel, db: AsyncSession) -> List[MessageModel]:
+        """L'intera cronologia della sessione in ordine cronologico"""
         result = await db.execute(
             select(MessageModel)
             .where(MessageModel.session_id == session.id)
             .order_by(MessageModel.timestamp.asc(), MessageModel.id.asc())
         )
-        messages = result.scalars().all()
+        return list(result.scalars().all())
 
+    def _format_conversation_context(self, messages: List[MessageModel]) -> str:
+        """Costruisce il contesto della conversazione dalla cronologia"""
         if not messages:
             return "Nessuna conversazione precedente."
 
@@ -383,29 +691,77 @@ class UnifiedAgent:
 
         return "\n".join(context_lines)
 
-    async def _get_unified_prompt(self, session: SessionModel, user_message: str, db: AsyncSession) -> str:
-        """Genera il prompt unificato che gestisce conversazione e lifecycle"""
+    def _select_snippets(self, lifecycle: LifecycleStage, user_message: str, messages: List[MessageModel]) -> str:
+        """Snippet del lifecycle per il prompt: i più pertinenti ai messaggi recenti o tutti"""
+        if not settings.snippet_retrieval_enabled:
+            return snippet_store.snippets_block(lifecycle)
+        recent = [m.message for m in messages if m.role == "user"][-settings.snippet_retrieval_history_messages:]
+        query = "\n".join(recent + [user_message])
+        return snippet_store.select_snippets_block(lifecycle, query, settings.snippet_retrieval_top_k)
+
+    async def _get_prompts(self, session: SessionModel, user_message: str, db: AsyncSession, history: Optional[List[MessageModel]] = None) -> Tuple[str, Optional[str]]:
+        """Prompt della risposta e, in modalità split, prompt del classificatore lifecycle"""
+        if history is None:
+            history = await self._load_history(session, db)
+        if choose_decision_mode(session.session_id) == SPLIT:
+            decision_prompt = build_decision_prompt(
+                session.current_lifecycle, user_message, self._format_conversation_context(history)
+            )
+            if decision_prompt is not None:
+                prompt = await self._get_unified_prompt(session, user_message, db, history=history, include_decision=False)
+                return prompt, decision_prompt
+        return await self._get_unified_prompt(session, user_message, db, history=history), None
+
+    async def _route_model(self, session: SessionModel, history: List[MessageModel], requested: Optional[str]) -> Optional[str]:
+        """Modello del turno: quello richiesto esplicitamente o la regola di routing del lifecycle
+
+        None = modello attivo. La decisione viene registrata a ogni turno.
+        """
+        lifecycle = session.current_lifecycle
+        if requested:
+            route_label, model_name = "request", requested
+        else:
+            route = await ModelRoutingService.resolve(lifecycle, len(history))
+            route_label, model_name = (str(route.id), route.model_name) if route else ("default", None)
+
+        shown = model_name or "attivo"
+        logger.info(f"Routing modello per sessione {session.session_id}: {shown} (regola {route_label}, lifecycle {lifecycle.value}, {len(history)} messaggi)")
+        log_capture.add_log("INFO", f"Model route: {shown} (rule {route_label}, lifecycle {lifecycle.value}, history {len(history)})")
+        metrics.increment("model_route_decisions_total", lifecycle=lifecycle.value, model=shown, route=route_label)
+        return model_name
+
+    async def _get_unified_prompt(self, session: SessionModel, user_message: str, db: AsyncSession, history: Optional[List[MessageModel]] = None, include_decision: bool = True) -> str:
+        """Genera il prompt unificato che gestisce conversazione e lifecycle
+
+        Con include_decision=False il prompt chiede solo la risposta: il cambio di lifecycle
+        è deciso dal classificatore (modalità split).
+        """
         current_lifecycle = session.current_lifecycle
         current_config = LIFECYCLE_SCRIPTS.get(current_lifecycle, {})
 
-        # Informazioni sul lifecycle corrente
-        script_raw = current_config.get("script", "")
-        if isinstance(script_raw, list):
-            # Se è una lista di snippet, formatta come elenco numerato
-            script_text = "\n".join(f"{i+1}. {snippet}" for i, snippet in enumerate(script_raw))
-        else:
-            # Se è una stringa, usa direttamente
-            script_text = script_raw
+        # Informazioni sul lifecycle corrente (blocchi pre-renderizzati dallo snippet store);
+        # il nome del contatto sceglie tra i passi alternativi dello script (saluto o richiesta)
+        name_known = True
+        if snippet_store.script_uses_name(current_lifecycle):
+            contact = await self._contact_fields(session, db)
+            name_known = bool(contact.get("contact.firstname"))
+        script_text = snippet_store.script_block(current_lifecycle, name_known)
         objective = current_config.get("objective", "")
         transition_indicators = current_config.get("transition_indicators", [])
         next_stage = current_config.get("next_stage")
 
-        # Ottieni snippet disponibili per questo lifecycle
-        available_snippets = current_config.get("available_snippets", {})
-        snippets_context = self._format_snippets_context(available_snippets)
-
         # Contesto conversazione
-        conversation_context = await self._build_conversation_context(session, db)
+        if history is None:
+            history = await self._load_history(session, db)
+        conversation_context = self._format_conversation_context(history)
+
+        # Snippet disponibili per questo lifecycle (solo i pertinenti con la selezione attiva)
+        snippets_context = self._select_snippets(current_lifecycle, user_message, history)
+
+        # Formato della risposta (verbose o lean) per questa sessione
+        response_mode = choose_response_mode(session.session_id)
+        prompt_keys = PROMPT_KEYS[response_mode]
+        metrics.increment("ai_response_mode_total", mode=response_mode)
 
         # Costruisci il prompt unificato
         unified_prompt = f"""LIFECYCLE CORRENTE: {current_lifecycle.value.upper()}
@@ -425,46 +781,21 @@ MESSAGGIO UTENTE: {user_message}
 
 ISTRUZIONI SPECIFICHE PER QUESTO LIFECYCLE:
 1. Usa il script come guida ma mantieni la conversazione fluida
-2. Valuta se il messaggio dell'utente indica che è pronto per il prossimo lifecycle
+{"2. Valuta se il messaggio dell'utente indica che è pronto per il prossimo lifecycle" if include_decision else "2. Il cambio di lifecycle viene valutato a parte: concentrati sulla risposta"}
 3. Se decidi di spezzettare, specifica i delay tra i messaggi, minimo 10 secondi tra messaggi multipli
-4. Nel caso in cui l'utente chiede delle cose a cui non sai rispondere, crea una task umana "human_task", ad esempio per richieste che richiedono l'attenzione di un professionista.
+4. Nel caso in cui l'utente chiede delle cose a cui non sai rispondere, crea una task umana "{prompt_keys['human_task']}", ad esempio per richieste che richiedono l'attenzione di un professionista.
+5. Per inviare uno snippet o una frase dello script senza modifiche non riscriverne il testo: indica il suo ID (quello tra parentesi quadre o prima dei due punti) con {prompt_keys['snippet_ref']}. Il testo esatto, con il nome del contatto, viene inserito automaticamente. I testi senza ID contengono segnaposto (es. [LINK], NOME): riscrivili completandoli.
 
 INDICATORI PER PASSARE AL PROSSIMO LIFECYCLE ({next_stage.value if next_stage else 'NESSUNO'}):
 {chr(10).join(f"- {indicator}" for indicator in transition_indicators) if transition_indicators else "- Lifecycle finale raggiunto"}
 
-FORMATO RISPOSTA RICHIESTO:
-Devi rispondere SEMPRE in questo formato JSON:
-{{
-    "messages": "La tua risposta completa"
-    OPPURE
-    "messages": [
-        {{"text": "Prima parte del messaggio", "delay_ms": 10000}},
-        {{"text": "Seconda parte", "delay_ms": 10000}}
-    ],
-    "should_change_lifecycle": true/false,
-    "new_lifecycle": "{next_stage.value} o null",
-    "reasoning": "Spiegazione del perché hai deciso di cambiare o non cambiare lifecycle",
-    "confidence": 0.0-1.0,
-    "requires_human": true/false,
-    "human_task": {{
-        "title": "Breve titolo della task",
-        "description": "Dettaglio della task per l'operatore umano",
-        "assigned_to": "opzionale@team.it",
-        "metadata": {{"key": "value"}}
-    }}
-}}
-
-IMPORTANTE:
-- Il campo "messages" può essere una stringa (risposta singola senza delay), un oggetto singolo con "text" e "delay_ms", o un array di oggetti
-- Ogni oggetto nell'array ha "text" (il messaggio) e "delay_ms" (millisecondi di attesa prima del prossimo, minimo 10000ms se multipli)
-- Cambia lifecycle solo se sei sicuro al 70% o più (confidence >= 0.7)
-- La risposta deve essere SEMPRE un JSON valido
+{response_format_block(response_mode, next_stage, include_decision)}
 """
 
-        logger.info(f"Generated unified prompt for session {session.session_id}:\n{unified_prompt}")
+        logger.info(f"Generated unified prompt ({response_mode}) for session {session.session_id}:\n{unified_prompt}")
         return unified_prompt
 
-    async def chat(self, session_id: str, user_message: str, model_name: str = None, batch_wait_seconds: Optional[int] = None) -> LifecycleResponse:
+    async def chat(self, session_id: str, user_message: str, model_name: str = None, batch_wait_seconds: Optional[int] = None, client_message_id: Optional[str] = None, resume: bool = False) -> LifecycleResponse:
         """
         Gestisce una conversazione completa con decisione automatica del lifecycle
 
@@ -472,6 +803,10 @@ IMPORTANTE:
             session_id: ID della sessione di chat
             user_message: Messaggio dell'utente
             model_name: Nome del modello AI da utilizzare (opzionale)
+            client_message_id: Chiave di idempotenza del messaggio (opzionale): se già
+                registrata per la sessione il messaggio non viene rielaborato
+            resume: Riprende un turno interrotto (retry di un job): se il messaggio è già
+                registrato ma senza risposta, si procede senza salvarlo di nuovo
 
         Returns:
             LifecycleResponse con la risposta e informazioni sul lifecycle
@@ -479,194 +814,240 @@ IMPORTANTE:
         # Inizia una nuova sessione di log
         log_capture.start_session()
 
+        # Finestra di aggregazione dei messaggi (0 esplicito = nessuna attesa, None = default)
+        wait_seconds = int(batch_wait_seconds) if batch_wait_seconds is not None else 60
+        if wait_seconds < 0:
+            wait_seconds = 0
+
         async for db in get_db():
             try:
                 # STARTING AGENT
                 log_capture.add_log("INFO", "-------------------------------------------------")
                 log_capture.add_log("INFO", "STARTING AGENT")
 
-                # Ottieni o crea la sessione
-                session = await self.get_or_create_session(session_id, db)
-                previous_lifecycle = session.current_lifecycle
-
-                # If there is an open human task associated with this session (not completed), we block the agent
-                # and ask for human intervention. This prevents the AI from continuing the conversation
-                # while a human is responsible for follow-up.
-                from sqlalchemy import and_
-                result_ht = await db.execute(
-                    select(HumanTaskModel).where(
-                        and_(HumanTaskModel.session_id == session.id, HumanTaskModel.completed == False)
-                    )
-                )
-                active_task = result_ht.scalar_one_or_none()
-                if active_task:
-                    log_capture.add_log("INFO", f"Flow blocked: human task {active_task.id} open for session {session.session_id}")
-                    # Save user message to history but don't proceed with AI — front-end will show the task dashboard
-                    await self._add_user_message_to_history(session, user_message, db)
-                    # Re-fetch session to see if lifecycle changed
-                    session_refreshed = await db.get(SessionModel, session.id)
-                    lifecycle_changed_flag = previous_lifecycle != session_refreshed.current_lifecycle
-
-                    return LifecycleResponse(
-                        messages=[],
-                        current_lifecycle=session.current_lifecycle,
-                        lifecycle_changed=False,
-                        previous_lifecycle=None,
-                        ai_reasoning="Human task open; awaiting human completion",
-                        confidence=1.0,
-                        is_conversation_finished=session.is_conversation_finished,
-                        requires_human=True,
-                        human_task={
-                            "id": active_task.id,
-                            "title": active_task.title,
-                            "description": active_task.description,
-                            "assigned_to": active_task.assigned_to,
-                            "created_at": active_task.created_at.isoformat(),
-                            "metadata": json_lib.loads(active_task.metadata_json) if active_task.metadata_json else None,
-                        }
-                    )
-
-                log_capture.add_log("INFO", f"Session loaded: {session_id}")
-
-                # Check if this is the first message
-                result = await db.execute(
-                    select(func.count(MessageModel.id)).where(MessageModel.session_id == session.id)
-                )
-                message_count = result.scalar()
-
-                if message_count == 0:
-                    # First message: send auto response and then call AI with CONTRASSEGNATO
-                    auto_response = """Ciao! Grazie di avermi scritto!
-
-Questo è un messaggio automatico che ho scritto personalmente per riuscire a ringraziarti subito della fiducia!🙏
+                # Fase di decisione (sessione, task aperte, batch) in esclusiva per sessione:
+                # il check-then-set di is_batch_waiting è atomico anche tra worker diversi
+                async with session_lock.hold(session_id, "decision"):
+                    # Ottieni o crea la sessione
+                    session = await self.get_or_create_session(session_id, db)
+                    previous_lifecycle = session.current_lifecycle
+                    cached_state = session_cache.get(session_id)
+
+                    # Retry di un messaggio già registrato (es. su un altro worker o dopo il TTL
+                    # della cache di idempotenza): nessuna nuova scrittura né chiamata AI
+                    message_saved = False
+                    existing = await self._find_client_message(session, client_message_id, db) if client_message_id else None
+                    existing_message_id, stored_response = existing if existing is not None else (None, None)
+                    if existing_message_id is not None:
+                        if resume and not await self._has_reply_after(session, existing_message_id, db):
+                            log_capture.add_log("INFO", f"Resuming interrupted turn for message {client_message_id}")
+                            message_saved = True
+                    if existing_message_id is not None and not message_saved:
+                        log_capture.add_log("INFO", f"Duplicate message {client_message_id} for session {session_id}")
+                        return LifecycleResponse(
+                            messages=[],
+                            current_lifecycle=session.current_lifecycle,
+                            lifecycle_changed=False,
+                            previous_lifecycle=None,
+                            ai_reasoning="Messaggio già ricevuto (richiesta duplicata)",
+                            confidence=1.0,
+                            is_conversation_finished=session.is_conversation_finished,
+                            is_duplicate=True,
+                            replayed_response=json_lib.loads(stored_response) if stored_response else None
+                        )
+
+                    # If there is an open human task associated with this session (not completed), we block the agent
+                    # and ask for human intervention. This prevents the AI from continuing the conversation
+                    # while a human is responsible for follow-up.
+                    # La query si salta solo se la cache sa già che non ci sono task aperte.
+                    active_task = None
+                    if cached_state is None or cached_state.has_open_task is not False:
+                        from sqlalchemy import and_
+                        result_ht = await db.execute(
+                            select(HumanTaskModel).where(
+                                and_(HumanTaskModel.session_id == session.id, HumanTaskModel.completed == False)
+                            ).order_by(HumanTaskModel.created_at.desc()).limit(1)
+                        )
+                        active_task = result_ht.scalar_one_or_none()
+                        session_cache.update(session_id, has_open_task=active_task is not None)
+                    if active_task:
+                        log_capture.add_log("INFO", f"Flow blocked: human task {active_task.id} open for session {session.session_id}")
+                        # Save user message to history but don't proceed with AI — front-end will show the task dashboard
+                        if not message_saved:
+                            await self._add_user_message_to_history(session, user_message, db, client_message_id)
+                        # Re-fetch session to see if lifecycle changed
+                        session_refreshed = await db.get(SessionModel, session.id)
+                        lifecycle_changed_flag = previous_lifecycle != session_refreshed.current_lifecycle
+
+                        return LifecycleResponse(
+                            messages=[],
+                            current_lifecycle=session.current_lifecycle,
+                            lifecycle_changed=False,
+                            previous_lifecycle=None,
+                            ai_reasoning="Human task open; awaiting human completion",
+                            confidence=1.0,
+                            is_conversation_finished=session.is_conversation_finished,
+                            requires_human=True,
+                            human_task={
+                                "id": active_task.id,
+                                "title": active_task.title,
+                                "description": active_task.description,
+                                "assigned_to": active_task.assigned_to,
+                                "created_at": active_task.created_at.isoformat(),
+                                "metadata": json_lib.loads(active_task.metadata_json) if active_task.metadata_json else None,
+                            }
+                        )
+
+                    log_capture.add_log("INFO", f"Session loaded: {session_id}")
+
+                    # Check if this is the first message
+                    has_messages = cached_state.has_messages if cached_state else None
+                    if has_messages is None:
+                        result = await db.execute(
+                            select(func.count(MessageModel.id)).where(MessageModel.session_id == session.id)
+                        )
+                        has_messages = result.scalar() > 0
+                        session_cache.update(session_id, has_messages=has_messages)
+
+                    if not has_messages:
+                        # First message: send auto response and then call AI with CONTRASSEGNATO
+                        auto_response = FIRST_MESSAGE_AUTO_RESPONSE
+
+                        # Update lifecycle to CONTRASSEGNATO
+                        await self._update_session_lifecycle(session, LifecycleStage.CONTRASSEGNATO, db)
+
+                        # Add auto response to history
+                        ai_msg = await self._add_to_conversation_history(session, user_message, auto_response, db, client_message_id)
+                        # If we updated session lifecycle above (NUOVA_LEAD -> CONTRASSEGNATO), create an anchored event
+                        if session.current_lifecycle != previous_lifecycle:
+                            await self._add_lifecycle_event(
+                                session.id, previous_lifecycle, session.current_lifecycle,
+                                ai_msg.id, None, model_name, db
+                            )
 
-Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti personalmente l'attenzione che meriti."""
+                        # Now generate prompt for CONTRASSEGNATO and call AI
+                        session_refreshed = await db.get(SessionModel, session.id)
+                        history = await self._load_history(session_refreshed, db)
+                        model_name = await self._route_model(session_refreshed, history, model_name)
+                        unified_prompt, decision_prompt = await self._get_prompts(session_refreshed, user_message, db, history=history)
+                        log_capture.add_log("INFO", f"SCRIPT GUIDA (CONTRASSEGNATO dopo messaggio automatico)\n{unified_prompt}")
 
-                    # Update lifecycle to CONTRASSEGNATO
-                    await self._update_session_lifecycle(session, LifecycleStage.CONTRASSEGNATO, db)
+                        logger.info(f"Generando risposta CONTRASSEGNATO per primo messaggio in sessione {session_id}")
 
-                    # Add auto response to history
-                    ai_msg = await self._add_to_conversation_history(session, user_message, auto_response, db)
-                    # If we updated session lifecycle above (NUOVA_LEAD -> CONTRASSEGNATO), create an anchored event
-                    if session.current_lifecycle != previous_lifecycle:
+                        # Call AI for CONTRASSEGNATO
                         try:
-                            event = LifecycleEventModel(
-                                session_id=session.id,
-                                previous_lifecycle=previous_lifecycle,
-                                new_lifecycle=session.current_lifecycle,
-                                trigger_message_id=ai_msg.id,
-                                confidence=None
+                            contrassegnato_result = await self._ask_ai(unified_prompt, session_refreshed, db, model_name, decision_prompt=decision_prompt)
+                        except AIUnavailableError as e:
+                            # Il messaggio automatico è già una risposta: la parte AI arriverà dal turno differito
+                            await self._defer_reply(session_refreshed, ai_msg.id, model_name, e.retry_after)
+                            return LifecycleResponse(
+                                messages=[{"text": auto_response.strip(), "delay_ms": 0, "id": ai_msg.id}],
+                                current_lifecycle=session_refreshed.current_lifecycle,
+                                lifecycle_changed=previous_lifecycle != session_refreshed.current_lifecycle,
+                                previous_lifecycle=previous_lifecycle if previous_lifecycle != session_refreshed.current_lifecycle else None,
+                                ai_reasoning=f"Modalità degradata: {e}",
+                                confidence=0.0,
+                                is_conversation_finished=False
                             )
-                            db.add(event)
-                            await db.commit()
-                        except Exception as e:
-                            logger.warning(f"Impossibile creare lifecycle event per contrassegnato: {e}")
-
-                    # Now generate prompt for CONTRASSEGNATO and call AI
-                    session_refreshed = await db.get(SessionModel, session.id)
-                    unified_prompt = await self._get_unified_prompt(session_refreshed, user_message, db)
-                    log_capture.add_log("INFO", f"SCRIPT GUIDA (CONTRASSEGNATO dopo messaggio automatico)\n{unified_prompt}")
-
-                    logger.info(f"Generando risposta CONTRASSEGNATO per primo messaggio in sessione {session_id}")
-
-                    # Call AI for CONTRASSEGNATO
-                    ai_response = await self._call_ai_agent(unified_prompt, model_name=model_name)
-                    log_capture.add_log("INFO", "AI response received (CONTRASSEGNATO)")
-
-                    # Process AI response
-                    contrassegnato_result = await self._process_ai_response(ai_response, session_refreshed, db)
-
-                    # Add AI response to history (unless human task required)
-                    created_task = None
-                    if not contrassegnato_result.get("requires_human"):
-                        # Save assistant message and anchor possible lifecycle change to this message
-                        ai_msg = await self._add_assistant_response_to_history(session_refreshed, contrassegnato_result["full_message_text"], db)
-                        # If the AI suggested a transition, apply it after saving the assistant message
-                        if contrassegnato_result.get("should_change"):
-                            prev = previous_lifecycle
-                            changed = await self._handle_lifecycle_transition(session_refreshed, contrassegnato_result["new_lifecycle_str"], contrassegnato_result["confidence"], db)
-                            if changed:
-                                try:
-                                    ai_msg.lifecycle = session_refreshed.current_lifecycle
-                                    await db.commit()
-                                except Exception:
-                                    pass
-                                try:
-                                    event = LifecycleEventModel(
-                                        session_id=session_refreshed.id,
-                                        previous_lifecycle=prev,
-                                        new_lifecycle=session_refreshed.current_lifecycle,
-                                        trigger_message_id=ai_msg.id,
-                                        confidence=contrassegnato_result.get("confidence")
+                        log_capture.add_log("INFO", "AI response received and processed (CONTRASSEGNATO)")
+
+                        # Add AI response to history (unless human task required)
+                        created_task = None
+                        if not contrassegnato_result.get("requires_human"):
+                            # Save assistant message and anchor possible lifecycle change to this message
+                            ai_msg = await self._add_assistant_response_to_history(session_refreshed, contrassegnato_result["full_message_text"], db)
+                            # If the AI suggested a transition, apply it after saving the assistant message
+                            if contrassegnato_result.get("should_change"):
+                                # La sessione è già passata a CONTRASSEGNATO col messaggio automatico
+                                prev = session_refreshed.current_lifecycle
+                                changed = await self._handle_lifecycle_transition(session_refreshed, contrassegnato_result["new_lifecycle_str"], contrassegnato_result["confidence"], db)
+                                if changed:
+                                    try:
+                                        ai_msg.lifecycle = session_refreshed.current_lifecycle
+                                        await db.commit()
+                                    except Exception:
+                                        pass
+                                    await self._add_lifecycle_event(
+                                        session_refreshed.id, prev, session_refreshed.current_lifecycle,
+                                        ai_msg.id, contrassegnato_result.get("confidence"), model_name, db
                                     )
-                                    db.add(event)
-                                    await db.commit()
-                                except Exception as e:
-                                    logger.warning(f"Impossibile creare lifecycle event: {e}")
-                    else:
-                        created_task = await self._create_human_task(session_refreshed, contrassegnato_result.get("human_task") or {}, db)
-                        log_capture.add_log("INFO", f"Human task created (contrassegnato first message): {created_task}")
-
-                    # Combine messages: auto response + AI response
-                    # First message (auto response) gets the ID from the first save
-                    combined_messages = [{"text": auto_response.strip(), "delay_ms": 0, "id": ai_msg.id}]
-
-                    # Subsequent messages (AI response) get the ID from the second save (if it exists)
-                    # Note: ai_msg variable was reused for the second save at line 586
-                    ai_response_id = ai_msg.id if 'ai_msg' in locals() and ai_msg else None
-
-                    if isinstance(contrassegnato_result["messages"], list):
-                        for m in contrassegnato_result["messages"]:
-                            if isinstance(m, dict):
-                                m["id"] = ai_response_id
-                            combined_messages.append(m)
-                    else:
-                        combined_messages.append({"text": contrassegnato_result["messages"], "delay_ms": 1000, "id": ai_response_id})
-
-                    lifecycle_changed_flag = previous_lifecycle != session_refreshed.current_lifecycle
-
-                    return LifecycleResponse(
-                        messages=combined_messages,
-                        current_lifecycle=session_refreshed.current_lifecycle,
-                        lifecycle_changed=lifecycle_changed_flag,
-                        previous_lifecycle=previous_lifecycle if lifecycle_changed_flag else None,
-                        ai_reasoning=contrassegnato_result["reasoning"],
-                        confidence=contrassegnato_result["confidence"],
-                        is_conversation_finished=False,
-                        requires_human=contrassegnato_result.get("requires_human", False),
-                        human_task=created_task if contrassegnato_result.get("requires_human") else None
-                    )
-
-                # If we are already in a batch wait window, append message and return queued response
-                if session.is_batch_waiting:
-                    # Save user message only and don't start a new AI call
-                    await self._add_user_message_to_history(session, user_message, db)
-                    log_capture.add_log("INFO", f"Message queued for session {session.session_id} in batch")
-                    return LifecycleResponse(
-                        messages=[],
-                        current_lifecycle=session.current_lifecycle,
-                        lifecycle_changed=False,
-                        previous_lifecycle=None,
-                        ai_reasoning="Messaggio messo in coda (batch aggregation)",
-                        confidence=1.0,
-                        is_conversation_finished=session.is_conversation_finished
-                    )
-
-                # If not in batch mode, set batch waiting and delay the AI call to gather subsequent messages
-                # This prevents multiple AI calls when the user sends several messages quickly.
-                # Save the current user message before entering batch wait so it is persisted in order.
-                await self._add_user_message_to_history(session, user_message, db)
-                # Mark session as waiting for batch and commit
-                session.is_batch_waiting = True
-                session.batch_started_at = datetime.now(timezone.utc)
-                await db.commit()
+                        else:
+                            created_task = await self._create_human_task(session_refreshed, contrassegnato_result.get("human_task") or {}, db)
+                            log_capture.add_log("INFO", f"Human task created (contrassegnato first message): {created_task}")
+
+                        # Combine messages: auto response + AI response
+                        # First message (auto response) gets the ID from the first save
+                        combined_messages = [{"text": auto_response.strip(), "delay_ms": 0, "id": ai_msg.id}]
+
+                        # Subsequent messages (AI response) get the ID from the second save (if it exists)
+                        # Note: ai_msg variable was reused for the second save at line 586
+                        ai_response_id = ai_msg.id if 'ai_msg' in locals() and ai_msg else None
+
+                        if isinstance(contrassegnato_result["messages"], list):
+                            for m in contrassegnato_result["messages"]:
+                                if isinstance(m, dict):
+                                    m["id"] = ai_response_id
+                                combined_messages.append(m)
+                        else:
+                            combined_messages.append({"text": contrassegnato_result["messages"], "delay_ms": 1000, "id": ai_response_id})
+
+                        lifecycle_changed_flag = previous_lifecycle != session_refreshed.current_lifecycle
+
+                        return LifecycleResponse(
+                            messages=combined_messages,
+                            current_lifecycle=session_refreshed.current_lifecycle,
+                            lifecycle_changed=lifecycle_changed_flag,
+                            previous_lifecycle=previous_lifecycle if lifecycle_changed_flag else None,
+                            ai_reasoning=contrassegnato_result["reasoning"],
+                            confidence=contrassegnato_result["confidence"],
+                            is_conversation_finished=False,
+                            requires_human=contrassegnato_result.get("requires_human", False),
+                            human_task=created_task if contrassegnato_result.get("requires_human") else None
+                        )
+
+                    # Lo stato di batch può essere stato cambiato da un altro worker: sotto lock
+                    # lo si rilegge sempre dal database prima di decidere
+                    await db.refresh(session, ["is_batch_waiting", "batch_started_at"])
+                    session_cache.store(session)
+
+                    # Ripresa di un turno interrotto durante la sua finestra di batch: il flag è
+                    # quello lasciato dal worker caduto (più vecchio della finestra), non di un
+                    # turno vivo. La finestra è già trascorsa: si passa subito alla risposta.
+                    resuming_batch = message_saved and session.is_batch_waiting and self._batch_window_elapsed(session, wait_seconds)
+                    if resuming_batch:
+                        log_capture.add_log("INFO", f"Resuming batch window left open by an interrupted turn for session {session.session_id}")
+                        wait_seconds = 0
+
+                    # If we are already in a batch wait window, append message and return queued response
+                    if session.is_batch_waiting and not resuming_batch:
+                        # Save user message only and don't start a new AI call
+                        if not message_saved:
+                            await self._add_user_message_to_history(session, user_message, db, client_message_id)
+                        log_capture.add_log("INFO", f"Message queued for session {session.session_id} in batch")
+                        return LifecycleResponse(
+                            messages=[],
+                            current_lifecycle=session.current_lifecycle,
+                            lifecycle_changed=False,
+                            previous_lifecycle=None,
+                            ai_reasoning="Messaggio messo in coda (batch aggregation)",
+                            confidence=1.0,
+                            is_conversation_finished=session.is_conversation_finished
+                        )
+
+                    # If not in batch mode, set batch waiting and delay the AI call to gather subsequent messages
+                    # This prevents multiple AI calls when the user sends several messages quickly.
+                    # Save the current user message before entering batch wait so it is persisted in order.
+                    if not message_saved:
+                        await self._add_user_message_to_history(session, user_message, db, client_message_id)
+                    if not resuming_batch:
+                        # Mark session as waiting for batch and commit
+                        session.is_batch_waiting = True
+                        session.batch_started_at = datetime.now(timezone.utc)
+                        await db.commit()
+                        session_cache.store(session)
 
                 # NOTE: We don't need to save the user message again after the wait because it is already stored.
                 # Wait for aggregation window (default 60s). This is intentionally blocking the request.
-                # Respect explicit 0 value (no wait) vs None (default wait)
-                wait_seconds = int(batch_wait_seconds) if batch_wait_seconds is not None else 60
-                if wait_seconds < 0:
-                    wait_seconds = 0
                 log_capture.add_log("INFO", f"Batch wait started for session {session.session_id} - waiting {wait_seconds}s")
                 # Log a per-second countdown in the terminal like a timer
                 logger.info(f"Batch wait started for session {session.session_id} - waiting {wait_seconds}s")
@@ -679,106 +1060,232 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
                     log_capture.add_log("INFO", timer_msg)
                     await asyncio.sleep(1)
 
-                # Refresh session and proceed to generate prompt with aggregated messages
-                session = await db.get(SessionModel, session.id)
-                session.is_batch_waiting = False
-                session.batch_started_at = None
-                await db.commit()
+                # Fase di risposta: una sola chiamata AI per sessione alla volta
+                async with session_lock.hold(session_id, "reply"):
+                    # Refresh session and proceed to generate prompt with aggregated messages
+                    # (rilettura forzata: un altro worker può aver cambiato lifecycle nel frattempo)
+                    session = await db.get(SessionModel, session.id, populate_existing=True)
+                    session.is_batch_waiting = False
+                    session.batch_started_at = None
+                    await db.commit()
+                    session_cache.store(session)
+
+                    log_capture.add_log("INFO", f"Batch window ended; calling AI for session {session.session_id}")
+
+                    try:
+                        return await self._generate_reply(session, user_message, previous_lifecycle, model_name, db)
+                    except AIUnavailableError as e:
+                        return await self._degraded_reply(session, model_name, e, db)
+
+            except SessionLockTimeout:
+                log_capture.add_log("INFO", "ERROR: Session lock timeout")
+                raise
+            except Exception as e:
+                log_capture.add_log("INFO", "ERROR: General error")
+                logger.error(f"Errore generale nell'agente unificato: {e}")
+                raise ChatbotError(f"Errore interno del chatbot: {str(e)}")
+
+    async def _generate_reply(self, session: SessionModel, user_message: str, previous_lifecycle: LifecycleStage, model_name: Optional[str], db: AsyncSession) -> LifecycleResponse:
+        """Chiamata AI sulla cronologia della sessione, salvataggio della risposta e transizione di lifecycle
+
+        Da chiamare con il lock "reply" della sessione.
+        """
+        # CASO NORMALE: genera il prompt unificato con i messaggi aggregati, sul modello scelto dal routing
+        history = await self._load_history(session, db)
+        model_name = await self._route_model(session, history, model_name)
+        unified_prompt, decision_prompt = await self._get_prompts(session, user_message, db, history=history)
+        log_capture.add_log("INFO", f"SCRIPT GUIDA\n{unified_prompt}")
+
+        logger.info("-------------------------------------------------")
+        logger.info(f"Prompt unificato per sessione {session.session_id}:\n{unified_prompt}")
+        logger.info("-------------------------------------------------")
+
+        # Invia il messaggio all'AI
+        log_capture.add_log("INFO", "-------------------------------------------------")
+        log_capture.add_log("INFO", f"Invio messaggio unificato per sessione {session.session_id}")
+        logger.info(f"Invio messaggio unificato per sessione {session.session_id}")
+
+        # Chiamata (con retry entro la deadline) ed elaborazione della risposta AI completa
+        result = await self._ask_ai(unified_prompt, session, db, model_name, decision_prompt=decision_prompt)
+        log_capture.add_log("INFO", "AI response received")
+        logger.info(f"Risposta AI ricevuta per sessione {session.session_id}")
+
+        log_capture.add_log("INFO", f"Decision: change={result['should_change']}, confidence={result['confidence']}, messages={len(result['messages'])}")
+        log_capture.add_log("INFO", f"```json\n{json.dumps(result, indent=2)}\n```")
+        log_capture.add_log("INFO", "JSON parsed successfully")
+
+        # Aggiungi il messaggio alla cronologia
+        # Se l'AI richiede intervento umano, creiamo prima la task e NON aggiungiamo la risposta dell'assistente
+        # alla cronologia per evitare che risposte incomplete vengano salvate.
+        created_task = None
+        # Il messaggio utente è già stato salvato prima della finestra di batch
+        if result.get("requires_human"):
+            created_task = await self._create_human_task(session, result.get("human_task") or {}, db)
+            log_capture.add_log("INFO", f"Human task created: {created_task}")
+        else:
+            ai_msg = await self._add_assistant_response_to_history(session, result["full_message_text"], db)
+
+            # Inject message ID into the result messages
+            if isinstance(result["messages"], list):
+                for m in result["messages"]:
+                    if isinstance(m, dict):
+                        m["id"] = ai_msg.id
+
+            log_capture.add_log("INFO", "Conversation history updated")
+            # If the AI suggested a transition, apply it AFTER saving the assistant message
+            if result.get("should_change"):
+                prev = previous_lifecycle
+                changed = await self._handle_lifecycle_transition(session, result["new_lifecycle_str"], result["confidence"], db)
+                if changed:
+                    try:
+                        ai_msg.lifecycle = session.current_lifecycle
+                        await db.commit()
+                    except Exception:
+                        pass
+                    await self._add_lifecycle_event(
+                        session.id, prev, session.current_lifecycle,
+                        ai_msg.id, result.get("confidence"), model_name, db
+                    )
 
-                # Now continue with the normal unified prompt generation using aggregated messages
-                unified_prompt = await self._get_unified_prompt(session, user_message, db)
-                log_capture.add_log("INFO", f"Batch window ended; calling AI for session {session.session_id}")
+        # `next_actions` removed - dropping per previous decision
 
-                # CASO NORMALE: genera il prompt unificato
-                unified_prompt = await self._get_unified_prompt(session, user_message, db)
-                log_capture.add_log("INFO", f"SCRIPT GUIDA\n{unified_prompt}")
+        log_capture.add_log("INFO", "Response ready")
 
-                logger.info("-------------------------------------------------")
-                logger.info(f"Prompt unificato per sessione {session_id}:\n{unified_prompt}")
-                logger.info("-------------------------------------------------")
+        session_after = await db.get(SessionModel, session.id)
+        lifecycle_changed_flag = previous_lifecycle != session_after.current_lifecycle
 
-                # Invia il messaggio all'AI
-                log_capture.add_log("INFO", "-------------------------------------------------")
-                log_capture.add_log("INFO", f"Invio messaggio unificato per sessione {session_id}")
-                logger.info(f"Invio messaggio unificato per sessione {session_id}")
+        return LifecycleResponse(
+            messages=result["messages"],
+            current_lifecycle=session.current_lifecycle,
+            lifecycle_changed=lifecycle_changed_flag,
+            previous_lifecycle=previous_lifecycle if lifecycle_changed_flag else None,
+            ai_reasoning=result["reasoning"],
+            confidence=result["confidence"],
+            is_conversation_finished=session.is_conversation_finished,
+            requires_human=result.get("requires_human", False),
+            human_task=created_task if result.get("requires_human") else None
+        )
 
-                ai_response = await self._call_ai_agent(unified_prompt, model_name=model_name)
-                log_capture.add_log("INFO", "AI response received")
-                logger.info(f"Risposta AI ricevuta per sessione {session_id}")
+    async def _defer_reply(self, session: SessionModel, after_message_id: int, model_name: Optional[str], retry_after: float) -> None:
+        """Registra il turno AI da eseguire quando il circuito torna disponibile"""
+        from app.services.chat_jobs import chat_job_queue
 
-                # Elabora la risposta AI completa
-                log_capture.add_log("INFO", "Parsing AI response...")
-                result = await self._process_ai_response(ai_response, session, db)
+        await chat_job_queue.enqueue_deferred_reply(
+            session.session_id,
+            after_message_id,
+            model_name=model_name,
+            delay_seconds=retry_after + settings.ai_deferred_reply_margin_seconds,
+        )
+        metrics.increment("ai_degraded_replies_total", lifecycle=session.current_lifecycle.value)
 
-                log_capture.add_log("INFO", f"Decision: change={result['should_change']}, confidence={result['confidence']}, messages={len(result['messages'])}")
-                log_capture.add_log("INFO", f"```json\n{json.dumps(result, indent=2)}\n```")
-                log_capture.add_log("INFO", "JSON parsed successfully")
+    async def _degraded_reply(self, session: SessionModel, model_name: Optional[str], error: AIUnavailableError, db: AsyncSession) -> LifecycleResponse:
+        """Risposta immediata con uno snippet del lifecycle mentre l'AI non è disponibile
 
-                # Aggiungi il messaggio alla cronologia
-                # Se l'AI richiede intervento umano, creiamo prima la task e NON aggiungiamo la risposta dell'assistente
-                # alla cronologia per evitare che risposte incomplete vengano salvate.
-                created_task = None
-                if result.get("requires_human"):
-                    # Salviamo solo il messaggio utente e creiamo la human task
-                    await self._add_user_message_to_history(session, user_message, db)
-                    created_task = await self._create_human_task(session, result.get("human_task") or {}, db)
-                    log_capture.add_log("INFO", f"Human task created: {created_task}")
-                else:
-                    ai_msg = await self._add_to_conversation_history(session, user_message, result["full_message_text"], db)
-
-                    # Inject message ID into the result messages
-                    if isinstance(result["messages"], list):
-                        for m in result["messages"]:
-                            if isinstance(m, dict):
-                                m["id"] = ai_msg.id
-
-                    log_capture.add_log("INFO", "Conversation history updated")
-                    # If the AI suggested a transition, apply it AFTER saving the assistant message
-                    if result.get("should_change"):
-                        prev = previous_lifecycle
-                        changed = await self._handle_lifecycle_transition(session, result["new_lifecycle_str"], result["confidence"], db)
-                        if changed:
-                            try:
-                                ai_msg.lifecycle = session.current_lifecycle
-                                await db.commit()
-                            except Exception:
-                                pass
-                            try:
-                                event = LifecycleEventModel(
-                                    session_id=session.id,
-                                    previous_lifecycle=prev,
-                                    new_lifecycle=session.current_lifecycle,
-                                    trigger_message_id=ai_msg.id,
-                                    confidence=result.get("confidence")
-                                )
-                                db.add(event)
-                                await db.commit()
-                            except Exception as e:
-                                logger.warning(f"Impossibile creare lifecycle event: {e}")
-
-                # `next_actions` removed - dropping per previous decision
-
-                log_capture.add_log("INFO", "Response ready")
-
-                session_after = await db.get(SessionModel, session.id)
-                lifecycle_changed_flag = previous_lifecycle != session_after.current_lifecycle
-
-                return LifecycleResponse(
-                    messages=result["messages"],
-                    current_lifecycle=session.current_lifecycle,
-                    lifecycle_changed=lifecycle_changed_flag,
-                    previous_lifecycle=previous_lifecycle if lifecycle_changed_flag else None,
-                    ai_reasoning=result["reasoning"],
-                    confidence=result["confidence"],
-                    is_conversation_finished=session.is_conversation_finished,
-                    requires_human=result.get("requires_human", False),
-                    human_task=created_task if result.get("requires_human") else None
+        Il turno vero viene differito (chat job "deferred_reply"). Se l'ultima risposta è già
+        lo stesso snippet non lo si ripete: il messaggio resta in attesa del turno differito.
+        """
+        logger.warning(f"Modalità degradata per sessione {session.session_id}: {error}")
+        log_capture.add_log("INFO", f"Degraded reply: {error}")
+        snippet = get_degraded_reply(session.current_lifecycle)
+
+        result = await db.execute(
+            select(MessageModel.id, MessageModel.message)
+            .where(MessageModel.session_id == session.id, MessageModel.role == "assistant")
+            .order_by(MessageModel.id.desc())
+            .limit(1)
+        )
+        last_reply = result.first()
+
+        messages: List[Dict[str, Union[str, int]]] = []
+        if last_reply is not None and last_reply.message == snippet:
+            anchor_id = last_reply.id
+        else:
+            ai_msg = await self._add_assistant_response_to_history(session, snippet, db)
+            anchor_id = ai_msg.id
+            messages = [{"text": snippet, "delay_ms": 0, "id": ai_msg.id}]
+
+        await self._defer_reply(session, anchor_id, model_name, error.retry_after)
+
+        return LifecycleResponse(
+            messages=messages,
+            current_lifecycle=session.current_lifecycle,
+            lifecycle_changed=False,
+            previous_lifecycle=None,
+            ai_reasoning=f"Modalità degradata: {error}",
+            confidence=0.0,
+            is_conversation_finished=session.is_conversation_finished
+        )
+
+    async def reply_deferred(self, session_id: str, after_message_id: int, model_name: Optional[str] = None) -> LifecycleResponse:
+        """Turno differito dalla modalità degradata: risponde alla cronologia della sessione
+
+        Se dopo `after_message_id` c'è già una risposta dell'assistente (un turno successivo
+        è andato a buon fine) non fa nulla.
+        """
+        log_capture.start_session()
+        async for db in get_db():
+            async with session_lock.hold(session_id, "reply"):
+                session_result = await db.execute(select(SessionModel).where(SessionModel.session_id == session_id))
+                session = session_result.scalar_one()
+                previous_lifecycle = session.current_lifecycle
+
+                answered = await db.scalar(
+                    select(func.count(MessageModel.id)).where(
+                        MessageModel.session_id == session.id,
+                        MessageModel.role == "assistant",
+                        MessageModel.id > after_message_id,
+                    )
                 )
+                if answered or session.is_conversation_finished:
+                    return LifecycleResponse(
+                        messages=[],
+                        current_lifecycle=session.current_lifecycle,
+                        lifecycle_changed=False,
+                        previous_lifecycle=None,
+                        ai_reasoning="Turno differito non necessario: risposta già inviata",
+                        confidence=1.0,
+                        is_conversation_finished=session.is_conversation_finished
+                    )
 
-            except Exception as e:
-                log_capture.add_log("INFO", "ERROR: General error")
-                logger.error(f"Errore generale nell'agente unificato: {e}")
-                raise ChatbotError(f"Errore interno del chatbot: {str(e)}")
+                last_user_message = await db.scalar(
+                    select(MessageModel.message)
+                    .where(MessageModel.session_id == session.id, MessageModel.role == "user")
+                    .order_by(MessageModel.id.desc())
+                    .limit(1)
+                )
+                log_capture.add_log("INFO", f"Deferred reply for session {session_id} after message {after_message_id}")
+                return await self._generate_reply(session, last_user_message or "", previous_lifecycle, model_name, db)
+
+    async def _add_lifecycle_event(
+        self,
+        session_pk: int,
+        previous_lifecycle: Optional[LifecycleStage],
+        new_lifecycle: LifecycleStage,
+        trigger_message_id: Optional[int],
+        confidence: Optional[float],
+        model_name: Optional[str],
+        db: AsyncSession,
+    ) -> None:
+        """Registra un evento di lifecycle con modello e prompt che hanno gestito il turno"""
+        try:
+            if not model_name:
+                from app.services.ai_model_service import AIModelService
+                model_name = await AIModelService.get_active_model_name(DEFAULT_MODEL_NAME)
+            prompt_name = await SystemPromptService.get_active_prompt_name()
+
+            event = LifecycleEventModel(
+                session_id=session_pk,
+                previous_lifecycle=previous_lifecycle,
+                new_lifecycle=new_lifecycle,
+                trigger_message_id=trigger_message_id,
+                confidence=confidence,
+                model_name=model_name,
+                prompt_name=prompt_name,
+            )
+            db.add(event)
+            await db.commit()
+        except Exception as e:
+            logger.warning(f"Impossibile creare lifecycle event: {e}")
 
     async def _update_session_lifecycle(self, session: SessionModel, new_lifecycle: LifecycleStage, db: AsyncSession) -> None:
         """Aggiorna il lifecycle della sessione"""
@@ -791,8 +1298,9 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
             logger.info(f"Conversazione finita impostata per sessione {session.session_id}")
 
         await db.commit()
+        session_cache.store(session)
 
-    async def _add_to_conversation_history(self, session: SessionModel, user_message: str, ai_response: str, db: AsyncSession) -> None:
+    async def _add_to_conversation_history(self, session: SessionModel, user_message: str, ai_response: str, db: AsyncSession, client_message_id: Optional[str] = None) -> None:
         """Aggiunge i messaggi alla cronologia della conversazione"""
 
         # Aggiungi messaggio utente
@@ -800,7 +1308,8 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
             session_id=session.id,
             role="user",
             message=user_message,
-            timestamp=datetime.now(timezone.utc)
+            timestamp=datetime.now(timezone.utc),
+            client_message_id=client_message_id
         )
         db.add(user_msg)
 
@@ -821,6 +1330,7 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
 
         await db.commit()
         await db.refresh(ai_msg)
+        session_cache.update(session.session_id, has_messages=True)
         return ai_msg
 
         # Mantieni solo gli ultimi 20 messaggi per ottimizzare la memoria (opzionale, ma per pulizia)
@@ -830,19 +1340,6 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
         """Aggiunge solo una risposta assistant alla cronologia (senza nuovo user message)"""
 
         # Aggiungi risposta AI
-        try:
-            # Deduplicate assistant messages that are identical and very recent
-            result = await db.execute(
-                select(MessageModel).where(MessageModel.session_id == session.id).order_by(MessageModel.timestamp.desc()).limit(1)
-            )
-            last_msg = result.scalar_one_or_none()
-            if last_msg and last_msg.role == "assistant":
-                delta = datetime.now(timezone.utc) - last_msg.timestamp
-                if last_msg.message.strip() == ai_response.strip() and delta.total_seconds() < 3:
-                    return
-        except Exception:
-            pass
-
         ai_msg = MessageModel(
             session_id=session.id,
             role="assistant",
@@ -857,6 +1354,7 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
 
         await db.commit()
         await db.refresh(ai_msg)
+        session_cache.update(session.session_id, has_messages=True)
         return ai_msg
 
     async def _create_human_task(self, session: SessionModel, task_payload: Dict, db: AsyncSession) -> Dict:
@@ -878,6 +1376,7 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
             db.add(human_task)
             await db.commit()
             await db.refresh(human_task)
+            session_cache.update(session.session_id, has_open_task=True)
 
             return {
                 "id": human_task.id,
@@ -928,21 +1427,41 @@ Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti person
         except:
             return False
 
-    async def health_check(self) -> Dict[str, str]:
-        """Esegue un health check del servizio"""
-        try:
-            # Test semplice con l'AI
-            agent = await self._get_agent()
-            test_result = await agent.a_run("Rispondi solo con 'OK'")
-            return {
-                "status": "healthy",
-                "ai_response": "OK" in test_result.text,
-            }
-        except Exception as e:
-            return {
-                "status": "unhealthy",
-                "error": str(e),
-            }
+    async def health_check(self, force: bool = False) -> Dict[str, str]:
+        """Esegue un health check del servizio
+
+        La chiamata di prova all'AI viene fatta al massimo una volta ogni
+        llm_probe_interval_seconds: nel frattempo si restituisce l'ultimo risultato.
+        """
+        async with self._health_lock:
+            now = time.monotonic()
+            if (
+                not force
+                and self._health_result is not None
+                and now - self._health_checked_at < settings.llm_probe_interval_seconds
+            ):
+                return {**self._health_result, "cached": True}
+
+            try:
+                # Test semplice con l'AI
+                agent = await self._get_agent()
+                test_result = await agent.a_run("Rispondi solo con 'OK'")
+                status_monitor.record_llm_success()
+                result = {
+                    "status": "healthy",
+                    "ai_response": "OK" in test_result.text,
+                }
+            except Exception as e:
+                status_monitor.record_llm_failure(e)
+                result = {
+                    "status": "unhealthy",
+                    "error": str(e),
+                }
+
+            result["checked_at"] = datetime.now(timezone.utc).isoformat()
+            self._health_result = result
+            self._health_checked_at = now
+            return {**result, "cached": False}
 
 
 # Istanza globale dell'agente unificato
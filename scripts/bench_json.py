@@ -0,0 +1,132 @@
+"""
+Benchmark della serializzazione JSON per cronologia e lista sessioni
+
+Confronta, per richiesta, il tempo CPU speso a serializzare il payload:
+- prima: dict con isoformat(), jsonable_encoder di FastAPI e json.dumps (JSONResponse)
+- dopo: serializzatori di righe e FastJSONResponse (orjson, o stdlib se non installato)
+
+Uso: python scripts/bench_json.py [--messages 500] [--sessions 1000] [--rounds 200]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("GOOGLE_AI_API_KEY", "bench")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.json_response import FastJSONResponse, _stdlib_dumps, encoder_name, message_rows, session_rows  # noqa: E402
+from app.models.lifecycle import LifecycleStage  # noqa: E402
+
+
+def build_messages(count: int):
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    return [
+        SimpleNamespace(
+            id=index,
+            role="user" if index % 2 == 0 else "assistant",
+            message=f"Messaggio numero {index} con un testo di lunghezza realistica, accenti è à ù e qualche dettaglio in più",
+            timestamp=start + timedelta(seconds=index),
+        )
+        for index in range(count)
+    ]
+
+
+def build_sessions(count: int):
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    stages = list(LifecycleStage)
+    return [
+        SimpleNamespace(
+            session_id=f"session-{index:06d}",
+            created_at=start + timedelta(minutes=index),
+            updated_at=start + timedelta(minutes=index, seconds=30),
+            current_lifecycle=stages[index % len(stages)],
+            message_count=index % 40,
+        )
+        for index in range(count)
+    ]
+
+
+def history_before(messages):
+    payload = {
+        "session_id": "bench",
+        "messages": [
+            {'id': m.id, 'role': m.role, 'message': m.message, 'timestamp': m.timestamp.isoformat()}
+            for m in messages
+        ],
+        "current_lifecycle": "in_target",
+        "last_message_id": messages[-1].id,
+        "is_delta": False,
+    }
+    return JSONResponse(content=jsonable_encoder(payload)).body
+
+
+def history_after(messages):
+    return FastJSONResponse(content={
+        "session_id": "bench",
+        "messages": message_rows(messages),
+        "current_lifecycle": "in_target",
+        "last_message_id": messages[-1].id,
+        "is_delta": False,
+    }).body
+
+
+def sessions_before(rows):
+    sessions = [
+        {
+            'session_id': row.session_id,
+            'created_at': row.created_at.isoformat(),
+            'updated_at': row.updated_at.isoformat(),
+            'current_lifecycle': row.current_lifecycle.value if row.current_lifecycle else None,
+            'message_count': row.message_count
+        }
+        for row in rows
+    ]
+    return JSONResponse(content=jsonable_encoder({"sessions": sessions})).body
+
+
+def sessions_after(rows):
+    return FastJSONResponse(content={"sessions": session_rows(rows)}).body
+
+
+def measure(fn, data, rounds: int) -> float:
+    """Millisecondi di CPU per richiesta"""
+    fn(data)
+    started = time.process_time()
+    for _ in range(rounds):
+        fn(data)
+    return (time.process_time() - started) * 1000 / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    messages = build_messages(args.messages)
+    sessions = build_sessions(args.sessions)
+
+    # Stesso contenuto JSON prima e dopo
+    assert _stdlib_dumps(message_rows(messages)) == JSONResponse(content=[
+        {'id': m.id, 'role': m.role, 'message': m.message, 'timestamp': m.timestamp.isoformat()} for m in messages
+    ]).body
+
+    print(f"Encoder: {encoder_name}, {args.rounds} round")
+    for label, before, after, data in (
+        (f"history ({args.messages} messaggi)", history_before, history_after, messages),
+        (f"sessions_list ({args.sessions} sessioni)", sessions_before, sessions_after, sessions),
+    ):
+        before_ms = measure(before, data, args.rounds)
+        after_ms = measure(after, data, args.rounds)
+        print(f"{label:<32} prima {before_ms:7.3f} ms  dopo {after_ms:7.3f} ms  ({before_ms / after_ms:4.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Confronto offline delle decisioni di lifecycle: modalità unified contro split
+
+Su conversazioni etichettate (lifecycle, cronologia, messaggio del lead, transizione
+attesa) esegue per ogni caso:
+- unified: il prompt completo, che genera risposta e decisione;
+- split: il prompt della sola risposta e, in parallelo, il classificatore
+  (LIFECYCLE_DECISION_PROMPT su LIFECYCLE_CLASSIFIER_MODEL).
+Riporta accuratezza delle transizioni (cambio con confidence >= 0.7 rispetto
+all'etichetta), falsi positivi/negativi e latenza end-to-end (p50/max) per modalità.
+
+Usa il database e le credenziali AI configurate (prompt di sistema e modello attivi).
+Uso: python scripts/eval_lifecycle_classifier.py [--repeat 2] [--verbose]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.models.lifecycle import LifecycleStage  # noqa: E402
+from app.services.lifecycle_classifier import build_decision_prompt  # noqa: E402
+from app.services.response_mode import expand_lean_response, is_lean_response  # noqa: E402
+from app.services.unified_agent import UnifiedAgent  # noqa: E402
+
+C = LifecycleStage.CONTRASSEGNATO
+T = LifecycleStage.IN_TARGET
+L = LifecycleStage.LINK_DA_INVIARE
+
+AUTO = "Ciao! Grazie per avermi scritto, ti rispondo a breve"
+
+# (lifecycle, cronologia [(ruolo, testo)], messaggio del lead, transizione attesa)
+CASES = [
+    (C, [("assistant", AUTO)], "Ciao", False),
+    (C, [("assistant", "Bene Giulia !! :) Quanti anni hai e qual è il tuo obiettivo?")],
+     "Ho 32 anni e vorrei perdere 8 kg, ci provo da anni senza risultati", True),
+    (C, [("assistant", "Qual è il tuo obiettivo?")], "boh non so, sto solo guardando", False),
+    (C, [("assistant", "Quanti anni hai?")], "35, voglio tornare in forma dopo la gravidanza e sentirmi meglio", True),
+    (T, [("assistant", "Ti propongo una consulenza gratuita con il nostro team, ti va?")], "Sì dai, mi interessa!", True),
+    (T, [("assistant", "Il percorso unisce nutrizione, sport e psicologia")], "quanto costa?", False),
+    (T, [("assistant", "Ti propongo una consulenza gratuita, ti va?")], "ci devo pensare, ora non ho tempo", False),
+    (T, [("assistant", "Vuoi prenotare la consulenza gratuita?")], "ok prenotiamo", True),
+    (L, [("assistant", "Ecco il link per prenotare la call")], "perfetto, grazie!", True),
+    (L, [("assistant", "Ecco il link per prenotare la call")], "ma gli orari sono solo di mattina?", False),
+    (L, [("assistant", "Ti mando il link?")], "sì mandamelo", True),
+    (L, [("assistant", "Ecco il link per prenotare")], "non mi interessa più", False),
+]
+
+
+def unified_decision(agent: UnifiedAgent, response: str) -> bool:
+    data = agent._parse_ai_response(response)
+    if is_lean_response(data):
+        data = expand_lean_response(data)
+    try:
+        confidence = float(data.get("confidence", 0.0))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return bool(data.get("should_change_lifecycle")) and confidence >= 0.7
+
+
+async def run_case(agent: UnifiedAgent, index: int, case, mode: str):
+    lifecycle, history, message, _ = case
+    session = SimpleNamespace(session_id=f"eval-{mode}-{index}", current_lifecycle=lifecycle)
+    messages = [SimpleNamespace(role=role, message=text) for role, text in history]
+    started = time.monotonic()
+    if mode == "unified":
+        prompt = await agent._get_unified_prompt(session, message, None, history=messages)
+        changed = unified_decision(agent, await agent._call_ai_agent(prompt))
+    else:
+        prompt = await agent._get_unified_prompt(session, message, None, history=messages, include_decision=False)
+        decision_prompt = build_decision_prompt(lifecycle, message, agent._format_conversation_context(messages))
+        _, decision = await asyncio.gather(
+            agent._call_ai_agent(prompt),
+            agent._classify_lifecycle(decision_prompt, session),
+        )
+        changed = decision["should_change"] and decision["confidence"] >= 0.7
+    return changed, time.monotonic() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    agent = UnifiedAgent()
+    print(f"{len(CASES)} casi etichettati x {args.repeat}")
+    print(f"{'modalità':<10} {'accuratezza':>11} {'falsi +':>8} {'falsi -':>8} {'p50 s':>7} {'max s':>7}")
+    for mode in ("unified", "split"):
+        correct = false_pos = false_neg = 0
+        latencies = []
+        for _ in range(args.repeat):
+            for index, case in enumerate(CASES):
+                changed, elapsed = await run_case(agent, index, case, mode)
+                expected = case[3]
+                latencies.append(elapsed)
+                correct += changed == expected
+                false_pos += changed and not expected
+                false_neg += expected and not changed
+                if args.verbose and changed != expected:
+                    print(f"  {mode}: atteso {expected}, deciso {changed} per {case[2]!r}")
+        total = len(CASES) * args.repeat
+        print(f"{mode:<10} {correct / total:11.2f} {false_pos:8d} {false_neg:8d} "
+              f"{statistics.median(latencies):7.2f} {max(latencies):7.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
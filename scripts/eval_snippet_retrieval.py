@@ -0,0 +1,112 @@
+"""
+Valutazione offline della selezione degli snippet (BM25) rispetto al dump completo
+
+Su un insieme di conversazioni etichettate (messaggi recenti del lead e snippet che la
+risposta dovrebbe usare) misura, per ogni top-k:
+- recall: quota degli snippet attesi presenti nel blocco del prompt (selezione BM25 o,
+  senza risultati, il dump completo del lifecycle);
+- hit rate: casi in cui almeno uno snippet atteso è nel blocco del prompt;
+- fallback: casi senza risultati BM25, risolti con il dump completo;
+- dimensione del blocco snippet nel prompt (caratteri e token stimati, ~4 caratteri/token)
+confrontata con il dump di tutti gli snippet del lifecycle (senza risultati la selezione
+ricade sul dump completo e il blocco ne ha la dimensione).
+
+Uso: python scripts/eval_snippet_retrieval.py [--k 2 3 4 6] [--verbose]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("GOOGLE_AI_API_KEY", "eval")
+
+from app.models.lifecycle import LifecycleStage  # noqa: E402
+from app.services.snippet_retrieval import tokenize  # noqa: E402
+from app.services.snippet_store import snippet_store  # noqa: E402
+
+C = LifecycleStage.CONTRASSEGNATO
+T = LifecycleStage.IN_TARGET
+L = LifecycleStage.LINK_DA_INVIARE
+
+# (lifecycle, messaggi recenti del lead, snippet attesi). Le frasi sono formulate a parte
+# e non riusano le parole chiave della colonna Argomenti del CSV, che BM25 indicizza:
+# altrimenti la recall misurerebbe solo la corrispondenza con le etichette
+CASES = [
+    (C, ["Ciao, vorrei perdere 10 kg", "che cifre ci sono per seguirti?"], {"costo_a"}),
+    (C, ["frequento la terza superiore e vorrei mettere massa"], {"under18"}),
+    (C, ["sono del 2005, vorrei dimagrire per l'estate"], {"under"}),
+    (C, ["Ma tu esattamente che mestiere svolgi?"], {"b_io_mi_occupo", "b_info_1"}),
+    (C, ["mi mandi uno schema alimentare da seguire?"], {"b_info_2"}),
+    (C, ["è fuori dalla mia portata economica, non ce la faccio"], {"budget", "b_budget_obiezione"}),
+    (C, ["preferirei sentire te e non qualcun altro del team"], {"parlare_con_te"}),
+    (C, ["adesso ho la testa altrove, magari fra qualche mese"], {"b_nit"}),
+    (T, ["ok ma alla fine a quanto ammonta?", "ci sono sorprese nel conto?"], {"costo_a"}),
+    (T, ["Mi interessa, in pratica cosa succede nella prima chiamata?"], {"b_info_2", "costo_b"}),
+    (T, ["in questi giorni sono pieno fino al collo tra turni e riunioni"], {"b_no_disponibilita"}),
+    (T, ["ehi?? nessuna novità? ti ho scritto ieri"], {"risposta_tardiva2", "risposta_tardiva3"}),
+    (T, ["la cifra è alta, devo rifletterci", "non so se il portafoglio regge"], {"budget", "b_budget_obiezione"}),
+    (T, ["vorrei fissare una chiamata conoscitiva"], {"costo_b"}),
+    (T, ["non sono maggiorenne, i miei genitori devono firmare qualcosa?"], {"under18"}),
+    (T, ["vado già in palestra, mi serve una mano a mangiare meglio"], {"b_info_1"}),
+    (L, ["mandami pure dove devo cliccare per scegliere il giorno"], {"costo_b"}),
+    (L, ["faccio i turni in fabbrica, la fascia proposta non mi va bene"], {"b_no_disponibilita"}),
+    (L, ["ci rifletto su e ti faccio sapere"], {"b_nit"}),
+    (L, ["ma la videochiamata la farò con te?"], {"parlare_con_te"}),
+]
+
+
+def leaked_keywords(messages, expected) -> set:
+    """Parole chiave (Argomenti) degli snippet attesi presenti nei messaggi del caso"""
+    words = set(tokenize(" ".join(messages)))
+    return {
+        topic
+        for snippet_id in expected
+        for topic in getattr(snippet_store.get(snippet_id), "topics", ())
+        if set(tokenize(topic)) and set(tokenize(topic)) <= words
+    }
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, round(len(text) / 4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 3, 4, 6])
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    index = snippet_store.index
+    full_tokens = sum(approx_tokens(snippet_store.snippets_block(lifecycle)) for lifecycle, _, _ in CASES) / len(CASES)
+    print(f"Sorgente snippet: {index.source}, {len(CASES)} casi etichettati")
+    for lifecycle, messages, expected in CASES:
+        leaked = leaked_keywords(messages, expected)
+        if leaked:
+            print(f"  attenzione: il caso {messages!r} riusa le parole chiave {sorted(leaked)}")
+    print(f"{'selezione':<12} {'recall':>7} {'hit rate':>9} {'fallback':>9} {'snippet/turno':>14} {'token blocco':>13} {'vs dump':>8}")
+    print(f"{'dump':<12} {1.0:7.2f} {1.0:9.2f} {'-':>9} {'tutti':>14} {full_tokens:13.0f} {'100%':>8}")
+
+    for k in args.k:
+        recall_sum = hits = fallbacks = selected_sum = tokens_sum = 0.0
+        for lifecycle, messages, expected in CASES:
+            query = "\n".join(messages)
+            selected = [snippet_id for snippet_id, _ in index.retrievers[lifecycle].search(query, k)]
+            if not selected:
+                # Nessun risultato: nel prompt finisce il dump completo del lifecycle
+                fallbacks += 1
+                selected = [s.id for s in snippet_store.snippets_for_lifecycle(lifecycle)]
+            block = snippet_store.select_snippets_block(lifecycle, query, k)
+            found = expected & set(selected)
+            recall_sum += len(found) / len(expected)
+            hits += bool(found)
+            selected_sum += len(selected)
+            tokens_sum += approx_tokens(block)
+            if args.verbose and not found:
+                print(f"  k={k} mancato {sorted(expected)} per {messages!r}: {selected}")
+        n = len(CASES)
+        tokens = tokens_sum / n
+        print(f"{f'top-{k}':<12} {recall_sum / n:7.2f} {hits / n:9.2f} {fallbacks / n:9.0%} {selected_sum / n:14.1f} {tokens:13.0f} {tokens / full_tokens:8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Fixture comuni: database SQLite temporaneo, client HTTP sull'app e budget di query
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+# Il database va configurato prima di importare l'app (settings ed engine sono globali)
+_db_dir = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_dir}/test.db"
+os.environ["DEBUG"] = "false"
+os.environ.setdefault("GOOGLE_AI_API_KEY", "test")
+
+import httpx  # noqa: E402
+from fastapi.responses import HTMLResponse  # noqa: E402
+
+from app.database import Base, count_queries, engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.services.session_cache import session_cache  # noqa: E402
+from app.services.timeline_service import timeline_service  # noqa: E402
+
+
+@pytest.fixture
+async def db_engine():
+    """Schema pulito per ogni test"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    session_cache.clear()
+    timeline_service.clear()
+    yield engine
+    # Le connessioni del pool appartengono all'event loop del test
+    await engine.dispose()
+
+
+@pytest.fixture
+async def client(db_engine):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http_client:
+        yield http_client
+
+
+@pytest.fixture
+def template_context(monkeypatch):
+    """Cattura nome e contesto dei template invece di renderizzarli
+
+    I test delle dashboard verificano query e dati passati al template, non l'HTML.
+    """
+    from app import routes
+
+    rendered = {}
+
+    def capture(name, context, *args, **kwargs):
+        rendered["name"] = name
+        rendered["context"] = context
+        return HTMLResponse("")
+
+    monkeypatch.setattr(routes.templates, "TemplateResponse", capture)
+    return rendered
+
+
+@pytest.fixture
+def query_budget():
+    """Fallisce se il blocco esegue più query del budget (regressioni N+1)
+
+    Uso: `with query_budget(3): await client.get(...)`
+    """
+    @contextmanager
+    def budget(max_queries: int):
+        with count_queries() as counter:
+            yield counter
+        assert counter.count <= max_queries, (
+            f"{counter.count} query eseguite, budget {max_queries}:\n" + "\n".join(counter.statements)
+        )
+
+    return budget
@@ -0,0 +1,91 @@
+"""
+Import NDJSON delle conversazioni: validazione per riga, batch e risoluzione degli eventi
+"""
+import json
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from app.models.database_models import LifecycleEventModel, MessageModel, SessionModel
+from app.models.lifecycle import LifecycleStage
+from app.services.bulk_import_service import BulkImportService
+
+
+def conversation(session_id, **extra):
+    return json.dumps({
+        "session_id": session_id,
+        "user_info": {"firstname": "Anna"},
+        "messages": [
+            {"role": "user", "message": "Ciao", "timestamp": "2025-11-20T10:00:00Z"},
+            {"role": "assistant", "message": "Ciao!", "timestamp": "2025-11-20T10:00:05Z", "lifecycle": "contrassegnato"},
+        ],
+        "lifecycle_events": [
+            {"previous_lifecycle": "nuova_lead", "new_lifecycle": "CONTRASSEGNATO",
+             "created_at": "2025-11-20T10:00:05Z", "trigger_message_index": 1, "confidence": 0.9},
+        ],
+        **extra,
+    })
+
+
+async def test_import_writes_sessions_messages_and_events(db_engine):
+    from app.database import async_session
+
+    report = await BulkImportService.import_ndjson([conversation("lead-1"), "", conversation("lead-2")], batch_size=1)
+
+    assert report["sessions_imported"] == 2 and report["errors"] == []
+    assert report["messages_imported"] == 4 and report["lifecycle_events_imported"] == 2
+    async with async_session() as db:
+        session = (await db.execute(select(SessionModel).where(SessionModel.session_id == "lead-1"))).scalar_one()
+        assert session.current_lifecycle == LifecycleStage.CONTRASSEGNATO
+        assert json.loads(session.user_info) == {"firstname": "Anna"}
+        assert session.updated_at.replace(tzinfo=timezone.utc) == datetime(2025, 11, 20, 10, 0, 5, tzinfo=timezone.utc)
+        event = (await db.execute(
+            select(LifecycleEventModel).where(LifecycleEventModel.session_id == session.id)
+        )).scalar_one()
+        trigger = await db.get(MessageModel, event.trigger_message_id)
+        assert trigger.session_id == session.id and trigger.message == "Ciao!"
+
+    again = await BulkImportService.import_ndjson([conversation("lead-1")])
+    assert again["sessions_skipped"] == 1 and again["sessions_imported"] == 0
+    failed = await BulkImportService.import_ndjson([conversation("lead-1")], on_conflict="fail")
+    assert "già esistente" in failed["errors"][0]["error"]
+
+
+async def test_malformed_lines_are_reported_per_line(db_engine):
+    lines = [
+        conversation("ok-1"),
+        "[1, 2, 3]",
+        '"solo una stringa"',
+        json.dumps({"session_id": "bad-messages", "messages": "Ciao"}),
+        json.dumps({"session_id": "bad-item", "messages": ["Ciao"]}),
+        json.dumps({"session_id": "bad-event", "lifecycle_events": [42]}),
+        json.dumps({"session_id": "bad-role", "messages": [{"role": "bot", "message": "x"}]}),
+        "{non json",
+        conversation("ok-2"),
+        json.dumps({"session_id": "bad-confidence", "lifecycle_events": [{"new_lifecycle": "in_target", "confidence": "alta"}]}),
+        conversation("ok-3"),
+    ]
+
+    # Un solo batch: la riga con confidence non valida non fa fallire le altre
+    report = await BulkImportService.import_ndjson(lines)
+
+    assert report["sessions_imported"] == 3
+    assert [error["line"] for error in report["errors"]] == [2, 3, 4, 5, 6, 7, 8, 10]
+    assert "oggetto JSON" in report["errors"][0]["error"]
+    assert "Messaggio 0" in report["errors"][3]["error"]
+    assert "Evento 0: confidence non valida" in report["errors"][7]["error"]
+
+
+async def test_import_endpoint_dry_run_and_rebase(client):
+    body = "\n".join([conversation("api-1"), "[]", conversation("api-2")])
+
+    dry = (await client.post("/api/import/conversations?dry_run=true", content=body)).json()
+    assert dry["sessions_imported"] == 2 and dry["messages_imported"] == 0 and len(dry["errors"]) == 1
+
+    response = await client.post("/api/import/conversations?rebase_to_now=true", content=body)
+    assert response.status_code == 200
+    assert response.json()["sessions_imported"] == 2
+
+    sessions = (await client.get("/api/sessions_list")).json()["sessions"]
+    assert {s["session_id"] for s in sessions} == {"api-1", "api-2"}
+    assert all(datetime.fromisoformat(s["updated_at"]).year >= 2026 for s in sessions)
@@ -0,0 +1,133 @@
+"""
+Coda durevole dei turni: ripresa di un job dopo la morte del worker (lease scaduto),
+retry con backoff, dead-letter e rimessa in coda manuale
+"""
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import func, select, update
+
+from app.database import async_session
+from app.models.api_models import ChatMessage
+from app.models.database_models import ChatJobModel, MessageModel, SessionModel
+from app.services.chat_jobs import ChatJobQueue, ChatWorkerPool
+from app.services.session_cache import session_cache
+from app.services.unified_agent import UnifiedAgent
+
+SESSION_ID = "jobs-session"
+
+
+@pytest.fixture
+def fake_agent(monkeypatch):
+    calls = []
+
+    async def call(self, prompt, model_name=None, context="", **kwargs):
+        calls.append(prompt)
+        return json.dumps({
+            "messages": "risposta ripresa",
+            "should_change_lifecycle": False,
+            "reasoning": "ok",
+            "confidence": 0.9,
+            "requires_human": False,
+        })
+
+    monkeypatch.setattr(UnifiedAgent, "_call_ai_agent", call)
+    return calls
+
+
+@pytest.fixture
+def queue():
+    return ChatJobQueue()
+
+
+async def _expire_lease(job_id: int) -> None:
+    async with async_session() as db:
+        await db.execute(
+            update(ChatJobModel)
+            .where(ChatJobModel.id == job_id)
+            .values(locked_until=datetime.now(timezone.utc) - timedelta(seconds=1))
+        )
+        await db.commit()
+
+
+async def test_worker_crash_during_batch_window_is_resumed(client, fake_agent, queue):
+    # Primo messaggio già servito: il turno successivo passa dalla finestra di batch
+    await client.post("/chat", json={"message": "ciao", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    calls_before = len(fake_agent)
+
+    chat_message = ChatMessage(message="vorrei perdere 5 kg", session_id=SESSION_ID, batch_wait_seconds=60)
+    job = await queue.enqueue(chat_message, "msg-2")
+    assert (await queue.claim("worker-morto")).id == job.id
+
+    # Il worker caduto aveva salvato il messaggio e aperto la finestra di batch
+    async with async_session() as db:
+        session = await db.scalar(select(SessionModel).where(SessionModel.session_id == SESSION_ID))
+        db.add(MessageModel(session_id=session.id, role="user", message=chat_message.message, client_message_id="msg-2"))
+        session.is_batch_waiting = True
+        session.batch_started_at = datetime.now(timezone.utc) - timedelta(seconds=130)
+        await db.commit()
+    session_cache.invalidate(SESSION_ID)
+    await _expire_lease(job.id)
+
+    resumed = await queue.claim("worker-vivo")
+    assert resumed.id == job.id and resumed.attempts == 2
+    await ChatWorkerPool(queue, concurrency=1)._run_job(resumed, "worker-vivo")
+
+    job = await queue.get(job.id)
+    assert job.status == "done"
+    assert [m["text"] for m in json.loads(job.result)["messages"]] == ["risposta ripresa"]
+    assert len(fake_agent) == calls_before + 1
+    async with async_session() as db:
+        session = await db.scalar(select(SessionModel).where(SessionModel.session_id == SESSION_ID))
+        assert session.is_batch_waiting is False
+        saved = await db.scalar(select(func.count(MessageModel.id)).where(MessageModel.client_message_id == "msg-2"))
+        assert saved == 1
+
+
+async def test_live_batch_window_still_queues_resumed_message(client, fake_agent, queue):
+    await client.post("/chat", json={"message": "ciao", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    calls_before = len(fake_agent)
+
+    # Un turno vivo ha appena aperto la finestra: risponderà anche al messaggio ripreso
+    async with async_session() as db:
+        session = await db.scalar(select(SessionModel).where(SessionModel.session_id == SESSION_ID))
+        db.add(MessageModel(session_id=session.id, role="user", message="ci sei?", client_message_id="msg-3"))
+        session.is_batch_waiting = True
+        session.batch_started_at = datetime.now(timezone.utc)
+        await db.commit()
+    session_cache.invalidate(SESSION_ID)
+
+    response = await UnifiedAgent().chat(SESSION_ID, "ci sei?", batch_wait_seconds=60, client_message_id="msg-3", resume=True)
+
+    assert response.messages == []
+    assert response.ai_reasoning.startswith("Messaggio messo in coda")
+    assert len(fake_agent) == calls_before
+
+
+async def test_failed_job_retries_then_dead_letter(db_engine, queue, monkeypatch):
+    async def failing_turn(*args, **kwargs):
+        raise RuntimeError("turno fallito")
+
+    monkeypatch.setattr("app.services.chat_service.run_chat_turn", failing_turn)
+    pool = ChatWorkerPool(queue, concurrency=1)
+    job = await queue.enqueue(ChatMessage(message="ciao", session_id=SESSION_ID), "msg-1")
+    # Stessa chiave: stesso job
+    assert (await queue.enqueue(ChatMessage(message="ciao", session_id=SESSION_ID), "msg-1")).id == job.id
+
+    for attempt in range(1, job.max_attempts + 1):
+        async with async_session() as db:
+            await db.execute(update(ChatJobModel).where(ChatJobModel.id == job.id).values(available_at=datetime.now(timezone.utc)))
+            await db.commit()
+        claimed = await queue.claim("worker")
+        assert claimed.attempts == attempt
+        await pool._run_job(claimed, "worker")
+
+    job = await queue.get(job.id)
+    assert job.status == "dead"
+    assert job.last_error == "turno fallito"
+    assert await queue.claim("worker") is None
+
+    assert await queue.retry(job.id) is True
+    job = await queue.get(job.id)
+    assert job.status == "pending" and job.attempts == 0
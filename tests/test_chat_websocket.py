@@ -0,0 +1,145 @@
+"""
+Trasporto WebSocket della chat: ack, push delle parti, ping/pong e resume dal cursore
+"""
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from app.database import async_session
+from app.models.database_models import MessageModel, SessionModel
+from app.models.lifecycle import LifecycleStage
+from app.services.chat_events import chat_events
+from app.services.chat_websocket import ChatSocket
+from app.services.unified_agent import UnifiedAgent
+
+SESSION_ID = "ws-session"
+
+
+class FakeWebSocket:
+    """WebSocket minimale pilotato dal test nello stesso event loop"""
+
+    def __init__(self):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent = []
+        self.accepted = False
+
+    async def accept(self):
+        self.accepted = True
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def receive_json(self):
+        data = await self.incoming.get()
+        if data is None:
+            raise WebSocketDisconnect(code=1000)
+        return data
+
+    async def close(self, code=1000):
+        await self.incoming.put(None)
+
+    async def wait_for(self, predicate, timeout=5.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            for event in self.sent:
+                if predicate(event):
+                    return event
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"Evento atteso non ricevuto: {self.sent}")
+
+
+@pytest.fixture
+def fake_agent(monkeypatch):
+    async def call(self, prompt, model_name=None, context="", **kwargs):
+        return json.dumps({
+            "messages": [{"text": "ciao", "delay_ms": 150}, {"text": "come posso aiutarti?", "delay_ms": 0}],
+            "should_change_lifecycle": False,
+            "new_lifecycle": None,
+            "reasoning": "saluto",
+            "confidence": 0.9,
+            "requires_human": False,
+        })
+
+    monkeypatch.setattr(UnifiedAgent, "_call_ai_agent", call)
+
+
+async def test_message_is_acked_and_parts_are_pushed(db_engine, fake_agent):
+    ws = FakeWebSocket()
+    serve = asyncio.create_task(ChatSocket(ws, SESSION_ID).serve())
+    await ws.incoming.put({"type": "ping"})
+    # Il primo messaggio riceve il benvenuto fisso, il secondo passa dall'agente
+    await ws.incoming.put({"type": "message", "text": "buongiorno", "client_message_id": "m1", "batch_wait_seconds": 0})
+    await ws.wait_for(lambda e: e["type"] == "turn_complete" and e["client_message_id"] == "m1")
+    await ws.incoming.put({"type": "message", "text": "info", "client_message_id": "m2", "batch_wait_seconds": 0})
+    await ws.wait_for(lambda e: e["type"] == "turn_complete" and e["client_message_id"] == "m2")
+    await ws.close()
+    await serve
+
+    types = [e["type"] for e in ws.sent]
+    assert ws.accepted
+    assert "pong" in types
+    assert types.index("ack") < types.index("turn_complete")
+    assert [e["text"] for e in ws.sent if e["type"] == "message"][-2:] == ["ciao", "come posso aiutarti?"]
+    # turn_complete arriva dopo l'ultima parte del suo turno
+    assert types[-1] == "turn_complete"
+    assert not chat_events.has_subscribers(SESSION_ID)
+
+
+async def test_back_to_back_turns_do_not_interleave(db_engine, fake_agent):
+    ws = FakeWebSocket()
+    serve = asyncio.create_task(ChatSocket(ws, SESSION_ID).serve())
+    # Il secondo turno termina mentre le parti del primo sono ancora in pausa (delay_ms)
+    await ws.incoming.put({"type": "message", "text": "buongiorno", "client_message_id": "m1", "batch_wait_seconds": 0})
+    await ws.incoming.put({"type": "message", "text": "info", "client_message_id": "m2", "batch_wait_seconds": 0})
+    await ws.wait_for(lambda e: e["type"] == "turn_complete" and e["client_message_id"] == "m2")
+    await ws.wait_for(lambda e: e["type"] == "turn_complete" and e["client_message_id"] == "m1")
+    await ws.close()
+    await serve
+
+    stream = [
+        e["text"] if e["type"] == "message" else f"complete:{e['client_message_id']}"
+        for e in ws.sent
+        if e["type"] in ("message", "turn_complete")
+    ]
+    welcome = stream[0]
+    assert stream == [
+        welcome, "ciao", "come posso aiutarti?", "complete:m1",
+        "ciao", "come posso aiutarti?", "complete:m2",
+    ]
+
+
+async def test_invalid_frames_get_error_events(db_engine):
+    ws = FakeWebSocket()
+    serve = asyncio.create_task(ChatSocket(ws, SESSION_ID).serve())
+    await ws.incoming.put({"type": "message", "text": "   "})
+    await ws.incoming.put({"type": "boh"})
+    await ws.wait_for(lambda e: e["type"] == "error" and "boh" in e["detail"])
+    await ws.close()
+    await serve
+
+    assert [e["status"] for e in ws.sent if e["type"] == "error"] == [422, 400]
+
+
+async def test_resume_replays_messages_after_cursor(db_engine):
+    async with async_session() as db:
+        session = SessionModel(session_id=SESSION_ID, current_lifecycle=LifecycleStage.NUOVA_LEAD)
+        db.add(session)
+        await db.flush()
+        seen = MessageModel(session_id=session.id, role="user", message="già visto")
+        db.add(seen)
+        await db.flush()
+        db.add(MessageModel(session_id=session.id, role="assistant", message="uno\n---SPLIT---\ndue"))
+        await db.commit()
+        cursor = seen.id
+
+    ws = FakeWebSocket()
+    serve = asyncio.create_task(ChatSocket(ws, SESSION_ID).serve(after_id=cursor))
+    await ws.wait_for(lambda e: e.get("replay") and e["part_index"] == 1)
+    await ws.close()
+    await serve
+
+    replayed = [e for e in ws.sent if e.get("replay")]
+    assert [e["text"] for e in replayed] == ["uno", "due"]
+    assert all(e["id"] > cursor for e in replayed)
@@ -0,0 +1,149 @@
+"""
+Circuit breaker delle chiamate AI e modalità degradata (snippet immediato + turno differito)
+"""
+import json
+import time
+
+import pytest
+from sqlalchemy import select
+
+from app.config import settings
+from app.data.lifecycle_config import get_degraded_reply
+from app.models.lifecycle import LifecycleStage
+from app.database import async_session
+from app.models.database_models import ChatJobModel, MessageModel
+from app.services.chat_service import run_deferred_reply
+from app.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, ai_circuit_breaker
+from app.services.unified_agent import UnifiedAgent
+
+SESSION_ID = "circuit-session"
+
+
+def test_opens_on_failure_rate_and_closes_after_probe(monkeypatch):
+    breaker = CircuitBreaker("test", window_size=10, minimum_calls=4, failure_rate_threshold=0.5, open_seconds=30)
+    breaker.record_success(0.1)
+    breaker.record_failure()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.acquire()
+    assert 0 < error.value.retry_after <= 30
+
+    # Scaduto open_seconds: una sola chiamata di prova alla volta
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 31)
+    assert breaker.state == HALF_OPEN
+    breaker.acquire()
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_and_failed_probe_reopen(monkeypatch):
+    breaker = CircuitBreaker("test", minimum_calls=3, slow_call_seconds=1.0, slow_call_rate_threshold=0.6, open_seconds=5)
+    for _ in range(3):
+        breaker.record_success(2.0)
+    assert breaker.state == OPEN
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    breaker.acquire()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+@pytest.fixture
+def fake_agent(monkeypatch):
+    calls = []
+
+    async def call(self, prompt, model_name=None, context="", **kwargs):
+        calls.append(prompt)
+        return json.dumps({
+            "messages": "risposta vera",
+            "should_change_lifecycle": False,
+            "new_lifecycle": None,
+            "reasoning": "ok",
+            "confidence": 0.9,
+            "requires_human": False,
+        })
+
+    monkeypatch.setattr(UnifiedAgent, "_call_ai_agent", call)
+    return calls
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(settings, "ai_circuit_enabled", True)
+    ai_circuit_breaker.reset()
+    yield ai_circuit_breaker
+    ai_circuit_breaker.reset()
+
+
+async def test_open_circuit_gets_degraded_reply_and_deferred_turn(client, db_engine, breaker, monkeypatch):
+    async def failing_agent(self, model_name=None):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(UnifiedAgent, "_get_agent", failing_agent)
+
+    # Primo messaggio: benvenuto + risposta AI fallita (circuito ancora chiuso)
+    for attempt in range(breaker.minimum_calls):
+        await client.post("/chat", json={"message": f"ciao {attempt}", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    assert breaker.state == OPEN
+
+    started = time.monotonic()
+    response = await client.post("/chat", json={"message": "ci sei?", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    assert time.monotonic() - started < 2
+    assert response.status_code == 200
+    data = response.json()
+    assert [m["text"] for m in data["messages"]] == [get_degraded_reply(LifecycleStage(data["current_lifecycle"]))]
+
+    # Un altro messaggio a circuito aperto non ripete lo snippet e confluisce nello stesso turno differito
+    response = await client.post("/chat", json={"message": "pronto?", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    assert response.json()["messages"] == []
+
+    async with async_session() as db:
+        jobs = (await db.execute(select(ChatJobModel).where(ChatJobModel.kind == "deferred_reply"))).scalars().all()
+    assert len(jobs) == 1
+    payload = json.loads(jobs[0].payload)
+    assert payload["after_message_id"] == data["messages"][0]["id"]
+    assert jobs[0].available_at.timestamp() > time.time()
+
+
+async def test_deferred_reply_answers_once(client, db_engine, breaker, fake_agent):
+    await client.post("/chat", json={"message": "ciao", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+    async with async_session() as db:
+        last_id = (await db.execute(select(MessageModel.id).order_by(MessageModel.id.desc()).limit(1))).scalar_one()
+
+    response = await run_deferred_reply(SESSION_ID, last_id)
+    assert response.messages == [{"text": "risposta vera", "delay_ms": 0, "id": last_id + 1}]
+
+    # Già risposto dopo il messaggio di riferimento: nessuna nuova chiamata AI
+    calls_before = len(fake_agent)
+    response = await run_deferred_reply(SESSION_ID, last_id)
+    assert response.messages == []
+    assert len(fake_agent) == calls_before
+
+
+def test_degraded_reply_depends_on_lifecycle():
+    replies = {stage: get_degraded_reply(stage) for stage in LifecycleStage}
+
+    assert len(set(replies.values())) == len(replies)
+    assert all(reply and "{{" not in reply for reply in replies.values())
+
+
+async def test_disabled_breaker_does_not_record_calls(client, db_engine, monkeypatch):
+    async def failing_agent(self, model_name=None):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(settings, "ai_circuit_enabled", False)
+    monkeypatch.setattr(UnifiedAgent, "_get_agent", failing_agent)
+    ai_circuit_breaker.reset()
+
+    for attempt in range(ai_circuit_breaker.minimum_calls):
+        await client.post("/chat", json={"message": f"ciao {attempt}", "session_id": SESSION_ID, "batch_wait_seconds": 0})
+
+    assert ai_circuit_breaker.state == CLOSED
+    assert ai_circuit_breaker.snapshot()["window_calls"] == 0
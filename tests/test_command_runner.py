@@ -0,0 +1,99 @@
+"""
+Runner dei comandi di /api/execute: streaming, single-flight, cache e timeout
+"""
+import sys
+
+import pytest
+
+from app.services import command_runner as runner_module
+from app.services.command_runner import CommandRunner
+
+SLOW_SCRIPT = "import sys, time\nfor i in range(3):\n    print(f'riga {i}', flush=True)\n    time.sleep(0.05)\n"
+
+
+@pytest.fixture
+def commands(monkeypatch, tmp_path):
+    counter = tmp_path / "runs.txt"
+    count_script = f"open({str(counter)!r}, 'a').write('x')\n" + SLOW_SCRIPT
+    monkeypatch.setattr(runner_module, "COMMANDS", {
+        "server-status": ([sys.executable, "-c", count_script], True),
+        "dependencies-lock": ([sys.executable, "-c", "print('lock')"], False),
+        "broken": ([sys.executable, "-c", "import sys; print('boom'); sys.exit(3)"], True),
+        "noisy": ([sys.executable, "-c", "import sys; print('dati'); print('avviso', file=sys.stderr)"], True),
+        "failing": ([sys.executable, "-c", "import sys; print('parziale'); sys.exit('errore grave')"], True),
+        "slow": ([sys.executable, "-c", "import time; time.sleep(5)"], True),
+    })
+    return counter
+
+
+def _runner(**overrides) -> CommandRunner:
+    options = {"cwd": ".", "max_concurrency": 2, "timeout_seconds": 5.0, "cache_ttl_seconds": 60.0}
+    options.update(overrides)
+    return CommandRunner(**options)
+
+
+async def test_concurrent_requests_share_one_process(commands):
+    runner = _runner()
+    runs = [runner.start("server-status") for _ in range(3)]
+    assert runs[0] is runs[1] is runs[2]
+
+    streamed = [chunk async for chunk in runs[0].stream()]
+    result = await runs[1].wait()
+    assert result.success
+    assert "".join(streamed) == result.output == "riga 0\nriga 1\nriga 2\n"
+    assert commands.read_text() == "x"
+
+
+async def test_read_only_results_are_cached_until_a_write(commands):
+    runner = _runner()
+    await runner.start("server-status").wait()
+    cached = runner.start("server-status")
+    assert cached.cached
+    assert (await cached.wait()).output.startswith("riga 0")
+    assert commands.read_text() == "x"
+
+    await runner.start("dependencies-lock").wait()
+    fresh = runner.start("server-status")
+    assert not fresh.cached
+    await fresh.wait()
+
+
+async def test_failures_and_timeouts_are_reported_and_not_cached(commands):
+    runner = _runner(timeout_seconds=0.2)
+    failed = await runner.start("broken").wait()
+    assert failed.returncode == 3
+    assert not failed.success
+    assert "boom" in failed.failure_detail
+    retried = runner.start("broken")
+    assert not retried.cached
+    await retried.wait()
+
+    timed_out = await runner.start("slow").wait()
+    assert timed_out.error.startswith("Timeout")
+
+
+async def test_stderr_is_kept_apart_from_output(commands):
+    runner = _runner()
+    noisy = await runner.start("noisy").wait()
+    assert noisy.success
+    assert noisy.output == "dati\n"
+    assert noisy.stderr == "avviso\n"
+
+    failing = await runner.start("failing").wait()
+    assert failing.output == "parziale\n"
+    assert failing.failure_detail == "errore grave"
+
+
+async def test_execute_endpoint_streams_output(client, db_engine, commands, monkeypatch):
+    monkeypatch.setattr(runner_module.command_runner, "cwd", ".")
+    runner_module.command_runner.invalidate()
+
+    response = await client.get("/api/execute/server-status", params={"stream": "true"})
+    assert response.status_code == 200
+    assert response.text == "riga 0\nriga 1\nriga 2\n"
+
+    response = await client.get("/api/execute/server-status")
+    assert response.json()["cached"] is True
+
+    response = await client.get("/api/execute/unknown")
+    assert response.status_code == 400
@@ -0,0 +1,96 @@
+"""
+Middleware di compressione: soglia, allow-list dei content type e streaming
+"""
+import gzip
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app.compression import CompressionMiddleware, negotiate_encoding
+
+LARGE_TEXT = "riga di testo ripetuta per superare la soglia\n" * 200
+
+
+async def large(request):
+    return PlainTextResponse(LARGE_TEXT)
+
+
+async def tagged(request):
+    return PlainTextResponse(LARGE_TEXT, headers={"ETag": '"v1"'})
+
+
+async def small(request):
+    return PlainTextResponse("ok")
+
+
+async def binary(request):
+    return Response(b"\x00" * 5000, media_type="application/octet-stream")
+
+
+async def stream(request):
+    async def chunks():
+        for index in range(3):
+            yield f"chunk {index}\n".encode()
+    return StreamingResponse(chunks(), media_type="text/csv")
+
+
+def _client(minimum_size: int = 500) -> httpx.AsyncClient:
+    app = Starlette(routes=[
+        Route("/large", large), Route("/tagged", tagged), Route("/small", small), Route("/binary", binary), Route("/stream", stream)
+    ])
+    app.add_middleware(CompressionMiddleware, minimum_size=minimum_size, level=6)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("gzip, deflate, br", brotli_available=True) == "br"
+    assert negotiate_encoding("gzip, deflate, br", brotli_available=False) == "gzip"
+    assert negotiate_encoding("br;q=0, gzip;q=0.5", brotli_available=True) == "gzip"
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("*;q=0") is None
+
+
+async def test_large_response_is_gzipped():
+    async with _client() as client:
+        response = await client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(LARGE_TEXT)
+    assert response.text == LARGE_TEXT
+
+
+async def test_compressed_response_gets_weak_etag():
+    async with _client() as client:
+        compressed = await client.get("/tagged", headers={"Accept-Encoding": "gzip"})
+        identity = await client.get("/tagged", headers={"Accept-Encoding": "identity"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["etag"] == 'W/"v1"'
+    assert identity.headers["etag"] == '"v1"'
+
+
+async def test_small_and_binary_responses_are_untouched():
+    async with _client() as client:
+        small_response = await client.get("/small", headers={"Accept-Encoding": "gzip"})
+        binary_response = await client.get("/binary", headers={"Accept-Encoding": "gzip"})
+        identity = await client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in small_response.headers
+    assert small_response.text == "ok"
+    assert "content-encoding" not in binary_response.headers
+    assert "content-encoding" not in identity.headers
+
+
+async def test_streaming_response_is_compressed_per_chunk():
+    async with _client() as client:
+        async with client.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(raw) == b"chunk 0\nchunk 1\nchunk 2\n"
+
+
+async def test_chat_sized_json_is_not_compressed(client, db_engine):
+    response = await client.get("/health/live", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
@@ -0,0 +1,128 @@
+"""
+Rollup incrementali del funnel: conteggi e tempi nello stage, breakdown per modello
+ed eventi con id più basso che diventano visibili dopo l'avanzamento del cursore
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import async_session
+from app.models.database_models import AnalyticsCursorModel, LifecycleEventModel, SessionModel
+from app.models.lifecycle import LifecycleStage
+from app.services.funnel_analytics_service import CURSOR_NAME, FunnelAnalyticsService
+
+N = LifecycleStage.NUOVA_LEAD
+C = LifecycleStage.CONTRASSEGNATO
+T = LifecycleStage.IN_TARGET
+
+STARTED = datetime.now(timezone.utc).replace(hour=8, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def service():
+    return FunnelAnalyticsService(refresh_interval=60, response_ttl=0)
+
+
+async def _session(name: str) -> int:
+    async with async_session() as db:
+        session = SessionModel(session_id=name, created_at=STARTED)
+        db.add(session)
+        await db.commit()
+        return session.id
+
+
+async def _event(event_id: int, session_pk: int, previous, new, seconds: int, model_name: str = "gemini-flash") -> None:
+    async with async_session() as db:
+        db.add(LifecycleEventModel(
+            id=event_id,
+            session_id=session_pk,
+            previous_lifecycle=previous,
+            new_lifecycle=new,
+            model_name=model_name,
+            created_at=STARTED + timedelta(seconds=seconds),
+        ))
+        await db.commit()
+
+
+async def _funnel(service: FunnelAnalyticsService, group_by=None):
+    return await service.get_funnel(STARTED.date(), STARTED.date(), group_by)
+
+
+def _transition(funnel, to_stage: str):
+    return next(t for t in funnel["transitions"] if t["to"] == to_stage)
+
+
+async def test_rollups_count_transitions_and_time_in_stage(db_engine, service):
+    first = await _session("funnel-1")
+    second = await _session("funnel-2")
+    await _event(1, first, N, C, 10)
+    await _event(2, first, C, T, 100)
+    await _event(3, second, N, C, 30, model_name="gemini-pro")
+
+    assert await service.update() == 3
+    funnel = await _funnel(service, group_by="model")
+
+    counts = {stage["stage"]: stage["count"] for stage in funnel["funnel"]}
+    assert counts[N.value] == 2 and counts[C.value] == 2 and counts[T.value] == 1
+    assert _transition(funnel, C.value)["avg_seconds"] == 20.0
+    assert _transition(funnel, T.value)["avg_seconds"] == 90.0
+    assert funnel["breakdown"]["groups"] == {
+        "gemini-flash": {C.value: 1, T.value: 1},
+        "gemini-pro": {C.value: 1},
+    }
+
+
+async def test_update_is_incremental(db_engine, service):
+    session_pk = await _session("funnel-1")
+    await _event(1, session_pk, N, C, 10)
+    assert await service.update() == 1
+
+    await _event(2, session_pk, C, T, 70)
+    assert await service.update() == 1
+    assert await service.update() == 0
+
+    funnel = await _funnel(service)
+    assert _transition(funnel, C.value)["count"] == 1
+    # Il tempo nello stage usa la transizione già aggregata nel batch precedente
+    assert _transition(funnel, T.value)["avg_seconds"] == 60.0
+
+
+async def test_late_committed_lower_id_is_not_skipped(db_engine, service):
+    first = await _session("funnel-1")
+    second = await _session("funnel-2")
+    # L'evento 2 è ancora in una transazione aperta quando il cursore supera l'id 3
+    await _event(1, first, N, C, 10)
+    await _event(3, first, C, T, 50)
+    assert await service.update() == 2
+
+    async with async_session() as db:
+        cursor = await db.get(AnalyticsCursorModel, CURSOR_NAME)
+        assert cursor.last_event_id == 3
+        assert "2" in cursor.pending_gaps
+
+    await _event(2, second, N, C, 40)
+    assert await service.update() == 1
+
+    funnel = await _funnel(service)
+    assert _transition(funnel, C.value)["count"] == 2
+    assert _transition(funnel, C.value)["avg_seconds"] == 25.0
+    async with async_session() as db:
+        assert (await db.get(AnalyticsCursorModel, CURSOR_NAME)).pending_gaps is None
+    # Evento recuperato una sola volta
+    assert await service.update() == 0
+
+
+async def test_rolled_back_gaps_expire(db_engine, service, monkeypatch):
+    session_pk = await _session("funnel-1")
+    await _event(1, session_pk, N, C, 10)
+    await _event(4, session_pk, C, T, 20)
+    await service.update()
+
+    monkeypatch.setattr(settings, "funnel_gap_timeout_seconds", 0.0)
+    assert await service.update() == 0
+
+    async with async_session() as db:
+        cursor = await db.scalar(select(AnalyticsCursorModel).where(AnalyticsCursorModel.name == CURSOR_NAME))
+        assert cursor.pending_gaps is None
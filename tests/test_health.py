@@ -0,0 +1,102 @@
+"""
+Sonde di salute: liveness, readiness dallo snapshot di stato e sonda AI limitata
+a una chiamata per llm_probe_interval_seconds
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.services.status_service import status_monitor
+from app.services.unified_agent import unified_agent
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    """Stato del monitor ripristinato a fine test (è globale e il lifespan non gira nei test)"""
+    for name in ("snapshot", "refreshed_at", "db_ok", "startup_complete"):
+        monkeypatch.setattr(status_monitor, name, getattr(status_monitor, name))
+    return status_monitor
+
+
+@pytest.fixture
+def fake_probe(monkeypatch):
+    calls = []
+
+    async def a_run(prompt):
+        calls.append(prompt)
+        return SimpleNamespace(text="OK")
+
+    async def get_agent(*args, **kwargs):
+        return SimpleNamespace(a_run=a_run)
+
+    monkeypatch.setattr(unified_agent, "_get_agent", get_agent)
+    monkeypatch.setattr(unified_agent, "_health_result", None)
+    monkeypatch.setattr(unified_agent, "_health_checked_at", None)
+    return calls
+
+
+async def test_liveness_has_no_dependencies(client, monitor):
+    monitor.startup_complete = False
+    monitor.db_ok = False
+
+    response = await client.get("/health/live")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "alive"
+
+
+async def test_ready_after_startup_and_fresh_refresh(client, monitor):
+    monitor.startup_complete = True
+    await monitor.refresh()
+
+    response = await client.get("/health/ready")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "ready"
+    assert body["database"]["ok"] is True
+
+
+@pytest.mark.parametrize("startup_complete, db_ok, age_intervals", [
+    (False, True, 0),  # avvio non terminato
+    (True, False, 0),  # database non raggiunto all'ultimo refresh
+    (True, True, 4),  # snapshot troppo vecchio: il refresher si è fermato
+])
+async def test_not_ready_returns_503(client, monitor, startup_complete, db_ok, age_intervals):
+    await monitor.refresh()
+    monitor.startup_complete = startup_complete
+    monitor.db_ok = db_ok
+    monitor.refreshed_at = time.monotonic() - age_intervals * monitor.refresh_interval
+
+    response = await client.get("/health/ready")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "not_ready"
+
+
+async def test_llm_probe_is_rate_limited(client, fake_probe, monkeypatch):
+    monkeypatch.setattr(settings, "llm_probe_interval_seconds", 300.0)
+
+    first = (await client.get("/unified/health", params={"probe": "true"})).json()["details"]["llm_probe"]
+    second = (await client.get("/unified/health", params={"probe": "true"})).json()["details"]["llm_probe"]
+
+    assert first["status"] == "healthy" and first["cached"] is False
+    assert second["cached"] is True and second["checked_at"] == first["checked_at"]
+    assert len(fake_probe) == 1
+
+    # Senza probe=true l'AI non viene chiamata
+    response = await client.get("/unified/health")
+    assert "llm_probe" not in response.json()["details"]
+    assert len(fake_probe) == 1
+
+
+async def test_llm_probe_runs_again_after_interval(client, fake_probe, monkeypatch):
+    monkeypatch.setattr(settings, "llm_probe_interval_seconds", 0.0)
+
+    await client.get("/unified/health", params={"probe": "true"})
+    response = await client.get("/unified/health", params={"probe": "true"})
+
+    assert response.json()["details"]["llm_probe"]["cached"] is False
+    assert len(fake_probe) == 2
@@ -0,0 +1,93 @@
+"""
+Sync incrementale della cronologia: cursore after_id ed ETag/304
+"""
+from app.database import async_session
+from app.models.database_models import MessageModel, SessionModel
+from app.models.lifecycle import LifecycleStage
+
+SESSION_ID = "history-session"
+
+
+async def _add_message(session_pk: int, role: str, text: str) -> int:
+    async with async_session() as db:
+        message = MessageModel(session_id=session_pk, role=role, message=text)
+        db.add(message)
+        await db.commit()
+        return message.id
+
+
+async def _create_session() -> int:
+    async with async_session() as db:
+        session = SessionModel(session_id=SESSION_ID, current_lifecycle=LifecycleStage.NUOVA_LEAD)
+        db.add(session)
+        await db.commit()
+        return session.id
+
+
+async def test_full_history_then_delta(client, db_engine):
+    session_pk = await _create_session()
+    await _add_message(session_pk, "user", "ciao")
+    last_id = await _add_message(session_pk, "assistant", "benvenuto")
+
+    response = await client.get(f"/api/session/{SESSION_ID}/history")
+    assert response.status_code == 200
+    data = response.json()
+    assert [m["message"] for m in data["messages"]] == ["ciao", "benvenuto"]
+    assert data["last_message_id"] == last_id
+    assert data["is_delta"] is False
+
+    new_id = await _add_message(session_pk, "user", "nuovo")
+    response = await client.get(f"/api/session/{SESSION_ID}/history", params={"after_id": last_id})
+    data = response.json()
+    assert [m["id"] for m in data["messages"]] == [new_id]
+    assert data["is_delta"] is True
+
+
+async def test_unchanged_history_answers_304_with_one_query(client, db_engine, query_budget):
+    session_pk = await _create_session()
+    last_id = await _add_message(session_pk, "user", "ciao")
+
+    response = await client.get(f"/api/session/{SESSION_ID}/history")
+    etag = response.headers["ETag"]
+
+    with query_budget(1):
+        response = await client.get(
+            f"/api/session/{SESSION_ID}/history",
+            params={"after_id": last_id},
+            headers={"If-None-Match": etag},
+        )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # Un nuovo messaggio invalida l'ETag
+    await _add_message(session_pk, "assistant", "risposta")
+    response = await client.get(
+        f"/api/session/{SESSION_ID}/history",
+        params={"after_id": last_id},
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert [m["message"] for m in response.json()["messages"]] == ["risposta"]
+
+
+async def test_history_unknown_session(client, db_engine):
+    response = await client.get("/api/session/missing/history")
+    assert response.status_code == 404
+
+
+async def test_compressed_history_etag_is_weak_and_still_matches(client, db_engine):
+    session_pk = await _create_session()
+    for index in range(40):
+        await _add_message(session_pk, "user", f"messaggio abbastanza lungo da superare la soglia {index}")
+
+    response = await client.get(f"/api/session/{SESSION_ID}/history", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+
+    response = await client.get(
+        f"/api/session/{SESSION_ID}/history",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+    )
+    assert response.status_code == 304
@@ -0,0 +1,121 @@
+"""
+Idempotenza di /chat: retry con la stessa chiave, richieste concorrenti, vincolo unico
+sui messaggi e retry arrivati dopo il TTL della cache (risposta originale dal database)
+"""
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app.database import async_session
+from app.models.database_models import MessageModel, SessionModel
+from app.services.idempotency import chat_idempotency
+from app.services.metrics import metrics
+from app.services.unified_agent import UnifiedAgent
+
+SESSION_ID = "idempotency-session"
+
+
+@pytest.fixture
+def fake_agent(monkeypatch):
+    calls = []
+
+    async def call(self, prompt, model_name=None, context="", **kwargs):
+        calls.append(prompt)
+        await asyncio.sleep(0.05)
+        return json.dumps({
+            "messages": [{"text": "Ciao!", "delay_ms": 0}, {"text": "Quanti anni hai?", "delay_ms": 10000}],
+            "should_change_lifecycle": False,
+            "reasoning": "ok",
+            "confidence": 0.9,
+            "requires_human": False,
+        })
+
+    monkeypatch.setattr(UnifiedAgent, "_call_ai_agent", call)
+    metrics.reset()
+    chat_idempotency._responses.clear()
+    yield calls
+    chat_idempotency._responses.clear()
+
+
+async def _post(client, message: str, key: str):
+    return await client.post(
+        "/chat",
+        json={"message": message, "session_id": SESSION_ID, "batch_wait_seconds": 0},
+        headers={"Idempotency-Key": key},
+    )
+
+
+async def _user_messages() -> int:
+    async with async_session() as db:
+        return await db.scalar(select(func.count(MessageModel.id)).where(MessageModel.role == "user"))
+
+
+async def test_retry_with_same_key_gets_cached_response(client, fake_agent):
+    first = await _post(client, "ciao", "msg-1")
+    retry = await _post(client, "ciao", "msg-1")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json()["messages"] == first.json()["messages"]
+    assert len(fake_agent) == 1
+    assert await _user_messages() == 1
+    assert metrics.get_counter("chat_idempotency_total", result="cached") == 1
+
+
+async def test_concurrent_retries_join_the_running_turn(client, fake_agent):
+    first, second = await asyncio.gather(_post(client, "ciao", "msg-1"), _post(client, "ciao", "msg-1"))
+
+    assert first.json()["messages"] == second.json()["messages"]
+    assert len(fake_agent) == 1
+    assert metrics.get_counter("chat_idempotency_total", result="joined") == 1
+
+
+async def test_retry_after_ttl_replays_original_response(client, fake_agent):
+    first = (await _post(client, "ciao", "msg-1")).json()
+    second = (await _post(client, "ho 30 anni", "msg-2")).json()
+    # TTL scaduto o retry arrivato su un altro worker
+    chat_idempotency._responses.clear()
+
+    retry = (await _post(client, "ciao", "msg-1")).json()
+
+    assert retry["messages"] == first["messages"]
+    assert retry["current_lifecycle"] == first["current_lifecycle"]
+    assert retry["messages"] != second["messages"]
+    assert len(fake_agent) == 2
+    assert await _user_messages() == 2
+    assert metrics.get_counter("chat_idempotency_total", result="replayed") == 1
+
+
+async def test_duplicate_without_stored_response_is_empty_and_not_saved(client, fake_agent):
+    await _post(client, "ciao", "msg-1")
+    # Turno originale ancora in corso su un altro worker: nessuna risposta salvata
+    async with async_session() as db:
+        session = await db.scalar(select(SessionModel).where(SessionModel.session_id == SESSION_ID))
+        db.add(MessageModel(session_id=session.id, role="user", message="ci sei?", client_message_id="msg-2"))
+        await db.commit()
+
+    retry = (await _post(client, "ci sei?", "msg-2")).json()
+
+    assert retry["messages"] == []
+    assert retry["ai_reasoning"] == "Messaggio già ricevuto (richiesta duplicata)"
+    async with async_session() as db:
+        stored = await db.scalar(select(MessageModel.response_json).where(MessageModel.client_message_id == "msg-2"))
+    assert stored is None
+
+
+async def test_client_message_id_is_unique_per_session(db_engine):
+    async with async_session() as db:
+        first = SessionModel(session_id="s-1")
+        other = SessionModel(session_id="s-2")
+        db.add_all([first, other])
+        await db.flush()
+        db.add(MessageModel(session_id=first.id, role="user", message="ciao", client_message_id="msg-1"))
+        # Stessa chiave su un'altra sessione: ammessa
+        db.add(MessageModel(session_id=other.id, role="user", message="ciao", client_message_id="msg-1"))
+        await db.commit()
+
+        db.add(MessageModel(session_id=first.id, role="user", message="ciao", client_message_id="msg-1"))
+        with pytest.raises(IntegrityError):
+            await db.commit()
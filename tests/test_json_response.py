@@ -0,0 +1,51 @@
+"""
+Encoder JSON delle risposte: orjson e fallback stdlib producono lo stesso JSON
+"""
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from app import json_response
+from app.models.api_models import HealthCheck
+from app.models.lifecycle import LifecycleStage
+
+PAYLOAD = {
+    "when": datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc),
+    "naive": datetime(2024, 5, 1, 12, 30),
+    "stage": LifecycleStage.IN_TARGET,
+    "text": "perché è così",
+    "items": [1, 2.5, None, True],
+}
+
+
+def test_stdlib_output_matches_isoformat():
+    decoded = json.loads(json_response._stdlib_dumps(PAYLOAD))
+    assert decoded["when"] == PAYLOAD["when"].isoformat()
+    assert decoded["naive"] == PAYLOAD["naive"].isoformat()
+    assert decoded["stage"] == LifecycleStage.IN_TARGET.value
+
+
+@pytest.mark.skipif(json_response.orjson is None, reason="orjson non installato")
+def test_orjson_and_stdlib_agree():
+    assert json.loads(json_response._orjson_dumps(PAYLOAD)) == json.loads(json_response._stdlib_dumps(PAYLOAD))
+
+
+def test_response_renders_pydantic_models():
+    model = HealthCheck(status="healthy", version="1.0", environment="test")
+    body = json_response.FastJSONResponse(content=model).body
+    assert json.loads(body)["status"] == "healthy"
+
+
+async def test_sessions_list_timestamps_are_iso(client, db_engine):
+    from app.database import async_session
+    from app.models.database_models import SessionModel
+
+    async with async_session() as db:
+        db.add(SessionModel(session_id="json-session", current_lifecycle=LifecycleStage.NUOVA_LEAD))
+        await db.commit()
+
+    response = await client.get("/api/sessions_list")
+    session = response.json()["sessions"][0]
+    assert datetime.fromisoformat(session["created_at"])
+    assert session["current_lifecycle"] == LifecycleStage.NUOVA_LEAD.value
@@ -0,0 +1,109 @@
+"""
+Modalità split: classificatore lifecycle in parallelo alla risposta
+"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.models.lifecycle import LifecycleStage
+from app.services.circuit_breaker import CLOSED, OPEN, ai_circuit_breaker, classifier_circuit_breaker
+from app.services.lifecycle_classifier import SPLIT, UNIFIED, build_decision_prompt, choose_decision_mode
+from app.services.metrics import metrics
+from app.services.retry_policy import ai_retry_policy
+from app.services.unified_agent import UnifiedAgent
+
+REPLY = json.dumps({"messages": "Perfetto, ti mando il link!", "requires_human": False})
+SESSION = SimpleNamespace(session_id="split-session", current_lifecycle=LifecycleStage.IN_TARGET)
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    ai_circuit_breaker.reset()
+    classifier_circuit_breaker.reset()
+    metrics.reset()
+    monkeypatch.setattr(ai_retry_policy, "base_delay_seconds", 0.001)
+    monkeypatch.setattr(ai_retry_policy, "min_attempt_seconds", 0.0)
+    yield
+    ai_circuit_breaker.reset()
+    classifier_circuit_breaker.reset()
+
+
+def fake_agent(monkeypatch, decision):
+    """Risposta per il prompt della conversazione, `decision` per quello del classificatore"""
+    async def a_run(prompt):
+        if prompt.lstrip().startswith("ANALISI LIFECYCLE"):
+            if isinstance(decision, BaseException):
+                raise decision
+            return SimpleNamespace(text=json.dumps(decision))
+        return SimpleNamespace(text=REPLY)
+
+    async def get_agent(self, model_name=None):
+        models.append(model_name)
+        return SimpleNamespace(a_run=a_run)
+
+    models = []
+
+    monkeypatch.setattr(UnifiedAgent, "_get_agent", get_agent)
+    return models
+
+
+def test_decision_mode_and_prompt(monkeypatch):
+    monkeypatch.setattr(settings, "lifecycle_decision_mode", UNIFIED)
+    monkeypatch.setattr(settings, "lifecycle_split_traffic_percent", 0)
+    assert choose_decision_mode("a") == UNIFIED
+    monkeypatch.setattr(settings, "lifecycle_split_traffic_percent", 100)
+    assert choose_decision_mode("a") == SPLIT
+
+    prompt = build_decision_prompt(LifecycleStage.IN_TARGET, "ok prenotiamo", "ASSISTENTE: ti va?")
+    assert "PROSSIMO LIFECYCLE POSSIBILE: link_da_inviare" in prompt
+    assert "ASSISTENTE: ti va?" in prompt and "MESSAGGIO UTENTE: ok prenotiamo" in prompt
+    assert build_decision_prompt(LifecycleStage.LINK_INVIATO, "grazie", "") is None
+
+
+async def test_split_decision_is_merged(monkeypatch):
+    fake_agent(monkeypatch, {
+        "should_change_lifecycle": True,
+        "target_lifecycle": "link_da_inviare",
+        "confidence_score": 0.85,
+        "reasoning": "Ha accettato la consulenza",
+    })
+    decision_prompt = build_decision_prompt(SESSION.current_lifecycle, "ok prenotiamo", "")
+
+    result = await UnifiedAgent()._ask_ai("prompt risposta", SESSION, db=None, decision_prompt=decision_prompt)
+
+    assert result["messages"][0]["text"] == "Perfetto, ti mando il link!"
+    assert result["should_change"] is True and result["new_lifecycle_str"] == "link_da_inviare"
+    assert result["confidence"] == 0.85 and result["reasoning"] == "Ha accettato la consulenza"
+    assert metrics.get_counter("lifecycle_decisions_total", decision_mode=SPLIT, lifecycle="in_target", outcome="change") == 1
+    [turn] = metrics.snapshot()["histograms"]["ai_turn_seconds"]
+    assert turn["labels"] == {"decision_mode": SPLIT}
+
+
+async def test_classifier_failure_keeps_lifecycle(monkeypatch):
+    fake_agent(monkeypatch, ValueError("risposta inattesa"))
+    decision_prompt = build_decision_prompt(SESSION.current_lifecycle, "ok", "")
+
+    result = await UnifiedAgent()._ask_ai("prompt risposta", SESSION, db=None, decision_prompt=decision_prompt)
+
+    assert result["messages"][0]["text"] == "Perfetto, ti mando il link!"
+    assert result["should_change"] is False
+    assert result["new_lifecycle_str"] == LifecycleStage.IN_TARGET.value
+    [classifier] = metrics.snapshot()["histograms"]["lifecycle_classifier_seconds"]
+    assert classifier["labels"] == {"outcome": "error"}
+
+
+async def test_classifier_failures_do_not_open_reply_circuit(monkeypatch):
+    monkeypatch.setattr(settings, "ai_circuit_enabled", True)
+    models = fake_agent(monkeypatch, ValueError("risposta inattesa"))
+    decision_prompt = build_decision_prompt(SESSION.current_lifecycle, "ok", "")
+
+    for _ in range(ai_circuit_breaker.minimum_calls):
+        await UnifiedAgent()._ask_ai("prompt risposta", SESSION, db=None, decision_prompt=decision_prompt)
+
+    # Il classificatore usa il modello piccolo e il proprio circuito
+    assert settings.lifecycle_classifier_model in models
+    assert ai_circuit_breaker.state == CLOSED
+    assert ai_circuit_breaker.snapshot()["failure_rate"] == 0
+    assert classifier_circuit_breaker.state == OPEN
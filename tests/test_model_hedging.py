@@ -0,0 +1,137 @@
+"""
+Hedged requests e catena di fallback tra i modelli AI
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.services.ai_model_service import AIModelService
+from app.services.circuit_breaker import ai_circuit_breaker
+from app.services.metrics import metrics
+from app.services.model_hedging import ModelLatencyTracker, model_latency, race_models
+from app.services.unified_agent import UnifiedAgent
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    metrics.reset()
+    model_latency.reset()
+    ai_circuit_breaker.reset()
+    AIModelService.invalidate_active_cache()
+    yield
+    model_latency.reset()
+    AIModelService.invalidate_active_cache()
+
+
+def scripted(latencies, failures=()):
+    """call(model) che risponde dopo latencies[model] secondi (o fallisce)"""
+    calls, cancelled = [], []
+
+    async def call(model):
+        calls.append(model)
+        try:
+            await asyncio.sleep(latencies[model])
+        except asyncio.CancelledError:
+            cancelled.append(model)
+            raise
+        if model in failures:
+            raise RuntimeError(f"503 {model} non disponibile")
+        return f"risposta {model}"
+
+    return call, calls, cancelled
+
+
+async def test_fast_primary_is_not_hedged():
+    call, calls, _ = scripted({"flash": 0.01, "pro": 0.01})
+
+    assert await race_models(call, ["flash", "pro"], hedge_delay=0.5) == ("flash", "risposta flash")
+    assert calls == ["flash"]
+
+
+async def test_slow_primary_is_hedged_and_cancelled():
+    call, calls, cancelled = scripted({"flash": 5.0, "pro": 0.02})
+
+    winner = await asyncio.wait_for(race_models(call, ["flash", "pro"], hedge_delay=0.05), timeout=2)
+
+    assert winner == ("pro", "risposta pro")
+    assert calls == ["flash", "pro"]
+    assert cancelled == ["flash"]
+    assert metrics.get_counter("ai_hedged_requests_total", primary="flash", fallback="pro") == 1
+
+
+async def test_failed_primary_fails_over_along_the_chain():
+    call, calls, _ = scripted({"flash": 0.0, "pro": 0.0, "lite": 0.0}, failures={"flash", "pro"})
+
+    assert await race_models(call, ["flash", "pro", "lite"], hedge_delay=1.0) == ("lite", "risposta lite")
+    assert calls == ["flash", "pro", "lite"]
+
+    call, _, _ = scripted({"flash": 0.0}, failures={"flash"})
+    with pytest.raises(RuntimeError):
+        await race_models(call, ["flash"], hedge_delay=1.0)
+
+
+def test_hedge_delay_from_p95_or_configuration():
+    tracker = ModelLatencyTracker(window_size=100, minimum_samples=10)
+    assert tracker.hedge_delay("flash", None) == settings.ai_hedge_default_delay_seconds
+
+    for index in range(1, 101):
+        tracker.record("flash", index / 10)
+    assert tracker.percentile("flash", 0.95) == 9.5
+    assert tracker.hedge_delay("flash", None) == 9.5
+    assert tracker.hedge_delay("flash", 750) == 0.75
+
+
+async def test_agent_hedges_to_configured_fallback(db_engine, client, monkeypatch):
+    await AIModelService.create_model("gemini-flash-latest", "Flash", is_active=True)
+    await AIModelService.create_model("gemini-2.5-pro", "Pro")
+
+    response = await client.put("/api/models/gemini-2.5-pro/hedging", json={"fallback_order": 1})
+    assert response.status_code == 200
+    response = await client.put("/api/models/gemini-flash-latest/hedging", json={"hedge_delay_ms": 50})
+    assert response.json()["hedge_delay_ms"] == 50
+    assert (await client.put("/api/models/sconosciuto/hedging", json={})).status_code == 404
+
+    latencies = {"gemini-flash-latest": 5.0, "gemini-2.5-pro": 0.01}
+
+    async def get_agent(self, model_name=None):
+        async def a_run(prompt):
+            await asyncio.sleep(latencies[model_name])
+            return SimpleNamespace(text=f"da {model_name}")
+        return SimpleNamespace(a_run=a_run)
+
+    monkeypatch.setattr(UnifiedAgent, "_get_agent", get_agent)
+    monkeypatch.setattr(settings, "ai_hedging_enabled", True)
+
+    text = await asyncio.wait_for(UnifiedAgent()._call_ai_agent("prompt"), timeout=2)
+
+    assert text == "da gemini-2.5-pro"
+    assert model_latency.snapshot()["gemini-2.5-pro"]["samples"] == 1
+    # Il primario cancellato dall'hedge conta con il tempo trascorso (limite inferiore)
+    assert model_latency._samples["gemini-flash-latest"][0] >= 0.05
+    listing = (await client.get("/api/models")).json()
+    assert {m["name"]: m["fallback_order"] for m in listing["models"]} == {
+        "gemini-flash-latest": None, "gemini-2.5-pro": 1
+    }
+
+
+async def test_hedging_update_database_error_is_500(db_engine, client, monkeypatch):
+    class BrokenSession:
+        async def execute(self, *args, **kwargs):
+            raise RuntimeError("database non raggiungibile")
+
+        async def rollback(self):
+            pass
+
+        async def close(self):
+            pass
+
+    async def broken_session():
+        return BrokenSession()
+
+    monkeypatch.setattr("app.services.ai_model_service.get_db_session", broken_session)
+
+    response = await client.put("/api/models/gemini-2.5-pro/hedging", json={"fallback_order": 1})
+
+    assert response.status_code == 500
@@ -0,0 +1,103 @@
+"""
+Routing dei modelli AI per lifecycle e lunghezza della cronologia
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from app.models.lifecycle import LifecycleStage
+from app.services.ai_model_service import AIModelService
+from app.services.metrics import metrics
+from app.services.model_routing_service import ModelRoutingService
+from app.services.unified_agent import UnifiedAgent
+
+
+@pytest.fixture(autouse=True)
+def clean_caches():
+    metrics.reset()
+    AIModelService.invalidate_active_cache()
+    ModelRoutingService.invalidate_cache()
+    yield
+    AIModelService.invalidate_active_cache()
+    ModelRoutingService.invalidate_cache()
+
+
+async def test_routes_api_and_resolution(db_engine, client):
+    await AIModelService.create_model("gemini-flash-latest", "Flash", is_active=True)
+    await AIModelService.create_model("gemini-2.5-pro", "Pro")
+
+    flash_default = await client.post("/api/model_routes", json={"model_name": "gemini-flash-latest"})
+    assert flash_default.status_code == 200 and flash_default.json()["lifecycle"] is None
+    in_target = await client.post("/api/model_routes", json={"lifecycle": "in_target", "model_name": "gemini-2.5-pro"})
+    long_history = await client.post("/api/model_routes", json={
+        "lifecycle": "contrassegnato", "min_history_messages": 10, "model_name": "gemini-2.5-pro",
+    })
+    assert long_history.status_code == 200
+
+    assert (await client.post("/api/model_routes", json={"model_name": "sconosciuto"})).status_code == 400
+    assert (await client.post("/api/model_routes", json={"lifecycle": "in_target", "model_name": "gemini-flash-latest"})).status_code == 409
+
+    async def resolve(lifecycle, history_length):
+        route = await ModelRoutingService.resolve(lifecycle, history_length)
+        return route.model_name if route else None
+
+    assert await resolve(LifecycleStage.IN_TARGET, 2) == "gemini-2.5-pro"
+    assert await resolve(LifecycleStage.CONTRASSEGNATO, 3) == "gemini-flash-latest"
+    assert await resolve(LifecycleStage.CONTRASSEGNATO, 12) == "gemini-2.5-pro"
+
+    # Le modifiche valgono dal turno successivo, senza riavvio
+    route_id = in_target.json()["id"]
+    response = await client.put(f"/api/model_routes/{route_id}", json={
+        "lifecycle": "in_target", "model_name": "gemini-2.5-pro", "is_enabled": False,
+    })
+    assert response.status_code == 200
+    assert await resolve(LifecycleStage.IN_TARGET, 2) == "gemini-flash-latest"
+    assert (await client.put("/api/model_routes/999", json={"model_name": "gemini-2.5-pro"})).status_code == 404
+
+    assert (await client.delete(f"/api/model_routes/{flash_default.json()['id']}")).status_code == 200
+    assert await resolve(LifecycleStage.IN_TARGET, 2) is None
+
+    listing = (await client.get("/api/model_routes")).json()
+    assert len(listing["routes"]) == 2 and listing["default_model"] == "gemini-flash-latest"
+
+
+async def test_turn_model_follows_routing(db_engine):
+    await AIModelService.create_model("gemini-flash-latest", "Flash", is_active=True)
+    await AIModelService.create_model("gemini-2.5-pro", "Pro")
+    await ModelRoutingService.create_route(LifecycleStage.IN_TARGET, None, "gemini-2.5-pro")
+
+    agent = UnifiedAgent()
+    in_target = SimpleNamespace(session_id="route-session", current_lifecycle=LifecycleStage.IN_TARGET)
+    scripted = SimpleNamespace(session_id="route-session", current_lifecycle=LifecycleStage.LINK_DA_INVIARE)
+
+    assert await agent._route_model(in_target, [], None) == "gemini-2.5-pro"
+    assert await agent._route_model(scripted, [], None) is None
+    # Il modello scelto esplicitamente dalla richiesta ha la precedenza
+    assert await agent._route_model(in_target, [], "gemini-flash-latest") == "gemini-flash-latest"
+
+    route_id = (await ModelRoutingService.get_all_routes())[0].id
+    assert metrics.get_counter(
+        "model_route_decisions_total", lifecycle="in_target", model="gemini-2.5-pro", route=str(route_id)
+    ) == 1
+    assert metrics.get_counter("model_route_decisions_total", lifecycle="link_da_inviare", model="attivo", route="default") == 1
+
+
+async def test_active_model_default_is_not_cached_on_error(db_engine, monkeypatch):
+    await AIModelService.create_model("gemini-2.5-pro", "Pro", is_active=True)
+
+    class BrokenSession:
+        async def execute(self, *args, **kwargs):
+            raise RuntimeError("database non pronto")
+
+        async def close(self):
+            pass
+
+    async def broken_session():
+        return BrokenSession()
+
+    # Avvio: il database non è ancora pronto, si usa il default senza metterlo in cache
+    with monkeypatch.context() as patch:
+        patch.setattr("app.services.ai_model_service.get_db_session", broken_session)
+        assert await AIModelService.get_active_model_name("gemini-flash-latest") == "gemini-flash-latest"
+
+    assert await AIModelService.get_active_model_name("gemini-flash-latest") == "gemini-2.5-pro"
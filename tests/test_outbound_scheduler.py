@@ -0,0 +1,144 @@
+"""
+Consegna lato server delle parti: orari da delay_ms, ripresa delle parti pendenti dopo
+un riavvio e ordine delle parti di ogni sessione tra un tick e l'altro
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, update
+
+from app.database import async_session
+from app.models.database_models import OutboundMessageModel
+from app.services.outbound_scheduler import OutboundScheduler, OutboundSink
+
+
+class RecordingSink(OutboundSink):
+    name = "test"
+
+    def __init__(self, failures: int = 0):
+        self.delivered = []
+        self.failures = failures
+
+    async def deliver(self, item: OutboundMessageModel) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("destinazione non raggiungibile")
+        self.delivered.append((time.monotonic(), item.session_id, item.text))
+
+
+@pytest.fixture
+async def scheduler(db_engine):
+    sink = RecordingSink()
+    scheduler = OutboundScheduler([sink])
+    scheduler.sink = sink
+    yield scheduler
+    await scheduler.stop()
+
+
+async def _wait_delivered(sink: RecordingSink, count: int, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while len(sink.delivered) < count:
+        assert time.monotonic() < deadline, f"consegnate {len(sink.delivered)} parti su {count}"
+        await asyncio.sleep(0.01)
+
+
+async def _rows(session_id: str):
+    async with async_session() as db:
+        result = await db.execute(
+            select(OutboundMessageModel)
+            .where(OutboundMessageModel.session_id == session_id)
+            .order_by(OutboundMessageModel.part_index)
+        )
+        return result.scalars().all()
+
+
+async def test_parts_are_due_after_previous_delays(scheduler):
+    start_at = datetime.now(timezone.utc)
+    items = await scheduler.schedule("s-1", [
+        {"id": 10, "text": "uno", "delay_ms": 1500},
+        {"id": 10, "text": "due", "delay_ms": 500},
+        {"id": 10, "text": "tre", "delay_ms": 0},
+    ], sink="test", start_at=start_at)
+
+    offsets = [(item.due_at - start_at).total_seconds() for item in items]
+    assert offsets == [0.0, 1.5, 2.0]
+    # Stessa risposta pianificata due volte: nessun doppio invio
+    assert await scheduler.schedule("s-1", [{"id": 10, "text": "uno"}], sink="test") == []
+    assert len(await _rows("s-1")) == 3
+
+
+async def test_delivery_respects_delays(scheduler):
+    await scheduler.start()
+    started = time.monotonic()
+    await scheduler.schedule("s-1", [
+        {"id": 10, "text": "uno", "delay_ms": 300},
+        {"id": 10, "text": "due", "delay_ms": 0},
+    ], sink="test")
+
+    await _wait_delivered(scheduler.sink, 2)
+
+    (first_at, _, first), (second_at, _, second) = scheduler.sink.delivered
+    assert (first, second) == ("uno", "due")
+    assert first_at - started < 0.25
+    assert second_at - first_at >= 0.25
+    assert [row.status for row in await _rows("s-1")] == ["sent", "sent"]
+
+
+async def test_pending_parts_resume_after_restart(scheduler):
+    # Pianificate da un'istanza che si è fermata prima della consegna
+    stopped = OutboundScheduler([RecordingSink()])
+    past = datetime.now(timezone.utc) - timedelta(seconds=30)
+    await stopped.schedule("s-1", [{"id": 10, "text": "scaduta", "delay_ms": 0}], sink="test", start_at=past)
+    await stopped.schedule("s-2", [{"id": 20, "text": "in invio", "delay_ms": 0}], sink="test", start_at=past)
+    await stopped.schedule("s-3", [{"id": 30, "text": "futura", "delay_ms": 0}], sink="test",
+                           start_at=datetime.now(timezone.utc) + timedelta(milliseconds=200))
+    # Istanza morta durante l'invio: lease scaduto
+    async with async_session() as db:
+        await db.execute(
+            update(OutboundMessageModel)
+            .where(OutboundMessageModel.session_id == "s-2")
+            .values(status="sending", attempts=1, locked_until=datetime.now(timezone.utc) - timedelta(seconds=1))
+        )
+        await db.commit()
+
+    await scheduler.start()
+    await _wait_delivered(scheduler.sink, 3)
+
+    assert [text for _, _, text in scheduler.sink.delivered] == ["scaduta", "in invio", "futura"]
+    assert (await _rows("s-2"))[0].attempts == 2
+
+
+async def test_session_order_is_kept_across_ticks(scheduler):
+    await scheduler.start()
+    for session_id, source_id in (("s-1", 10), ("s-2", 20)):
+        await scheduler.schedule(session_id, [
+            {"id": source_id, "text": f"{session_id}-{index}", "delay_ms": 50}
+            for index in range(4)
+        ], sink="test")
+
+    await _wait_delivered(scheduler.sink, 8)
+
+    for session_id in ("s-1", "s-2"):
+        texts = [text for _, sid, text in scheduler.sink.delivered if sid == session_id]
+        assert texts == [f"{session_id}-{index}" for index in range(4)]
+
+
+async def test_failed_part_postpones_later_parts(scheduler):
+    items = await scheduler.schedule("s-1", [
+        {"id": 10, "text": "uno", "delay_ms": 100},
+        {"id": 10, "text": "due", "delay_ms": 0},
+    ], sink="test")
+    second_due = items[1].due_at
+    scheduler.sink.failures = 1
+
+    await scheduler._deliver_due([items[0].id])
+
+    first, second = await _rows("s-1")
+    assert first.status == "pending" and first.attempts == 1
+    assert first.last_error == "destinazione non raggiungibile"
+    # Backoff di 2s applicato anche alla parte successiva: resta dopo la prima
+    shift = second.due_at.replace(tzinfo=timezone.utc) - second_due
+    assert shift == timedelta(seconds=2)
+    assert second.due_at >= first.due_at
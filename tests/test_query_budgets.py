@@ -0,0 +1,128 @@
+"""
+Budget di query per gli endpoint delle dashboard: il numero di query non deve crescere
+con il numero di messaggi, note, task o eventi della sessione (niente N+1)
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.database import async_session
+from app.models.database_models import (
+    HumanTaskModel,
+    LifecycleEventModel,
+    MessageModel,
+    MessageNoteModel,
+    SessionModel,
+    SessionNoteModel,
+)
+from app.models.lifecycle import LifecycleStage
+
+SESSION_ID = "budget-session"
+
+
+@pytest.fixture
+async def seeded_session(db_engine):
+    """Sessione con abbastanza righe collegate da far esplodere un eventuale N+1"""
+    started = datetime.now(timezone.utc) - timedelta(hours=1)
+    async with async_session() as db:
+        session = SessionModel(session_id=SESSION_ID, current_lifecycle=LifecycleStage.IN_TARGET)
+        db.add(session)
+        await db.flush()
+
+        messages = []
+        for index in range(30):
+            message = MessageModel(
+                session_id=session.id,
+                role="user" if index % 2 == 0 else "assistant",
+                message=f"messaggio {index}",
+                timestamp=started + timedelta(seconds=index),
+            )
+            db.add(message)
+            messages.append(message)
+        await db.flush()
+
+        for message in messages[1::2]:
+            db.add(MessageNoteModel(message_id=message.id, session_id=session.id, rating=4, note="ok"))
+        for index in range(5):
+            db.add(SessionNoteModel(session_id=session.id, note=f"nota {index}"))
+            db.add(HumanTaskModel(session_id=session.id, title=f"task {index}", description="da fare"))
+        db.add(LifecycleEventModel(
+            session_id=session.id,
+            previous_lifecycle=LifecycleStage.NUOVA_LEAD,
+            new_lifecycle=LifecycleStage.CONTRASSEGNATO,
+            trigger_message_id=messages[1].id,
+            created_at=started + timedelta(seconds=2),
+        ))
+        db.add(LifecycleEventModel(
+            session_id=session.id,
+            previous_lifecycle=LifecycleStage.CONTRASSEGNATO,
+            new_lifecycle=LifecycleStage.IN_TARGET,
+            created_at=started + timedelta(seconds=10),
+        ))
+        await db.commit()
+        return session.id
+
+
+async def test_session_notes_dashboard_budget(client, seeded_session, template_context, query_budget):
+    with query_budget(3):
+        response = await client.get(f"/session/{SESSION_ID}/notes")
+
+    assert response.status_code == 200
+    context = template_context["context"]
+    assert len(context["notes"]) == 15
+    assert all(note["message_preview"].startswith("messaggio") for note in context["notes"])
+    assert len(context["session_notes"]) == 5
+
+
+async def test_session_tasks_dashboard_budget(client, seeded_session, template_context, query_budget):
+    with query_budget(2):
+        response = await client.get(f"/session/{SESSION_ID}/tasks")
+
+    assert response.status_code == 200
+    context = template_context["context"]
+    assert context["session"]["message_count"] == 30
+    assert context["session"]["task_count"] == 5
+
+
+async def test_session_conversation_budget(client, seeded_session, template_context, query_budget):
+    # A freddo: sessione + note, impronta, messaggi, eventi
+    with query_budget(5):
+        response = await client.get(f"/session/{SESSION_ID}/messages")
+    assert response.status_code == 200
+    entries = template_context["context"]["entries"]
+    assert len(entries) == 32
+    # L'evento ancorato precede il messaggio che lo ha generato
+    anchored = next(i for i, e in enumerate(entries) if e["type"] == "lifecycle_event" and e["message_id"])
+    assert entries[anchored + 1]["id"] == entries[anchored]["message_id"]
+
+    # Timeline in cache: resta solo la verifica dell'impronta
+    with query_budget(3):
+        await client.get(f"/session/{SESSION_ID}/messages")
+
+
+async def test_timeline_api_budget(client, seeded_session, query_budget):
+    with query_budget(4):
+        response = await client.get(f"/api/session/{SESSION_ID}/timeline")
+    assert response.status_code == 200
+    assert len(response.json()["entries"]) == 32
+
+    with query_budget(1):
+        await client.get(f"/api/session/{SESSION_ID}/timeline")
+
+
+async def test_sessions_dashboards_budget(client, seeded_session, template_context, query_budget):
+    with query_budget(1):
+        response = await client.get("/sessions")
+    assert response.status_code == 200
+    assert template_context["context"]["sessions"][0]["message_count"] == 30
+
+    with query_budget(1):
+        response = await client.get("/api/sessions_list")
+    assert response.json()["sessions"][0]["message_count"] == 30
+
+
+async def test_tasks_api_budget(client, seeded_session, query_budget):
+    with query_budget(2):
+        response = await client.get("/api/tasks", params={"session_id": SESSION_ID})
+    assert response.status_code == 200
+    assert len(response.json()) == 5
@@ -0,0 +1,69 @@
+"""
+Formato lean della risposta AI: scelta della modalità ed espansione alle chiavi verbose
+"""
+import json
+from types import SimpleNamespace
+
+from app.config import settings
+from app.models.lifecycle import LifecycleStage
+from app.services.metrics import metrics
+from app.services.response_mode import LEAN, VERBOSE, choose_response_mode, response_format_block, traffic_bucket
+from app.services.unified_agent import UnifiedAgent
+
+SESSION = SimpleNamespace(session_id="lean-session", current_lifecycle=LifecycleStage.IN_TARGET)
+
+
+def test_mode_per_environment_and_traffic_share(monkeypatch):
+    monkeypatch.setattr(settings, "ai_response_mode", VERBOSE)
+    monkeypatch.setattr(settings, "ai_lean_traffic_percent", 0)
+    assert choose_response_mode("a") == VERBOSE
+
+    monkeypatch.setattr(settings, "ai_lean_traffic_percent", 30)
+    sessions = [f"sessione-{i}" for i in range(1000)]
+    lean = [s for s in sessions if choose_response_mode(s) == LEAN]
+    assert 200 < len(lean) < 400
+    # Stabile per sessione
+    assert all(traffic_bucket(s) < 30 for s in lean)
+
+    monkeypatch.setattr(settings, "ai_response_mode", LEAN)
+    assert choose_response_mode("a") == LEAN
+
+
+def test_format_blocks():
+    lean = response_format_block(LEAN, LifecycleStage.LINK_DA_INVIARE)
+    assert '"m"' in lean and '"lc": "link_da_inviare"' in lean and "human_task" not in lean
+    verbose = response_format_block(VERBOSE, None)
+    assert '"new_lifecycle": "null"' in verbose
+
+
+async def test_lean_reply_is_expanded():
+    metrics.reset()
+    agent = UnifiedAgent()
+
+    minimal = await agent._process_ai_response(json.dumps({"m": "Ciao!"}), SESSION, db=None)
+    assert minimal["messages"] == [{"text": "Ciao!", "delay_ms": 0}]
+    assert minimal["should_change"] is False and minimal["requires_human"] is False
+    assert minimal["new_lifecycle_str"] == LifecycleStage.IN_TARGET.value
+
+    reply = json.dumps({
+        "m": [{"t": "Perfetto", "d": 10000}, {"t": "Ti mando il link", "d": 10000}],
+        "lc": "link_da_inviare",
+        "c": 0.9,
+        "r": "lead interessato alla call",
+    })
+    result = await agent._process_ai_response(reply, SESSION, db=None)
+    assert result["messages"][1] == {"text": "Ti mando il link", "delay_ms": 10000}
+    assert result["should_change"] is True
+    assert result["new_lifecycle_str"] == "link_da_inviare" and result["confidence"] == 0.9
+    assert result["reasoning"] == "lead interessato alla call"
+
+    # "lc" senza "c": la transizione vale la soglia invece di essere scartata
+    implied = await agent._process_ai_response(json.dumps({"m": "Ok", "lc": "link_da_inviare"}), SESSION, db=None)
+    assert implied["should_change"] is True and implied["confidence"] == 0.7
+
+    human = await agent._process_ai_response(json.dumps({"m": "", "h": "Domanda medica"}), SESSION, db=None)
+    assert human["requires_human"] is True and human["messages"] == []
+    assert human["human_task"] == {"title": "Domanda medica", "description": "Domanda medica"}
+
+    [series] = metrics.snapshot()["histograms"]["ai_response_chars"]
+    assert series["labels"] == {"mode": LEAN} and series["count"] == 4
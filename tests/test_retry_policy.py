@@ -0,0 +1,148 @@
+"""
+Retry delle chiamate AI: classificazione degli errori, budget, backoff e deadline del turno
+"""
+import asyncio
+import json
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from app.models.lifecycle import LifecycleStage
+from app.services.circuit_breaker import ai_circuit_breaker
+from app.services.metrics import metrics
+from app.services.retry_policy import (
+    FATAL, PARSE, RATE_LIMITED, SERVER_ERROR, TIMEOUT,
+    RetryPolicy, ai_retry_policy, classify_error, request_deadline, time_remaining,
+)
+from app.services.unified_agent import AIError, ParsingError, UnifiedAgent
+
+VALID_REPLY = json.dumps({
+    "messages": "ciao",
+    "should_change_lifecycle": False,
+    "reasoning": "ok",
+    "confidence": 0.9,
+    "requires_human": False,
+})
+
+
+class APIError(Exception):
+    def __init__(self, code: int, message: str = "errore"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    ai_circuit_breaker.reset()
+    metrics.reset()
+    monkeypatch.setattr(ai_retry_policy, "base_delay_seconds", 0.001)
+    monkeypatch.setattr(ai_retry_policy, "min_attempt_seconds", 0.0)
+    yield
+    ai_circuit_breaker.reset()
+
+
+def fake_agent(monkeypatch, *outcomes):
+    """Fa restituire (o sollevare) a a_run gli esiti indicati, in ordine"""
+    prompts = []
+    pending = list(outcomes)
+
+    async def a_run(prompt):
+        prompts.append(prompt)
+        outcome = pending.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+            return SimpleNamespace(text=VALID_REPLY)
+        return SimpleNamespace(text=outcome)
+
+    async def get_agent(self, model_name=None):
+        return SimpleNamespace(a_run=a_run)
+
+    monkeypatch.setattr(UnifiedAgent, "_get_agent", get_agent)
+    return prompts
+
+
+def test_classify_error():
+    assert classify_error(APIError(429)) == RATE_LIMITED
+    assert classify_error(APIError(503)) == SERVER_ERROR
+    assert classify_error(Exception("503 UNAVAILABLE")) == SERVER_ERROR
+    assert classify_error(Exception("RESOURCE_EXHAUSTED: quota")) == RATE_LIMITED
+    assert classify_error(TimeoutError()) == TIMEOUT
+    assert classify_error(ConnectionResetError()) == SERVER_ERROR
+    assert classify_error(APIError(400, "invalid argument")) == FATAL
+
+
+def test_full_jitter_budget_and_deadline(monkeypatch):
+    policy = RetryPolicy({SERVER_ERROR: 2}, base_delay_seconds=1.0, max_delay_seconds=8.0, min_attempt_seconds=1.0)
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+
+    retry = policy.start()
+    assert retry.next_delay(SERVER_ERROR) == 1.0
+    assert retry.next_delay(SERVER_ERROR) == 2.0
+    assert retry.next_delay(SERVER_ERROR) is None
+    assert retry.next_delay(RATE_LIMITED) is None
+
+    # Attesa più un tentativo oltre la deadline: non si riprova
+    with request_deadline(1.5):
+        assert policy.start().next_delay(SERVER_ERROR) is None
+    assert metrics.get_counter("ai_retry_exhausted_total", error=SERVER_ERROR, reason="deadline") == 1
+
+
+def test_request_deadline_never_extends():
+    assert time_remaining() is None
+    with request_deadline(1.0):
+        with request_deadline(60.0):
+            assert time_remaining() <= 1.0
+    assert time_remaining() is None
+
+
+async def test_transient_errors_are_retried(monkeypatch):
+    fake_agent(monkeypatch, APIError(429), APIError(503), VALID_REPLY)
+
+    text = await UnifiedAgent()._call_ai_agent("prompt")
+
+    assert text == VALID_REPLY
+    assert metrics.get_counter("ai_retries_total", error=RATE_LIMITED) == 1
+    assert metrics.get_counter("ai_retries_total", error=SERVER_ERROR) == 1
+    assert "ai_retry_added_latency_seconds" in metrics.snapshot()["histograms"]
+
+
+async def test_fatal_errors_are_not_retried(monkeypatch):
+    prompts = fake_agent(monkeypatch, APIError(401, "API key not valid"), VALID_REPLY)
+
+    with pytest.raises(AIError):
+        await UnifiedAgent()._call_ai_agent("prompt")
+    assert len(prompts) == 1
+
+
+async def test_attempt_is_bounded_by_deadline(monkeypatch):
+    prompts = fake_agent(monkeypatch, 5.0, 5.0)
+    monkeypatch.setattr(ai_retry_policy, "min_attempt_seconds", 1.0)
+
+    with request_deadline(0.05):
+        with pytest.raises(AIError):
+            await asyncio.wait_for(UnifiedAgent()._call_ai_agent("prompt"), timeout=2)
+    assert len(prompts) == 1
+    assert metrics.get_counter("ai_deadline_exceeded_total") == 1
+
+
+async def test_reprompt_after_parse_failure(monkeypatch):
+    prompts = fake_agent(monkeypatch, "non è json", VALID_REPLY)
+    session = SimpleNamespace(session_id="retry-session", current_lifecycle=LifecycleStage.NUOVA_LEAD)
+
+    result = await UnifiedAgent()._ask_ai("prompt", session, db=None)
+
+    assert result["messages"][0]["text"] == "ciao"
+    assert prompts[0] == "prompt"
+    assert prompts[1].startswith("prompt") and "JSON valido" in prompts[1]
+    assert metrics.get_counter("ai_retries_total", error=PARSE) == 1
+
+
+async def test_parse_budget_exhausted(monkeypatch):
+    fake_agent(monkeypatch, "non è json", "ancora no")
+    session = SimpleNamespace(session_id="retry-session", current_lifecycle=LifecycleStage.NUOVA_LEAD)
+
+    with pytest.raises(ParsingError):
+        await UnifiedAgent()._ask_ai("prompt", session, db=None)
@@ -0,0 +1,175 @@
+"""
+Cache delle sessioni: LRU e TTL, aggiornamento write-through dopo le scritture e
+attach() delle sessioni in cache senza SELECT
+"""
+import time
+from dataclasses import replace
+
+from sqlalchemy import select
+
+from app.database import async_session
+from app.models.database_models import SessionModel
+from app.models.lifecycle import LifecycleStage
+from app.services.session_cache import CachedSession, SessionCache, session_cache
+from app.services.unified_agent import UnifiedAgent
+
+SESSION_ID = "cache-session"
+
+
+def _entry(index: int, **fields) -> CachedSession:
+    return CachedSession(id=index, session_id=f"s-{index}", current_lifecycle=LifecycleStage.NUOVA_LEAD, **fields)
+
+
+async def _seed_session(**fields) -> SessionModel:
+    async with async_session() as db:
+        session = SessionModel(session_id=SESSION_ID, current_lifecycle=LifecycleStage.IN_TARGET, **fields)
+        db.add(session)
+        await db.commit()
+        await db.refresh(session)
+        return session
+
+
+def test_lru_evicts_least_recently_used():
+    cache = SessionCache(max_size=2, ttl_seconds=60)
+    cache.put(_entry(1))
+    cache.put(_entry(2))
+    assert cache.get("s-1") is not None  # s-1 diventa la più recente
+    cache.put(_entry(3))
+
+    assert cache.get("s-2") is None
+    assert cache.get("s-1") is not None and cache.get("s-3") is not None
+    # L'indice per id interno segue le espulsioni
+    cache.update_by_id(2, has_open_task=True)
+    assert cache.get("s-2") is None
+    assert cache.stats()["size"] == 2
+
+
+def test_ttl_expiry_invalidates_entry():
+    cache = SessionCache(max_size=10, ttl_seconds=30)
+    cache.put(_entry(1, cached_at=time.monotonic() - 31))
+
+    assert cache.get("s-1") is None
+    assert cache.stats()["size"] == 0
+    assert cache.misses == 1
+    # update() non resuscita una voce scaduta
+    cache.put(_entry(2, cached_at=time.monotonic() - 31))
+    cache.update("s-2", has_messages=True)
+    assert cache.get("s-2") is None
+
+
+def test_update_refreshes_ttl_and_by_id_lookup():
+    cache = SessionCache(max_size=10, ttl_seconds=30)
+    cache.put(_entry(1, cached_at=time.monotonic() - 20))
+    cache.update_by_id(1, has_open_task=True)
+
+    entry = cache.get("s-1")
+    assert entry.has_open_task is True
+    assert time.monotonic() - entry.cached_at < 5
+
+
+def test_disabled_cache_never_stores():
+    cache = SessionCache(max_size=10, ttl_seconds=30, enabled=False)
+    cache.put(_entry(1))
+    assert cache.get("s-1") is None
+    assert cache.stats()["size"] == 0
+
+
+async def test_store_keeps_known_flags(db_engine):
+    session = await _seed_session()
+    session_cache.store(session, has_open_task=True, has_messages=False)
+
+    session.current_lifecycle = LifecycleStage.LINK_DA_INVIARE
+    entry = session_cache.store(session)
+
+    assert entry.current_lifecycle == LifecycleStage.LINK_DA_INVIARE
+    assert entry.has_open_task is True
+    assert entry.has_messages is False
+
+
+async def test_get_or_create_session_uses_cache(db_engine, query_budget):
+    agent = UnifiedAgent()
+    async with async_session() as db:
+        created = await agent.get_or_create_session(SESSION_ID, db)
+    assert session_cache.get(SESSION_ID).id == created.id
+
+    async with async_session() as db:
+        with query_budget(0):
+            session = await agent.get_or_create_session(SESSION_ID, db)
+        assert session.id == created.id
+        assert session.current_lifecycle == created.current_lifecycle
+
+
+async def test_attach_without_select_and_commit_changes(db_engine, query_budget):
+    seeded = await _seed_session()
+    entry = session_cache.store(seeded)
+
+    async with async_session() as db:
+        with query_budget(0):
+            session = session_cache.attach(entry, db)
+            assert session.session_id == SESSION_ID
+            assert session.current_lifecycle == LifecycleStage.IN_TARGET
+        session.current_lifecycle = LifecycleStage.LINK_DA_INVIARE
+        await db.commit()
+
+    async with async_session() as db:
+        stored = await db.scalar(select(SessionModel).where(SessionModel.session_id == SESSION_ID))
+        assert stored.current_lifecycle == LifecycleStage.LINK_DA_INVIARE
+        # Gli attributi non in cache non sono stati sovrascritti dall'attach
+        assert stored.created_at is not None
+
+
+async def test_attach_returns_identity_map_instance(db_engine):
+    seeded = await _seed_session()
+    entry = session_cache.store(seeded)
+
+    async with async_session() as db:
+        loaded = await db.get(SessionModel, seeded.id)
+        assert session_cache.attach(entry, db) is loaded
+        # Anche una voce in cache non aggiornata non crea un secondo oggetto
+        assert session_cache.attach(replace(entry, is_batch_waiting=True), db) is loaded
+
+
+async def test_task_routes_write_through(client):
+    seeded = await _seed_session()
+    session_cache.store(seeded, has_open_task=False)
+
+    response = await client.post("/api/tasks", json={"session_id": SESSION_ID, "title": "Richiamare", "description": "Lead da richiamare"})
+    assert response.status_code == 200
+    assert session_cache.get(SESSION_ID).has_open_task is True
+
+    response = await client.put(f"/api/tasks/{response.json()['id']}", json={"completed": True})
+    assert response.status_code == 200
+    # Altre task potrebbero essere aperte: lo stato torna non noto
+    assert session_cache.get(SESSION_ID).has_open_task is None
+
+
+async def test_finish_session_write_through(client):
+    seeded = await _seed_session()
+    session_cache.store(seeded)
+
+    response = await client.post(f"/session/{SESSION_ID}/finish")
+    assert response.status_code == 200
+
+    entry = session_cache.get(SESSION_ID)
+    assert entry.is_conversation_finished is True
+    assert entry.current_lifecycle == LifecycleStage.LINK_INVIATO
+
+
+async def test_flags_expire_even_when_entry_is_restored(db_engine, monkeypatch):
+    session = await _seed_session()
+    cache = SessionCache(max_size=10, ttl_seconds=30)
+    now = time.monotonic()
+    cache.store(session, has_open_task=False, has_messages=True)
+
+    # Turni successivi riscrivono la voce: i flag restano quelli letti all'inizio
+    monkeypatch.setattr(time, "monotonic", lambda: now + 20)
+    assert cache.store(session).has_open_task is False
+    monkeypatch.setattr(time, "monotonic", lambda: now + 40)
+    assert cache.store(session).has_open_task is None
+
+    # Voce ancora valida ma flag scaduti: la task aperta da un'altra istanza va riletta
+    entry = cache.get(SESSION_ID)
+    assert entry is not None
+    assert entry.has_open_task is None and entry.has_messages is None
+    cache.update(SESSION_ID, has_open_task=True)
+    assert cache.get(SESSION_ID).has_open_task is True
@@ -0,0 +1,137 @@
+"""
+Lock per sessione: serializzazione locale e advisory lock su un pool separato da quello
+delle query dei turni (nessuno stallo con molti turni concorrenti)
+"""
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import select
+
+from app.database import async_session
+from app.models.database_models import SessionModel
+from app.services.metrics import metrics
+from app.services.session_lock import SessionLockManager, SessionLockTimeout
+from app.services.unified_agent import UnifiedAgent
+
+# Testo esatto della risposta automatica al primo messaggio (non deve cambiare)
+FIRST_MESSAGE = (
+    "Ciao! Grazie di avermi scritto!\n"
+    "\n"
+    "Questo è un messaggio automatico che ho scritto personalmente per riuscire a ringraziarti subito della fiducia!🙏\n"
+    "\n"
+    "Come sai ricevo centinaia di richieste ogni giorno e ci tengo a dedicarti personalmente l'attenzione che meriti."
+)
+
+
+class FakeLockConnection:
+    """Connessione PostgreSQL simulata: registra le query e occupa un posto del pool"""
+
+    def __init__(self, engine: "FakeLockEngine"):
+        self.engine = engine
+
+    async def start(self):
+        await self.engine.slots.acquire()
+        self.engine.checked_out += 1
+        return self
+
+    def begin(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, params=None):
+        self.engine.statements.append(str(statement))
+
+    async def close(self):
+        self.engine.checked_out -= 1
+        self.engine.slots.release()
+
+
+class FakeLockEngine:
+    def __init__(self, pool_size: int):
+        self.slots = asyncio.Semaphore(pool_size)
+        self.checked_out = 0
+        self.statements = []
+
+    def connect(self):
+        return FakeLockConnection(self)
+
+
+@pytest.fixture
+def advisory_manager(monkeypatch):
+    def build(pool_size: int, timeout_seconds: float = 5.0):
+        manager = SessionLockManager(timeout_seconds=timeout_seconds)
+        manager._engine = FakeLockEngine(pool_size)
+        return manager
+
+    monkeypatch.setattr(SessionLockManager, "uses_advisory_locks", True)
+    metrics.reset()
+    return build
+
+
+async def test_local_lock_serializes_same_session():
+    manager = SessionLockManager(timeout_seconds=5)
+    order = []
+
+    async def turn(name):
+        async with manager.hold("s-1"):
+            order.append(f"{name}:start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name}:end")
+
+    await asyncio.gather(turn("a"), turn("b"))
+
+    assert order == ["a:start", "a:end", "b:start", "b:end"]
+    assert manager._local == {}
+
+
+async def test_advisory_locks_do_not_starve_query_pool(db_engine, advisory_manager):
+    manager = advisory_manager(pool_size=40)
+    async with async_session() as db:
+        db.add(SessionModel(session_id="lock-session"))
+        await db.commit()
+
+    async def turn(index):
+        async with manager.hold(f"s-{index}"):
+            # Le query del turno usano il pool dell'app mentre il lock è tenuto
+            async with async_session() as db:
+                await db.scalar(select(SessionModel.id))
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(asyncio.gather(*(turn(i) for i in range(40))), timeout=10)
+
+    engine = manager._engine
+    assert engine.checked_out == 0
+    assert sum("pg_advisory_xact_lock" in s for s in engine.statements) == 40
+
+
+async def test_exhausted_lock_pool_times_out(advisory_manager):
+    manager = advisory_manager(pool_size=1, timeout_seconds=0.05)
+
+    async with manager.hold("s-1"):
+        with pytest.raises(SessionLockTimeout):
+            async with manager.hold("s-2", "reply"):
+                pass
+
+    assert metrics.get_counter("session_lock_timeouts_total", phase="reply", backend="advisory") == 1
+    # Il posto liberato è di nuovo disponibile
+    async with manager.hold("s-2"):
+        pass
+    assert manager._engine.checked_out == 0
+
+
+async def test_first_message_auto_response_text_under_lock(client, monkeypatch):
+    async def call(self, prompt, model_name=None, context="", **kwargs):
+        return json.dumps({"messages": "Raccontami di te", "should_change_lifecycle": False, "confidence": 0.9})
+
+    monkeypatch.setattr(UnifiedAgent, "_call_ai_agent", call)
+
+    response = await client.post("/chat", json={"message": "ciao", "session_id": "first-session", "batch_wait_seconds": 0})
+
+    assert response.status_code == 200
+    assert response.json()["messages"][0]["text"] == FIRST_MESSAGE
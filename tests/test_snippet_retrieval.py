@@ -0,0 +1,46 @@
+"""
+Selezione BM25 degli snippet pertinenti ai messaggi recenti
+"""
+from types import SimpleNamespace
+
+from app.config import settings
+from app.models.lifecycle import LifecycleStage
+from app.services.snippet_retrieval import BM25Index, tokenize
+from app.services.snippet_store import snippet_store
+from app.services.unified_agent import UnifiedAgent
+
+
+def test_tokenize_folds_accents_stopwords_and_endings():
+    assert tokenize("Quanto costa? Perché è così caro") == tokenize("quanto costo perche cosi cari")
+    assert "il" not in tokenize("il percorso")
+
+
+def test_bm25_ranks_matching_documents():
+    index = BM25Index([
+        ("costo", "prezzo costo del programma in euro"),
+        ("eta", "lavoro solo con gli over 18 anni"),
+        ("info", "nutrizione sport e psicologia alimentare"),
+    ])
+    assert [doc_id for doc_id, _ in index.search("quanto costa il programma?", 2)] == ["costo"]
+    assert index.search("ho 16 anni", 3)[0][0] == "eta"
+    assert index.search("buongiorno", 3) == []
+
+
+def test_prompt_includes_only_relevant_snippets(monkeypatch):
+    agent = UnifiedAgent()
+    history = [
+        SimpleNamespace(role="user", message="Ciao, vorrei perdere peso"),
+        SimpleNamespace(role="assistant", message="Ciao! Raccontami di più"),
+    ]
+
+    block = agent._select_snippets(LifecycleStage.IN_TARGET, "ok ma quanto costa?", history)
+    lines = block.splitlines()
+    assert lines[0].startswith("- costo_a:")
+    assert len([line for line in lines if line.startswith("- ")]) <= settings.snippet_retrieval_top_k
+    assert "{{" not in block
+
+    # Nessuno snippet pertinente: blocco completo del lifecycle invece di nessuno snippet
+    assert agent._select_snippets(LifecycleStage.IN_TARGET, "ok", []) == snippet_store.snippets_block(LifecycleStage.IN_TARGET)
+
+    monkeypatch.setattr(settings, "snippet_retrieval_enabled", False)
+    assert agent._select_snippets(LifecycleStage.IN_TARGET, "ok", []) == snippet_store.snippets_block(LifecycleStage.IN_TARGET)
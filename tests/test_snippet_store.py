@@ -0,0 +1,192 @@
+"""
+Snippet store: indice dal CSV, blocchi del prompt pre-renderizzati e hot reload
+"""
+import csv
+import json
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import defer
+
+from app.config import settings
+from app.data.snippets import LEVEL_4_SNIPPETS
+from app.models.lifecycle import LifecycleStage
+from app.services.snippet_store import NO_SNIPPETS_TEXT, SnippetStore, fill_placeholders
+from app.services.unified_agent import ParsingError, UnifiedAgent
+
+FIELDS = ["Nome", "Messaggio", "File", "Argomenti", "ID", "Data Aggiunta"]
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({"File": "", "Argomenti": "", "Data Aggiunta": "", **row})
+
+
+def test_bundled_csv_index_and_prompt_blocks():
+    store = SnippetStore(csv_path=settings.snippets_csv_path)
+    index = store.index
+
+    assert index.source.endswith("Snippets.csv")
+    assert store.text("livello_2") == "Bene {{$contact.firstname}} !! :)"
+    # ID assenti dal CSV: testo predefinito
+    assert store.text("link") == LEVEL_4_SNIPPETS["link"]
+    assert [s.id for s in index.by_group["level_2"]][:3] == ["livello_2", "a_livello_2_b", "a_livello_2_c"]
+
+    script = store.script_block(LifecycleStage.CONTRASSEGNATO)
+    assert script.startswith("1. [livello_2] Bene NOME !! :)\n2. [a_livello_2_b]")
+    assert "{{" not in script
+    # Saluto col nome e richiesta del nome sono alternativi
+    assert "[a_livello_2_c]" not in script
+    assert store.script_uses_name(LifecycleStage.CONTRASSEGNATO)
+    without_name = store.script_block(LifecycleStage.CONTRASSEGNATO, name_known=False)
+    assert without_name.startswith("1. [a_livello_2_b]")
+    assert "\n2. [a_livello_2_c] Ps.Posso chiederti il tuo nome" in without_name
+    assert "[livello_2]" not in without_name
+    assert "- budget:" in store.snippets_block(LifecycleStage.CONTRASSEGNATO)
+    assert store.snippets_block(LifecycleStage.LINK_INVIATO) == NO_SNIPPETS_TEXT
+
+
+async def test_reload_when_csv_changes(tmp_path):
+    path = tmp_path / "Snippets.csv"
+    write_csv(path, [
+        {"Nome": "Budget", "Messaggio": "Testo vecchio", "ID": "budget", "Argomenti": "prezzo, costo"},
+    ])
+    store = SnippetStore(csv_path=str(path), reload_interval_seconds=0)
+    await store.start()
+    old_index = store.index
+    assert store.text("budget") == "Testo vecchio"
+    assert [s.id for s in store.snippets_for_topic("Prezzo")] == ["budget"]
+    assert await store.reload_if_changed() is False
+
+    write_csv(path, [
+        {"Nome": "Budget", "Messaggio": "Testo nuovo, più lungo del precedente", "ID": "budget"},
+    ])
+    assert await store.reload_if_changed() is True
+    assert store.text("budget") == "Testo nuovo, più lungo del precedente"
+    assert "Testo nuovo" in store.snippets_block(LifecycleStage.IN_TARGET)
+    # L'indice precedente non viene modificato: chi lo stava usando lo vede intero
+    assert old_index.by_id["budget"].text == "Testo vecchio"
+    await store.stop()
+
+
+async def test_unreadable_csv_keeps_previous_index(tmp_path):
+    path = tmp_path / "Snippets.csv"
+    write_csv(path, [{"Nome": "Budget", "Messaggio": "Testo valido", "ID": "budget"}])
+    store = SnippetStore(csv_path=str(path), reload_interval_seconds=0)
+    await store.load()
+
+    path.write_bytes(b'"Nome","Messaggio","ID"\n"x","\xff\xfe non utf-8","budget"\n')
+    await store.reload_if_changed()
+    assert store.text("budget") == "Testo valido"
+
+    missing = SnippetStore(csv_path=str(tmp_path / "assente.csv"))
+    assert missing.index.source == "builtin"
+    assert missing.text("link") == LEVEL_4_SNIPPETS["link"]
+
+
+async def test_snippets_api(client):
+    response = await client.get("/api/snippets")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["snippets"] and {"id", "text", "topics", "groups"} <= set(body["snippets"][0])
+    assert (await client.post("/api/snippets/reload")).json()["count"] == body["count"] == len(body["snippets"])
+
+
+def test_fill_placeholders():
+    text = "Bene {{$contact.firstname}} !! :)"
+    assert fill_placeholders(text, {"contact.firstname": "Anna"}) == "Bene Anna !! :)"
+    assert fill_placeholders(text, {}) == "Bene !! :)"
+    assert fill_placeholders("{{ contact.firstname }}, ciao", {"contact.firstname": "Anna"}) == "Anna, ciao"
+
+
+async def test_snippet_refs_expanded_with_contact_data(db_engine):
+    from app.database import async_session
+    from app.models.database_models import SessionModel
+
+    async with async_session() as db:
+        db.add(SessionModel(
+            session_id="refs-session",
+            current_lifecycle=LifecycleStage.CONTRASSEGNATO,
+            user_info=json.dumps({"first_name": "Anna"}),
+        ))
+        await db.commit()
+
+    reply = json.dumps({
+        "messages": [
+            {"snippet_id": "livello_2", "delay_ms": 10000},
+            {"text": "Testo libero", "delay_ms": 10000},
+        ],
+        "should_change_lifecycle": False,
+        "confidence": 0.9,
+    })
+    agent = UnifiedAgent()
+    async with async_session() as db:
+        # user_info non caricato, come per le sessioni ricostruite dalla cache
+        session = (await db.execute(
+            select(SessionModel).options(defer(SessionModel.user_info)).where(SessionModel.session_id == "refs-session")
+        )).scalar_one()
+        result = await agent._process_ai_response(reply, session, db)
+
+        assert result["messages"] == [
+            {"text": "Bene Anna !! :)", "delay_ms": 10000},
+            {"text": "Testo libero", "delay_ms": 10000},
+        ]
+        assert result["full_message_text"].startswith("Bene Anna !! :)\n---SPLIT---\n")
+
+        unknown = json.dumps({"messages": [{"snippet_id": "inesistente"}]})
+        with pytest.raises(ParsingError):
+            await agent._process_ai_response(unknown, session, db)
+
+
+async def test_prompt_script_depends_on_known_name(db_engine):
+    from app.database import async_session
+    from app.models.database_models import SessionModel
+
+    async with async_session() as db:
+        db.add_all([
+            SessionModel(session_id="con-nome", current_lifecycle=LifecycleStage.CONTRASSEGNATO,
+                         user_info=json.dumps({"firstname": "Anna"})),
+            SessionModel(session_id="senza-nome", current_lifecycle=LifecycleStage.CONTRASSEGNATO),
+        ])
+        await db.commit()
+
+    agent = UnifiedAgent()
+    async with async_session() as db:
+        prompts = {}
+        for session_id in ("con-nome", "senza-nome"):
+            session = await db.scalar(select(SessionModel).where(SessionModel.session_id == session_id))
+            prompts[session_id] = await agent._get_unified_prompt(session, "ciao", db, history=[])
+
+    assert "[livello_2]" in prompts["con-nome"] and "[a_livello_2_c]" not in prompts["con-nome"]
+    assert "[a_livello_2_c]" in prompts["senza-nome"] and "[livello_2]" not in prompts["senza-nome"]
+
+
+async def test_snippets_with_manual_placeholders_are_not_referenceable(db_engine):
+    from app.database import async_session
+    from app.models.database_models import SessionModel
+
+    store = SnippetStore(csv_path=settings.snippets_csv_path)
+    assert not store.get("link").referenceable and not store.get("risposta_tardiva3").referenceable
+    assert store.get("risposta_tardiva2").referenceable
+
+    # Nessun ID nei blocchi del prompt: il testo va riscritto completando i segnaposto
+    assert store.script_block(LifecycleStage.LINK_DA_INVIARE).startswith("1. [LINK] Ok bene!")
+    snippets = store.snippets_block(LifecycleStage.IN_TARGET)
+    assert "- risposta_tardiva2:" in snippets
+    assert "risposta_tardiva3" not in snippets
+    assert "- (da adattare) Hey NOME" in snippets
+
+    async with async_session() as db:
+        db.add(SessionModel(session_id="manual-session", current_lifecycle=LifecycleStage.LINK_DA_INVIARE))
+        await db.commit()
+
+    agent = UnifiedAgent()
+    async with async_session() as db:
+        session = await db.scalar(select(SessionModel).where(SessionModel.session_id == "manual-session"))
+        for snippet_id in ("link", "risposta_tardiva3"):
+            reply = json.dumps({"messages": [{"snippet_id": snippet_id, "text": "testo"}], "confidence": 0.9})
+            with pytest.raises(ParsingError):
+                await agent._process_ai_response(reply, session, db)